@@ -0,0 +1,53 @@
+"""Measure the per-call overhead of Map methods in tight loops.
+
+Usage:
+
+    PYTHONPATH=. python benchmarks/bench_calls.py [--size N] [--number N]
+
+Run it from the root of the repository; the C extension must be
+built in-place (``make``) for the results to be meaningful.
+"""
+
+import argparse
+import timeit
+
+from immutables._map import Map
+
+
+def run(name, stmt, setup, number, repeat):
+    timings = timeit.repeat(
+        stmt, setup, number=number, repeat=repeat, globals=globals())
+    best = min(timings) / number
+    print('{:<28} {:>9.1f} ns/call'.format(name, best * 1e9))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=1000)
+    parser.add_argument('--number', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    setup = (
+        'm = Map({{i: i for i in range({size})}}); '
+        'mm = m.mutate(); k = {size} // 2'.format(size=args.size))
+
+    benchmarks = [
+        ('Map.get(k)', 'm.get(k)'),
+        ('Map.get(k, None)', 'm.get(k, None)'),
+        ('Map[k]', 'm[k]'),
+        ('Map.set(k, 1)', 'm.set(k, 1)'),
+        ('MapMutation.get(k)', 'mm.get(k)'),
+        ('MapMutation.set(k, 1)', 'mm.set(k, 1)'),
+        ('MapMutation.pop(-1, None)', 'mm.pop(-1, None)'),
+        ('Map()', 'Map()'),
+        ('Map(m)', 'Map(m)'),
+        ('Map(a=1)', 'Map(a=1)'),
+    ]
+
+    for name, stmt in benchmarks:
+        run(name, stmt, setup, args.number, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
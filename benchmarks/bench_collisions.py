@@ -0,0 +1,77 @@
+"""Measure Map performance with adversarial keys.
+
+Usage:
+
+    PYTHONPATH=. python benchmarks/bench_collisions.py [--size N] [--repeat N]
+
+Python's 64-bit hashes are folded into 32 bits by the C extension
+(unless it's built with IMMUTABLES_HASH_BITS=64), so keys can be
+chosen to land in a single Collision node even though their full
+hashes differ.  "folded" keys are such ints; "full" keys are ints with
+equal full hashes (like the ones an attacker could craft for a dict);
+"random" keys are regular ints for comparison.
+
+Collision nodes are searched by full hash, so lookups and Map(dict)
+of "folded" keys are nearly as fast as for "random" keys; set() and
+delete() still copy the whole Collision node and take time
+proportional to its size.  With IMMUTABLES_HASH_BITS=64 "folded" keys
+don't collide at all.
+"""
+
+import argparse
+import sys
+import timeit
+
+from immutables._map import Map
+
+
+def folded_keys(size):
+    # (i << 32) ^ i folds into the same 32-bit hash for all i.
+    return [(i << 32) | (12345 ^ i) for i in range(1, size + 1)]
+
+
+def full_keys(size):
+    # Ints equal modulo sys.hash_info.modulus have equal hashes.
+    return [12345 + i * sys.hash_info.modulus for i in range(size)]
+
+
+def random_keys(size):
+    return [i * 7919 for i in range(size)]
+
+
+def run(name, stmt, ns, repeat):
+    timings = timeit.repeat(stmt, number=1, repeat=repeat, globals=ns)
+    print('{:<32} {:>10.2f} ms'.format(name, min(timings) * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for kind, make_keys in [('random', random_keys),
+                            ('folded', folded_keys),
+                            ('full', full_keys)]:
+        keys = make_keys(args.size)
+        ns = {
+            'Map': Map,
+            'keys': keys,
+            'items': dict.fromkeys(keys, 1),
+            'm': Map(dict.fromkeys(keys, 1)),
+        }
+
+        run('{}: Map.set() x {}'.format(kind, args.size),
+            'h = Map()\n'
+            'for k in keys: h = h.set(k, 1)',
+            ns, args.repeat)
+        run('{}: Map(dict)'.format(kind),
+            'Map(items)', ns, args.repeat)
+        run('{}: Map[k] x {}'.format(kind, args.size),
+            'for k in keys: m[k]', ns, args.repeat)
+        run('{}: Map.delete() x {}'.format(kind, args.size // 10),
+            'for k in keys[::10]: m.delete(k)', ns, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
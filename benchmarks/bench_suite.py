@@ -0,0 +1,372 @@
+"""Compare the C Map, the pure-Python Map and dict across Map sizes.
+
+Usage (from the root of the repository, after ``make``):
+
+    PYTHONPATH=. python benchmarks/bench_suite.py
+        [--sizes N,N] [--impl NAME,NAME] [--bench NAME,NAME]
+        [--json FILE] [--compare FILE]
+
+Every benchmark is run for every size with every implementation:
+"c" is ``immutables._map.Map`` (the in-place build of the extension),
+"py" is ``immutables.map.Map`` and "dict" is a dict that is copied
+before every modification, like an immutable mapping implemented on
+top of dict would have to.  Operations that don't apply to dicts
+(``hash()``) are skipped for them.
+
+Timings are reported per operation: per key for lookups and
+modifications, per item for iteration and construction, and per call
+otherwise.  Like pyperf, the number of loops is calibrated so that
+every sample takes at least ``--min-time`` seconds, and the median
+of ``--repeat`` samples is shown.
+
+``--json`` writes all samples, along with the Python version and the
+platform, to a file; ``--compare`` shows the change of every median
+relative to such a file from an earlier run, so that regressions can
+be tracked without any third-party tools.
+
+Sizes from 10 to 10,000,000 are supported, but the pure-Python Map is
+only run for sizes up to ``--py-max-size``: building it is slow.
+"""
+
+import argparse
+import json
+import pickle
+import platform
+import random
+import sys
+import time
+import timeit
+
+from immutables.map import Map as PyMap
+
+try:
+    from immutables._map import Map as CMap
+except ImportError:
+    CMap = None
+
+
+# The number of keys used by the benchmarks that look up or modify
+# individual keys.  It is lowered for large Maps, where every "set"
+# copies the whole dict.
+BATCH = 1000
+
+
+def batch_size(size):
+    return min(size, BATCH, max(10, 10 ** 8 // size))
+
+
+class CopyOnWriteDict:
+    """The "dict" implementation: derives new dicts by copying."""
+
+    def __init__(self, *args, **kwargs):
+        self._d = dict(*args, **kwargs)
+
+    @classmethod
+    def wrap(cls, d):
+        self = cls.__new__(cls)
+        self._d = d
+        return self
+
+    def __getitem__(self, key):
+        return self._d[key]
+
+    def __iter__(self):
+        return iter(self._d)
+
+    def __len__(self):
+        return len(self._d)
+
+    def __eq__(self, other):
+        return self._d == other._d
+
+    def __reduce__(self):
+        return (type(self).wrap, (self._d,))
+
+    def get(self, key, default=None):
+        return self._d.get(key, default)
+
+    def set(self, key, val):
+        d = self._d.copy()
+        d[key] = val
+        return self.wrap(d)
+
+    def delete(self, key):
+        d = self._d.copy()
+        del d[key]
+        return self.wrap(d)
+
+    def update(self, other):
+        d = self._d.copy()
+        if isinstance(other, CopyOnWriteDict):
+            other = other._d
+        d.update(other)
+        return self.wrap(d)
+
+    def keys(self):
+        return self._d.keys()
+
+    def values(self):
+        return self._d.values()
+
+    def items(self):
+        return self._d.items()
+
+
+# name -> (statement, number of operations in the statement, setup)
+#
+# Statements are run in a namespace with the implementation `M`,
+# a `m` mapping with `size` items from `items`, an equal but distinct
+# `m2`, and `keys` (existing keys), `new_keys` and `new_items` (keys
+# that are not in `m`) with `batch_size(size)` elements each.
+BENCHMARKS = {
+    'construct': (
+        'M(items)', 'size', None),
+    'get': (
+        'for k in keys: m[k]', 'batch', None),
+    'get_missing': (
+        'for k in new_keys: m.get(k)', 'batch', None),
+    'set': (
+        'for k in new_keys: m.set(k, 1)', 'batch', None),
+    'set_existing': (
+        'for k in keys: m.set(k, 2)', 'batch', None),
+    'delete': (
+        'for k in keys: m.delete(k)', 'batch', None),
+    'update_dict': (
+        'm.update(new_items)', 'batch', None),
+    'update_map': (
+        'm.update(new_map)', 'batch', 'new_map = M(new_items)'),
+    'update_seq': (
+        'm.update(new_seq)', 'batch', 'new_seq = list(new_items.items())'),
+    'iter_keys': (
+        'for _ in m: pass', 'size', None),
+    'iter_values': (
+        'for _ in m.values(): pass', 'size', None),
+    'iter_items': (
+        'for _ in m.items(): pass', 'size', None),
+    'hash': (
+        # Maps memoize their hashes, so a fresh Map is hashed every
+        # time (see `measure_hash`).
+        None, 'call', None),
+    'hash_derived': (
+        'for k in keys: hash(m.set(k, 2))', 'batch', None),
+    'eq': (
+        'm == m2', 'call', None),
+    'pickle': (
+        'pickle.loads(pickle.dumps(m, pickle.HIGHEST_PROTOCOL))',
+        'call', None),
+    'mutate': (
+        'with m.mutate() as mm:\n'
+        '    for k in new_keys: mm[k] = 1\n'
+        '    for k in keys: del mm[k]\n'
+        '    mm.finish()',
+        'batch', None),
+}
+
+DICT_MUTATE = (
+    'd = dict(m.items())\n'
+    'for k in new_keys: d[k] = 1\n'
+    'for k in keys: del d[k]\n'
+    'M.wrap(d)')
+
+# dict runs first, the Maps are shown relative to it.
+IMPLEMENTATIONS = ['dict', 'c', 'py']
+
+
+def get_impl(name):
+    return {'c': CMap, 'py': PyMap, 'dict': CopyOnWriteDict}[name]
+
+
+def make_namespace(impl, size):
+    rng = random.Random(size)
+    batch = batch_size(size)
+    all_keys = rng.sample(range(size * 4), size + batch)
+    items = {k: k for k in all_keys[:size]}
+    new_items = {k: k for k in all_keys[size:]}
+
+    M = get_impl(impl)
+    return {
+        'M': M,
+        'pickle': pickle,
+        'items': items,
+        'm': M(items),
+        'm2': M(items),
+        'keys': all_keys[:batch],
+        'new_keys': list(new_items),
+        'new_items': new_items,
+    }
+
+
+def calibrate(timer, min_time):
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            return number
+        if elapsed > 0:
+            number = max(number * 2, int(number * min_time / elapsed * 1.2))
+        else:
+            number *= 10
+
+
+def measure(stmt, setup, ns, repeat, min_time):
+    timer = timeit.Timer(stmt, setup or 'pass', globals=ns)
+    number = calibrate(timer, min_time)
+    return [t / number for t in timer.repeat(repeat, number)]
+
+
+def measure_hash(ns, repeat, min_time):
+    # Hash a Map that was created in setup, one call per sample.
+    M = ns['M']
+    items = ns['items']
+    values = []
+    while len(values) < repeat:
+        samples = []
+        started = time.perf_counter()
+        while not samples or time.perf_counter() - started < min_time:
+            m = M(items)
+            t0 = time.perf_counter()
+            hash(m)
+            samples.append(time.perf_counter() - t0)
+        values.append(sorted(samples)[len(samples) // 2])
+    return values
+
+
+def run_benchmark(name, impl, size, ns, args):
+    stmt, ops, setup = BENCHMARKS[name]
+
+    if impl == 'dict':
+        if name.startswith('hash'):
+            return None
+        if name == 'mutate':
+            stmt = DICT_MUTATE
+
+    if name == 'hash':
+        values = measure_hash(ns, args.repeat, args.min_time)
+    else:
+        values = measure(stmt, setup, ns, args.repeat, args.min_time)
+
+    nops = {'size': size, 'batch': batch_size(size), 'call': 1}[ops]
+    return [v / nops for v in values]
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2
+
+
+def format_time(seconds):
+    ns = seconds * 1e9
+    if ns >= 1e6:
+        return '{:.2f} ms'.format(ns / 1e6)
+    if ns >= 1e3:
+        return '{:.2f} us'.format(ns / 1e3)
+    return '{:.1f} ns'.format(ns)
+
+
+def load_results(path):
+    with open(path) as f:
+        data = json.load(f)
+    return {
+        (b['name'], b['impl'], b['size']): median(b['values'])
+        for b in data['benchmarks']
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark Map implementations against dict.')
+    parser.add_argument('--sizes', default='10,1000,100000',
+                        help='comma-separated Map sizes')
+    parser.add_argument('--impl', default=','.join(IMPLEMENTATIONS),
+                        help='comma-separated implementations '
+                             '(c, py, dict)')
+    parser.add_argument('--bench', default=None,
+                        help='comma-separated benchmarks to run; '
+                             'all by default')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.02,
+                        help='minimum duration of a sample in seconds')
+    parser.add_argument('--py-max-size', type=int, default=100000)
+    parser.add_argument('--json', default=None,
+                        help='write the results to this file')
+    parser.add_argument('--compare', default=None,
+                        help='compare with results written by --json')
+    args = parser.parse_args()
+
+    sizes = [int(n) for n in args.sizes.split(',')]
+    impls = args.impl.split(',')
+    names = args.bench.split(',') if args.bench else list(BENCHMARKS)
+    for impl in impls:
+        if impl not in IMPLEMENTATIONS:
+            parser.error('unknown implementation {!r}'.format(impl))
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {!r}'.format(name))
+    impls.sort(key=IMPLEMENTATIONS.index)
+    if 'c' in impls and CMap is None:
+        print('The C extension is not built, skipping "c"', file=sys.stderr)
+        impls.remove('c')
+
+    base = load_results(args.compare) if args.compare else {}
+
+    print('Python {} on {}'.format(
+        sys.version.split()[0], platform.platform()))
+    print('{:<14} {:>9} {:>5} {:>12} {:>10}'.format(
+        'benchmark', 'size', 'impl', 'time/op', 'vs dict' if not base
+        else 'vs base'))
+
+    results = []
+    for size in sizes:
+        for impl in impls:
+            if impl == 'py' and size > args.py_max_size:
+                continue
+            ns = make_namespace(impl, size)
+            for name in names:
+                values = run_benchmark(name, impl, size, ns, args)
+                if values is None:
+                    continue
+                results.append({
+                    'name': name,
+                    'impl': impl,
+                    'size': size,
+                    'unit': 'second',
+                    'values': values,
+                })
+
+                t = median(values)
+                if base:
+                    ref = base.get((name, impl, size))
+                    rel = (t / ref - 1) * 100 if ref else None
+                    rel = '' if rel is None else '{:+.1f}%'.format(rel)
+                else:
+                    ref = next(
+                        (median(r['values']) for r in results
+                         if (r['name'], r['impl'], r['size']) ==
+                            (name, 'dict', size)),
+                        None)
+                    rel = '' if ref is None else '{:.2f}x'.format(t / ref)
+                print('{:<14} {:>9} {:>5} {:>12} {:>10}'.format(
+                    name, size, impl, format_time(t), rel))
+            del ns
+
+    if args.json:
+        data = {
+            'metadata': {
+                'python_version': sys.version,
+                'python_implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'repeat': args.repeat,
+                'min_time': args.min_time,
+            },
+            'benchmarks': results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Measure how Map reads and derivations scale across threads.
+
+Usage:
+
+    PYTHONPATH=. python benchmarks/bench_threads.py
+        [--size N] [--ops N] [--threads N,N]
+
+Every thread performs the same number of operations on one shared Map,
+so on a free-threaded build of CPython (3.13t or newer) throughput
+should grow almost linearly with the number of threads, up to the
+number of cores.  With the GIL the threads run one at a time and the
+throughput stays flat.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+from immutables._map import Map
+
+
+def read_get(m, keys, ops):
+    n = len(keys)
+    for i in range(ops):
+        m.get(keys[i % n])
+
+
+def read_contains(m, keys, ops):
+    n = len(keys)
+    for i in range(ops):
+        keys[i % n] in m
+
+
+def derive_set(m, keys, ops):
+    n = len(keys)
+    for i in range(ops):
+        m.set(keys[i % n], i)
+
+
+def derive_delete(m, keys, ops):
+    n = len(keys)
+    for i in range(ops):
+        m.delete(keys[i % n])
+
+
+def derive_hash(m, keys, ops):
+    # Derived Maps share all nodes but one path with `m`, so hashing
+    # them mostly reads the hashes memoized in the shared nodes.
+    n = len(keys)
+    for i in range(ops):
+        hash(m.set(keys[i % n], i))
+
+
+def mutate(m, keys, ops):
+    n = len(keys)
+    for i in range(0, ops, 10):
+        with m.mutate() as mm:
+            for j in range(i, i + 10):
+                mm[keys[j % n]] = j
+
+
+def run(func, m, keys, ops, nthreads):
+    barrier = threading.Barrier(nthreads + 1)
+
+    def worker():
+        barrier.wait()
+        func(m, keys, ops)
+
+    threads = [threading.Thread(target=worker) for _ in range(nthreads)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=10000)
+    parser.add_argument('--ops', type=int, default=200000,
+                        help='number of operations per thread')
+    parser.add_argument('--threads', default=None,
+                        help='comma-separated thread counts')
+    args = parser.parse_args()
+
+    if args.threads:
+        counts = [int(n) for n in args.threads.split(',')]
+    else:
+        cpus = os.cpu_count() or 1
+        counts = [1]
+        while counts[-1] * 2 <= cpus:
+            counts.append(counts[-1] * 2)
+
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print('Python {}, GIL {}, {} CPUs'.format(
+        sys.version.split()[0], 'enabled' if gil else 'disabled',
+        os.cpu_count()))
+
+    m = Map({str(i): i for i in range(args.size)})
+    keys = [str(i) for i in range(args.size)]
+    hash(m)
+
+    for func in [read_get, read_contains, derive_set, derive_delete,
+                 derive_hash, mutate]:
+        base = None
+        for nthreads in counts:
+            elapsed = run(func, m, keys, args.ops, nthreads)
+            rate = nthreads * args.ops / elapsed
+            if base is None:
+                base = rate
+            print('{:<16} {:>3} threads {:>12.0f} ops/s {:>6.2f}x'.format(
+                func.__name__, nthreads, rate, rate / base))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,13 @@
 # flake8: noqa
 
 try:
-    from ._map import Map
+    from ._map import Map, Atom
 except ImportError:
-    from .map import Map
+    from .map import Map, Atom
 else:
     import collections.abc as _abc
     _abc.Mapping.register(Map)
 
 from ._version import __version__
 
-__all__ = 'Map',
+__all__ = 'Map', 'Atom'
@@ -1,5 +1,132 @@
 #include <stddef.h> /* For offsetof */
 #include "_map.h"
+#include "structmember.h"
+
+
+#if PY_VERSION_HEX < 0x030900A4
+#define Py_SET_SIZE(o, size) (Py_SIZE(o) = (size))
+#endif
+
+#ifndef PyDict_GET_SIZE
+#define PyDict_GET_SIZE(o) (((PyDictObject *)(o))->ma_used)
+#endif
+
+#if PY_VERSION_HEX < 0x03090000
+#define PyObject_GC_IsTracked(o) _PyObject_GC_IS_TRACKED(o)
+#endif
+
+/* Instances of heap types own a reference to their type since
+   Python 3.8, and have to visit it since Python 3.9. */
+#if PY_VERSION_HEX >= 0x03080000
+#define MAP_DECREF_TYPE(tp) Py_DECREF(tp)
+#else
+#define MAP_DECREF_TYPE(tp) ((void)(tp))
+#endif
+
+#if PY_VERSION_HEX >= 0x03090000
+#define MAP_VISIT_TYPE(o) Py_VISIT(Py_TYPE(o))
+#else
+#define MAP_VISIT_TYPE(o)
+#endif
+
+/* All types are heap types.  Py_TPFLAGS_IMMUTABLETYPE and
+   Py_TPFLAGS_DISALLOW_INSTANTIATION are new in Python 3.10; before
+   that, types without a Py_tp_new slot get their tp_new cleared
+   after they are created (see `map_add_type`). */
+#ifndef Py_TPFLAGS_IMMUTABLETYPE
+#define Py_TPFLAGS_IMMUTABLETYPE 0
+#endif
+
+#ifndef Py_TPFLAGS_DISALLOW_INSTANTIATION
+#define Py_TPFLAGS_DISALLOW_INSTANTIATION 0
+#endif
+
+#define MAP_TPFLAGS \
+    (Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC | Py_TPFLAGS_IMMUTABLETYPE)
+#define MAP_TPFLAGS_INTERNAL \
+    (MAP_TPFLAGS | Py_TPFLAGS_DISALLOW_INSTANTIATION)
+
+/* Weak references to instances of heap types are declared with
+   a __weaklistoffset__ member since Python 3.9; older versions get
+   tp_weaklistoffset set directly (see `map_module_exec`). */
+#if PY_VERSION_HEX >= 0x03090000
+#define MAP_WEAKLIST_MEMBERS(name, type, field)                 \
+    static PyMemberDef name[] = {                               \
+        {"__weaklistoffset__", T_PYSSIZET,                      \
+         offsetof(type, field), READONLY},                      \
+        {NULL}                                                  \
+    };
+#define MAP_MEMBERS_SLOT(members) {Py_tp_members, members},
+#else
+#define MAP_WEAKLIST_MEMBERS(name, type, field)
+#define MAP_MEMBERS_SLOT(members)
+#endif
+
+#if PY_VERSION_HEX >= 0x03080000
+#define MAP_TRASHCAN_BEGIN(op, dealloc) Py_TRASHCAN_BEGIN(op, dealloc)
+#define MAP_TRASHCAN_END(op) Py_TRASHCAN_END
+#else
+#define MAP_TRASHCAN_BEGIN(op, dealloc) Py_TRASHCAN_SAFE_BEGIN(op)
+#define MAP_TRASHCAN_END(op) Py_TRASHCAN_SAFE_END(op)
+#endif
+
+#if PY_VERSION_HEX < 0x030D0000
+#define Py_BEGIN_CRITICAL_SECTION(op) {
+#define Py_END_CRITICAL_SECTION() }
+#define Py_BEGIN_CRITICAL_SECTION2(a, b) {
+#define Py_END_CRITICAL_SECTION2() }
+#endif
+
+
+/* Free-threaded builds (PEP 703) run Python code without the GIL.
+
+   Maps and their nodes are immutable once created, so they can be
+   read and derived from concurrently without any locking, with a few
+   exceptions:
+
+   * hashes of Maps and nodes are memoized on first use; concurrent
+     threads compute the same value, so the memoized hashes are read
+     and written with relaxed atomics (MAP_LOAD_HASH/MAP_STORE_HASH);
+
+   * mutids have to be unique across threads and are allocated with
+     an atomic increment (see `map_next_mutid`);
+
+   * the freelists are shared by all threads of an interpreter and
+     aren't used;
+
+   * MapMutations, Map.__init__ and iterators modify their objects
+     in place and hold a critical section on them.
+*/
+#ifdef Py_GIL_DISABLED
+#define MAP_LOAD_HASH(field) _Py_atomic_load_ssize_relaxed(&(field))
+#define MAP_STORE_HASH(field, value) \
+    _Py_atomic_store_ssize_relaxed(&(field), (value))
+#define MAP_USE_FREELISTS 0
+#else
+#define MAP_LOAD_HASH(field) (field)
+#define MAP_STORE_HASH(field, value) ((field) = (value))
+#define MAP_USE_FREELISTS 1
+#endif
+
+
+/* Methods taking positional arguments only are implemented with the
+   METH_FASTCALL signature.  On Pythons that don't support
+   METH_FASTCALL they are wrapped into METH_VARARGS functions. */
+#if PY_VERSION_HEX >= 0x030700A0
+#define MAP_FASTCALL_WRAPPER(func, type)
+#define MAP_FASTCALL_METH(func) \
+    (PyCFunction)(void(*)(void))(func), METH_FASTCALL
+#else
+#define MAP_FASTCALL_WRAPPER(func, type)                        \
+    static PyObject *                                           \
+    func##_varargs(type *self, PyObject *args)                  \
+    {                                                           \
+        return func(self, &PyTuple_GET_ITEM(args, 0),           \
+                    PyTuple_GET_SIZE(args));                    \
+    }
+#define MAP_FASTCALL_METH(func) \
+    (PyCFunction)(func##_varargs), METH_VARARGS
+#endif
 
 
 /*
@@ -168,16 +295,20 @@ a number of pointers, but use bitmap compression to eliminate unused
 pointers.
 
 
-Bitmap nodes have two pointers for each item:
-
-  +----+----+----+----+  --  +----+----+
-  | k1 | v1 | k2 | v2 |  ..  | kN | vN |
-  +----+----+----+----+  --  +----+----+
+Bitmap nodes use the CHAMP layout [4]: instead of one bitmap they have
+two -- `b_datamap` for the elements that are key/value pairs, and
+`b_nodemap` for the elements that point to another tree level (a bit
+is never set in both).  Key/value pairs are stored first, two pointers
+each, followed by the subnodes, one pointer each, in reverse order:
 
-When kI == NULL, vI points to another tree level.
+  +----+----+--  --+----+----+----+--  --+----+
+  | k1 | v1 |  ..  | kN | vN | nM |  ..  | n1 |
+  +----+----+--  --+----+----+----+--  --+----+
 
-When kI != NULL, the actual key object is stored in kI, and its
-value is stored in vI.
+So the key of an element `bit` is at `2 * popcount(datamap & (bit - 1))`,
+and its subnode at `size - 1 - popcount(nodemap & (bit - 1))`.  Nodes
+don't waste a pointer on every subnode, and iterating over a node
+doesn't have to test every element for what it is.
 
 
 Collision Nodes
@@ -197,6 +328,40 @@ Tree Structure
 
 All nodes are PyObjects.
 
+The shape of the tree only depends on the keys it holds, not on
+the order of the operations that produced it:
+
+ * a single key/value pair is stored inline in a Bitmap node, or,
+   in an Array node, in a single-item Bitmap node;
+
+ * two or more keys with equal hashes are stored in a Collision node
+   that is placed in the parent directly, and never wrapped in
+   an otherwise empty Bitmap node (except by the root);
+
+ * tree levels with more than 16 elements are Array nodes, and
+   levels with 16 elements or less are Bitmap nodes.
+
+All operations keep the tree canonical, which makes `map_node_eq`
+possible: equal Maps have trees of the same shape.
+
+Every node memoizes the XOR of the hashes of all key/value pairs
+stored in its subtree (see `map_node_items_hash`).  Since nodes
+are never modified once they become reachable from a MapObject,
+computing `hash()` of a map derived from an already hashed one only
+needs to visit the nodes that were copied by `set()` or `delete()`.
+
+Nodes are created tracked by the GC.  When a new MapObject is
+created, the nodes created for it are "settled" (see `map_settle`):
+nodes whose keys, values, and subnodes can't be part of a reference
+cycle are untracked, just like CPython untracks dicts that hold only
+atomic objects.  A Map whose root node is untracked is untracked
+as well.  Settled nodes are never visited again, so settling costs
+as much as creating the new nodes.  Settled nodes are never mutated
+in place either, so their mutid field is reused to record the result,
+along with the number of keys in the node's subtree (computed from
+the counts of its already settled subnodes), which makes
+`map_node_count` O(1) for the nodes of any Map.
+
 The `MapObject` object has a pointer to the root node (h_root),
 and has a length field (h_count).
 
@@ -245,12 +410,23 @@ Further Reading
 
 3. Clojure's PersistentHashMap implementation:
    https://github.com/clojure/clojure/blob/master/src/jvm/clojure/lang/PersistentHashMap.java
+
+4. Steindorfer, Vinju. Optimizing Hash-Array Mapped Tries for Fast and
+   Lean Immutable JVM Collections (CHAMP), OOPSLA 2015.
 */
 
 
-#define IS_ARRAY_NODE(node)     (Py_TYPE(node) == &_Map_ArrayNode_Type)
-#define IS_BITMAP_NODE(node)    (Py_TYPE(node) == &_Map_BitmapNode_Type)
-#define IS_COLLISION_NODE(node) (Py_TYPE(node) == &_Map_CollisionNode_Type)
+/* Node types are per-module heap types (see `MapModuleState`), so
+   nodes are told apart by their deallocators, which don't depend on
+   the module instance. */
+#define IS_NODE_OF_KIND(node, dealloc) \
+    (Py_TYPE(node)->tp_dealloc == (destructor)(dealloc))
+#define IS_ARRAY_NODE(node) \
+    IS_NODE_OF_KIND(node, map_node_array_dealloc)
+#define IS_BITMAP_NODE(node) \
+    IS_NODE_OF_KIND(node, map_node_bitmap_dealloc)
+#define IS_COLLISION_NODE(node) \
+    IS_NODE_OF_KIND(node, map_node_collision_dealloc)
 
 
 /* Return type for 'find' (lookup a key) functions.
@@ -282,6 +458,35 @@ typedef enum {W_ERROR, W_NOT_FOUND, W_EMPTY, W_NEWNODE} map_without_t;
 typedef enum {I_ITEM, I_END} map_iter_t;
 
 
+/* Kinds of transformations done by `map_transform`.
+
+   * T_FILTER - keep the keys for which pred(key, value) is true;
+   * T_FILTER_KEYS - keep the keys for which pred(key) is true;
+   * T_MAP_VALUES - replace every value with func(value).
+*/
+typedef enum {T_FILTER, T_FILTER_KEYS, T_MAP_VALUES} map_transform_t;
+
+
+/* GC tracking state of a node (see `map_node_settle`).
+
+   * G_UNSETTLED - the node is new and is tracked by the GC;
+   * G_UNTRACKED - the node was settled and untracked;
+   * G_TRACKED - the node was settled and stays tracked.
+
+   Settled nodes are never mutated in place, so instead of having
+   separate fields, the state of a settled node and the number of keys
+   in its subtree are stored in its mutid: MAP_MUTID_SETTLED is set
+   (the mutid counters never get anywhere near it), bit 0 is set if
+   the node stays tracked, and the rest is the number of keys.
+*/
+typedef enum {G_UNSETTLED, G_UNTRACKED, G_TRACKED} map_gc_state_t;
+
+#define MAP_MUTID_SETTLED   ((uint64_t)1 << 63)
+#define MAP_MUTID_TRACKED   ((uint64_t)1)
+#define MAP_MUTID_COUNT(mutid) \
+    ((Py_ssize_t)(((mutid) & ~MAP_MUTID_SETTLED) >> 1))
+
+
 #define HAMT_ARRAY_NODE_SIZE 32
 
 
@@ -290,13 +495,16 @@ typedef struct {
     MapNode *a_array[HAMT_ARRAY_NODE_SIZE];
     Py_ssize_t a_count;
     uint64_t a_mutid;
+    Py_hash_t a_cached_hash;
 } MapNode_Array;
 
 
 typedef struct {
     PyObject_VAR_HEAD
     uint64_t b_mutid;
-    uint32_t b_bitmap;
+    Py_hash_t b_cached_hash;
+    uint32_t b_datamap;
+    uint32_t b_nodemap;
     PyObject *b_array[1];
 } MapNode_Bitmap;
 
@@ -304,19 +512,161 @@ typedef struct {
 typedef struct {
     PyObject_VAR_HEAD
     uint64_t c_mutid;
-    int32_t c_hash;
+    Py_hash_t c_cached_hash;
+    map_hash_t c_hash;
     PyObject *c_array[1];
 } MapNode_Collision;
 
 
-static volatile uint64_t mutid_counter = 1;
+static void
+map_node_array_dealloc(MapNode_Array *self);
+
+static void
+map_node_bitmap_dealloc(MapNode_Bitmap *self);
+
+static void
+map_node_collision_dealloc(MapNode_Collision *self);
+
+
+/* Key/value pairs collected by map_node_update_from_dict,
+   map_node_update_from_seq, etc.  The buffer holds strong references
+   to the keys and the values of its entries. */
+typedef struct {
+    MapEntry *b_entries;
+    Py_ssize_t b_size;
+    Py_ssize_t b_allocated;
+} MapBuildBuffer;
+
+
+/* Counters collected by map_node_stats in one traversal of a tree. */
+typedef struct {
+    Py_ssize_t s_bitmap_nodes;
+    Py_ssize_t s_array_nodes;
+    Py_ssize_t s_collision_nodes;
+    /* The number of used slots of all Bitmap and Array nodes. */
+    Py_ssize_t s_slots;
+    /* The number of keys stored on every level of the tree. */
+    Py_ssize_t s_depths[_Py_HAMT_MAX_TREE_DEPTH];
+    /* Memory used by the nodes, not counting keys and values. */
+    Py_ssize_t s_bytes;
+} MapStats;
+
+
+/* Maps with up to this many keys are created without a tree: their
+   keys and values are stored in an array inside the Map object. */
+#define MAP_FLAT_MAXSIZE 8
+
+#define IS_FLAT_MAP(o) (((BaseMapObject *)(o))->b_root == NULL)
+
+
+/* Freelists.
+
+   Every Map.set() allocates a new MapObject and O(log N) Bitmap nodes,
+   and the previous version of the Map is usually freed right away.
+   Similarly to CPython's tuple freelist, freed Bitmap nodes of small
+   sizes and freed Map objects are kept in per-size singly-linked
+   lists (chained through their first array slot and their h_root
+   field respectively), and freed iterator objects are kept in
+   a fixed-size array.
+*/
+
+/* Bitmap nodes with up to this many array slots (two per key/value
+   pair, one per subnode) are put on a freelist. */
+#define MAP_BITMAP_FREELIST_MAXSIZE 16
+#define MAP_BITMAP_FREELIST_MAXLEN 128
+#define MAP_FREELIST_MAXLEN 80
+#define MAP_ITER_FREELIST_MAXLEN 16
+
+
+/* Module state.
+
+   All types are heap types and every instance of the module (there is
+   one per interpreter) has its own copies of them, of the freelists
+   and of the shared empty bitmap node, so that isolated
+   subinterpreters never share any objects.  Node-level functions get
+   the state as their first argument; Map-level functions look it up
+   from the type of the Map (see `MAP_STATE`).
+*/
+typedef struct {
+    PyTypeObject *ms_map_type;
+    PyTypeObject *ms_mapmut_type;
+    PyTypeObject *ms_array_node_type;
+    PyTypeObject *ms_bitmap_node_type;
+    PyTypeObject *ms_collision_node_type;
+    PyTypeObject *ms_keys_type;
+    PyTypeObject *ms_values_type;
+    PyTypeObject *ms_items_type;
+    PyTypeObject *ms_keys_iter_type;
+    PyTypeObject *ms_values_iter_type;
+    PyTypeObject *ms_items_iter_type;
+    PyTypeObject *ms_atom_type;
+
+    MapNode_Bitmap *ms_empty_bitmap_node;
+
+    uint64_t ms_mutid_counter;
+
+    MapNode_Bitmap *ms_bitmap_freelist[MAP_BITMAP_FREELIST_MAXSIZE];
+    int ms_bitmap_freelist_len[MAP_BITMAP_FREELIST_MAXSIZE];
+
+    MapObject *ms_map_freelist[MAP_FLAT_MAXSIZE + 1];
+    int ms_map_freelist_len[MAP_FLAT_MAXSIZE + 1];
+
+    MapIterator *ms_iter_freelist[MAP_ITER_FREELIST_MAXLEN];
+    int ms_iter_freelist_len;
+} MapModuleState;
+
+
+#if PY_VERSION_HEX >= 0x03090000
+/* None of the types can be subclassed, so the module of the type of
+   an object is always set. */
+#define MAP_TYPE_STATE(type) \
+    ((MapModuleState *)PyType_GetModuleState(type))
+#else
+/* Types can't be associated with their module before Python 3.9,
+   which doesn't support isolated subinterpreters anyway: all
+   instances of the module share one state, which is initialized on
+   the first import and never freed. */
+static MapModuleState _map_module_state;
+#define MAP_TYPE_STATE(type) (&_map_module_state)
+#endif
+
+#define MAP_STATE(o) MAP_TYPE_STATE(Py_TYPE(o))
+
 
-static MapNode_Bitmap *_empty_bitmap_node;
+static MapModuleState *
+map_dealloc_state(PyTypeObject *type)
+{
+    /* Return the state for the freelists in a deallocator, or NULL
+       if the module of the type is already gone. */
+#if PY_VERSION_HEX >= 0x03090000
+    PyObject *module = ((PyHeapTypeObject *)type)->ht_module;
+    return module == NULL ? NULL : (MapModuleState *)PyModule_GetState(module);
+#else
+    return &_map_module_state;
+#endif
+}
+
+#define Map_Check(st, o) (Py_TYPE(o) == (st)->ms_map_type)
+#define MapMutation_Check(st, o) (Py_TYPE(o) == (st)->ms_mapmut_type)
+#define MapItems_Check(st, o) (Py_TYPE(o) == (st)->ms_items_type)
+
+
+static uint64_t
+map_next_mutid(MapModuleState *st)
+{
+    /* Mutids only have to be unique within one interpreter, as nodes
+       are never shared with other interpreters. */
+#ifdef Py_GIL_DISABLED
+    return _Py_atomic_add_uint64(&st->ms_mutid_counter, 1);
+#else
+    return st->ms_mutid_counter++;
+#endif
+}
 
 
 /* Create a new HAMT immutable mapping. */
 static MapObject *
-map_new(void);
+map_new(MapModuleState *st);
 
 /* Return a new collection based on "o", but with an additional
    key/val pair. */
@@ -346,41 +696,66 @@ map_len(BaseMapObject *o);
 
 
 static MapObject *
-map_alloc(void);
+map_alloc(MapModuleState *st, Py_ssize_t size);
+
+static map_gc_state_t
+map_node_settle(MapNode *node);
 
 static MapNode *
-map_node_assoc(MapNode *node,
-               uint32_t shift, int32_t hash,
+map_node_assoc(MapModuleState *st, MapNode *node,
+               uint32_t shift, map_hash_t hash,
                PyObject *key, PyObject *val, int* added_leaf,
                uint64_t mutid);
 
 static map_without_t
-map_node_without(MapNode *node,
-                 uint32_t shift, int32_t hash,
+map_node_without(MapModuleState *st, MapNode *node,
+                 uint32_t shift, map_hash_t hash,
                  PyObject *key,
                  MapNode **new_node,
                  uint64_t mutid);
 
 static map_find_t
 map_node_find(MapNode *node,
-              uint32_t shift, int32_t hash,
+              uint32_t shift, map_hash_t hash,
               PyObject *key, PyObject **val);
 
 static int
 map_node_dump(MapNode *node,
               _PyUnicodeWriter *writer, int level);
 
+static int
+map_node_items_hash(MapNode *node, Py_uhash_t *hash);
+
+static void
+map_node_stats(MapNode *node, int level, MapStats *stats);
+
 static MapNode *
-map_node_array_new(Py_ssize_t, uint64_t mutid);
+map_node_array_new(MapModuleState *st, Py_ssize_t, uint64_t mutid);
 
 static MapNode *
-map_node_collision_new(int32_t hash, Py_ssize_t size, uint64_t mutid);
+map_node_new_from_slots(MapModuleState *st, map_hash_t *hashes,
+                        PyObject **keys, PyObject **vals, uint32_t bitmap,
+                        uint32_t shift, uint64_t mutid);
+
+static inline uint32_t
+map_bitcount(uint32_t i);
+
+static MapNode *
+map_node_collision_new(MapModuleState *st,
+                       map_hash_t hash, Py_ssize_t size, uint64_t mutid);
 
 static inline Py_ssize_t
 map_node_collision_count(MapNode_Collision *node);
 
+static inline Py_hash_t
+map_collision_hash(PyObject *key, map_hash_t hash);
+
+static inline void
+map_node_collision_set(MapNode_Collision *node, Py_ssize_t idx,
+                       Py_hash_t key_hash, PyObject *key, PyObject *val);
+
 static int
-map_node_update(uint64_t mutid,
+map_node_update(MapModuleState *st, uint64_t mutid,
                 PyObject *seq,
                 MapNode *root, Py_ssize_t count,
                 MapNode **new_root, Py_ssize_t *new_count);
@@ -392,6 +767,67 @@ map_update_inplace(uint64_t mutid, BaseMapObject *o, PyObject *src);
 static MapObject *
 map_update(uint64_t mutid, MapObject *o, PyObject *src);
 
+static PyObject *
+map_diff(MapObject *o, MapObject *other);
+
+static MapObject *
+map_select(MapObject *o, MapObject *other, int difference, int items);
+
+static MapObject *
+map_take(MapObject *o, PyObject *keys);
+
+static MapObject *
+map_delete_many(MapObject *o, PyObject *keys, int missing_ok);
+
+static int
+map_node_delete_many(MapModuleState *st,
+                     MapNode *root, Py_ssize_t count, PyObject *keys,
+                     int missing_ok, uint64_t mutid,
+                     MapNode **new_root, Py_ssize_t *new_count);
+
+static MapObject *
+map_transform(MapObject *o, map_transform_t kind, PyObject *func);
+
+static PyObject *
+map_split(MapObject *o, Py_ssize_t n);
+
+static PyObject *
+map_partitions(MapObject *o);
+
+static void
+map_build_buffer_init(MapBuildBuffer *buf);
+
+static void
+map_build_buffer_clear(MapBuildBuffer *buf);
+
+static int
+map_build_buffer_reserve(MapBuildBuffer *buf, Py_ssize_t size);
+
+static int
+map_build_buffer_append(MapBuildBuffer *buf, map_hash_t key_hash,
+                        PyObject *key, PyObject *val);
+
+static int
+map_build_buffer_extend(MapModuleState *st, MapBuildBuffer *buf,
+                        PyObject *src);
+
+static int
+map_node_update_from_entries(MapModuleState *st, uint64_t mutid,
+                             MapBuildBuffer *buf,
+                             MapNode *root, Py_ssize_t count,
+                             MapNode **new_root, Py_ssize_t *new_count);
+
+static int
+map_set_entries(MapObject *o, MapBuildBuffer *buf, uint64_t mutid);
+
+static MapObject *
+map_from_build_buffer(MapModuleState *st, MapBuildBuffer *buf, uint64_t mutid);
+
+static MapNode *
+map_node_build(MapModuleState *st, MapEntry *entries, MapEntry *scratch,
+               Py_ssize_t n, uint32_t shift,
+               Py_ssize_t *count, uint64_t mutid);
+
 
 #if !defined(NDEBUG)
 static void
@@ -411,18 +847,41 @@ _map_node_array_validate(void *o)
 
 #define VALIDATE_ARRAY_NODE(NODE) \
     do { _map_node_array_validate(NODE); } while (0);
+
+static void
+_map_node_bitmap_validate(void *o)
+{
+    assert(IS_BITMAP_NODE(o));
+    MapNode_Bitmap *node = (MapNode_Bitmap*)(o);
+    assert((node->b_datamap & node->b_nodemap) == 0);
+    Py_ssize_t data_size = 2 * (Py_ssize_t)map_bitcount(node->b_datamap);
+    assert(Py_SIZE(node) ==
+           data_size + (Py_ssize_t)map_bitcount(node->b_nodemap));
+    for (Py_ssize_t i = 0; i < Py_SIZE(node); i++) {
+        assert(node->b_array[i] != NULL);
+        if (i >= data_size) {
+            assert(IS_BITMAP_NODE(node->b_array[i]) ||
+                   IS_ARRAY_NODE(node->b_array[i]) ||
+                   IS_COLLISION_NODE(node->b_array[i]));
+        }
+    }
+}
+
+#define VALIDATE_BITMAP_NODE(NODE) \
+    do { _map_node_bitmap_validate(NODE); } while (0);
 #else
 #define VALIDATE_ARRAY_NODE(NODE)
+#define VALIDATE_BITMAP_NODE(NODE)
 #endif
 
 
 /* Returns -1 on error */
-static inline int32_t
+static inline map_hash_t
 map_hash(PyObject *o)
 {
     Py_hash_t hash = PyObject_Hash(o);
 
-#if SIZEOF_PY_HASH_T <= 4
+#if SIZEOF_PY_HASH_T <= 4 || MAP_HASH_BITS == 64
     return hash;
 #else
     if (hash == -1) {
@@ -445,13 +904,13 @@ map_hash(PyObject *o)
 }
 
 static inline uint32_t
-map_mask(int32_t hash, uint32_t shift)
+map_mask(map_hash_t hash, uint32_t shift)
 {
-    return (((uint32_t)hash >> shift) & 0x01f);
+    return (uint32_t)(((map_uhash_t)hash >> shift) & 0x01f);
 }
 
 static inline uint32_t
-map_bitpos(int32_t hash, uint32_t shift)
+map_bitpos(map_hash_t hash, uint32_t shift)
 {
     return (uint32_t)1 << map_mask(hash, shift);
 }
@@ -482,6 +941,32 @@ map_bitindex(uint32_t bitmap, uint32_t bit)
     return map_bitcount(bitmap & (bit - 1));
 }
 
+static inline Py_uhash_t
+_shuffle_bits(Py_uhash_t h)
+{
+    return ((h ^ 89869747UL) ^ (h << 16)) * 3644798167UL;
+}
+
+static int
+map_item_hash(PyObject *key, PyObject *val, Py_uhash_t *hash)
+{
+    /* Compute the contribution of a key/value pair to the hash
+       of the map. */
+
+    Py_hash_t kh = PyObject_Hash(key);
+    if (kh == -1) {
+        return -1;
+    }
+
+    Py_hash_t vh = PyObject_Hash(val);
+    if (vh == -1) {
+        return -1;
+    }
+
+    *hash = _shuffle_bits((Py_uhash_t)kh) ^ _shuffle_bits((Py_uhash_t)vh);
+    return 0;
+}
+
 
 /////////////////////////////////// Dump Helpers
 
@@ -528,11 +1013,7 @@ _map_dump_format(_PyUnicodeWriter *writer, const char *format, ...)
     int ret;
 
     va_list vargs;
-#ifdef HAVE_STDARG_PROTOTYPES
     va_start(vargs, format);
-#else
-    va_start(vargs);
-#endif
     msg = PyUnicode_FromFormatV(format, vargs);
     va_end(vargs);
 
@@ -548,8 +1029,29 @@ _map_dump_format(_PyUnicodeWriter *writer, const char *format, ...)
 /////////////////////////////////// Bitmap Node
 
 
+/* Bitmap nodes store the hashes of their keys after the array,
+   in the same order as the key/value pairs:
+
+  +----+----+--  --+----+----+----+----+--  --+----+----+--  --+
+  | k1 | v1 |  ..  | kN | vN | nM |  ..  | n1 | h1 |  ..  | hN
+  +----+----+--  --+----+----+----+----+--  --+----+----+--  --+
+
+   This way keys don't have to be hashed again when they are moved
+   to a new level of the tree, or when nodes are merged, diffed, or
+   rebuilt; lookups also skip `__eq__` for keys with different hashes.
+   Room is reserved for the hashes of Py_SIZE(node) / 2 keys, so that
+   the allocation size only depends on the size of the node.
+*/
+#define BITMAP_HASHES(node) \
+    ((map_hash_t *)(void *)((node)->b_array + Py_SIZE(node)))
+
+#define BITMAP_HASH_ITEMS(size) \
+    (((size) / 2 * (Py_ssize_t)sizeof(map_hash_t) + \
+      (Py_ssize_t)sizeof(PyObject *) - 1) / (Py_ssize_t)sizeof(PyObject *))
+
+
 static MapNode *
-map_node_bitmap_new(Py_ssize_t size, uint64_t mutid)
+map_node_bitmap_new(MapModuleState *st, Py_ssize_t size, uint64_t mutid)
 {
     /* Create a new bitmap node of size 'size' */
 
@@ -557,50 +1059,137 @@ map_node_bitmap_new(Py_ssize_t size, uint64_t mutid)
     Py_ssize_t i;
 
     assert(size >= 0);
-    assert(size % 2 == 0);
 
-    if (size == 0 && _empty_bitmap_node != NULL && mutid == 0) {
-        Py_INCREF(_empty_bitmap_node);
-        return (MapNode *)_empty_bitmap_node;
+    if (size == 0 && st->ms_empty_bitmap_node != NULL && mutid == 0) {
+        Py_INCREF(st->ms_empty_bitmap_node);
+        return (MapNode *)st->ms_empty_bitmap_node;
     }
 
-    /* No freelist; allocate a new bitmap node */
-    node = PyObject_GC_NewVar(
-        MapNode_Bitmap, &_Map_BitmapNode_Type, size);
-    if (node == NULL) {
-        return NULL;
+    if (size > 0 && size <= MAP_BITMAP_FREELIST_MAXSIZE &&
+            st->ms_bitmap_freelist[size - 1] != NULL)
+    {
+        /* Reuse a node from the freelist; the rest of the chain
+           is stored in the first slot of the array. */
+        node = st->ms_bitmap_freelist[size - 1];
+        st->ms_bitmap_freelist[size - 1] =
+            (MapNode_Bitmap *)node->b_array[0];
+        st->ms_bitmap_freelist_len[size - 1]--;
+        (void)PyObject_InitVar(
+            (PyVarObject *)node, st->ms_bitmap_node_type, size);
+    }
+    else {
+        node = PyObject_GC_NewVar(
+            MapNode_Bitmap, st->ms_bitmap_node_type,
+            size + BITMAP_HASH_ITEMS(size));
+        if (node == NULL) {
+            return NULL;
+        }
     }
 
-    Py_SIZE(node) = size;
+    Py_SET_SIZE(node, size);
 
     for (i = 0; i < size; i++) {
         node->b_array[i] = NULL;
     }
 
-    node->b_bitmap = 0;
+    node->b_datamap = 0;
+    node->b_nodemap = 0;
     node->b_mutid = mutid;
+    node->b_cached_hash = -1;
 
     PyObject_GC_Track(node);
+    return (MapNode *)node;
+}
 
-    if (size == 0 && _empty_bitmap_node == NULL && mutid == 0) {
-        /* Since bitmap nodes are immutable, we can cache the instance
-           for size=0 and reuse it whenever we need an empty bitmap node.
-        */
-        _empty_bitmap_node = node;
-        Py_INCREF(_empty_bitmap_node);
+static MapNode *
+map_node_bitmap_new_item(MapModuleState *st, uint32_t shift, map_hash_t hash,
+                         PyObject *key, PyObject *val, uint64_t mutid)
+{
+    /* Create a Bitmap node located at the `shift` level of the tree
+       with one key/value pair. */
+
+    MapNode_Bitmap *node = (MapNode_Bitmap *)map_node_bitmap_new(st, 2, mutid);
+    if (node == NULL) {
+        return NULL;
     }
 
+    node->b_datamap = map_bitpos(hash, shift);
+    Py_INCREF(key);
+    node->b_array[0] = key;
+    Py_INCREF(val);
+    node->b_array[1] = val;
+    BITMAP_HASHES(node)[0] = hash;
     return (MapNode *)node;
 }
 
 static inline Py_ssize_t
-map_node_bitmap_count(MapNode_Bitmap *node)
+map_node_bitmap_data_size(MapNode_Bitmap *node)
 {
-    return Py_SIZE(node) / 2;
+    /* Return the number of array slots taken by key/value pairs;
+       the subnodes are stored after them. */
+    return Py_SIZE(node) - (Py_ssize_t)map_bitcount(node->b_nodemap);
+}
+
+static inline Py_ssize_t
+map_node_bitmap_key_index(MapNode_Bitmap *node, uint32_t bit)
+{
+    assert(node->b_datamap & bit);
+    return 2 * (Py_ssize_t)map_bitindex(node->b_datamap, bit);
+}
+
+static inline Py_ssize_t
+map_node_bitmap_node_index(MapNode_Bitmap *node, uint32_t bit)
+{
+    assert(node->b_nodemap & bit);
+    return Py_SIZE(node) - 1 - (Py_ssize_t)map_bitindex(node->b_nodemap, bit);
+}
+
+static inline int
+map_node_bitmap_is_item(MapNode_Bitmap *node)
+{
+    /* Return 1 if the node holds a single key/value pair and nothing
+       else.  Such nodes are only found in Array nodes (and at the
+       root); Bitmap nodes store single key/value pairs inline. */
+    return Py_SIZE(node) == 2 && node->b_nodemap == 0;
+}
+
+static inline void
+map_node_bitmap_get(MapNode_Bitmap *node, uint32_t bit,
+                    map_hash_t *key_hash,
+                    PyObject **key_or_null, PyObject **val_or_node)
+{
+    /* Get the `bit` element of the node (borrowed references):
+       either a key/value pair and the hash of the key, or a NULL key
+       and a subnode (*key_hash is set to -1 then). */
+
+    if (node->b_datamap & bit) {
+        Py_ssize_t key_idx = map_node_bitmap_key_index(node, bit);
+        *key_hash = BITMAP_HASHES(node)[key_idx / 2];
+        *key_or_null = node->b_array[key_idx];
+        *val_or_node = node->b_array[key_idx + 1];
+    }
+    else {
+        *key_hash = -1;
+        *key_or_null = NULL;
+        *val_or_node = node->b_array[map_node_bitmap_node_index(node, bit)];
+    }
+}
+
+static inline void
+map_node_bitmap_copy_hashes(MapNode_Bitmap *dst, Py_ssize_t dst_idx,
+                            MapNode_Bitmap *src, Py_ssize_t src_idx,
+                            Py_ssize_t n)
+{
+    /* Copy the hashes of `n` keys starting with the `src_idx`-th key
+       of `src` to `dst`, starting with its `dst_idx`-th key. */
+
+    assert(n >= 0);
+    memcpy(BITMAP_HASHES(dst) + dst_idx, BITMAP_HASHES(src) + src_idx,
+           (size_t)n * sizeof(map_hash_t));
 }
 
 static MapNode_Bitmap *
-map_node_bitmap_clone(MapNode_Bitmap *node, uint64_t mutid)
+map_node_bitmap_clone(MapModuleState *st, MapNode_Bitmap *node, uint64_t mutid)
 {
     /* Clone a bitmap node; return a new one with the same child notes. */
 
@@ -608,119 +1197,298 @@ map_node_bitmap_clone(MapNode_Bitmap *node, uint64_t mutid)
     Py_ssize_t i;
 
     clone = (MapNode_Bitmap *)map_node_bitmap_new(
-        Py_SIZE(node), mutid);
+        st, Py_SIZE(node), mutid);
     if (clone == NULL) {
         return NULL;
     }
 
     for (i = 0; i < Py_SIZE(node); i++) {
-        Py_XINCREF(node->b_array[i]);
+        Py_INCREF(node->b_array[i]);
         clone->b_array[i] = node->b_array[i];
     }
 
-    clone->b_bitmap = node->b_bitmap;
+    map_node_bitmap_copy_hashes(
+        clone, 0, node, 0, map_bitcount(node->b_datamap));
+
+    clone->b_datamap = node->b_datamap;
+    clone->b_nodemap = node->b_nodemap;
     return clone;
 }
 
 static MapNode_Bitmap *
-map_node_bitmap_clone_without(MapNode_Bitmap *o, uint32_t bit, uint64_t mutid)
+map_node_bitmap_clone_without(MapModuleState *st,
+                              MapNode_Bitmap *o, uint32_t bit, uint64_t mutid)
 {
-    assert(bit & o->b_bitmap);
-    assert(map_node_bitmap_count(o) > 1);
+    /* Return a copy of `o` without the key/value pair of the `bit`
+       element. */
+
+    assert(o->b_datamap & bit);
+    assert(Py_SIZE(o) > 2);
 
     MapNode_Bitmap *new = (MapNode_Bitmap *)map_node_bitmap_new(
-        Py_SIZE(o) - 2, mutid);
+        st, Py_SIZE(o) - 2, mutid);
     if (new == NULL) {
         return NULL;
     }
 
-    uint32_t idx = map_bitindex(o->b_bitmap, bit);
-    uint32_t key_idx = 2 * idx;
-    uint32_t val_idx = key_idx + 1;
-    uint32_t i;
+    Py_ssize_t key_idx = map_node_bitmap_key_index(o, bit);
+    Py_ssize_t i;
 
     for (i = 0; i < key_idx; i++) {
-        Py_XINCREF(o->b_array[i]);
+        Py_INCREF(o->b_array[i]);
         new->b_array[i] = o->b_array[i];
     }
 
-    assert(Py_SIZE(o) >= 0 && Py_SIZE(o) <= 32);
-    for (i = val_idx + 1; i < (uint32_t)Py_SIZE(o); i++) {
-        Py_XINCREF(o->b_array[i]);
+    for (i = key_idx + 2; i < Py_SIZE(o); i++) {
+        Py_INCREF(o->b_array[i]);
         new->b_array[i - 2] = o->b_array[i];
     }
 
-    new->b_bitmap = o->b_bitmap & ~bit;
+    map_node_bitmap_copy_hashes(new, 0, o, 0, key_idx / 2);
+    map_node_bitmap_copy_hashes(
+        new, key_idx / 2, o, key_idx / 2 + 1,
+        map_bitcount(o->b_datamap) - key_idx / 2 - 1);
+
+    new->b_datamap = o->b_datamap & ~bit;
+    new->b_nodemap = o->b_nodemap;
+    VALIDATE_BITMAP_NODE(new)
     return new;
 }
 
-static MapNode *
-map_node_new_bitmap_or_collision(uint32_t shift,
-                                 PyObject *key1, PyObject *val1,
-                                 int32_t key2_hash,
-                                 PyObject *key2, PyObject *val2,
-                                 uint64_t mutid)
+static MapNode_Bitmap *
+map_node_bitmap_clone_with_node(MapModuleState *st,
+                                MapNode_Bitmap *o, uint32_t bit,
+                                MapNode *sub_node, uint64_t mutid)
 {
-    /* Helper method.  Creates a new node for key1/val and key2/val2
-       pairs.
+    /* Return a copy of `o` in which the key/value pair of the `bit`
+       element is replaced with `sub_node`. */
 
-       If key1 hash is equal to the hash of key2, a Collision node
-       will be created.  If they are not equal, a Bitmap node is
-       created.
-    */
+    assert(o->b_datamap & bit);
 
-    int32_t key1_hash = map_hash(key1);
-    if (key1_hash == -1) {
+    MapNode_Bitmap *new = (MapNode_Bitmap *)map_node_bitmap_new(
+        st, Py_SIZE(o) - 1, mutid);
+    if (new == NULL) {
         return NULL;
     }
 
-    if (key1_hash == key2_hash) {
-        MapNode_Collision *n;
-        n = (MapNode_Collision *)map_node_collision_new(key1_hash, 4, mutid);
-        if (n == NULL) {
-            return NULL;
-        }
-
-        Py_INCREF(key1);
-        n->c_array[0] = key1;
-        Py_INCREF(val1);
-        n->c_array[1] = val1;
+    new->b_datamap = o->b_datamap & ~bit;
+    new->b_nodemap = o->b_nodemap | bit;
 
-        Py_INCREF(key2);
-        n->c_array[2] = key2;
-        Py_INCREF(val2);
-        n->c_array[3] = val2;
+    Py_ssize_t key_idx = map_node_bitmap_key_index(o, bit);
+    Py_ssize_t node_idx = map_node_bitmap_node_index(new, bit);
+    Py_ssize_t i;
 
-        return (MapNode *)n;
+    for (i = 0; i < key_idx; i++) {
+        Py_INCREF(o->b_array[i]);
+        new->b_array[i] = o->b_array[i];
     }
-    else {
-        int added_leaf = 0;
-        MapNode *n = map_node_bitmap_new(0, mutid);
-        if (n == NULL) {
-            return NULL;
-        }
 
-        MapNode *n2 = map_node_assoc(
-            n, shift, key1_hash, key1, val1, &added_leaf, mutid);
-        Py_DECREF(n);
-        if (n2 == NULL) {
-            return NULL;
-        }
+    /* Key/value pairs after the removed one, and subnodes of
+       the elements that follow `bit`, move two slots to the left. */
+    for (i = key_idx + 2; i < node_idx + 2; i++) {
+        Py_INCREF(o->b_array[i]);
+        new->b_array[i - 2] = o->b_array[i];
+    }
 
-        n = map_node_assoc(
-            n2, shift, key2_hash, key2, val2, &added_leaf, mutid);
-        Py_DECREF(n2);
-        if (n == NULL) {
-            return NULL;
-        }
+    Py_INCREF(sub_node);
+    new->b_array[node_idx] = (PyObject *)sub_node;
 
-        return n;
+    for (i = node_idx + 2; i < Py_SIZE(o); i++) {
+        Py_INCREF(o->b_array[i]);
+        new->b_array[i - 1] = o->b_array[i];
     }
+
+    map_node_bitmap_copy_hashes(new, 0, o, 0, key_idx / 2);
+    map_node_bitmap_copy_hashes(
+        new, key_idx / 2, o, key_idx / 2 + 1,
+        map_bitcount(o->b_datamap) - key_idx / 2 - 1);
+
+    VALIDATE_BITMAP_NODE(new)
+    return new;
+}
+
+static MapNode_Bitmap *
+map_node_bitmap_clone_with_item(MapModuleState *st,
+                                MapNode_Bitmap *o, uint32_t bit,
+                                map_hash_t key_hash,
+                                PyObject *key, PyObject *val,
+                                uint64_t mutid)
+{
+    /* Return a copy of `o` in which the subnode of the `bit` element
+       is replaced with the key/val pair. */
+
+    assert(o->b_nodemap & bit);
+
+    MapNode_Bitmap *new = (MapNode_Bitmap *)map_node_bitmap_new(
+        st, Py_SIZE(o) + 1, mutid);
+    if (new == NULL) {
+        return NULL;
+    }
+
+    new->b_datamap = o->b_datamap | bit;
+    new->b_nodemap = o->b_nodemap & ~bit;
+
+    Py_ssize_t node_idx = map_node_bitmap_node_index(o, bit);
+    Py_ssize_t key_idx = map_node_bitmap_key_index(new, bit);
+    Py_ssize_t i;
+
+    for (i = 0; i < key_idx; i++) {
+        Py_INCREF(o->b_array[i]);
+        new->b_array[i] = o->b_array[i];
+    }
+
+    Py_INCREF(key);
+    new->b_array[key_idx] = key;
+    Py_INCREF(val);
+    new->b_array[key_idx + 1] = val;
+
+    /* Key/value pairs after the new one, and subnodes of the
+       elements that follow `bit`, move two slots to the right. */
+    for (i = key_idx; i < node_idx; i++) {
+        Py_INCREF(o->b_array[i]);
+        new->b_array[i + 2] = o->b_array[i];
+    }
+
+    for (i = node_idx + 1; i < Py_SIZE(o); i++) {
+        Py_INCREF(o->b_array[i]);
+        new->b_array[i + 1] = o->b_array[i];
+    }
+
+    map_node_bitmap_copy_hashes(new, 0, o, 0, key_idx / 2);
+    BITMAP_HASHES(new)[key_idx / 2] = key_hash;
+    map_node_bitmap_copy_hashes(
+        new, key_idx / 2 + 1, o, key_idx / 2,
+        map_bitcount(o->b_datamap) - key_idx / 2);
+
+    VALIDATE_BITMAP_NODE(new)
+    return new;
+}
+
+static MapNode *
+map_node_new_bitmap_or_collision(MapModuleState *st, uint32_t shift,
+                                 map_hash_t key1_hash,
+                                 PyObject *key1, PyObject *val1,
+                                 map_hash_t key2_hash,
+                                 PyObject *key2, PyObject *val2,
+                                 uint64_t mutid)
+{
+    /* Helper method.  Creates a new node for key1/val and key2/val2
+       pairs.
+
+       If key1 hash is equal to the hash of key2, a Collision node
+       will be created.  If they are not equal, a Bitmap node is
+       created.
+    */
+
+    if (key1_hash == key2_hash) {
+        MapNode_Collision *n;
+
+        Py_hash_t key1_full_hash = map_collision_hash(key1, key1_hash);
+        if (key1_full_hash == -1) {
+            return NULL;
+        }
+
+        Py_hash_t key2_full_hash = map_collision_hash(key2, key2_hash);
+        if (key2_full_hash == -1) {
+            return NULL;
+        }
+
+        n = (MapNode_Collision *)map_node_collision_new(
+            st, key1_hash, 4, mutid);
+        if (n == NULL) {
+            return NULL;
+        }
+
+        if (key1_full_hash <= key2_full_hash) {
+            map_node_collision_set(n, 0, key1_full_hash, key1, val1);
+            map_node_collision_set(n, 2, key2_full_hash, key2, val2);
+        }
+        else {
+            map_node_collision_set(n, 0, key2_full_hash, key2, val2);
+            map_node_collision_set(n, 2, key1_full_hash, key1, val1);
+        }
+
+        return (MapNode *)n;
+    }
+    else {
+        int added_leaf = 0;
+        MapNode *n = map_node_bitmap_new(st, 0, mutid);
+        if (n == NULL) {
+            return NULL;
+        }
+
+        MapNode *n2 = map_node_assoc(
+            st, n, shift, key1_hash, key1, val1, &added_leaf, mutid);
+        Py_DECREF(n);
+        if (n2 == NULL) {
+            return NULL;
+        }
+
+        n = map_node_assoc(
+            st, n2, shift, key2_hash, key2, val2, &added_leaf, mutid);
+        Py_DECREF(n2);
+        if (n == NULL) {
+            return NULL;
+        }
+
+        return n;
+    }
+}
+
+static MapNode *
+map_node_bitmap_to_array(MapModuleState *st, MapNode_Bitmap *self,
+                         uint32_t shift, map_hash_t hash,
+                         PyObject *key, PyObject *val,
+                         uint64_t mutid)
+{
+    /* Create an Array node with all elements of `self` and
+       the new key/val pair. */
+
+    map_hash_t hashes[HAMT_ARRAY_NODE_SIZE];
+    PyObject *keys[HAMT_ARRAY_NODE_SIZE];
+    PyObject *vals[HAMT_ARRAY_NODE_SIZE];
+    uint32_t bitmap = self->b_datamap | self->b_nodemap;
+    uint32_t jdx = map_mask(hash, shift);
+    uint32_t i;
+
+    assert(!(bitmap & ((uint32_t)1 << jdx)));
+
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        uint32_t bit = (uint32_t)1 << i;
+
+        if (i == jdx) {
+            hashes[i] = hash;
+            keys[i] = key;
+            vals[i] = val;
+        }
+        else if (bitmap & bit) {
+            map_node_bitmap_get(self, bit, &hashes[i], &keys[i], &vals[i]);
+        }
+        else {
+            keys[i] = NULL;
+            vals[i] = NULL;
+            continue;
+        }
+
+        Py_XINCREF(keys[i]);
+        Py_INCREF(vals[i]);
+    }
+
+    MapNode *res = map_node_new_from_slots(
+        st, hashes, keys, vals, bitmap | ((uint32_t)1 << jdx), shift, mutid);
+
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        Py_XDECREF(keys[i]);
+        Py_XDECREF(vals[i]);
+    }
+
+    assert(res == NULL || IS_ARRAY_NODE(res));
+    return res;
 }
 
 static MapNode *
-map_node_bitmap_assoc(MapNode_Bitmap *self,
-                      uint32_t shift, int32_t hash,
+map_node_bitmap_assoc(MapModuleState *st, MapNode_Bitmap *self,
+                      uint32_t shift, map_hash_t hash,
                       PyObject *key, PyObject *val, int* added_leaf,
                       uint64_t mutid)
 {
@@ -734,78 +1502,61 @@ map_node_bitmap_assoc(MapNode_Bitmap *self,
     */
 
     uint32_t bit = map_bitpos(hash, shift);
-    uint32_t idx = map_bitindex(self->b_bitmap, bit);
-
-    /* Bitmap node layout:
-
-    +------+------+------+------+  ---  +------+------+
-    | key1 | val1 | key2 | val2 |  ...  | keyN | valN |
-    +------+------+------+------+  ---  +------+------+
-    where `N < Py_SIZE(node)`.
-
-    The `node->b_bitmap` field is a bitmap.  For a given
-    `(shift, hash)` pair we can determine:
-
-     - If this node has the corresponding key/val slots.
-     - The index of key/val slots.
-    */
-
-    if (self->b_bitmap & bit) {
-        /* The key is set in this node */
 
-        uint32_t key_idx = 2 * idx;
-        uint32_t val_idx = key_idx + 1;
+    if (self->b_nodemap & bit) {
+        /* There are a few keys that have the same (hash, shift) pair
+           as our key: set it in the subnode. */
 
-        assert(val_idx < (size_t)Py_SIZE(self));
+        Py_ssize_t node_idx = map_node_bitmap_node_index(self, bit);
+        MapNode *node = (MapNode *)self->b_array[node_idx];
 
-        PyObject *key_or_null = self->b_array[key_idx];
-        PyObject *val_or_node = self->b_array[val_idx];
-
-        if (key_or_null == NULL) {
-            /* key is NULL.  This means that we have a few keys
-               that have the same (hash, shift) pair. */
-
-            assert(val_or_node != NULL);
+        MapNode *sub_node = map_node_assoc(
+            st, node, shift + 5, hash, key, val, added_leaf, mutid);
+        if (sub_node == NULL) {
+            return NULL;
+        }
 
-            MapNode *sub_node = map_node_assoc(
-                (MapNode *)val_or_node,
-                shift + 5, hash, key, val, added_leaf,
-                mutid);
-            if (sub_node == NULL) {
-                return NULL;
-            }
+        if (node == sub_node) {
+            Py_DECREF(sub_node);
+            Py_INCREF(self);
+            return (MapNode *)self;
+        }
 
-            if (val_or_node == (PyObject *)sub_node) {
+        if (mutid != 0 && self->b_mutid == mutid) {
+            Py_SETREF(self->b_array[node_idx], (PyObject*)sub_node);
+            Py_INCREF(self);
+            return (MapNode *)self;
+        }
+        else {
+            MapNode_Bitmap *ret = map_node_bitmap_clone(st, self, mutid);
+            if (ret == NULL) {
                 Py_DECREF(sub_node);
-                Py_INCREF(self);
-                return (MapNode *)self;
-            }
-
-            if (mutid != 0 && self->b_mutid == mutid) {
-                Py_SETREF(self->b_array[val_idx], (PyObject*)sub_node);
-                Py_INCREF(self);
-                return (MapNode *)self;
-            }
-            else {
-                MapNode_Bitmap *ret = map_node_bitmap_clone(self, mutid);
-                if (ret == NULL) {
-                    return NULL;
-                }
-                Py_SETREF(ret->b_array[val_idx], (PyObject*)sub_node);
-                return (MapNode *)ret;
+                return NULL;
             }
+            Py_SETREF(ret->b_array[node_idx], (PyObject*)sub_node);
+            return (MapNode *)ret;
         }
+    }
 
-        assert(key != NULL);
-        /* key is not NULL.  This means that we have only one other
-           key in this collection that matches our hash for this shift. */
+    if (self->b_datamap & bit) {
+        /* We have only one other key in this collection that
+           matches our hash for this shift. */
 
-        int comp_err = PyObject_RichCompareBool(key, key_or_null, Py_EQ);
-        if (comp_err < 0) {  /* exception in __eq__ */
-            return NULL;
+        Py_ssize_t key_idx = map_node_bitmap_key_index(self, bit);
+        Py_ssize_t val_idx = key_idx + 1;
+        map_hash_t other_hash = BITMAP_HASHES(self)[key_idx / 2];
+        PyObject *other_key = self->b_array[key_idx];
+        PyObject *other_val = self->b_array[val_idx];
+
+        int comp_err = 0;
+        if (other_hash == hash) {
+            comp_err = PyObject_RichCompareBool(key, other_key, Py_EQ);
+            if (comp_err < 0) {  /* exception in __eq__ */
+                return NULL;
+            }
         }
-        if (comp_err == 1) {  /* key == key_or_null */
-            if (val == val_or_node) {
+        if (comp_err == 1) {  /* key == other_key */
+            if (val == other_val) {
                 /* we already have the same key/val pair; return self. */
                 Py_INCREF(self);
                 return (MapNode *)self;
@@ -822,7 +1573,7 @@ map_node_bitmap_assoc(MapNode_Bitmap *self,
             else {
                 /* Make a new bitmap node with a replaced value,
                    and return it. */
-                MapNode_Bitmap *ret = map_node_bitmap_clone(self, mutid);
+                MapNode_Bitmap *ret = map_node_bitmap_clone(st, self, mutid);
                 if (ret == NULL) {
                     return NULL;
                 }
@@ -841,210 +1592,120 @@ map_node_bitmap_assoc(MapNode_Bitmap *self,
            a new Bitmap node.
         */
         MapNode *sub_node = map_node_new_bitmap_or_collision(
-            shift + 5,
-            key_or_null, val_or_node,  /* existing key/val */
-            hash,
-            key, val,  /* new key/val */
-            self->b_mutid
+            st, shift + 5,
+            other_hash, other_key, other_val,  /* existing key/val */
+            hash, key, val,  /* new key/val */
+            mutid
         );
         if (sub_node == NULL) {
             return NULL;
         }
 
-        if (mutid != 0 && self->b_mutid == mutid) {
-            Py_SETREF(self->b_array[key_idx], NULL);
-            Py_SETREF(self->b_array[val_idx], (PyObject *)sub_node);
-            Py_INCREF(self);
+        *added_leaf = 1;
 
-            *added_leaf = 1;
-            return (MapNode *)self;
+        if (shift > 0 && IS_COLLISION_NODE(sub_node) &&
+                map_node_bitmap_is_item(self))
+        {
+            /* `self` is a single-item node in an Array node; Collision
+               nodes take the place of such nodes instead of being
+               wrapped in them. */
+            return sub_node;
         }
-        else {
-            MapNode_Bitmap *ret = map_node_bitmap_clone(self, mutid);
-            if (ret == NULL) {
-                Py_DECREF(sub_node);
-                return NULL;
-            }
-            Py_SETREF(ret->b_array[key_idx], NULL);
-            Py_SETREF(ret->b_array[val_idx], (PyObject *)sub_node);
 
-            *added_leaf = 1;
-            return (MapNode *)ret;
-        }
+        MapNode_Bitmap *ret = map_node_bitmap_clone_with_node(
+            st, self, bit, sub_node, mutid);
+        Py_DECREF(sub_node);
+        return (MapNode *)ret;
     }
-    else {
-        /* There was no key before with the same (shift,hash). */
-
-        uint32_t n = map_bitcount(self->b_bitmap);
-
-        if (n >= 16) {
-            /* When we have a situation where we want to store more
-               than 16 nodes at one level of the tree, we no longer
-               want to use the Bitmap node with bitmap encoding.
-
-               Instead we start using an Array node, which has
-               simpler (faster) implementation at the expense of
-               having prealocated 32 pointers for its keys/values
-               pairs.
-
-               Small map objects (<30 keys) usually don't have any
-               Array nodes at all.  Between ~30 and ~400 keys map
-               objects usually have one Array node, and usually it's
-               a root node.
-            */
 
-            uint32_t jdx = map_mask(hash, shift);
-            /* 'jdx' is the index of where the new key should be added
-               in the new Array node we're about to create. */
+    /* There was no key before with the same (shift,hash). */
 
-            MapNode *empty = NULL;
-            MapNode_Array *new_node = NULL;
-            MapNode *res = NULL;
+    if (map_bitcount(self->b_datamap | self->b_nodemap) >= 16) {
+        /* When we have a situation where we want to store more
+           than 16 nodes at one level of the tree, we no longer
+           want to use the Bitmap node with bitmap encoding.
 
-            /* Create a new Array node. */
-            new_node = (MapNode_Array *)map_node_array_new(n + 1, mutid);
-            if (new_node == NULL) {
-                goto fin;
-            }
+           Instead we start using an Array node, which has
+           simpler (faster) implementation at the expense of
+           having prealocated 32 pointers for its keys/values
+           pairs.
 
-            /* Create an empty bitmap node for the next
-               map_node_assoc call. */
-            empty = map_node_bitmap_new(0, mutid);
-            if (empty == NULL) {
-                goto fin;
-            }
-
-            /* Make a new bitmap node for the key/val we're adding.
-               Set that bitmap node to new-array-node[jdx]. */
-            new_node->a_array[jdx] = map_node_assoc(
-                empty, shift + 5, hash, key, val, added_leaf, mutid);
-            if (new_node->a_array[jdx] == NULL) {
-                goto fin;
-            }
+           Small map objects (<30 keys) usually don't have any
+           Array nodes at all.  Between ~30 and ~400 keys map
+           objects usually have one Array node, and usually it's
+           a root node.
+        */
 
-            /* Copy existing key/value pairs from the current Bitmap
-               node to the new Array node we've just created. */
-            Py_ssize_t i, j;
-            for (i = 0, j = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
-                if (((self->b_bitmap >> i) & 1) != 0) {
-                    /* Ensure we don't accidentally override `jdx` element
-                       we set few lines above.
-                    */
-                    assert(new_node->a_array[i] == NULL);
-
-                    if (self->b_array[j] == NULL) {
-                        new_node->a_array[i] =
-                            (MapNode *)self->b_array[j + 1];
-                        Py_INCREF(new_node->a_array[i]);
-                    }
-                    else {
-                        int32_t rehash = map_hash(self->b_array[j]);
-                        if (rehash == -1) {
-                            goto fin;
-                        }
-
-                        new_node->a_array[i] = map_node_assoc(
-                            empty, shift + 5,
-                            rehash,
-                            self->b_array[j],
-                            self->b_array[j + 1],
-                            added_leaf,
-                            mutid);
-
-                        if (new_node->a_array[i] == NULL) {
-                            goto fin;
-                        }
-                    }
-                    j += 2;
-                }
-            }
+        *added_leaf = 1;
+        return map_node_bitmap_to_array(
+            st, self, shift, hash, key, val, mutid);
+    }
 
-            VALIDATE_ARRAY_NODE(new_node)
+    /* We have less than 16 keys at this level; let's just
+       create a new bitmap node out of this node with the
+       new key/val pair added. */
 
-            /* That's it! */
-            res = (MapNode *)new_node;
+    Py_ssize_t key_idx = 2 * (Py_ssize_t)map_bitindex(self->b_datamap, bit);
+    Py_ssize_t i;
 
-        fin:
-            Py_XDECREF(empty);
-            if (res == NULL) {
-                Py_XDECREF(new_node);
-            }
-            return res;
-        }
-        else {
-            /* We have less than 16 keys at this level; let's just
-               create a new bitmap node out of this node with the
-               new key/val pair added. */
+    *added_leaf = 1;
 
-            uint32_t key_idx = 2 * idx;
-            uint32_t val_idx = key_idx + 1;
-            uint32_t i;
+    /* Allocate new Bitmap node which can have one more key/val
+       pair in addition to what we have already. */
+    MapNode_Bitmap *new_node =
+        (MapNode_Bitmap *)map_node_bitmap_new(st, Py_SIZE(self) + 2, mutid);
+    if (new_node == NULL) {
+        return NULL;
+    }
 
-            *added_leaf = 1;
+    /* Copy all keys/values that will be before the new key/value
+       we are adding. */
+    for (i = 0; i < key_idx; i++) {
+        Py_INCREF(self->b_array[i]);
+        new_node->b_array[i] = self->b_array[i];
+    }
 
-            /* Allocate new Bitmap node which can have one more key/val
-               pair in addition to what we have already. */
-            MapNode_Bitmap *new_node =
-                (MapNode_Bitmap *)map_node_bitmap_new(2 * (n + 1), mutid);
-            if (new_node == NULL) {
-                return NULL;
-            }
+    /* Set the new key/value to the new Bitmap node. */
+    Py_INCREF(key);
+    new_node->b_array[key_idx] = key;
+    Py_INCREF(val);
+    new_node->b_array[key_idx + 1] = val;
 
-            /* Copy all keys/values that will be before the new key/value
-               we are adding. */
-            for (i = 0; i < key_idx; i++) {
-                Py_XINCREF(self->b_array[i]);
-                new_node->b_array[i] = self->b_array[i];
-            }
+    /* Copy all keys/values and subnodes that will be after the new
+       key/value we are adding. */
+    for (i = key_idx; i < Py_SIZE(self); i++) {
+        Py_INCREF(self->b_array[i]);
+        new_node->b_array[i + 2] = self->b_array[i];
+    }
 
-            /* Set the new key/value to the new Bitmap node. */
-            Py_INCREF(key);
-            new_node->b_array[key_idx] = key;
-            Py_INCREF(val);
-            new_node->b_array[val_idx] = val;
-
-            /* Copy all keys/values that will be after the new key/value
-               we are adding. */
-            assert(Py_SIZE(self) >= 0 && Py_SIZE(self) <= 32);
-            for (i = key_idx; i < (uint32_t)Py_SIZE(self); i++) {
-                Py_XINCREF(self->b_array[i]);
-                new_node->b_array[i + 2] = self->b_array[i];
-            }
+    map_node_bitmap_copy_hashes(new_node, 0, self, 0, key_idx / 2);
+    BITMAP_HASHES(new_node)[key_idx / 2] = hash;
+    map_node_bitmap_copy_hashes(
+        new_node, key_idx / 2 + 1, self, key_idx / 2,
+        map_bitcount(self->b_datamap) - key_idx / 2);
 
-            new_node->b_bitmap = self->b_bitmap | bit;
-            return (MapNode *)new_node;
-        }
-    }
+    new_node->b_datamap = self->b_datamap | bit;
+    new_node->b_nodemap = self->b_nodemap;
+    VALIDATE_BITMAP_NODE(new_node)
+    return (MapNode *)new_node;
 }
 
 static map_without_t
-map_node_bitmap_without(MapNode_Bitmap *self,
-                        uint32_t shift, int32_t hash,
+map_node_bitmap_without(MapModuleState *st, MapNode_Bitmap *self,
+                        uint32_t shift, map_hash_t hash,
                         PyObject *key,
                         MapNode **new_node,
                         uint64_t mutid)
 {
     uint32_t bit = map_bitpos(hash, shift);
-    if ((self->b_bitmap & bit) == 0) {
-        return W_NOT_FOUND;
-    }
-
-    uint32_t idx = map_bitindex(self->b_bitmap, bit);
-
-    uint32_t key_idx = 2 * idx;
-    uint32_t val_idx = key_idx + 1;
-
-    PyObject *key_or_null = self->b_array[key_idx];
-    PyObject *val_or_node = self->b_array[val_idx];
-
-    if (key_or_null == NULL) {
-        /* key == NULL means that 'value' is another tree node. */
 
+    if (self->b_nodemap & bit) {
+        Py_ssize_t node_idx = map_node_bitmap_node_index(self, bit);
         MapNode *sub_node = NULL;
         MapNode_Bitmap *target = NULL;
 
         map_without_t res = map_node_without(
-            (MapNode *)val_or_node,
+            st, (MapNode *)self->b_array[node_idx],
             shift + 5, hash, key, &sub_node,
             mutid);
 
@@ -1053,7 +1714,7 @@ map_node_bitmap_without(MapNode_Bitmap *self,
                 /* It's impossible for us to receive a W_EMPTY here:
 
                     - Array nodes are converted to Bitmap nodes when
-                      we delete 16th item from them;
+                      they are left with 16 elements;
 
                     - Collision nodes are converted to Bitmap when
                       there is one item in them;
@@ -1069,45 +1730,24 @@ map_node_bitmap_without(MapNode_Bitmap *self,
             case W_NEWNODE: {
                 assert(sub_node != NULL);
 
-                if (IS_BITMAP_NODE(sub_node)) {
+                if (IS_BITMAP_NODE(sub_node) &&
+                        map_node_bitmap_is_item((MapNode_Bitmap *)sub_node))
+                {
+                    /* A bitmap node with one key/value pair.  Just
+                       merge it into this node. */
+
                     MapNode_Bitmap *sub_tree = (MapNode_Bitmap *)sub_node;
-                    if (map_node_bitmap_count(sub_tree) == 1 &&
-                            sub_tree->b_array[0] != NULL)
-                    {
-                        /* A bitmap node with one key/value pair.  Just
-                           merge it into this node.
-
-                           Note that we don't inline Bitmap nodes that
-                           have a NULL key -- those nodes point to another
-                           tree level, and we cannot simply move tree levels
-                           up or down.
-                        */
-
-                        if (mutid != 0 && self->b_mutid == mutid) {
-                            target = self;
-                            Py_INCREF(target);
-                        }
-                        else {
-                            target = map_node_bitmap_clone(self, mutid);
-                            if (target == NULL) {
-                                Py_DECREF(sub_node);
-                                return W_ERROR;
-                            }
-                        }
-
-                        PyObject *key = sub_tree->b_array[0];
-                        PyObject *val = sub_tree->b_array[1];
-
-                        Py_INCREF(key);
-                        Py_XSETREF(target->b_array[key_idx], key);
-                        Py_INCREF(val);
-                        Py_SETREF(target->b_array[val_idx], val);
-
-                        Py_DECREF(sub_tree);
-
-                        *new_node = (MapNode *)target;
-                        return W_NEWNODE;
+                    target = map_node_bitmap_clone_with_item(
+                        st, self, bit, BITMAP_HASHES(sub_tree)[0],
+                        sub_tree->b_array[0], sub_tree->b_array[1],
+                        mutid);
+                    Py_DECREF(sub_tree);
+                    if (target == NULL) {
+                        return W_ERROR;
                     }
+
+                    *new_node = (MapNode *)target;
+                    return W_NEWNODE;
                 }
 
 #if !defined(NDEBUG)
@@ -1120,18 +1760,28 @@ map_node_bitmap_without(MapNode_Bitmap *self,
                 }
 #endif
 
+                if (shift > 0 && IS_COLLISION_NODE(sub_node) &&
+                        Py_SIZE(self) == 1)
+                {
+                    /* Collision nodes are not wrapped in otherwise
+                       empty Bitmap nodes (except for the root). */
+                    *new_node = sub_node;
+                    return W_NEWNODE;
+                }
+
                 if (mutid != 0 && self->b_mutid == mutid) {
                     target = self;
                     Py_INCREF(target);
                 }
                 else {
-                    target = map_node_bitmap_clone(self, mutid);
+                    target = map_node_bitmap_clone(st, self, mutid);
                     if (target == NULL) {
+                        Py_DECREF(sub_node);
                         return W_ERROR;
                     }
                 }
 
-                Py_SETREF(target->b_array[val_idx],
+                Py_SETREF(target->b_array[node_idx],
                           (PyObject *)sub_node);  /* borrow */
 
                 *new_node = (MapNode *)target;
@@ -1147,82 +1797,135 @@ map_node_bitmap_without(MapNode_Bitmap *self,
                 abort();
         }
     }
-    else {
-        /* We have a regular key/value pair */
 
-        int cmp = PyObject_RichCompareBool(key_or_null, key, Py_EQ);
-        if (cmp < 0) {
-            return W_ERROR;
-        }
-        if (cmp == 0) {
-            return W_NOT_FOUND;
-        }
+    if ((self->b_datamap & bit) == 0) {
+        return W_NOT_FOUND;
+    }
 
-        if (map_node_bitmap_count(self) == 1) {
-            return W_EMPTY;
-        }
+    /* We have a regular key/value pair */
 
-        *new_node = (MapNode *)
-            map_node_bitmap_clone_without(self, bit, mutid);
-        if (*new_node == NULL) {
-            return W_ERROR;
-        }
+    Py_ssize_t key_idx = map_node_bitmap_key_index(self, bit);
+    if (BITMAP_HASHES(self)[key_idx / 2] != hash) {
+        return W_NOT_FOUND;
+    }
 
+    int cmp = PyObject_RichCompareBool(self->b_array[key_idx], key, Py_EQ);
+    if (cmp < 0) {
+        return W_ERROR;
+    }
+    if (cmp == 0) {
+        return W_NOT_FOUND;
+    }
+
+    if (Py_SIZE(self) == 2) {
+        return W_EMPTY;
+    }
+
+    if (shift > 0 && Py_SIZE(self) == 3 &&
+            IS_COLLISION_NODE(self->b_array[2]))
+    {
+        /* Only a Collision node would be left in this node. */
+        Py_INCREF(self->b_array[2]);
+        *new_node = (MapNode *)self->b_array[2];
         return W_NEWNODE;
     }
+
+    *new_node = (MapNode *)
+        map_node_bitmap_clone_without(st, self, bit, mutid);
+    if (*new_node == NULL) {
+        return W_ERROR;
+    }
+
+    return W_NEWNODE;
 }
 
 static map_find_t
 map_node_bitmap_find(MapNode_Bitmap *self,
-                     uint32_t shift, int32_t hash,
+                     uint32_t shift, map_hash_t hash,
                      PyObject *key, PyObject **val)
 {
     /* Lookup a key in a Bitmap node. */
 
     uint32_t bit = map_bitpos(hash, shift);
-    uint32_t idx;
-    uint32_t key_idx;
-    uint32_t val_idx;
-    PyObject *key_or_null;
-    PyObject *val_or_node;
+    Py_ssize_t key_idx;
     int comp_err;
 
-    if ((self->b_bitmap & bit) == 0) {
-        return F_NOT_FOUND;
-    }
-
-    idx = map_bitindex(self->b_bitmap, bit);
-    key_idx = idx * 2;
-    val_idx = key_idx + 1;
-
-    assert(val_idx < (size_t)Py_SIZE(self));
+    if (self->b_datamap & bit) {
+        /* We have only one key -- a potential match.  Let's compare if
+           the key we are looking at is equal to the key we are looking
+           for. */
+        key_idx = map_node_bitmap_key_index(self, bit);
+        if (BITMAP_HASHES(self)[key_idx / 2] != hash) {
+            /* Keys with different hashes can't be equal. */
+            return F_NOT_FOUND;
+        }
 
-    key_or_null = self->b_array[key_idx];
-    val_or_node = self->b_array[val_idx];
+        assert(key != NULL);
+        comp_err = PyObject_RichCompareBool(
+            key, self->b_array[key_idx], Py_EQ);
+        if (comp_err < 0) {  /* exception in __eq__ */
+            return F_ERROR;
+        }
+        if (comp_err == 1) {  /* key == self->b_array[key_idx] */
+            *val = self->b_array[key_idx + 1];
+            return F_FOUND;
+        }
 
-    if (key_or_null == NULL) {
-        /* There are a few keys that have the same hash at the current shift
-           that match our key.  Dispatch the lookup further down the tree. */
-        assert(val_or_node != NULL);
-        return map_node_find((MapNode *)val_or_node,
-                             shift + 5, hash, key, val);
+        return F_NOT_FOUND;
     }
 
-    /* We have only one key -- a potential match.  Let's compare if the
-       key we are looking at is equal to the key we are looking for. */
-    assert(key != NULL);
-    comp_err = PyObject_RichCompareBool(key, key_or_null, Py_EQ);
-    if (comp_err < 0) {  /* exception in __eq__ */
-        return F_ERROR;
-    }
-    if (comp_err == 1) {  /* key == key_or_null */
-        *val = val_or_node;
-        return F_FOUND;
+    if (self->b_nodemap & bit) {
+        /* There are a few keys that have the same hash at the current
+           shift that match our key.  Dispatch the lookup further down
+           the tree. */
+        return map_node_find(
+            (MapNode *)self->b_array[map_node_bitmap_node_index(self, bit)],
+            shift + 5, hash, key, val);
     }
 
     return F_NOT_FOUND;
 }
 
+static int
+map_node_bitmap_items_hash(MapNode_Bitmap *self, Py_uhash_t *hash)
+{
+    /* Compute the XOR of hashes of all key/value pairs in this node
+       and its subtrees.  The result is memoized in the node. */
+
+    Py_uhash_t h = 0;
+    Py_uhash_t item_hash;
+    Py_ssize_t data_size = map_node_bitmap_data_size(self);
+    Py_ssize_t i;
+
+    Py_hash_t cached_hash = MAP_LOAD_HASH(self->b_cached_hash);
+    if (cached_hash != -1) {
+        *hash = (Py_uhash_t)cached_hash;
+        return 0;
+    }
+
+    for (i = 0; i < data_size; i += 2) {
+        if (map_item_hash(self->b_array[i], self->b_array[i + 1],
+                          &item_hash))
+        {
+            return -1;
+        }
+        h ^= item_hash;
+    }
+
+    for (; i < Py_SIZE(self); i++) {
+        if (map_node_items_hash((MapNode *)self->b_array[i], &item_hash)) {
+            return -1;
+        }
+        h ^= item_hash;
+    }
+
+    /* -1 is used to mark nodes without a cached hash; in the
+       unlikely case of an actual -1 we'll just recompute it. */
+    MAP_STORE_HASH(self->b_cached_hash, (Py_hash_t)h);
+    *hash = h;
+    return 0;
+}
+
 static int
 map_node_bitmap_traverse(MapNode_Bitmap *self, visitproc visit, void *arg)
 {
@@ -1230,6 +1933,8 @@ map_node_bitmap_traverse(MapNode_Bitmap *self, visitproc visit, void *arg)
 
     Py_ssize_t i;
 
+    MAP_VISIT_TYPE(self);
+
     for (i = Py_SIZE(self); --i >= 0; ) {
         Py_VISIT(self->b_array[i]);
     }
@@ -1242,11 +1947,13 @@ map_node_bitmap_dealloc(MapNode_Bitmap *self)
 {
     /* Bitmap's tp_dealloc */
 
+    PyTypeObject *tp = Py_TYPE(self);
+    MapModuleState *st = map_dealloc_state(tp);
     Py_ssize_t len = Py_SIZE(self);
     Py_ssize_t i;
 
     PyObject_GC_UnTrack(self);
-    Py_TRASHCAN_SAFE_BEGIN(self)
+    MAP_TRASHCAN_BEGIN(self, map_node_bitmap_dealloc)
 
     if (len > 0) {
         i = len;
@@ -1255,8 +1962,20 @@ map_node_bitmap_dealloc(MapNode_Bitmap *self)
         }
     }
 
-    Py_TYPE(self)->tp_free((PyObject *)self);
-    Py_TRASHCAN_SAFE_END(self)
+    if (MAP_USE_FREELISTS && st != NULL &&
+            len > 0 && len <= MAP_BITMAP_FREELIST_MAXSIZE &&
+            st->ms_bitmap_freelist_len[len - 1] < MAP_BITMAP_FREELIST_MAXLEN)
+    {
+        self->b_array[0] = (PyObject *)st->ms_bitmap_freelist[len - 1];
+        st->ms_bitmap_freelist[len - 1] = self;
+        st->ms_bitmap_freelist_len[len - 1]++;
+    }
+    else {
+        tp->tp_free((PyObject *)self);
+    }
+    MAP_DECREF_TYPE(tp);
+
+    MAP_TRASHCAN_END(self)
 }
 
 static int
@@ -1265,60 +1984,75 @@ map_node_bitmap_dump(MapNode_Bitmap *node,
 {
     /* Debug build: __dump__() method implementation for Bitmap nodes. */
 
+    Py_ssize_t data_size = map_node_bitmap_data_size(node);
     Py_ssize_t i;
     PyObject *tmp1;
     PyObject *tmp2;
+    PyObject *tmp3;
 
     if (_map_dump_ident(writer, level + 1)) {
         goto error;
     }
 
     if (_map_dump_format(writer, "BitmapNode(size=%zd count=%zd ",
-                         Py_SIZE(node), Py_SIZE(node) / 2))
+                         Py_SIZE(node), data_size / 2))
     {
         goto error;
     }
 
-    tmp1 = PyLong_FromUnsignedLong(node->b_bitmap);
+    tmp1 = PyLong_FromUnsignedLong(node->b_datamap | node->b_nodemap);
     if (tmp1 == NULL) {
         goto error;
     }
-    tmp2 = _PyLong_Format(tmp1, 2);
+    tmp2 = PyNumber_ToBase(tmp1, 2);
     Py_DECREF(tmp1);
     if (tmp2 == NULL) {
         goto error;
     }
-    if (_map_dump_format(writer, "bitmap=%S id=%p):\n", tmp2, node)) {
+    tmp1 = PyLong_FromUnsignedLong(node->b_nodemap);
+    if (tmp1 == NULL) {
+        Py_DECREF(tmp2);
+        goto error;
+    }
+    tmp3 = PyNumber_ToBase(tmp1, 2);
+    Py_DECREF(tmp1);
+    if (tmp3 == NULL) {
+        Py_DECREF(tmp2);
+        goto error;
+    }
+    if (_map_dump_format(writer, "bitmap=%S nodemap=%S id=%p):\n",
+                         tmp2, tmp3, node))
+    {
         Py_DECREF(tmp2);
+        Py_DECREF(tmp3);
         goto error;
     }
     Py_DECREF(tmp2);
+    Py_DECREF(tmp3);
 
-    for (i = 0; i < Py_SIZE(node); i += 2) {
-        PyObject *key_or_null = node->b_array[i];
-        PyObject *val_or_node = node->b_array[i + 1];
-
+    for (i = 0; i < data_size; i += 2) {
         if (_map_dump_ident(writer, level + 2)) {
             goto error;
         }
 
-        if (key_or_null == NULL) {
-            if (_map_dump_format(writer, "NULL:\n")) {
-                goto error;
-            }
+        if (_map_dump_format(writer, "%R: %R\n", node->b_array[i],
+                             node->b_array[i + 1]))
+        {
+            goto error;
+        }
+    }
 
-            if (map_node_dump((MapNode *)val_or_node,
-                              writer, level + 2))
-            {
-                goto error;
-            }
+    for (; i < Py_SIZE(node); i++) {
+        if (_map_dump_ident(writer, level + 2)) {
+            goto error;
         }
-        else {
-            if (_map_dump_format(writer, "%R: %R", key_or_null,
-                                 val_or_node))
-            {
-                goto error;
-            }
+
+        if (_map_dump_format(writer, "NULL:\n")) {
+            goto error;
+        }
+
+        if (map_node_dump((MapNode *)node->b_array[i], writer, level + 2)) {
+            goto error;
         }
 
         if (_map_dump_format(writer, "\n")) {
@@ -1332,11 +2066,71 @@ error:
 }
 
 
+static void
+map_node_bitmap_stats(MapNode_Bitmap *node, int level, MapStats *stats)
+{
+    Py_ssize_t data_size = map_node_bitmap_data_size(node);
+    Py_ssize_t i;
+
+    stats->s_bitmap_nodes++;
+    stats->s_slots += Py_SIZE(node) - data_size / 2;
+    stats->s_depths[level] += data_size / 2;
+    /* Room for the key hashes is allocated after the array. */
+    stats->s_bytes += Py_TYPE(node)->tp_basicsize +
+        (Py_SIZE(node) + BITMAP_HASH_ITEMS(Py_SIZE(node))) *
+        Py_TYPE(node)->tp_itemsize;
+
+    for (i = data_size; i < Py_SIZE(node); i++) {
+        map_node_stats((MapNode *)node->b_array[i], level + 1, stats);
+    }
+}
+
+
 /////////////////////////////////// Collision Node
 
 
+/* Collision nodes keep their key/value pairs sorted by the full
+   Python hash of the keys; the hashes are stored in the node right
+   after the key/value pairs:
+
+  +----+----+----+----+--  --+----+----+----+----+--  --+
+  | k1 | v1 | k2 | v2 |  ..  | kN | vN | h1 | h2 |  ..  | hN
+  +----+----+----+----+--  --+----+----+----+----+--  --+
+
+   When Python's 64-bit hashes are folded into 32 bits, keys with
+   different hashes can end up in the same Collision node.  Lookups
+   find them with a binary search, and only keys with equal full
+   hashes are compared with `==`.  Otherwise a node with many
+   colliding keys (possibly chosen by an attacker) would make every
+   lookup call `__eq__` for all of them.
+
+   Only lookups (and building a Map from a collection) are sped up:
+   `map_node_collision_assoc` and `map_node_collision_without` still
+   copy the whole node, so set() and delete() of a key in a node of
+   N colliding keys take O(N) time.  Builds with MAP_HASH_BITS == 64
+   index the trie with the full hashes and only put keys with equal
+   full hashes in Collision nodes.
+*/
+#define COLLISION_HASHES(node) \
+    ((Py_hash_t *)&(node)->c_array[Py_SIZE(node)])
+
+
+static inline Py_hash_t
+map_collision_hash(PyObject *key, map_hash_t hash)
+{
+    /* Return the full Python hash of "key" given its trie "hash". */
+
+#if SIZEOF_PY_HASH_T <= 4 || MAP_HASH_BITS == 64
+    (void)key;
+    return (Py_hash_t)hash;
+#else
+    return PyObject_Hash(key);
+#endif
+}
+
 static MapNode *
-map_node_collision_new(int32_t hash, Py_ssize_t size, uint64_t mutid)
+map_node_collision_new(MapModuleState *st,
+                       map_hash_t hash, Py_ssize_t size, uint64_t mutid)
 {
     /* Create a new Collision node. */
 
@@ -1346,8 +2140,11 @@ map_node_collision_new(int32_t hash, Py_ssize_t size, uint64_t mutid)
     assert(size >= 4);
     assert(size % 2 == 0);
 
+    /* Hashes are stored in the items following the key/value pairs. */
+    Py_BUILD_ASSERT(sizeof(Py_hash_t) == sizeof(PyObject *));
+
     node = PyObject_GC_NewVar(
-        MapNode_Collision, &_Map_CollisionNode_Type, size);
+        MapNode_Collision, st->ms_collision_node_type, size + size / 2);
     if (node == NULL) {
         return NULL;
     }
@@ -1356,10 +2153,11 @@ map_node_collision_new(int32_t hash, Py_ssize_t size, uint64_t mutid)
         node->c_array[i] = NULL;
     }
 
-    Py_SIZE(node) = size;
+    Py_SET_SIZE(node, size);
     node->c_hash = hash;
 
     node->c_mutid = mutid;
+    node->c_cached_hash = -1;
 
     PyObject_GC_Track(node);
     return (MapNode *)node;
@@ -1367,34 +2165,86 @@ map_node_collision_new(int32_t hash, Py_ssize_t size, uint64_t mutid)
 
 static map_find_t
 map_node_collision_find_index(MapNode_Collision *self, PyObject *key,
-                              Py_ssize_t *idx)
+                              Py_hash_t key_hash, Py_ssize_t *idx)
 {
-    /* Lookup `key` in the Collision node `self`.  Set the index of the
-       found key to 'idx'. */
-
-    Py_ssize_t i;
-    PyObject *el;
-
-    for (i = 0; i < Py_SIZE(self); i += 2) {
-        el = self->c_array[i];
+    /* Lookup `key` with the full hash `key_hash` in the Collision node
+       `self`.  Set the index of the found key to 'idx'; if the key is
+       not found, set 'idx' to the index where it should be inserted. */
+
+    Py_hash_t *hashes = COLLISION_HASHES(self);
+    Py_ssize_t count = map_node_collision_count(self);
+    Py_ssize_t lo = 0;
+    Py_ssize_t hi = count;
+    Py_ssize_t mid;
+
+    while (lo < hi) {
+        mid = lo + (hi - lo) / 2;
+        if (hashes[mid] < key_hash) {
+            lo = mid + 1;
+        }
+        else {
+            hi = mid;
+        }
+    }
 
-        assert(el != NULL);
-        int cmp = PyObject_RichCompareBool(key, el, Py_EQ);
+    for (; lo < count && hashes[lo] == key_hash; lo++) {
+        assert(self->c_array[lo * 2] != NULL);
+        int cmp = PyObject_RichCompareBool(
+            key, self->c_array[lo * 2], Py_EQ);
         if (cmp < 0) {
             return F_ERROR;
         }
         if (cmp == 1) {
-            *idx = i;
+            *idx = lo * 2;
             return F_FOUND;
         }
     }
 
+    *idx = lo * 2;
     return F_NOT_FOUND;
 }
 
+static void
+map_node_collision_copy(MapNode_Collision *dst, Py_ssize_t dst_idx,
+                        MapNode_Collision *src, Py_ssize_t src_idx,
+                        Py_ssize_t len)
+{
+    /* Copy `len` array items (two per key/value pair) starting at
+       `src_idx` in `src` to `dst` at `dst_idx`, along with the hashes
+       of the keys. */
+
+    Py_ssize_t i;
+
+    assert(dst_idx % 2 == 0 && src_idx % 2 == 0 && len % 2 == 0);
+    assert(dst_idx + len <= Py_SIZE(dst));
+    assert(src_idx + len <= Py_SIZE(src));
+
+    for (i = 0; i < len; i++) {
+        Py_INCREF(src->c_array[src_idx + i]);
+        dst->c_array[dst_idx + i] = src->c_array[src_idx + i];
+    }
+
+    for (i = 0; i < len / 2; i++) {
+        COLLISION_HASHES(dst)[dst_idx / 2 + i] =
+            COLLISION_HASHES(src)[src_idx / 2 + i];
+    }
+}
+
+static inline void
+map_node_collision_set(MapNode_Collision *node, Py_ssize_t idx,
+                       Py_hash_t key_hash, PyObject *key, PyObject *val)
+{
+    assert(node->c_array[idx] == NULL);
+    Py_INCREF(key);
+    node->c_array[idx] = key;
+    Py_INCREF(val);
+    node->c_array[idx + 1] = val;
+    COLLISION_HASHES(node)[idx / 2] = key_hash;
+}
+
 static MapNode *
-map_node_collision_assoc(MapNode_Collision *self,
-                         uint32_t shift, int32_t hash,
+map_node_collision_assoc(MapModuleState *st, MapNode_Collision *self,
+                         uint32_t shift, map_hash_t hash,
                          PyObject *key, PyObject *val, int* added_leaf,
                          uint64_t mutid)
 {
@@ -1408,10 +2258,14 @@ map_node_collision_assoc(MapNode_Collision *self,
         Py_ssize_t key_idx = -1;
         map_find_t found;
         MapNode_Collision *new_node;
-        Py_ssize_t i;
+
+        Py_hash_t key_hash = map_collision_hash(key, hash);
+        if (key_hash == -1) {
+            return NULL;
+        }
 
         /* Let's try to lookup the new 'key', maybe we already have it. */
-        found = map_node_collision_find_index(self, key, &key_idx);
+        found = map_node_collision_find_index(self, key, key_hash, &key_idx);
         switch (found) {
             case F_ERROR:
                 /* Exception. */
@@ -1419,23 +2273,20 @@ map_node_collision_assoc(MapNode_Collision *self,
 
             case F_NOT_FOUND:
                 /* This is a totally new key.  Clone the current node,
-                   add a new key/value to the cloned node. */
+                   inserting the new key/value at 'key_idx' to keep
+                   the keys sorted by their hashes. */
 
                 new_node = (MapNode_Collision *)map_node_collision_new(
-                    self->c_hash, Py_SIZE(self) + 2, mutid);
+                    st, self->c_hash, Py_SIZE(self) + 2, mutid);
                 if (new_node == NULL) {
                     return NULL;
                 }
 
-                for (i = 0; i < Py_SIZE(self); i++) {
-                    Py_INCREF(self->c_array[i]);
-                    new_node->c_array[i] = self->c_array[i];
-                }
-
-                Py_INCREF(key);
-                new_node->c_array[i] = key;
-                Py_INCREF(val);
-                new_node->c_array[i + 1] = val;
+                map_node_collision_copy(new_node, 0, self, 0, key_idx);
+                map_node_collision_set(new_node, key_idx, key_hash, key, val);
+                map_node_collision_copy(
+                    new_node, key_idx + 2,
+                    self, key_idx, Py_SIZE(self) - key_idx);
 
                 *added_leaf = 1;
                 return (MapNode *)new_node;
@@ -1463,16 +2314,14 @@ map_node_collision_assoc(MapNode_Collision *self,
                 else {
                     /* Create a new Collision node.*/
                     new_node = (MapNode_Collision *)map_node_collision_new(
-                        self->c_hash, Py_SIZE(self), mutid);
+                        st, self->c_hash, Py_SIZE(self), mutid);
                     if (new_node == NULL) {
                         return NULL;
                     }
 
                     /* Copy all elements of the old node to the new one. */
-                    for (i = 0; i < Py_SIZE(self); i++) {
-                        Py_INCREF(self->c_array[i]);
-                        new_node->c_array[i] = self->c_array[i];
-                    }
+                    map_node_collision_copy(
+                        new_node, 0, self, 0, Py_SIZE(self));
                 }
 
                 /* Replace the old value with the new value for the our key. */
@@ -1498,16 +2347,16 @@ map_node_collision_assoc(MapNode_Collision *self,
         MapNode_Bitmap *new_node;
         MapNode *assoc_res;
 
-        new_node = (MapNode_Bitmap *)map_node_bitmap_new(2, mutid);
+        new_node = (MapNode_Bitmap *)map_node_bitmap_new(st, 1, mutid);
         if (new_node == NULL) {
             return NULL;
         }
-        new_node->b_bitmap = map_bitpos(self->c_hash, shift);
+        new_node->b_nodemap = map_bitpos(self->c_hash, shift);
         Py_INCREF(self);
-        new_node->b_array[1] = (PyObject*) self;
+        new_node->b_array[0] = (PyObject*) self;
 
         assoc_res = map_node_bitmap_assoc(
-            new_node, shift, hash, key, val, added_leaf, mutid);
+            st, new_node, shift, hash, key, val, added_leaf, mutid);
         Py_DECREF(new_node);
         return assoc_res;
     }
@@ -1520,8 +2369,8 @@ map_node_collision_count(MapNode_Collision *node)
 }
 
 static map_without_t
-map_node_collision_without(MapNode_Collision *self,
-                           uint32_t shift, int32_t hash,
+map_node_collision_without(MapModuleState *st, MapNode_Collision *self,
+                           uint32_t shift, map_hash_t hash,
                            PyObject *key,
                            MapNode **new_node,
                            uint64_t mutid)
@@ -1530,8 +2379,14 @@ map_node_collision_without(MapNode_Collision *self,
         return W_NOT_FOUND;
     }
 
+    Py_hash_t key_hash = map_collision_hash(key, hash);
+    if (key_hash == -1) {
+        return W_ERROR;
+    }
+
     Py_ssize_t key_idx = -1;
-    map_find_t found = map_node_collision_find_index(self, key, &key_idx);
+    map_find_t found = map_node_collision_find_index(
+        self, key, key_hash, &key_idx);
 
     switch (found) {
         case F_ERROR:
@@ -1560,29 +2415,14 @@ map_node_collision_without(MapNode_Collision *self,
                    with one key shouldn't exist, so convert it to a
                    Bitmap node.
                 */
-                MapNode_Bitmap *node = (MapNode_Bitmap *)
-                    map_node_bitmap_new(2, mutid);
-                if (node == NULL) {
+                assert(key_idx == 0 || key_idx == 2);
+                *new_node = map_node_bitmap_new_item(
+                    st, shift, hash,
+                    self->c_array[2 - key_idx], self->c_array[3 - key_idx],
+                    mutid);
+                if (*new_node == NULL) {
                     return W_ERROR;
                 }
-
-                if (key_idx == 0) {
-                    Py_INCREF(self->c_array[2]);
-                    node->b_array[0] = self->c_array[2];
-                    Py_INCREF(self->c_array[3]);
-                    node->b_array[1] = self->c_array[3];
-                }
-                else {
-                    assert(key_idx == 2);
-                    Py_INCREF(self->c_array[0]);
-                    node->b_array[0] = self->c_array[0];
-                    Py_INCREF(self->c_array[1]);
-                    node->b_array[1] = self->c_array[1];
-                }
-
-                node->b_bitmap = map_bitpos(hash, shift);
-
-                *new_node = (MapNode *)node;
                 return W_NEWNODE;
             }
 
@@ -1590,21 +2430,16 @@ map_node_collision_without(MapNode_Collision *self,
                less key/value pair */
             MapNode_Collision *new = (MapNode_Collision *)
                 map_node_collision_new(
-                    self->c_hash, Py_SIZE(self) - 2, mutid);
+                    st, self->c_hash, Py_SIZE(self) - 2, mutid);
             if (new == NULL) {
                 return W_ERROR;
             }
 
             /* Copy all other keys from `self` to `new` */
-            Py_ssize_t i;
-            for (i = 0; i < key_idx; i++) {
-                Py_INCREF(self->c_array[i]);
-                new->c_array[i] = self->c_array[i];
-            }
-            for (i = key_idx + 2; i < Py_SIZE(self); i++) {
-                Py_INCREF(self->c_array[i]);
-                new->c_array[i - 2] = self->c_array[i];
-            }
+            map_node_collision_copy(new, 0, self, 0, key_idx);
+            map_node_collision_copy(
+                new, key_idx,
+                self, key_idx + 2, Py_SIZE(self) - key_idx - 2);
 
             *new_node = (MapNode*)new;
             return W_NEWNODE;
@@ -1616,7 +2451,7 @@ map_node_collision_without(MapNode_Collision *self,
 
 static map_find_t
 map_node_collision_find(MapNode_Collision *self,
-                        uint32_t shift, int32_t hash,
+                        uint32_t shift, map_hash_t hash,
                         PyObject *key, PyObject **val)
 {
     /* Lookup `key` in the Collision node `self`.  Set the value
@@ -1625,7 +2460,16 @@ map_node_collision_find(MapNode_Collision *self,
     Py_ssize_t idx = -1;
     map_find_t res;
 
-    res = map_node_collision_find_index(self, key, &idx);
+    if (hash != self->c_hash) {
+        return F_NOT_FOUND;
+    }
+
+    Py_hash_t key_hash = map_collision_hash(key, hash);
+    if (key_hash == -1) {
+        return F_ERROR;
+    }
+
+    res = map_node_collision_find_index(self, key, key_hash, &idx);
     if (res == F_ERROR || res == F_NOT_FOUND) {
         return res;
     }
@@ -1640,6 +2484,33 @@ map_node_collision_find(MapNode_Collision *self,
 }
 
 
+static int
+map_node_collision_items_hash(MapNode_Collision *self, Py_uhash_t *hash)
+{
+    Py_uhash_t h = 0;
+    Py_uhash_t item_hash;
+    Py_ssize_t i;
+
+    Py_hash_t cached_hash = MAP_LOAD_HASH(self->c_cached_hash);
+    if (cached_hash != -1) {
+        *hash = (Py_uhash_t)cached_hash;
+        return 0;
+    }
+
+    for (i = 0; i < Py_SIZE(self); i += 2) {
+        if (map_item_hash(self->c_array[i], self->c_array[i + 1],
+                          &item_hash))
+        {
+            return -1;
+        }
+        h ^= item_hash;
+    }
+
+    MAP_STORE_HASH(self->c_cached_hash, (Py_hash_t)h);
+    *hash = h;
+    return 0;
+}
+
 static int
 map_node_collision_traverse(MapNode_Collision *self,
                             visitproc visit, void *arg)
@@ -1648,6 +2519,8 @@ map_node_collision_traverse(MapNode_Collision *self,
 
     Py_ssize_t i;
 
+    MAP_VISIT_TYPE(self);
+
     for (i = Py_SIZE(self); --i >= 0; ) {
         Py_VISIT(self->c_array[i]);
     }
@@ -1660,10 +2533,11 @@ map_node_collision_dealloc(MapNode_Collision *self)
 {
     /* Collision's tp_dealloc */
 
+    PyTypeObject *tp = Py_TYPE(self);
     Py_ssize_t len = Py_SIZE(self);
 
     PyObject_GC_UnTrack(self);
-    Py_TRASHCAN_SAFE_BEGIN(self)
+    MAP_TRASHCAN_BEGIN(self, map_node_collision_dealloc)
 
     if (len > 0) {
 
@@ -1672,8 +2546,9 @@ map_node_collision_dealloc(MapNode_Collision *self)
         }
     }
 
-    Py_TYPE(self)->tp_free((PyObject *)self);
-    Py_TRASHCAN_SAFE_END(self)
+    tp->tp_free((PyObject *)self);
+    MAP_DECREF_TYPE(tp);
+    MAP_TRASHCAN_END(self)
 }
 
 static int
@@ -1713,16 +2588,27 @@ error:
 }
 
 
+static void
+map_node_collision_stats(MapNode_Collision *node, int level,
+                         MapStats *stats)
+{
+    stats->s_collision_nodes++;
+    stats->s_depths[level] += Py_SIZE(node) / 2;
+    stats->s_bytes += Py_TYPE(node)->tp_basicsize +
+        Py_SIZE(node) * Py_TYPE(node)->tp_itemsize;
+}
+
+
 /////////////////////////////////// Array Node
 
 
 static MapNode *
-map_node_array_new(Py_ssize_t count, uint64_t mutid)
+map_node_array_new(MapModuleState *st, Py_ssize_t count, uint64_t mutid)
 {
     Py_ssize_t i;
 
     MapNode_Array *node = PyObject_GC_New(
-        MapNode_Array, &_Map_ArrayNode_Type);
+        MapNode_Array, st->ms_array_node_type);
     if (node == NULL) {
         return NULL;
     }
@@ -1733,13 +2619,14 @@ map_node_array_new(Py_ssize_t count, uint64_t mutid)
 
     node->a_count = count;
     node->a_mutid = mutid;
+    node->a_cached_hash = -1;
 
     PyObject_GC_Track(node);
     return (MapNode *)node;
 }
 
 static MapNode_Array *
-map_node_array_clone(MapNode_Array *node, uint64_t mutid)
+map_node_array_clone(MapModuleState *st, MapNode_Array *node, uint64_t mutid)
 {
     MapNode_Array *clone;
     Py_ssize_t i;
@@ -1748,7 +2635,7 @@ map_node_array_clone(MapNode_Array *node, uint64_t mutid)
     assert(node->a_count <= HAMT_ARRAY_NODE_SIZE);
 
     /* Create a new Array node. */
-    clone = (MapNode_Array *)map_node_array_new(node->a_count, mutid);
+    clone = (MapNode_Array *)map_node_array_new(st, node->a_count, mutid);
     if (clone == NULL) {
         return NULL;
     }
@@ -1766,8 +2653,8 @@ map_node_array_clone(MapNode_Array *node, uint64_t mutid)
 }
 
 static MapNode *
-map_node_array_assoc(MapNode_Array *self,
-                     uint32_t shift, int32_t hash,
+map_node_array_assoc(MapModuleState *st, MapNode_Array *self,
+                     uint32_t shift, map_hash_t hash,
                      PyObject *key, PyObject *val, int* added_leaf,
                      uint64_t mutid)
 {
@@ -1788,23 +2675,12 @@ map_node_array_assoc(MapNode_Array *self,
         /* There's no child node for the given hash.  Create a new
            Bitmap node for this key. */
 
-        MapNode_Bitmap *empty = NULL;
-
-        /* Get an empty Bitmap node to work with. */
-        empty = (MapNode_Bitmap *)map_node_bitmap_new(0, mutid);
-        if (empty == NULL) {
-            return NULL;
-        }
-
-        /* Set key/val to the newly created empty Bitmap, thus
-           creating a new Bitmap node with our key/value pair. */
-        child_node = map_node_bitmap_assoc(
-            empty,
-            shift + 5, hash, key, val, added_leaf, mutid);
-        Py_DECREF(empty);
+        child_node = map_node_bitmap_new_item(
+            st, shift + 5, hash, key, val, mutid);
         if (child_node == NULL) {
             return NULL;
         }
+        *added_leaf = 1;
 
         if (mutid != 0 && self->a_mutid == mutid) {
             new_node = self;
@@ -1814,7 +2690,7 @@ map_node_array_assoc(MapNode_Array *self,
         else {
             /* Create a new Array node. */
             new_node = (MapNode_Array *)map_node_array_new(
-                self->a_count + 1, mutid);
+                st, self->a_count + 1, mutid);
             if (new_node == NULL) {
                 Py_DECREF(child_node);
                 return NULL;
@@ -1837,7 +2713,7 @@ map_node_array_assoc(MapNode_Array *self,
            Set the key to it./ */
 
         child_node = map_node_assoc(
-            node, shift + 5, hash, key, val, added_leaf, mutid);
+            st, node, shift + 5, hash, key, val, added_leaf, mutid);
         if (child_node == NULL) {
             return NULL;
         }
@@ -1851,7 +2727,7 @@ map_node_array_assoc(MapNode_Array *self,
             Py_INCREF(self);
         }
         else {
-            new_node = map_node_array_clone(self, mutid);
+            new_node = map_node_array_clone(st, self, mutid);
         }
 
         if (new_node == NULL) {
@@ -1867,8 +2743,8 @@ map_node_array_assoc(MapNode_Array *self,
 }
 
 static map_without_t
-map_node_array_without(MapNode_Array *self,
-                       uint32_t shift, int32_t hash,
+map_node_array_without(MapModuleState *st, MapNode_Array *self,
+                       uint32_t shift, map_hash_t hash,
                        PyObject *key,
                        MapNode **new_node,
                        uint64_t mutid)
@@ -1883,7 +2759,7 @@ map_node_array_without(MapNode_Array *self,
     MapNode *sub_node = NULL;
     MapNode_Array *target = NULL;
     map_without_t res = map_node_without(
-        (MapNode *)node,
+        st, (MapNode *)node,
         shift + 5, hash, key, &sub_node, mutid);
 
     switch (res) {
@@ -1903,7 +2779,7 @@ map_node_array_without(MapNode_Array *self,
                 Py_INCREF(self);
             }
             else {
-                target = map_node_array_clone(self, mutid);
+                target = map_node_array_clone(st, self, mutid);
                 if (target == NULL) {
                     Py_DECREF(sub_node);
                     return W_ERROR;
@@ -1926,12 +2802,11 @@ map_node_array_without(MapNode_Array *self,
                 return W_EMPTY;
             }
 
-            if (new_count >= 16) {
+            if (new_count > 16) {
                 /* We convert Bitmap nodes to Array nodes, when a
-                   Bitmap node needs to store more than 15 key/value
-                   pairs.  So we will create a new Array node if we
-                   the number of key/values after deletion is still
-                   greater than 15.
+                   Bitmap node needs to store more than 16 elements.
+                   So we will create a new Array node if the number
+                   of elements after deletion is still greater than 16.
                 */
 
                 if (mutid != 0 && self->a_mutid == mutid) {
@@ -1939,7 +2814,7 @@ map_node_array_without(MapNode_Array *self,
                     Py_INCREF(self);
                 }
                 else {
-                    target = map_node_array_clone(self, mutid);
+                    target = map_node_array_clone(st, self, mutid);
                     if (target == NULL) {
                         return W_ERROR;
                     }
@@ -1952,85 +2827,41 @@ map_node_array_without(MapNode_Array *self,
                 return W_NEWNODE;
             }
 
-            /* New Array node would have less than 16 key/value
-               pairs.  We need to create a replacement Bitmap node. */
+            /* New Array node would have 16 elements or less.  We need
+               to create a replacement Bitmap node; single-item Bitmap
+               children are inlined into it. */
 
-            Py_ssize_t bitmap_size = new_count * 2;
+            map_hash_t hashes[HAMT_ARRAY_NODE_SIZE];
+            PyObject *keys[HAMT_ARRAY_NODE_SIZE];
+            PyObject *vals[HAMT_ARRAY_NODE_SIZE];
             uint32_t bitmap = 0;
 
-            MapNode_Bitmap *new = (MapNode_Bitmap *)
-                map_node_bitmap_new(bitmap_size, mutid);
-            if (new == NULL) {
-                return W_ERROR;
-            }
-
-            Py_ssize_t new_i = 0;
             for (uint32_t i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
-                if (i == idx) {
-                    /* Skip the node we are deleting. */
-                    continue;
-                }
+                keys[i] = NULL;
+                vals[i] = NULL;
 
-                MapNode *node = self->a_array[i];
-                if (node == NULL) {
-                    /* Skip any missing nodes. */
+                if (i == idx || self->a_array[i] == NULL) {
+                    /* Skip the node we are deleting and missing
+                       nodes. */
                     continue;
                 }
 
                 bitmap |= 1u << i;
+                Py_INCREF(self->a_array[i]);
+                vals[i] = (PyObject *)self->a_array[i];
+            }
 
-                if (IS_BITMAP_NODE(node)) {
-                    MapNode_Bitmap *child = (MapNode_Bitmap *)node;
-
-                    if (map_node_bitmap_count(child) == 1 &&
-                            child->b_array[0] != NULL)
-                    {
-                        /* node is a Bitmap with one key/value pair, just
-                           merge it into the new Bitmap node we're building.
-
-                           Note that we don't inline Bitmap nodes that
-                           have a NULL key -- those nodes point to another
-                           tree level, and we cannot simply move tree levels
-                           up or down.
-                        */
-                        PyObject *key = child->b_array[0];
-                        PyObject *val = child->b_array[1];
-
-                        Py_INCREF(key);
-                        new->b_array[new_i] = key;
-                        Py_INCREF(val);
-                        new->b_array[new_i + 1] = val;
-                    }
-                    else {
-                        new->b_array[new_i] = NULL;
-                        Py_INCREF(node);
-                        new->b_array[new_i + 1] = (PyObject*)node;
-                    }
-                }
-                else {
-
-#if !defined(NDEBUG)
-                    if (IS_COLLISION_NODE(node)) {
-                        assert(
-                            (map_node_collision_count(
-                                (MapNode_Collision*)node)) > 1);
-                    }
-                    else if (IS_ARRAY_NODE(node)) {
-                        assert(((MapNode_Array*)node)->a_count >= 16);
-                    }
-#endif
-
-                    /* Just copy the node into our new Bitmap */
-                    new->b_array[new_i] = NULL;
-                    Py_INCREF(node);
-                    new->b_array[new_i + 1] = (PyObject*)node;
-                }
+            *new_node = map_node_new_from_slots(
+                st, hashes, keys, vals, bitmap, shift, mutid);
 
-                new_i += 2;
+            for (uint32_t i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+                Py_XDECREF(keys[i]);
+                Py_XDECREF(vals[i]);
             }
 
-            new->b_bitmap = bitmap;
-            *new_node = (MapNode*)new;  /* borrow */
+            if (*new_node == NULL) {
+                return W_ERROR;
+            }
             return W_NEWNODE;
         }
 
@@ -2041,7 +2872,7 @@ map_node_array_without(MapNode_Array *self,
 
 static map_find_t
 map_node_array_find(MapNode_Array *self,
-                    uint32_t shift, int32_t hash,
+                    uint32_t shift, map_hash_t hash,
                     PyObject *key, PyObject **val)
 {
     /* Lookup `key` in the Array node `self`.  Set the value
@@ -2059,6 +2890,34 @@ map_node_array_find(MapNode_Array *self,
     return map_node_find(node, shift + 5, hash, key, val);
 }
 
+static int
+map_node_array_items_hash(MapNode_Array *self, Py_uhash_t *hash)
+{
+    Py_uhash_t h = 0;
+    Py_uhash_t child_hash;
+    Py_ssize_t i;
+
+    Py_hash_t cached_hash = MAP_LOAD_HASH(self->a_cached_hash);
+    if (cached_hash != -1) {
+        *hash = (Py_uhash_t)cached_hash;
+        return 0;
+    }
+
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        if (self->a_array[i] == NULL) {
+            continue;
+        }
+        if (map_node_items_hash(self->a_array[i], &child_hash)) {
+            return -1;
+        }
+        h ^= child_hash;
+    }
+
+    MAP_STORE_HASH(self->a_cached_hash, (Py_hash_t)h);
+    *hash = h;
+    return 0;
+}
+
 static int
 map_node_array_traverse(MapNode_Array *self,
                         visitproc visit, void *arg)
@@ -2067,6 +2926,8 @@ map_node_array_traverse(MapNode_Array *self,
 
     Py_ssize_t i;
 
+    MAP_VISIT_TYPE(self);
+
     for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
         Py_VISIT(self->a_array[i]);
     }
@@ -2079,17 +2940,19 @@ map_node_array_dealloc(MapNode_Array *self)
 {
     /* Array's tp_dealloc */
 
+    PyTypeObject *tp = Py_TYPE(self);
     Py_ssize_t i;
 
     PyObject_GC_UnTrack(self);
-    Py_TRASHCAN_SAFE_BEGIN(self)
+    MAP_TRASHCAN_BEGIN(self, map_node_array_dealloc)
 
     for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
         Py_XDECREF(self->a_array[i]);
     }
 
-    Py_TYPE(self)->tp_free((PyObject *)self);
-    Py_TRASHCAN_SAFE_END(self)
+    tp->tp_free((PyObject *)self);
+    MAP_DECREF_TYPE(tp);
+    MAP_TRASHCAN_END(self)
 }
 
 static int
@@ -2138,12 +3001,29 @@ error:
 }
 
 
+static void
+map_node_array_stats(MapNode_Array *node, int level, MapStats *stats)
+{
+    Py_ssize_t i;
+
+    stats->s_array_nodes++;
+    stats->s_slots += node->a_count;
+    stats->s_bytes += Py_TYPE(node)->tp_basicsize;
+
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        if (node->a_array[i] != NULL) {
+            map_node_stats(node->a_array[i], level + 1, stats);
+        }
+    }
+}
+
+
 /////////////////////////////////// Node Dispatch
 
 
 static MapNode *
-map_node_assoc(MapNode *node,
-               uint32_t shift, int32_t hash,
+map_node_assoc(MapModuleState *st, MapNode *node,
+               uint32_t shift, map_hash_t hash,
                PyObject *key, PyObject *val, int* added_leaf,
                uint64_t mutid)
 {
@@ -2162,39 +3042,39 @@ map_node_assoc(MapNode *node,
 
     if (IS_BITMAP_NODE(node)) {
         return map_node_bitmap_assoc(
-            (MapNode_Bitmap *)node,
+            st, (MapNode_Bitmap *)node,
             shift, hash, key, val, added_leaf, mutid);
     }
     else if (IS_ARRAY_NODE(node)) {
         return map_node_array_assoc(
-            (MapNode_Array *)node,
+            st, (MapNode_Array *)node,
             shift, hash, key, val, added_leaf, mutid);
     }
     else {
         assert(IS_COLLISION_NODE(node));
         return map_node_collision_assoc(
-            (MapNode_Collision *)node,
+            st, (MapNode_Collision *)node,
             shift, hash, key, val, added_leaf, mutid);
     }
 }
 
 static map_without_t
-map_node_without(MapNode *node,
-                 uint32_t shift, int32_t hash,
+map_node_without(MapModuleState *st, MapNode *node,
+                 uint32_t shift, map_hash_t hash,
                  PyObject *key,
                  MapNode **new_node,
                  uint64_t mutid)
 {
     if (IS_BITMAP_NODE(node)) {
         return map_node_bitmap_without(
-            (MapNode_Bitmap *)node,
+            st, (MapNode_Bitmap *)node,
             shift, hash, key,
             new_node,
             mutid);
     }
     else if (IS_ARRAY_NODE(node)) {
         return map_node_array_without(
-            (MapNode_Array *)node,
+            st, (MapNode_Array *)node,
             shift, hash, key,
             new_node,
             mutid);
@@ -2202,7 +3082,7 @@ map_node_without(MapNode *node,
     else {
         assert(IS_COLLISION_NODE(node));
         return map_node_collision_without(
-            (MapNode_Collision *)node,
+            st, (MapNode_Collision *)node,
             shift, hash, key,
             new_node,
             mutid);
@@ -2211,7 +3091,7 @@ map_node_without(MapNode *node,
 
 static map_find_t
 map_node_find(MapNode *node,
-              uint32_t shift, int32_t hash,
+              uint32_t shift, map_hash_t hash,
               PyObject *key, PyObject **val)
 {
     /* Find the key in the node starting with the given shift/hash.
@@ -2246,6 +3126,32 @@ map_node_find(MapNode *node,
     }
 }
 
+static int
+map_node_items_hash(MapNode *node, Py_uhash_t *hash)
+{
+    /* Set *hash to the XOR of hashes of all key/value pairs of the
+       subtree (see `map_item_hash`); return -1 on error.
+
+       Hashes are memoized per node, so the subtrees shared with
+       a previously hashed map are not visited again.
+
+       This method automatically dispatches to the suitable
+       map_node_{nodetype}_items_hash method.
+    */
+
+    if (IS_BITMAP_NODE(node)) {
+        return map_node_bitmap_items_hash((MapNode_Bitmap *)node, hash);
+    }
+    else if (IS_ARRAY_NODE(node)) {
+        return map_node_array_items_hash((MapNode_Array *)node, hash);
+    }
+    else {
+        assert(IS_COLLISION_NODE(node));
+        return map_node_collision_items_hash(
+            (MapNode_Collision *)node, hash);
+    }
+}
+
 static int
 map_node_dump(MapNode *node,
               _PyUnicodeWriter *writer, int level)
@@ -2272,6 +3178,31 @@ map_node_dump(MapNode *node,
 }
 
 
+static void
+map_node_stats(MapNode *node, int level, MapStats *stats)
+{
+    /* Add the nodes of the subtree to *stats; keys of `node` are
+       on the given level of the tree.
+
+       This method automatically dispatches to the suitable
+       map_node_{nodetype}_stats method.
+    */
+
+    assert(level < _Py_HAMT_MAX_TREE_DEPTH);
+
+    if (IS_BITMAP_NODE(node)) {
+        map_node_bitmap_stats((MapNode_Bitmap *)node, level, stats);
+    }
+    else if (IS_ARRAY_NODE(node)) {
+        map_node_array_stats((MapNode_Array *)node, level, stats);
+    }
+    else {
+        assert(IS_COLLISION_NODE(node));
+        map_node_collision_stats((MapNode_Collision *)node, level, stats);
+    }
+}
+
+
 /////////////////////////////////// Iterators: Machinery
 
 
@@ -2293,8 +3224,17 @@ map_iterator_init(MapIteratorState *iter, MapNode *root)
     iter->i_nodes[0] = root;
 }
 
-static map_iter_t
-map_iterator_bitmap_next(MapIteratorState *iter,
+static void
+map_iterator_init_map(MapIteratorState *iter, BaseMapObject *o)
+{
+    /* Flat Maps don't have a root node: the iterator visits
+       the Map object itself, as if it was a node. */
+    map_iterator_init(
+        iter, IS_FLAT_MAP(o) ? (MapNode *)o : o->b_root);
+}
+
+static map_iter_t
+map_iterator_bitmap_next(MapIteratorState *iter,
                          PyObject **key, PyObject **val)
 {
     int8_t level = iter->i_level;
@@ -2302,7 +3242,21 @@ map_iterator_bitmap_next(MapIteratorState *iter,
     MapNode_Bitmap *node = (MapNode_Bitmap *)(iter->i_nodes[level]);
     Py_ssize_t pos = iter->i_pos[level];
 
-    if (pos + 1 >= Py_SIZE(node)) {
+    /* Yield the key/value pairs of the node first, then descend into
+       its subnodes.  Most nodes (the ones close to the leaves) have
+       no subnodes at all. */
+
+    Py_ssize_t data_size = node->b_nodemap == 0 ?
+        Py_SIZE(node) : map_node_bitmap_data_size(node);
+
+    if (pos < data_size) {
+        *key = node->b_array[pos];
+        *val = node->b_array[pos + 1];
+        iter->i_pos[level] = pos + 2;
+        return I_ITEM;
+    }
+
+    if (pos >= Py_SIZE(node)) {
 #if !defined(NDEBUG)
         assert(iter->i_level >= 0);
         iter->i_nodes[iter->i_level] = NULL;
@@ -2311,23 +3265,15 @@ map_iterator_bitmap_next(MapIteratorState *iter,
         return map_iterator_next(iter, key, val);
     }
 
-    if (node->b_array[pos] == NULL) {
-        iter->i_pos[level] = pos + 2;
-
-        assert(level + 1 < _Py_HAMT_MAX_TREE_DEPTH);
-        int8_t next_level = (int8_t)(level + 1);
-        iter->i_level = next_level;
-        iter->i_pos[next_level] = 0;
-        iter->i_nodes[next_level] = (MapNode *)
-            node->b_array[pos + 1];
+    iter->i_pos[level] = pos + 1;
 
-        return map_iterator_next(iter, key, val);
-    }
+    assert(level + 1 < _Py_HAMT_MAX_TREE_DEPTH);
+    int8_t next_level = (int8_t)(level + 1);
+    iter->i_level = next_level;
+    iter->i_pos[next_level] = 0;
+    iter->i_nodes[next_level] = (MapNode *)node->b_array[pos];
 
-    *key = node->b_array[pos];
-    *val = node->b_array[pos + 1];
-    iter->i_pos[level] = pos + 2;
-    return I_ITEM;
+    return map_iterator_next(iter, key, val);
 }
 
 static map_iter_t
@@ -2354,6 +3300,31 @@ map_iterator_collision_next(MapIteratorState *iter,
     return I_ITEM;
 }
 
+static map_iter_t
+map_iterator_flat_next(MapIteratorState *iter,
+                       PyObject **key, PyObject **val)
+{
+    int8_t level = iter->i_level;
+
+    MapObject *o = (MapObject *)(iter->i_nodes[level]);
+    Py_ssize_t pos = iter->i_pos[level];
+
+    assert(level == 0);
+
+    if (pos >= o->h_count) {
+#if !defined(NDEBUG)
+        iter->i_nodes[level] = NULL;
+#endif
+        iter->i_level--;
+        return I_END;
+    }
+
+    *key = o->h_entries[pos].e_key;
+    *val = o->h_entries[pos].e_val;
+    iter->i_pos[level] = pos + 1;
+    return I_ITEM;
+}
+
 static map_iter_t
 map_iterator_array_next(MapIteratorState *iter,
                         PyObject **key, PyObject **val)
@@ -2412,138 +3383,81 @@ map_iterator_next(MapIteratorState *iter, PyObject **key, PyObject **val)
     else if (IS_ARRAY_NODE(current)) {
         return map_iterator_array_next(iter, key, val);
     }
-    else {
-        assert(IS_COLLISION_NODE(current));
+    else if (IS_COLLISION_NODE(current)) {
         return map_iterator_collision_next(iter, key, val);
     }
+    else {
+        assert(Map_Check(MAP_STATE(current), current));
+        return map_iterator_flat_next(iter, key, val);
+    }
 }
 
 
-/////////////////////////////////// HAMT high-level functions
-
-
-static MapObject *
-map_assoc(MapObject *o, PyObject *key, PyObject *val)
+static map_hash_t
+map_iterator_hash(MapIteratorState *iter)
 {
-    int32_t key_hash;
-    int added_leaf = 0;
-    MapNode *new_root;
-    MapObject *new_o;
+    /* Return the hash of the key that map_iterator_next() has just
+       yielded; the hash is stored next to it. */
 
-    key_hash = map_hash(key);
-    if (key_hash == -1) {
-        return NULL;
-    }
+    MapNode *current = iter->i_nodes[iter->i_level];
+    Py_ssize_t pos = iter->i_pos[iter->i_level];
 
-    new_root = map_node_assoc(
-        (MapNode *)(o->h_root),
-        0, key_hash, key, val, &added_leaf,
-        0);
-    if (new_root == NULL) {
-        return NULL;
+    if (IS_BITMAP_NODE(current)) {
+        return BITMAP_HASHES((MapNode_Bitmap *)current)[(pos - 2) / 2];
     }
-
-    if (new_root == o->h_root) {
-        Py_DECREF(new_root);
-        Py_INCREF(o);
-        return o;
+    else if (IS_COLLISION_NODE(current)) {
+        return ((MapNode_Collision *)current)->c_hash;
     }
-
-    new_o = map_alloc();
-    if (new_o == NULL) {
-        Py_DECREF(new_root);
-        return NULL;
+    else {
+        assert(Map_Check(MAP_STATE(current), current));
+        return ((MapObject *)current)->h_entries[pos - 1].e_hash;
     }
-
-    new_o->h_root = new_root;  /* borrow */
-    new_o->h_count = added_leaf ? o->h_count + 1 : o->h_count;
-
-    return new_o;
 }
 
-static MapObject *
-map_without(MapObject *o, PyObject *key)
-{
-    int32_t key_hash = map_hash(key);
-    if (key_hash == -1) {
-        return NULL;
-    }
-
-    MapNode *new_root = NULL;
-
-    map_without_t res = map_node_without(
-        (MapNode *)(o->h_root),
-        0, key_hash, key,
-        &new_root,
-        0);
-
-    switch (res) {
-        case W_ERROR:
-            return NULL;
-        case W_EMPTY:
-            return map_new();
-        case W_NOT_FOUND:
-            PyErr_SetObject(PyExc_KeyError, key);
-            return NULL;
-        case W_NEWNODE: {
-            assert(new_root != NULL);
 
-            MapObject *new_o = map_alloc();
-            if (new_o == NULL) {
-                Py_DECREF(new_root);
-                return NULL;
-            }
+/////////////////////////////////// Structural Comparison
 
-            new_o->h_root = new_root;  /* borrow */
-            new_o->h_count = o->h_count - 1;
-            assert(new_o->h_count >= 0);
-            return new_o;
-        }
-        default:
-            abort();
-    }
-}
 
-static map_find_t
-map_find(BaseMapObject *o, PyObject *key, PyObject **val)
+static int
+map_item_eq(PyObject *a_key, PyObject *a_val,
+            PyObject *b_key, PyObject *b_val)
 {
-    if (o->b_count == 0) {
-        return F_NOT_FOUND;
-    }
+    /* Return 1 if the a_key/a_val pair is equal to b_key/b_val,
+       0 if it's not, and -1 on error. */
 
-    int32_t key_hash = map_hash(key);
-    if (key_hash == -1) {
-        return F_ERROR;
+    int cmp = PyObject_RichCompareBool(a_key, b_key, Py_EQ);
+    if (cmp != 1) {
+        return cmp;
     }
 
-    return map_node_find(o->b_root, 0, key_hash, key, val);
+    return PyObject_RichCompareBool(a_val, b_val, Py_EQ);
 }
 
 static int
-map_eq(BaseMapObject *v, BaseMapObject *w)
+map_node_items_in(MapNode *node, MapNode *other, uint32_t shift)
 {
-    if (v == w) {
-        return 1;
-    }
+    /* Look up every key/value pair of the `node` subtree in the
+       `other` subtree (that is located at the `shift` level of the
+       tree).
 
-    if (v->b_count != w->b_count) {
-        return 0;
-    }
+       This is used to compare Collision nodes, which can store
+       keys with equal hashes in any order.
+    */
 
     MapIteratorState iter;
     map_iter_t iter_res;
-    map_find_t find_res;
-    PyObject *v_key;
-    PyObject *v_val;
-    PyObject *w_val;
+    PyObject *key;
+    PyObject *val;
+    PyObject *other_val;
 
-    map_iterator_init(&iter, v->b_root);
+    map_iterator_init(&iter, node);
 
     do {
-        iter_res = map_iterator_next(&iter, &v_key, &v_val);
+        iter_res = map_iterator_next(&iter, &key, &val);
         if (iter_res == I_ITEM) {
-            find_res = map_find(w, v_key, &w_val);
-            switch (find_res) {
+            map_hash_t key_hash = map_iterator_hash(&iter);
+
+            switch (map_node_find(other, shift, key_hash, key, &other_val)) {
                 case F_ERROR:
                     return -1;
 
@@ -2551,14 +3465,16 @@ map_eq(BaseMapObject *v, BaseMapObject *w)
                     return 0;
 
                 case F_FOUND: {
-                    int cmp = PyObject_RichCompareBool(v_val, w_val, Py_EQ);
-                    if (cmp < 0) {
-                        return -1;
-                    }
-                    if (cmp == 0) {
-                        return 0;
+                    int cmp = PyObject_RichCompareBool(
+                        val, other_val, Py_EQ);
+                    if (cmp != 1) {
+                        return cmp;
                     }
+                    break;
                 }
+
+                default:
+                    abort();
             }
         }
     } while (iter_res != I_END);
@@ -2566,1328 +3482,6313 @@ map_eq(BaseMapObject *v, BaseMapObject *w)
     return 1;
 }
 
-static Py_ssize_t
-map_len(BaseMapObject *o)
+static int
+map_node_eq(MapNode *a, MapNode *b, uint32_t shift)
 {
-    return o->b_count;
-}
+    /* Check if the `a` and `b` subtrees (both located at the `shift`
+       level) have equal key/value pairs.
+
+       Tries are canonical: their shape depends only on the set of
+       keys they hold, not on the order in which the keys were added
+       or removed.  Therefore subtrees of equal maps must have equal
+       shapes, and any difference in the node types or bitmaps means
+       the maps are not equal, which is detected without calling
+       `__eq__` on keys or values.
+
+       Return 1 if the subtrees are equal, 0 if they aren't, and -1
+       if an error occurred.
+    */
 
-static MapObject *
-map_alloc(void)
-{
-    MapObject *o;
-    o = PyObject_GC_New(MapObject, &_Map_Type);
-    if (o == NULL) {
-        return NULL;
-    }
-    o->h_weakreflist = NULL;
-    o->h_hash = -1;
-    o->h_count = 0;
-    o->h_root = NULL;
-    PyObject_GC_Track(o);
-    return o;
-}
+    Py_ssize_t i;
+    int res;
 
-static MapObject *
-map_new(void)
-{
-    MapObject *o = map_alloc();
-    if (o == NULL) {
-        return NULL;
+    if (a == b) {
+        return 1;
     }
 
-    o->h_root = map_node_bitmap_new(0, 0);
-    if (o->h_root == NULL) {
-        Py_DECREF(o);
-        return NULL;
+    if (Py_TYPE(a) != Py_TYPE(b)) {
+        return 0;
     }
 
-    return o;
-}
+    if (IS_BITMAP_NODE(a)) {
+        MapNode_Bitmap *x = (MapNode_Bitmap *)a;
+        MapNode_Bitmap *y = (MapNode_Bitmap *)b;
+        Py_ssize_t data_size = map_node_bitmap_data_size(x);
 
-static PyObject *
-map_dump(MapObject *self)
-{
-    _PyUnicodeWriter writer;
+        if (x->b_datamap != y->b_datamap || x->b_nodemap != y->b_nodemap) {
+            return 0;
+        }
 
-    _PyUnicodeWriter_Init(&writer);
+        /* Equal keys have equal hashes. */
+        for (i = 0; i < data_size; i += 2) {
+            if (BITMAP_HASHES(x)[i / 2] != BITMAP_HASHES(y)[i / 2]) {
+                return 0;
+            }
+        }
 
-    if (_map_dump_format(&writer, "HAMT(len=%zd):\n", self->h_count)) {
-        goto error;
+        for (i = data_size; i < Py_SIZE(x); i++) {
+            res = map_node_eq((MapNode *)x->b_array[i],
+                              (MapNode *)y->b_array[i], shift + 5);
+            if (res != 1) {
+                return res;
+            }
+        }
+
+        for (i = 0; i < data_size; i += 2) {
+            res = map_item_eq(x->b_array[i], x->b_array[i + 1],
+                              y->b_array[i], y->b_array[i + 1]);
+            if (res != 1) {
+                return res;
+            }
+        }
+
+        return 1;
     }
+    else if (IS_ARRAY_NODE(a)) {
+        MapNode_Array *x = (MapNode_Array *)a;
+        MapNode_Array *y = (MapNode_Array *)b;
 
-    if (map_node_dump(self->h_root, &writer, 0)) {
-        goto error;
+        if (x->a_count != y->a_count) {
+            return 0;
+        }
+
+        for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+            if ((x->a_array[i] == NULL) != (y->a_array[i] == NULL)) {
+                return 0;
+            }
+        }
+
+        for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+            if (x->a_array[i] != NULL) {
+                res = map_node_eq(x->a_array[i], y->a_array[i], shift + 5);
+                if (res != 1) {
+                    return res;
+                }
+            }
+        }
+
+        return 1;
     }
+    else {
+        MapNode_Collision *x = (MapNode_Collision *)a;
+        MapNode_Collision *y = (MapNode_Collision *)b;
 
-    return _PyUnicodeWriter_Finish(&writer);
+        if (x->c_hash != y->c_hash || Py_SIZE(x) != Py_SIZE(y)) {
+            return 0;
+        }
 
-error:
-    _PyUnicodeWriter_Dealloc(&writer);
-    return NULL;
+        return map_node_items_in(a, b, shift);
+    }
 }
 
 
-/////////////////////////////////// Iterators: Shared Iterator Implementation
+/////////////////////////////////// Merge
 
 
-static int
-map_baseiter_tp_clear(MapIterator *it)
-{
-    Py_CLEAR(it->mi_obj);
-    return 0;
-}
+static MapNode *
+map_node_merge(MapModuleState *st, MapNode *a, MapNode *b, uint32_t shift,
+               PyObject *resolve, Py_ssize_t *added, uint64_t mutid);
 
-static void
-map_baseiter_tp_dealloc(MapIterator *it)
-{
-    PyObject_GC_UnTrack(it);
-    (void)map_baseiter_tp_clear(it);
-    PyObject_GC_Del(it);
-}
 
-static int
-map_baseiter_tp_traverse(MapIterator *it, visitproc visit, void *arg)
+static Py_ssize_t
+map_node_count(MapNode *node)
 {
-    Py_VISIT(it->mi_obj);
-    return 0;
-}
+    /* Return the number of key/value pairs in the `node` subtree.
 
-static PyObject *
-map_baseiter_tp_iternext(MapIterator *it)
-{
-    PyObject *key;
-    PyObject *val;
-    map_iter_t res = map_iterator_next(&it->mi_iter, &key, &val);
+       Settled nodes record the count in their mutid (see
+       `map_node_settle`), so only the nodes that aren't reachable
+       from a MapObject yet are walked. */
 
-    switch (res) {
-        case I_END:
-            PyErr_SetNone(PyExc_StopIteration);
-            return NULL;
+    Py_ssize_t count = 0;
+    Py_ssize_t i;
 
-        case I_ITEM: {
-            return (*(it->mi_yield))(key, val);
+    if (IS_BITMAP_NODE(node)) {
+        MapNode_Bitmap *bitmap = (MapNode_Bitmap *)node;
+        if (bitmap->b_mutid & MAP_MUTID_SETTLED) {
+            return MAP_MUTID_COUNT(bitmap->b_mutid);
         }
-
-        default: {
-            abort();
+        count = map_bitcount(bitmap->b_datamap);
+        for (i = map_node_bitmap_data_size(bitmap); i < Py_SIZE(bitmap); i++) {
+            count += map_node_count((MapNode *)bitmap->b_array[i]);
         }
     }
-}
+    else if (IS_ARRAY_NODE(node)) {
+        MapNode_Array *array = (MapNode_Array *)node;
+        if (array->a_mutid & MAP_MUTID_SETTLED) {
+            return MAP_MUTID_COUNT(array->a_mutid);
+        }
+        for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+            if (array->a_array[i] != NULL) {
+                count += map_node_count(array->a_array[i]);
+            }
+        }
+    }
+    else {
+        assert(IS_COLLISION_NODE(node));
+        count = map_node_collision_count((MapNode_Collision *)node);
+    }
 
-static int
-map_baseview_tp_clear(MapView *view)
-{
-    Py_CLEAR(view->mv_obj);
-    Py_CLEAR(view->mv_itertype);
-    return 0;
+    return count;
 }
 
-static void
-map_baseview_tp_dealloc(MapView *view)
+static MapNode *
+map_node_merge_item(MapModuleState *st,
+                    MapNode *node, uint32_t shift, map_hash_t hash,
+                    PyObject *key, PyObject *val,
+                    PyObject *resolve, int *added_leaf, uint64_t mutid)
 {
-    PyObject_GC_UnTrack(view);
-    (void)map_baseview_tp_clear(view);
-    PyObject_GC_Del(view);
-}
+    /* Set key/val in `node`.  If the key is already in `node`,
+       call `resolve(key, old_val, val)` to compute the new value
+       (if `resolve` is not NULL). */
 
-static int
-map_baseview_tp_traverse(MapView *view, visitproc visit, void *arg)
-{
-    Py_VISIT(view->mv_obj);
-    return 0;
-}
+    PyObject *new_val = NULL;
+    MapNode *res;
 
-static Py_ssize_t
-map_baseview_tp_len(MapView *view)
-{
-    return view->mv_obj->h_count;
-}
+    if (resolve != NULL) {
+        PyObject *old_val;
 
-static PyMappingMethods MapView_as_mapping = {
-    (lenfunc)map_baseview_tp_len,
-};
+        switch (map_node_find(node, shift, hash, key, &old_val)) {
+            case F_ERROR:
+                return NULL;
 
-static PyObject *
-map_baseview_newiter(PyTypeObject *type, binaryfunc yield, MapObject *map)
-{
-    MapIterator *iter = PyObject_GC_New(MapIterator, type);
-    if (iter == NULL) {
-        return NULL;
-    }
+            case F_NOT_FOUND:
+                break;
 
-    Py_INCREF(map);
-    iter->mi_obj = map;
-    iter->mi_yield = yield;
-    map_iterator_init(&iter->mi_iter, map->h_root);
+            case F_FOUND:
+                new_val = PyObject_CallFunctionObjArgs(
+                    resolve, key, old_val, val, NULL);
+                if (new_val == NULL) {
+                    return NULL;
+                }
+                val = new_val;
+                break;
 
-    PyObject_GC_Track(iter);
-    return (PyObject *)iter;
-}
+            default:
+                abort();
+        }
+    }
 
-static PyObject *
-map_baseview_iter(MapView *view)
-{
-    return map_baseview_newiter(
-        view->mv_itertype, view->mv_yield, view->mv_obj);
+    res = map_node_assoc(st, node, shift, hash, key, val, added_leaf, mutid);
+    Py_XDECREF(new_val);
+    return res;
 }
 
-static PyObject *
-map_baseview_new(PyTypeObject *type, binaryfunc yield,
-                 MapObject *o, PyTypeObject *itertype)
+static MapNode *
+map_node_merge_items(MapModuleState *st,
+                     MapNode *a, MapNode *b, uint32_t shift,
+                     PyObject *resolve, Py_ssize_t *added, uint64_t mutid)
 {
-    MapView *view = PyObject_GC_New(MapView, type);
-    if (view == NULL) {
-        return NULL;
-    }
-
-    Py_INCREF(o);
-    view->mv_obj = o;
-    view->mv_yield = yield;
+    /* Slow path of map_node_merge: set key/value pairs of the `b`
+       subtree in `a` one by one. */
 
-    Py_INCREF(itertype);
-    view->mv_itertype = itertype;
+    MapIteratorState iter;
+    map_iter_t iter_res;
+    PyObject *key;
+    PyObject *val;
+    MapNode *res;
 
-    PyObject_GC_Track(view);
-    return (PyObject *)view;
-}
+    Py_INCREF(a);
+    res = a;
 
-#define ITERATOR_TYPE_SHARED_SLOTS                              \
-    .tp_basicsize = sizeof(MapIterator),                        \
-    .tp_itemsize = 0,                                           \
-    .tp_dealloc = (destructor)map_baseiter_tp_dealloc,          \
-    .tp_getattro = PyObject_GenericGetAttr,                     \
-    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,        \
-    .tp_traverse = (traverseproc)map_baseiter_tp_traverse,      \
-    .tp_clear = (inquiry)map_baseiter_tp_clear,                 \
-    .tp_iter = PyObject_SelfIter,                               \
-    .tp_iternext = (iternextfunc)map_baseiter_tp_iternext,
+    map_iterator_init(&iter, b);
+    do {
+        iter_res = map_iterator_next(&iter, &key, &val);
+        if (iter_res == I_ITEM) {
+            int added_leaf;
+            map_hash_t key_hash = map_iterator_hash(&iter);
 
+            MapNode *new_res = map_node_merge_item(
+                st, res, shift, key_hash, key, val, resolve, &added_leaf,
+                mutid);
+            if (new_res == NULL) {
+                goto err;
+            }
 
-#define VIEW_TYPE_SHARED_SLOTS                                  \
-    .tp_basicsize = sizeof(MapView),                            \
-    .tp_itemsize = 0,                                           \
-    .tp_as_mapping = &MapView_as_mapping,                       \
-    .tp_dealloc = (destructor)map_baseview_tp_dealloc,          \
-    .tp_getattro = PyObject_GenericGetAttr,                     \
-    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,        \
-    .tp_traverse = (traverseproc)map_baseview_tp_traverse,      \
-    .tp_clear = (inquiry)map_baseview_tp_clear,                 \
-    .tp_iter = (getiterfunc)map_baseview_iter,                  \
+            if (added_leaf) {
+                (*added)++;
+            }
 
+            Py_SETREF(res, new_res);
+        }
+    } while (iter_res != I_END);
 
-/////////////////////////////////// _MapItems_Type
+    return res;
 
+err:
+    Py_DECREF(res);
+    return NULL;
+}
 
-PyTypeObject _MapItems_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "items",
-    VIEW_TYPE_SHARED_SLOTS
-};
+static int
+map_node_merge_slot(MapModuleState *st,
+                    map_hash_t a_hash, PyObject *a_key, PyObject *a_val,
+                    map_hash_t b_hash, PyObject *b_key, PyObject *b_val,
+                    uint32_t shift, PyObject *resolve,
+                    map_hash_t *key_hash,
+                    PyObject **key_or_null, PyObject **val_or_node,
+                    Py_ssize_t *added, uint64_t mutid)
+{
+    /* Merge two key/value slots that correspond to the same position
+       in the tree; `shift` is the level of their subtrees.
 
-PyTypeObject _MapItemsIter_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "items_iterator",
-    ITERATOR_TYPE_SHARED_SLOTS
-};
+       A slot either holds a key/value pair and the hash of the key,
+       or a NULL key and a subtree node.  Set *key_or_null and
+       *val_or_node to new references (and *key_hash for pairs).
+    */
 
-static PyObject *
-map_iter_yield_items(PyObject *key, PyObject *val)
-{
-    return PyTuple_Pack(2, key, val);
-}
+    int added_leaf = 0;
+    MapNode *node;
 
-static PyObject *
-map_new_items_view(MapObject *o)
-{
-    return map_baseview_new(
-        &_MapItems_Type, map_iter_yield_items, o,
-        &_MapItemsIter_Type);
-}
+    if (a_key == NULL && b_key == NULL) {
+        node = map_node_merge(
+            st, (MapNode *)a_val, (MapNode *)b_val, shift,
+            resolve, added, mutid);
+    }
+    else if (a_key == NULL) {
+        node = map_node_merge_item(
+            st, (MapNode *)a_val, shift, b_hash, b_key, b_val,
+            resolve, &added_leaf, mutid);
+        *added += added_leaf;
+    }
+    else if (b_key == NULL) {
+        /* The key from `a` has to be merged into the subtree of `b`;
+           values from `b` win unless `resolve` says otherwise. */
 
+        PyObject *old_val;
 
-/////////////////////////////////// _MapKeys_Type
+        switch (map_node_find((MapNode *)b_val, shift, a_hash, a_key,
+                              &old_val))
+        {
+            case F_ERROR:
+                return -1;
 
+            case F_NOT_FOUND:
+                node = map_node_assoc(
+                    st, (MapNode *)b_val, shift, a_hash, a_key, a_val,
+                    &added_leaf, mutid);
+                *added += map_node_count((MapNode *)b_val);
+                break;
 
-PyTypeObject _MapKeys_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "keys",
-    VIEW_TYPE_SHARED_SLOTS
-};
+            case F_FOUND:
+                if (resolve == NULL) {
+                    Py_INCREF(b_val);
+                    node = (MapNode *)b_val;
+                }
+                else {
+                    PyObject *new_val = PyObject_CallFunctionObjArgs(
+                        resolve, a_key, a_val, old_val, NULL);
+                    if (new_val == NULL) {
+                        return -1;
+                    }
 
-PyTypeObject _MapKeysIter_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "keys_iterator",
-    ITERATOR_TYPE_SHARED_SLOTS
-};
+                    node = map_node_assoc(
+                        st, (MapNode *)b_val, shift, a_hash, a_key, new_val,
+                        &added_leaf, mutid);
+                    Py_DECREF(new_val);
+                }
+                *added += map_node_count((MapNode *)b_val) - 1;
+                break;
 
-static PyObject *
-map_iter_yield_keys(PyObject *key, PyObject *val)
-{
-    Py_INCREF(key);
-    return key;
-}
+            default:
+                abort();
+        }
+    }
+    else {
+        int cmp = 0;
+        if (a_hash == b_hash) {
+            cmp = PyObject_RichCompareBool(b_key, a_key, Py_EQ);
+            if (cmp < 0) {
+                return -1;
+            }
+        }
 
-static PyObject *
-map_new_keys_iter(MapObject *o)
-{
-    return map_baseview_newiter(
-        &_MapKeysIter_Type, map_iter_yield_keys, o);
-}
+        if (cmp == 1) {
+            PyObject *new_val;
 
-static PyObject *
-map_new_keys_view(MapObject *o)
-{
-    return map_baseview_new(
-        &_MapKeys_Type, map_iter_yield_keys, o,
-        &_MapKeysIter_Type);
-}
+            if (resolve != NULL) {
+                new_val = PyObject_CallFunctionObjArgs(
+                    resolve, a_key, a_val, b_val, NULL);
+                if (new_val == NULL) {
+                    return -1;
+                }
+            }
+            else {
+                Py_INCREF(b_val);
+                new_val = b_val;
+            }
 
-/////////////////////////////////// _MapValues_Type
+            *key_hash = a_hash;
+            Py_INCREF(a_key);
+            *key_or_null = a_key;
+            *val_or_node = new_val;
+            return 0;
+        }
 
+        node = map_node_new_bitmap_or_collision(
+            st, shift, a_hash, a_key, a_val, b_hash, b_key, b_val, mutid);
+        (*added)++;
+    }
 
-PyTypeObject _MapValues_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "values",
-    VIEW_TYPE_SHARED_SLOTS
-};
+    if (node == NULL) {
+        return -1;
+    }
 
-PyTypeObject _MapValuesIter_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "values_iterator",
-    ITERATOR_TYPE_SHARED_SLOTS
-};
+    *key_or_null = NULL;
+    *val_or_node = (PyObject *)node;
+    return 0;
+}
 
-static PyObject *
-map_iter_yield_values(PyObject *key, PyObject *val)
+static uint32_t
+map_node_slot_bitmap(MapNode *node)
 {
-    Py_INCREF(val);
-    return val;
+    /* Return a bitmap of occupied slots of a Bitmap or Array node. */
+
+    if (IS_BITMAP_NODE(node)) {
+        MapNode_Bitmap *bitmap = (MapNode_Bitmap *)node;
+        return bitmap->b_datamap | bitmap->b_nodemap;
+    }
+
+    assert(IS_ARRAY_NODE(node));
+    MapNode_Array *array = (MapNode_Array *)node;
+    uint32_t bitmap = 0;
+    for (uint32_t i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        if (array->a_array[i] != NULL) {
+            bitmap |= (uint32_t)1 << i;
+        }
+    }
+    return bitmap;
 }
 
-static PyObject *
-map_new_values_view(MapObject *o)
+static void
+map_node_get_slot(MapNode *node, uint32_t i, map_hash_t *key_hash,
+                  PyObject **key_or_null, PyObject **val_or_node)
 {
-    return map_baseview_new(
-        &_MapValues_Type, map_iter_yield_values, o,
-        &_MapValuesIter_Type);
+    /* Get the i-th slot of a Bitmap or an Array node (borrowed
+       references).  Array node slots always point to subtrees. */
+
+    if (IS_BITMAP_NODE(node)) {
+        map_node_bitmap_get((MapNode_Bitmap *)node, (uint32_t)1 << i,
+                            key_hash, key_or_null, val_or_node);
+    }
+    else {
+        assert(IS_ARRAY_NODE(node));
+        *key_hash = -1;
+        *key_or_null = NULL;
+        *val_or_node = (PyObject *)((MapNode_Array *)node)->a_array[i];
+    }
 }
 
+static MapNode *
+map_node_new_from_slots(MapModuleState *st, map_hash_t *hashes,
+                        PyObject **keys, PyObject **vals, uint32_t bitmap,
+                        uint32_t shift, uint64_t mutid)
+{
+    /* Create a Bitmap or an Array node located at the `shift` level
+       out of HAMT_ARRAY_NODE_SIZE slots; slots set in `bitmap` hold
+       either a key/value pair (and the hash of the key in `hashes`),
+       or a NULL key and a subtree node.
+
+       The references held by the slots are stolen (the slots are
+       reset to NULL as they are consumed); the caller is responsible
+       for releasing the remaining ones if an error occurs.
+    */
 
-/////////////////////////////////// _Map_Type
+    uint32_t i;
+    uint32_t n = map_bitcount(bitmap);
 
+    if (n > 16) {
+        MapNode_Array *new_node = (MapNode_Array *)map_node_array_new(
+            st, n, mutid);
+        if (new_node == NULL) {
+            return NULL;
+        }
 
-static PyObject *
-map_dump(MapObject *self);
+        for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+            if (vals[i] == NULL) {
+                continue;
+            }
 
+            if (keys[i] == NULL) {
+                new_node->a_array[i] = (MapNode *)vals[i];  /* borrow */
+            }
+            else {
+                /* Array nodes can only point to other nodes: wrap
+                   the key/value pair in a single-item Bitmap node. */
 
-static PyObject *
-map_tp_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
-{
-    return (PyObject*)map_new();
-}
+                MapNode *child = map_node_bitmap_new_item(
+                    st, shift + 5, hashes[i], keys[i], vals[i], mutid);
+                if (child == NULL) {
+                    Py_DECREF(new_node);
+                    return NULL;
+                }
 
+                Py_CLEAR(keys[i]);
+                Py_DECREF(vals[i]);
 
-static int
-map_tp_init(MapObject *self, PyObject *args, PyObject *kwds)
-{
-    PyObject *arg = NULL;
-    uint64_t mutid = 0;
+                new_node->a_array[i] = child;
+            }
 
-    if (!PyArg_UnpackTuple(args, "immutables.Map", 0, 1, &arg)) {
-        return -1;
+            vals[i] = NULL;
+        }
+
+        VALIDATE_ARRAY_NODE(new_node)
+        return (MapNode *)new_node;
     }
+    else {
+        uint32_t datamap = 0;
+        uint32_t nodemap = 0;
 
-    if (arg != NULL) {
-        if (Map_Check(arg)) {
-            MapObject *other = (MapObject *)arg;
+        for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+            if (vals[i] == NULL) {
+                continue;
+            }
 
-            Py_INCREF(other->h_root);
-            Py_SETREF(self->h_root, other->h_root);
+            if (keys[i] == NULL && IS_BITMAP_NODE(vals[i])) {
+                MapNode_Bitmap *child = (MapNode_Bitmap *)vals[i];
+                if (map_node_bitmap_is_item(child)) {
+                    /* Array node children can be single-item Bitmap
+                       nodes; Bitmap nodes store such items inline. */
+                    hashes[i] = BITMAP_HASHES(child)[0];
+                    Py_INCREF(child->b_array[0]);
+                    keys[i] = child->b_array[0];
+                    Py_INCREF(child->b_array[1]);
+                    vals[i] = child->b_array[1];
+                    Py_DECREF(child);
+                }
+            }
 
-            self->h_count = other->h_count;
-            self->h_hash = other->h_hash;
-        }
-        else if (MapMutation_Check(arg)) {
-            PyErr_Format(
-                PyExc_TypeError,
-                "cannot create Maps from MapMutations");
-            return -1;
-        }
-        else {
-            mutid = mutid_counter++;
-            if (map_update_inplace(mutid, (BaseMapObject *)self, arg)) {
-                return -1;
+            if (keys[i] == NULL) {
+                nodemap |= (uint32_t)1 << i;
+            }
+            else {
+                datamap |= (uint32_t)1 << i;
             }
         }
-    }
 
-    if (kwds != NULL) {
-        if (!PyArg_ValidateKeywordArguments(kwds)) {
-            return -1;
+        if (shift > 0 && datamap == 0 && map_bitcount(nodemap) == 1) {
+            i = map_bitcount(nodemap - 1);
+            if (IS_COLLISION_NODE(vals[i])) {
+                /* Collision nodes are never wrapped in Bitmap nodes
+                   below the root. */
+                MapNode *res = (MapNode *)vals[i];  /* borrow */
+                vals[i] = NULL;
+                return res;
+            }
         }
 
-        if (!mutid) {
-            mutid = mutid_counter++;
-        }
+        Py_ssize_t data_size = 2 * (Py_ssize_t)map_bitcount(datamap);
+        Py_ssize_t node_idx = data_size + (Py_ssize_t)map_bitcount(nodemap);
+        Py_ssize_t key_idx = 0;
 
-        if (map_update_inplace(mutid, (BaseMapObject *)self, kwds)) {
-            return -1;
+        MapNode_Bitmap *new_node = (MapNode_Bitmap *)map_node_bitmap_new(
+            st, node_idx, mutid);
+        if (new_node == NULL) {
+            return NULL;
         }
-    }
 
-    return 0;
-}
+        /* Key/value pairs go first in the order of their bits;
+           subnodes are stored at the end of the array in the
+           reverse order. */
+        for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+            if (vals[i] == NULL) {
+                continue;
+            }
 
+            if (keys[i] == NULL) {
+                new_node->b_array[--node_idx] = vals[i];  /* borrow */
+            }
+            else {
+                new_node->b_array[key_idx] = keys[i];  /* borrow */
+                new_node->b_array[key_idx + 1] = vals[i];  /* borrow */
+                BITMAP_HASHES(new_node)[key_idx / 2] = hashes[i];
+                key_idx += 2;
+            }
 
-static int
-map_tp_clear(BaseMapObject *self)
-{
-    Py_CLEAR(self->b_root);
-    return 0;
-}
+            keys[i] = NULL;
+            vals[i] = NULL;
+        }
 
+        assert(key_idx == data_size && node_idx == data_size);
 
-static int
-map_tp_traverse(BaseMapObject *self, visitproc visit, void *arg)
-{
-    Py_VISIT(self->b_root);
-    return 0;
+        new_node->b_datamap = datamap;
+        new_node->b_nodemap = nodemap;
+        VALIDATE_BITMAP_NODE(new_node)
+        return (MapNode *)new_node;
+    }
 }
 
-static void
-map_tp_dealloc(BaseMapObject *self)
+static MapNode *
+map_node_merge_levels(MapModuleState *st,
+                      MapNode *a, MapNode *b, uint32_t shift,
+                      PyObject *resolve, Py_ssize_t *added, uint64_t mutid)
 {
-    PyObject_GC_UnTrack(self);
-    if (self->b_weakreflist != NULL) {
-        PyObject_ClearWeakRefs((PyObject*)self);
-    }
-    (void)map_tp_clear(self);
-    Py_TYPE(self)->tp_free(self);
-}
+    /* Merge two Bitmap or Array nodes slot by slot.
 
+       Slots that are only present in one of the nodes are adopted
+       with their subtrees as is; only slots present in both nodes
+       are merged.  Depending on the number of the resulting slots,
+       the result is either a Bitmap or an Array node.
+    */
 
-static PyObject *
-map_tp_richcompare(PyObject *v, PyObject *w, int op)
-{
-    if (!Map_Check(v) || !Map_Check(w) || (op != Py_EQ && op != Py_NE)) {
-        Py_RETURN_NOTIMPLEMENTED;
-    }
+    map_hash_t hashes[HAMT_ARRAY_NODE_SIZE];
+    PyObject *keys[HAMT_ARRAY_NODE_SIZE];
+    PyObject *vals[HAMT_ARRAY_NODE_SIZE];
+    uint32_t a_bitmap = map_node_slot_bitmap(a);
+    uint32_t b_bitmap = map_node_slot_bitmap(b);
+    uint32_t bitmap = a_bitmap | b_bitmap;
+    uint32_t i;
+    int changed = 0;
+    MapNode *res = NULL;
 
-    int res = map_eq((BaseMapObject *)v, (BaseMapObject *)w);
-    if (res < 0) {
-        return NULL;
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        keys[i] = NULL;
+        vals[i] = NULL;
     }
 
-    if (op == Py_NE) {
-        res = !res;
-    }
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        uint32_t bit = (uint32_t)1 << i;
+        map_hash_t a_hash, b_hash;
+        PyObject *a_key, *a_val, *b_key, *b_val;
 
-    if (res) {
-        Py_RETURN_TRUE;
+        if (!(bitmap & bit)) {
+            continue;
+        }
+
+        if (!(b_bitmap & bit)) {
+            map_node_get_slot(a, i, &hashes[i], &a_key, &a_val);
+            Py_XINCREF(a_key);
+            keys[i] = a_key;
+            Py_INCREF(a_val);
+            vals[i] = a_val;
+            continue;
+        }
+
+        map_node_get_slot(b, i, &b_hash, &b_key, &b_val);
+
+        if (!(a_bitmap & bit)) {
+            hashes[i] = b_hash;
+            Py_XINCREF(b_key);
+            keys[i] = b_key;
+            Py_INCREF(b_val);
+            vals[i] = b_val;
+
+            *added += b_key == NULL ? map_node_count((MapNode *)b_val) : 1;
+            changed = 1;
+            continue;
+        }
+
+        map_node_get_slot(a, i, &a_hash, &a_key, &a_val);
+
+        if (map_node_merge_slot(st, a_hash, a_key, a_val, b_hash, b_key, b_val,
+                                shift + 5, resolve,
+                                &hashes[i], &keys[i], &vals[i],
+                                added, mutid))
+        {
+            goto fin;
+        }
+
+        if (keys[i] != a_key || vals[i] != a_val) {
+            changed = 1;
+        }
     }
-    else {
-        Py_RETURN_FALSE;
+
+    if (!changed) {
+        Py_INCREF(a);
+        res = a;
+        goto fin;
     }
-}
 
-static int
-map_tp_contains(BaseMapObject *self, PyObject *key)
-{
-    PyObject *val;
-    map_find_t res = map_find(self, key, &val);
-    switch (res) {
-        case F_ERROR:
-            return -1;
-        case F_NOT_FOUND:
-            return 0;
-        case F_FOUND:
-            return 1;
-        default:
-            abort();
+    res = map_node_new_from_slots(
+        st, hashes, keys, vals, bitmap, shift, mutid);
+
+fin:
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        Py_XDECREF(keys[i]);
+        Py_XDECREF(vals[i]);
     }
+    return res;
 }
 
-static PyObject *
-map_tp_subscript(BaseMapObject *self, PyObject *key)
+static MapNode *
+map_node_merge(MapModuleState *st, MapNode *a, MapNode *b, uint32_t shift,
+               PyObject *resolve, Py_ssize_t *added, uint64_t mutid)
 {
-    PyObject *val;
-    map_find_t res = map_find(self, key, &val);
-    switch (res) {
-        case F_ERROR:
-            return NULL;
-        case F_FOUND:
-            Py_INCREF(val);
-            return val;
-        case F_NOT_FOUND:
-            PyErr_SetObject(PyExc_KeyError, key);
-            return NULL;
-        default:
-            abort();
+    /* Return a new node with all key/value pairs of `a` and `b`;
+       both nodes are located at the `shift` level of the tree.
+
+       For keys present in both subtrees the value from `b` is used,
+       unless `resolve` is not NULL, in which case the value is
+       `resolve(key, a_val, b_val)`, even if both values are the same
+       object.
+
+       Subtrees present in only one of the trees are adopted
+       as is, and (without `resolve`) pairs of identical subtrees are
+       skipped, so the cost of the operation is proportional to the
+       size of the region in which `a` and `b` overlap.
+
+       The number of keys of `b` that weren't in `a` is added to
+       *added.
+    */
+
+    if (a == b && resolve == NULL) {
+        Py_INCREF(a);
+        return a;
+    }
+
+    if (!IS_COLLISION_NODE(a) && !IS_COLLISION_NODE(b)) {
+        return map_node_merge_levels(st, a, b, shift, resolve, added, mutid);
     }
+
+    return map_node_merge_items(st, a, b, shift, resolve, added, mutid);
 }
 
-static Py_ssize_t
-map_tp_len(BaseMapObject *self)
+
+/////////////////////////////////// GC Tracking
+
+
+static inline int
+map_may_be_tracked(PyObject *o)
 {
-    return map_len(self);
+    /* Check if "o" can be a part of a reference cycle.  Like dict's
+       MAINTAIN_TRACKING, only trust the tracking status of tuples:
+       other untracked objects (including Maps, as Map.__init__()
+       can be called again) can start being tracked later. */
+
+    if (!PyType_IS_GC(Py_TYPE(o))) {
+        return 0;
+    }
+
+    if (PyTuple_CheckExact(o)) {
+        return PyObject_GC_IsTracked(o);
+    }
+
+    return 1;
 }
 
-static PyObject *
-map_tp_iter(MapObject *self)
+static inline map_gc_state_t
+map_node_gc_state(uint64_t mutid)
 {
-    return map_new_keys_iter(self);
+    if (!(mutid & MAP_MUTID_SETTLED)) {
+        return G_UNSETTLED;
+    }
+    return (mutid & MAP_MUTID_TRACKED) ? G_TRACKED : G_UNTRACKED;
 }
 
-static PyObject *
-map_py_set(MapObject *self, PyObject *args)
+static map_gc_state_t
+map_node_settle_items(PyObject **array, Py_ssize_t size)
 {
-    PyObject *key;
-    PyObject *val;
+    Py_ssize_t i;
 
-    if (!PyArg_UnpackTuple(args, "set", 2, 2, &key, &val)) {
-        return NULL;
+    for (i = 0; i < size; i += 2) {
+        if (map_may_be_tracked(array[i]) ||
+                map_may_be_tracked(array[i + 1]))
+        {
+            return G_TRACKED;
+        }
     }
 
-    return (PyObject *)map_assoc(self, key, val);
+    return G_UNTRACKED;
 }
 
-static PyObject *
-map_py_get(BaseMapObject *self, PyObject *args)
+static map_gc_state_t
+map_node_settle(MapNode *node)
 {
-    PyObject *key;
-    PyObject *def = NULL;
+    /* Untrack "node" and its unsettled subnodes if they can't be
+       a part of a reference cycle.
+
+       Nodes are settled once they become reachable from a MapObject
+       and are never modified after that, so settled nodes are
+       skipped: only the nodes created for the new MapObject
+       are visited.  The number of keys in the subtree is recorded
+       as well (see `map_node_count`).
+    */
 
-    if (!PyArg_UnpackTuple(args, "get", 1, 2, &key, &def)) {
-        return NULL;
-    }
+    uint64_t *mutid;
+    map_gc_state_t state;
+    Py_ssize_t count;
+    Py_ssize_t i;
 
-    PyObject *val = NULL;
-    map_find_t res = map_find(self, key, &val);
-    switch (res) {
-        case F_ERROR:
-            return NULL;
-        case F_FOUND:
-            Py_INCREF(val);
-            return val;
-        case F_NOT_FOUND:
-            if (def == NULL) {
-                Py_RETURN_NONE;
+    if (IS_BITMAP_NODE(node)) {
+        MapNode_Bitmap *b = (MapNode_Bitmap *)node;
+        Py_ssize_t data_size = map_node_bitmap_data_size(b);
+
+        mutid = &b->b_mutid;
+        state = map_node_gc_state(*mutid);
+        if (state != G_UNSETTLED) {
+            return state;
+        }
+
+        state = map_node_settle_items(b->b_array, data_size);
+        count = data_size / 2;
+
+        /* Subnodes have to be settled even if we already know
+           that "node" stays tracked. */
+        for (i = data_size; i < Py_SIZE(b); i++) {
+            MapNode *child = (MapNode *)b->b_array[i];
+            if (map_node_settle(child) == G_TRACKED) {
+                state = G_TRACKED;
             }
-            Py_INCREF(def);
-            return def;
-        default:
-            abort();
+            count += map_node_count(child);
+        }
     }
-}
-
-static PyObject *
-map_py_delete(MapObject *self, PyObject *key)
-{
-    return (PyObject *)map_without(self, key);
-}
+    else if (IS_COLLISION_NODE(node)) {
+        MapNode_Collision *c = (MapNode_Collision *)node;
 
-static PyObject *
-map_py_mutate(MapObject *self, PyObject *args)
-{
+        mutid = &c->c_mutid;
+        state = map_node_gc_state(*mutid);
+        if (state != G_UNSETTLED) {
+            return state;
+        }
 
-    MapMutationObject *o;
-    o = PyObject_GC_New(MapMutationObject, &_MapMutation_Type);
-    if (o == NULL) {
-        return NULL;
+        state = map_node_settle_items(c->c_array, Py_SIZE(c));
+        count = map_node_collision_count(c);
     }
-    o->m_weakreflist = NULL;
-    o->m_count = self->h_count;
+    else {
+        MapNode_Array *a = (MapNode_Array *)node;
+        assert(IS_ARRAY_NODE(node));
 
-    Py_INCREF(self->h_root);
-    o->m_root = self->h_root;
+        mutid = &a->a_mutid;
+        state = map_node_gc_state(*mutid);
+        if (state != G_UNSETTLED) {
+            return state;
+        }
 
-    o->m_mutid = mutid_counter++;
+        state = G_UNTRACKED;
+        count = 0;
+        for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+            MapNode *child = a->a_array[i];
+            map_gc_state_t child_state;
 
-    PyObject_GC_Track(o);
-    return (PyObject *)o;
+            if (child == NULL) {
+                continue;
+            }
+
+            /* Most of the children are shared with older Maps and
+               are already settled. */
+            if (IS_COLLISION_NODE(child)) {
+                child_state = map_node_settle(child);
+                count += map_node_collision_count(
+                    (MapNode_Collision *)child);
+            }
+            else {
+                uint64_t *child_mutid = IS_BITMAP_NODE(child) ?
+                    &((MapNode_Bitmap *)child)->b_mutid :
+                    &((MapNode_Array *)child)->a_mutid;
+                child_state = map_node_gc_state(*child_mutid);
+                if (child_state == G_UNSETTLED) {
+                    child_state = map_node_settle(child);
+                }
+                count += MAP_MUTID_COUNT(*child_mutid);
+            }
+
+            if (child_state == G_TRACKED) {
+                state = G_TRACKED;
+            }
+        }
+    }
+
+    *mutid = MAP_MUTID_SETTLED | ((uint64_t)count << 1);
+    if (state == G_UNTRACKED) {
+        PyObject_GC_UnTrack(node);
+    }
+    else {
+        *mutid |= MAP_MUTID_TRACKED;
+    }
+    return state;
 }
 
-static PyObject *
-map_py_update(MapObject *self, PyObject *args, PyObject *kwds)
+static void
+map_settle(MapObject *o)
 {
-    PyObject *arg = NULL;
-    MapObject *new = NULL;
-    uint64_t mutid = 0;
+    /* Called when "o" gets its root node or its entries: settle the
+       new nodes, and untrack "o" if its root node is untracked (or if
+       all of its keys and values are untracked for flat Maps). */
 
-    if (!PyArg_UnpackTuple(args, "update", 0, 1, &arg)) {
-        return NULL;
-    }
+    map_gc_state_t state;
+    Py_ssize_t i;
 
-    if (arg != NULL) {
-        mutid = mutid_counter++;
-        new = map_update(mutid, self, arg);
-        if (new == NULL) {
-            return NULL;
+    if (IS_FLAT_MAP(o)) {
+        state = G_UNTRACKED;
+        for (i = 0; i < o->h_count; i++) {
+            if (map_may_be_tracked(o->h_entries[i].e_key) ||
+                    map_may_be_tracked(o->h_entries[i].e_val))
+            {
+                state = G_TRACKED;
+                break;
+            }
         }
     }
     else {
-        Py_INCREF(self);
-        new = self;
+        state = map_node_settle(o->h_root);
     }
 
-    if (kwds != NULL) {
-        if (!PyArg_ValidateKeywordArguments(kwds)) {
-            Py_DECREF(new);
-            return NULL;
+    if (state == G_TRACKED) {
+        if (!PyObject_GC_IsTracked((PyObject *)o)) {
+            /* Map.__init__() can be called more than once. */
+            PyObject_GC_Track(o);
         }
+    }
+    else {
+        PyObject_GC_UnTrack(o);
+    }
+}
+
+
+/////////////////////////////////// Flat Maps
+
+
+static map_find_t
+map_entries_find(const MapEntry *entries, Py_ssize_t n,
+                 map_hash_t hash, PyObject *key, Py_ssize_t *idx)
+{
+    /* Find the key among `n` entries with unique keys and set *idx
+       to its position.  Just like in the tree, keys are only compared
+       with __eq__ if their hashes are equal. */
+
+    Py_ssize_t i;
 
-        if (!mutid) {
-            mutid = mutid_counter++;
+    for (i = 0; i < n; i++) {
+        if (entries[i].e_hash != hash) {
+            continue;
         }
 
-        MapObject *new2 = map_update(mutid, new, kwds);
-        Py_DECREF(new);
-        if (new2 == NULL) {
-            return NULL;
+        int cmp = PyObject_RichCompareBool(key, entries[i].e_key, Py_EQ);
+        if (cmp < 0) {
+            return F_ERROR;
+        }
+        if (cmp == 1) {
+            *idx = i;
+            return F_FOUND;
         }
-        new = new2;
     }
 
-    return (PyObject *)new;
+    return F_NOT_FOUND;
 }
 
-static PyObject *
-map_py_items(MapObject *self, PyObject *args)
+static void
+map_entries_copy(MapEntry *dst, const MapEntry *src, Py_ssize_t n)
 {
-    return map_new_items_view(self);
-}
+    Py_ssize_t i;
 
-static PyObject *
-map_py_values(MapObject *self, PyObject *args)
-{
-    return map_new_values_view(self);
+    for (i = 0; i < n; i++) {
+        dst[i] = src[i];
+        Py_INCREF(dst[i].e_key);
+        Py_INCREF(dst[i].e_val);
+    }
 }
 
-static PyObject *
-map_py_keys(MapObject *self, PyObject *args)
+static void
+map_entries_clear(MapObject *o)
 {
-    return map_new_keys_view(self);
+    Py_ssize_t i = o->h_count;
+
+    assert(IS_FLAT_MAP(o));
+
+    o->h_count = 0;
+    while (--i >= 0) {
+        Py_DECREF(o->h_entries[i].e_key);
+        Py_DECREF(o->h_entries[i].e_val);
+    }
 }
 
-static PyObject *
-map_py_dump(MapObject *self, PyObject *args)
+static MapNode *
+map_node_build_flat(MapModuleState *st,
+                    const MapEntry *src, Py_ssize_t n, uint64_t mutid)
 {
-    return map_dump(self);
-}
+    /* Build a tree out of `n` entries with unique keys (up to
+       MAP_FLAT_MAXSIZE + 1 of them), which are borrowed. */
 
+    MapEntry entries[MAP_FLAT_MAXSIZE + 1];
+    MapEntry scratch[MAP_FLAT_MAXSIZE + 1];
+    Py_ssize_t count = 0;
+    Py_ssize_t i;
 
-static PyObject *
-map_py_repr(BaseMapObject *m)
+    assert(n > 0 && n <= MAP_FLAT_MAXSIZE + 1);
+
+    /* map_node_build takes the entries over, and drops the ones
+       with duplicate keys. */
+    map_entries_copy(entries, src, n);
+
+    MapNode *root = map_node_build(st, entries, scratch, n, 0, &count, mutid);
+
+    for (i = 0; i < n; i++) {
+        Py_XDECREF(entries[i].e_key);
+        Py_XDECREF(entries[i].e_val);
+    }
+
+    return root;
+}
+
+static MapNode *
+map_root(MapObject *o, uint64_t mutid)
 {
-    Py_ssize_t i;
-    _PyUnicodeWriter writer;
+    /* Return a new reference to the root node of "o".  A tree is
+       built for flat Maps; its nodes are owned by `mutid`. */
 
+    MapModuleState *st = MAP_STATE(o);
+    if (!IS_FLAT_MAP(o)) {
+        Py_INCREF(o->h_root);
+        return o->h_root;
+    }
 
-    i = Py_ReprEnter((PyObject *)m);
-    if (i != 0) {
-        return i > 0 ? PyUnicode_FromString("{...}") : NULL;
+    if (o->h_count == 0) {
+        return map_node_bitmap_new(st, 0, mutid);
     }
 
-    _PyUnicodeWriter_Init(&writer);
+    return map_node_build_flat(st, o->h_entries, o->h_count, mutid);
+}
 
-    if (MapMutation_Check(m)) {
-        if (_PyUnicodeWriter_WriteASCIIString(
-                &writer, "<immutables.MapMutation({", 25) < 0)
-        {
-            goto error;
+static MapObject *
+map_from_root(MapModuleState *st, MapNode *root, Py_ssize_t count)
+{
+    /* Create a new Map out of the `root` tree with `count` keys;
+       the reference to `root` is stolen.  Small trees are flattened
+       using the hashes stored in them. */
+
+    MapObject *o;
+
+    if (count > MAP_FLAT_MAXSIZE) {
+        o = map_alloc(st, 0);
+        if (o == NULL) {
+            Py_DECREF(root);
+            return NULL;
         }
+
+        o->h_root = root;  /* borrow */
+        o->h_count = count;
     }
     else {
-        if (_PyUnicodeWriter_WriteASCIIString(
-                &writer, "<immutables.Map({", 17) < 0)
-        {
-            goto error;
+        MapIteratorState iter;
+        PyObject *key;
+        PyObject *val;
+
+        o = map_alloc(st, count);
+        if (o == NULL) {
+            Py_DECREF(root);
+            return NULL;
         }
-    }
 
-    MapIteratorState iter;
+        map_iterator_init(&iter, root);
+        while (map_iterator_next(&iter, &key, &val) == I_ITEM) {
+            MapEntry *entry = &o->h_entries[o->h_count++];
+            entry->e_hash = map_iterator_hash(&iter);
+            Py_INCREF(key);
+            entry->e_key = key;
+            Py_INCREF(val);
+            entry->e_val = val;
+        }
+        assert(o->h_count == count);
+
+        Py_DECREF(root);
+    }
+
+    map_settle(o);
+    return o;
+}
+
+static map_find_t
+map_find_hash(BaseMapObject *o, map_hash_t hash,
+              PyObject *key, PyObject **val)
+{
+    if (IS_FLAT_MAP(o)) {
+        MapObject *m = (MapObject *)o;
+        Py_ssize_t idx;
+
+        map_find_t res = map_entries_find(
+            m->h_entries, m->h_count, hash, key, &idx);
+        if (res == F_FOUND) {
+            *val = m->h_entries[idx].e_val;
+        }
+        return res;
+    }
+
+    return map_node_find(o->b_root, 0, hash, key, val);
+}
+
+static MapObject *
+map_flat_assoc(MapObject *o, map_hash_t hash, PyObject *key, PyObject *val)
+{
+    MapModuleState *st = MAP_STATE(o);
+    Py_ssize_t n = o->h_count;
+    Py_ssize_t idx;
+    MapObject *new_o;
+
+    switch (map_entries_find(o->h_entries, n, hash, key, &idx)) {
+        case F_ERROR:
+            return NULL;
+
+        case F_FOUND:
+            if (o->h_entries[idx].e_val == val) {
+                Py_INCREF(o);
+                return o;
+            }
+
+            new_o = map_alloc(st, n);
+            if (new_o == NULL) {
+                return NULL;
+            }
+
+            map_entries_copy(new_o->h_entries, o->h_entries, n);
+            Py_INCREF(val);
+            Py_SETREF(new_o->h_entries[idx].e_val, val);
+            new_o->h_count = n;
+            break;
+
+        case F_NOT_FOUND:
+            if (n < MAP_FLAT_MAXSIZE) {
+                new_o = map_alloc(st, n + 1);
+                if (new_o == NULL) {
+                    return NULL;
+                }
+
+                map_entries_copy(new_o->h_entries, o->h_entries, n);
+                new_o->h_entries[n].e_hash = hash;
+                Py_INCREF(key);
+                new_o->h_entries[n].e_key = key;
+                Py_INCREF(val);
+                new_o->h_entries[n].e_val = val;
+                new_o->h_count = n + 1;
+            }
+            else {
+                /* The Map is too big to stay flat. */
+
+                MapEntry entries[MAP_FLAT_MAXSIZE + 1];
+
+                memcpy(entries, o->h_entries, (size_t)n * sizeof(MapEntry));
+                entries[n].e_hash = hash;
+                entries[n].e_key = key;
+                entries[n].e_val = val;
+
+                MapNode *root = map_node_build_flat(st, entries, n + 1, 0);
+                if (root == NULL) {
+                    return NULL;
+                }
+
+                return map_from_root(st, root, n + 1);
+            }
+            break;
+
+        default:
+            abort();
+    }
+
+    map_settle(new_o);
+    return new_o;
+}
+
+static MapObject *
+map_flat_without(MapObject *o, map_hash_t hash, PyObject *key)
+{
+    MapModuleState *st = MAP_STATE(o);
+    Py_ssize_t n = o->h_count;
+    Py_ssize_t idx;
+
+    switch (map_entries_find(o->h_entries, n, hash, key, &idx)) {
+        case F_ERROR:
+            return NULL;
+
+        case F_NOT_FOUND:
+            PyErr_SetObject(PyExc_KeyError, key);
+            return NULL;
+
+        case F_FOUND: {
+            MapObject *new_o = map_alloc(st, n - 1);
+            if (new_o == NULL) {
+                return NULL;
+            }
+
+            map_entries_copy(new_o->h_entries, o->h_entries, idx);
+            map_entries_copy(new_o->h_entries + idx,
+                             o->h_entries + idx + 1, n - idx - 1);
+            new_o->h_count = n - 1;
+            map_settle(new_o);
+            return new_o;
+        }
+
+        default:
+            abort();
+    }
+}
+
+static MapObject *
+map_flat_merge(MapObject *o, MapObject *other, PyObject *resolve)
+{
+    /* Same as map_node_merge for two flat Maps: the keys of `o` are
+       kept, values from `other` win unless `resolve` says otherwise. */
+
+    MapModuleState *st = MAP_STATE(o);
+    MapBuildBuffer buf;
+    MapObject *new_o = NULL;
+    Py_ssize_t n = o->h_count;
+    Py_ssize_t i;
+    Py_ssize_t idx;
+    int changed = 0;
+
+    map_build_buffer_init(&buf);
+
+    for (i = 0; i < n; i++) {
+        MapEntry *entry = &o->h_entries[i];
+        if (map_build_buffer_append(
+                &buf, entry->e_hash, entry->e_key, entry->e_val))
+        {
+            goto fin;
+        }
+    }
+
+    for (i = 0; i < other->h_count; i++) {
+        MapEntry *entry = &other->h_entries[i];
+
+        switch (map_entries_find(buf.b_entries, n,
+                                 entry->e_hash, entry->e_key, &idx))
+        {
+            case F_ERROR:
+                goto fin;
+
+            case F_NOT_FOUND:
+                if (map_build_buffer_append(
+                        &buf, entry->e_hash, entry->e_key, entry->e_val))
+                {
+                    goto fin;
+                }
+                changed = 1;
+                break;
+
+            case F_FOUND: {
+                PyObject *new_val;
+
+                if (resolve != NULL) {
+                    new_val = PyObject_CallFunctionObjArgs(
+                        resolve, buf.b_entries[idx].e_key,
+                        buf.b_entries[idx].e_val, entry->e_val, NULL);
+                    if (new_val == NULL) {
+                        goto fin;
+                    }
+                }
+                else {
+                    Py_INCREF(entry->e_val);
+                    new_val = entry->e_val;
+                }
+
+                if (new_val != buf.b_entries[idx].e_val) {
+                    changed = 1;
+                }
+                Py_SETREF(buf.b_entries[idx].e_val, new_val);
+                break;
+            }
+
+            default:
+                abort();
+        }
+    }
+
+    if (changed) {
+        new_o = map_from_build_buffer(st, &buf, map_next_mutid(st));
+    }
+    else {
+        Py_INCREF(o);
+        new_o = o;
+    }
+
+fin:
+    map_build_buffer_clear(&buf);
+    return new_o;
+}
+
+
+/////////////////////////////////// HAMT high-level functions
+
+
+static MapObject *
+map_assoc(MapObject *o, PyObject *key, PyObject *val)
+{
+    MapModuleState *st = MAP_STATE(o);
+    map_hash_t key_hash;
+    int added_leaf = 0;
+    MapNode *new_root;
+
+    key_hash = map_hash(key);
+    if (key_hash == -1) {
+        return NULL;
+    }
+
+    if (IS_FLAT_MAP(o)) {
+        return map_flat_assoc(o, key_hash, key, val);
+    }
+
+    new_root = map_node_assoc(
+        st, (MapNode *)(o->h_root),
+        0, key_hash, key, val, &added_leaf,
+        0);
+    if (new_root == NULL) {
+        return NULL;
+    }
+
+    if (new_root == o->h_root) {
+        Py_DECREF(new_root);
+        Py_INCREF(o);
+        return o;
+    }
+
+    return map_from_root(
+        st, new_root, added_leaf ? o->h_count + 1 : o->h_count);
+}
+
+static MapObject *
+map_without(MapObject *o, PyObject *key)
+{
+    MapModuleState *st = MAP_STATE(o);
+
+    map_hash_t key_hash = map_hash(key);
+    if (key_hash == -1) {
+        return NULL;
+    }
+
+    if (IS_FLAT_MAP(o)) {
+        return map_flat_without(o, key_hash, key);
+    }
+
+    MapNode *new_root = NULL;
+
+    map_without_t res = map_node_without(
+        st, (MapNode *)(o->h_root),
+        0, key_hash, key,
+        &new_root,
+        0);
+
+    switch (res) {
+        case W_ERROR:
+            return NULL;
+        case W_EMPTY:
+            return map_new(st);
+        case W_NOT_FOUND:
+            PyErr_SetObject(PyExc_KeyError, key);
+            return NULL;
+        case W_NEWNODE:
+            assert(new_root != NULL);
+            assert(o->h_count > 1);
+            return map_from_root(st, new_root, o->h_count - 1);
+        default:
+            abort();
+    }
+}
+
+static MapObject *
+map_merge(MapObject *o, MapObject *other, PyObject *resolve)
+{
+    MapModuleState *st = MAP_STATE(o);
+    Py_ssize_t added = 0;
+    MapNode *o_root;
+    MapNode *other_root;
+    MapNode *new_root;
+
+    if (other->h_count == 0) {
+        Py_INCREF(o);
+        return o;
+    }
+
+    if (o->h_count == 0) {
+        Py_INCREF(other);
+        return other;
+    }
+
+    if (IS_FLAT_MAP(o) && IS_FLAT_MAP(other)) {
+        return map_flat_merge(o, other, resolve);
+    }
+
+    /* Trees built for flat Maps must not be modified in place:
+       the result is compared with `o_root`. */
+    o_root = map_root(o, 0);
+    if (o_root == NULL) {
+        return NULL;
+    }
+
+    other_root = map_root(other, 0);
+    if (other_root == NULL) {
+        Py_DECREF(o_root);
+        return NULL;
+    }
+
+    new_root = map_node_merge(
+        st, o_root, other_root, 0, resolve, &added,
+        map_next_mutid(st));
+    Py_DECREF(other_root);
+    Py_DECREF(o_root);
+    if (new_root == NULL) {
+        return NULL;
+    }
+
+    if (new_root == o_root) {
+        Py_DECREF(new_root);
+        Py_INCREF(o);
+        return o;
+    }
+
+    return map_from_root(st, new_root, o->h_count + added);
+}
+
+static map_find_t
+map_find(BaseMapObject *o, PyObject *key, PyObject **val)
+{
+    if (o->b_count == 0) {
+        return F_NOT_FOUND;
+    }
+
+    map_hash_t key_hash = map_hash(key);
+    if (key_hash == -1) {
+        return F_ERROR;
+    }
+
+    return map_find_hash(o, key_hash, key, val);
+}
+
+static int
+map_eq(BaseMapObject *v, BaseMapObject *w)
+{
+    if (v == w) {
+        return 1;
+    }
+
+    if (v->b_count != w->b_count) {
+        return 0;
+    }
+
+    if (!IS_FLAT_MAP(v) && !IS_FLAT_MAP(w)) {
+        return map_node_eq(v->b_root, w->b_root, 0);
+    }
+
+    /* A flat Map is compared with a Map of the same size by looking up
+       its keys, using the hashes stored in its entries. */
+
+    if (!IS_FLAT_MAP(v)) {
+        BaseMapObject *tmp = v;
+        v = w;
+        w = tmp;
+    }
+
+    MapObject *flat = (MapObject *)v;
+    Py_ssize_t i;
+
+    for (i = 0; i < flat->h_count; i++) {
+        MapEntry *entry = &flat->h_entries[i];
+        PyObject *w_val;
+
+        switch (map_find_hash(w, entry->e_hash, entry->e_key, &w_val)) {
+            case F_ERROR:
+                return -1;
+
+            case F_NOT_FOUND:
+                return 0;
+
+            case F_FOUND: {
+                int cmp = PyObject_RichCompareBool(
+                    entry->e_val, w_val, Py_EQ);
+                if (cmp != 1) {
+                    return cmp;
+                }
+                break;
+            }
+
+            default:
+                abort();
+        }
+    }
+
+    return 1;
+}
+
+static Py_ssize_t
+map_len(BaseMapObject *o)
+{
+    return o->b_count;
+}
+
+static MapObject *
+map_alloc(MapModuleState *st, Py_ssize_t size)
+{
+    /* Allocate a flat Map with room for `size` entries; Maps
+       with trees are allocated with size 0. */
+
+    MapObject *o;
+
+    assert(size >= 0 && size <= MAP_FLAT_MAXSIZE);
+
+    if (st->ms_map_freelist[size] != NULL) {
+        o = st->ms_map_freelist[size];
+        st->ms_map_freelist[size] = (MapObject *)o->h_root;
+        st->ms_map_freelist_len[size]--;
+        (void)PyObject_InitVar((PyVarObject *)o, st->ms_map_type, size);
+    }
+    else {
+        o = PyObject_GC_NewVar(MapObject, st->ms_map_type, size);
+        if (o == NULL) {
+            return NULL;
+        }
+    }
+    o->h_weakreflist = NULL;
+    o->h_hash = -1;
+    o->h_count = 0;
+    o->h_root = NULL;
+    PyObject_GC_Track(o);
+    return o;
+}
+
+static MapObject *
+map_new(MapModuleState *st)
+{
+    MapObject *o = map_alloc(st, 0);
+    if (o == NULL) {
+        return NULL;
+    }
+
+    map_settle(o);
+    return o;
+}
+
+static PyObject *
+map_dump(MapObject *self)
+{
+    _PyUnicodeWriter writer;
+    Py_ssize_t i;
+
+    _PyUnicodeWriter_Init(&writer);
+
+    if (_map_dump_format(&writer, "HAMT(len=%zd):\n", self->h_count)) {
+        goto error;
+    }
+
+    if (IS_FLAT_MAP(self)) {
+        if (_map_dump_ident(&writer, 1)) {
+            goto error;
+        }
+
+        if (_map_dump_format(&writer, "FlatMap(size=%zd count=%zd):\n",
+                             Py_SIZE(self), self->h_count))
+        {
+            goto error;
+        }
+
+        for (i = 0; i < self->h_count; i++) {
+            if (_map_dump_ident(&writer, 2)) {
+                goto error;
+            }
+
+            if (_map_dump_format(&writer, "%R: %R\n",
+                                 self->h_entries[i].e_key,
+                                 self->h_entries[i].e_val))
+            {
+                goto error;
+            }
+        }
+    }
+    else if (map_node_dump(self->h_root, &writer, 0)) {
+        goto error;
+    }
+
+    return _PyUnicodeWriter_Finish(&writer);
+
+error:
+    _PyUnicodeWriter_Dealloc(&writer);
+    return NULL;
+}
+
+
+static void
+map_collect_stats(MapObject *self, MapStats *stats)
+{
+    memset(stats, 0, sizeof(MapStats));
+
+    /* Flat Maps store their entries in the Map object itself. */
+    stats->s_bytes = Py_TYPE(self)->tp_basicsize +
+        Py_SIZE(self) * Py_TYPE(self)->tp_itemsize;
+
+    if (IS_FLAT_MAP(self)) {
+        stats->s_depths[0] = self->h_count;
+    }
+    else {
+        map_node_stats(self->h_root, 0, stats);
+    }
+}
+
+static PyObject *
+map_stats(MapObject *self)
+{
+    MapStats stats;
+    PyObject *depths = NULL;
+    Py_ssize_t ndepths = 0;
+    Py_ssize_t nodes;
+    Py_ssize_t i;
+
+    map_collect_stats(self, &stats);
+
+    for (i = 0; i < _Py_HAMT_MAX_TREE_DEPTH; i++) {
+        if (stats.s_depths[i] != 0) {
+            ndepths = i + 1;
+        }
+    }
+
+    depths = PyList_New(ndepths);
+    if (depths == NULL) {
+        return NULL;
+    }
+    for (i = 0; i < ndepths; i++) {
+        PyObject *n = PyLong_FromSsize_t(stats.s_depths[i]);
+        if (n == NULL) {
+            Py_DECREF(depths);
+            return NULL;
+        }
+        PyList_SET_ITEM(depths, i, n);
+    }
+
+    nodes = stats.s_bitmap_nodes + stats.s_array_nodes;
+
+    return Py_BuildValue(
+        "{s:n,s:n,s:n,s:N,s:d,s:n}",
+        "bitmap_nodes", stats.s_bitmap_nodes,
+        "array_nodes", stats.s_array_nodes,
+        "collision_nodes", stats.s_collision_nodes,
+        "depths", depths,
+        "fill", nodes == 0 ? 0.0 :
+            (double)stats.s_slots / (double)(nodes * HAMT_ARRAY_NODE_SIZE),
+        "bytes", stats.s_bytes);
+}
+
+
+/////////////////////////////////// Iterators: Shared Iterator Implementation
+
+
+static int
+map_baseiter_tp_clear(MapIterator *it)
+{
+    Py_CLEAR(it->mi_obj);
+    return 0;
+}
+
+static void
+map_baseiter_tp_dealloc(MapIterator *it)
+{
+    PyTypeObject *tp = Py_TYPE(it);
+    MapModuleState *st = map_dealloc_state(tp);
+
+    PyObject_GC_UnTrack(it);
+    (void)map_baseiter_tp_clear(it);
+    if (MAP_USE_FREELISTS && st != NULL &&
+            st->ms_iter_freelist_len < MAP_ITER_FREELIST_MAXLEN)
+    {
+        /* All iterator types share the MapIterator layout. */
+        st->ms_iter_freelist[st->ms_iter_freelist_len++] = it;
+    }
+    else {
+        PyObject_GC_Del(it);
+    }
+    MAP_DECREF_TYPE(tp);
+}
+
+static int
+map_baseiter_tp_traverse(MapIterator *it, visitproc visit, void *arg)
+{
+    MAP_VISIT_TYPE(it);
+    Py_VISIT(it->mi_obj);
+    return 0;
+}
+
+static PyObject *
+map_baseiter_tp_iternext(MapIterator *it)
+{
+    PyObject *key;
+    PyObject *val;
+    map_iter_t res;
+
+    Py_BEGIN_CRITICAL_SECTION(it);
+    res = map_iterator_next(&it->mi_iter, &key, &val);
+    Py_END_CRITICAL_SECTION();
+
+    switch (res) {
+        case I_END:
+            PyErr_SetNone(PyExc_StopIteration);
+            return NULL;
+
+        case I_ITEM: {
+            return (*(it->mi_yield))(key, val);
+        }
+
+        default: {
+            abort();
+        }
+    }
+}
+
+static int
+map_baseview_tp_clear(MapView *view)
+{
+    Py_CLEAR(view->mv_obj);
+    Py_CLEAR(view->mv_itertype);
+    return 0;
+}
+
+static void
+map_baseview_tp_dealloc(MapView *view)
+{
+    PyTypeObject *tp = Py_TYPE(view);
+
+    PyObject_GC_UnTrack(view);
+    (void)map_baseview_tp_clear(view);
+    PyObject_GC_Del(view);
+    MAP_DECREF_TYPE(tp);
+}
+
+static int
+map_baseview_tp_traverse(MapView *view, visitproc visit, void *arg)
+{
+    MAP_VISIT_TYPE(view);
+    Py_VISIT(view->mv_obj);
+    Py_VISIT(view->mv_itertype);
+    return 0;
+}
+
+static Py_ssize_t
+map_baseview_tp_len(MapView *view)
+{
+    return view->mv_obj->h_count;
+}
+
+static PyObject *
+map_baseview_newiter(PyTypeObject *type, binaryfunc yield, MapObject *map)
+{
+    MapModuleState *st = MAP_STATE(map);
+    MapIterator *iter;
+
+    if (st->ms_iter_freelist_len > 0) {
+        iter = st->ms_iter_freelist[--st->ms_iter_freelist_len];
+        (void)PyObject_Init((PyObject *)iter, type);
+    }
+    else {
+        iter = PyObject_GC_New(MapIterator, type);
+        if (iter == NULL) {
+            return NULL;
+        }
+    }
+
+    Py_INCREF(map);
+    iter->mi_obj = map;
+    iter->mi_yield = yield;
+    map_iterator_init_map(&iter->mi_iter, (BaseMapObject *)map);
+
+    PyObject_GC_Track(iter);
+    return (PyObject *)iter;
+}
+
+static PyObject *
+map_baseview_iter(MapView *view)
+{
+    return map_baseview_newiter(
+        view->mv_itertype, view->mv_yield, view->mv_obj);
+}
+
+static PyObject *
+map_baseview_new(PyTypeObject *type, binaryfunc yield,
+                 MapObject *o, PyTypeObject *itertype)
+{
+    MapView *view = PyObject_GC_New(MapView, type);
+    if (view == NULL) {
+        return NULL;
+    }
+
+    Py_INCREF(o);
+    view->mv_obj = o;
+    view->mv_yield = yield;
+
+    Py_INCREF(itertype);
+    view->mv_itertype = itertype;
+
+    PyObject_GC_Track(view);
+    return (PyObject *)view;
+}
+
+/* All iterator types share one set of slots; the views of keys and
+   of items also support set operations. */
+static PyType_Slot MapIter_slots[] = {
+    {Py_tp_dealloc, map_baseiter_tp_dealloc},
+    {Py_tp_traverse, map_baseiter_tp_traverse},
+    {Py_tp_clear, map_baseiter_tp_clear},
+    {Py_tp_iter, PyObject_SelfIter},
+    {Py_tp_iternext, map_baseiter_tp_iternext},
+    {0, NULL}
+};
+
+#define ITERATOR_TYPE_SPEC(type_name)                           \
+    {                                                           \
+        .name = "immutables._map." type_name,                   \
+        .basicsize = sizeof(MapIterator),                       \
+        .flags = MAP_TPFLAGS_INTERNAL,                          \
+        .slots = MapIter_slots,                                 \
+    }
+
+
+#define VIEW_TYPE_SHARED_SLOTS                                  \
+    {Py_mp_length, map_baseview_tp_len},                        \
+    {Py_tp_dealloc, map_baseview_tp_dealloc},                   \
+    {Py_tp_traverse, map_baseview_tp_traverse},                 \
+    {Py_tp_clear, map_baseview_tp_clear},                       \
+    {Py_tp_iter, map_baseview_iter},
+
+
+/////////////////////////////////// Set Operations on Views
+
+
+static PyObject *
+map_view_new_like(MapView *view, MapObject *o)
+{
+    /* Create a view of the same kind as `view` for the `o` map. */
+    return map_baseview_new(
+        Py_TYPE(view), view->mv_yield, o, view->mv_itertype);
+}
+
+static PyObject *
+map_view_set_op(PyObject *self, PyObject *other, const char *method)
+{
+    /* Fallback for operands that are not views of the same kind:
+       just like dict views do, convert the left operand to a set and
+       apply the operation to it. */
+
+    PyObject *res = PySet_New(self);
+    if (res == NULL) {
+        return NULL;
+    }
+
+    PyObject *tmp = PyObject_CallMethod(res, method, "(O)", other);
+    if (tmp == NULL) {
+        Py_DECREF(res);
+        return NULL;
+    }
+    Py_DECREF(tmp);
+
+    return res;
+}
+
+static int
+map_view_issubset(MapView *view, MapView *other)
+{
+    MapModuleState *st = MAP_STATE(view);
+
+    if (view->mv_obj->h_count > other->mv_obj->h_count) {
+        return 0;
+    }
+
+    MapObject *diff = map_select(
+        view->mv_obj, other->mv_obj, 1, MapItems_Check(st, view));
+    if (diff == NULL) {
+        return -1;
+    }
+
+    int res = diff->h_count == 0;
+    Py_DECREF(diff);
+    return res;
+}
+
+static PyObject *
+map_view_select(PyObject *self, PyObject *other, int difference)
+{
+    if (Py_TYPE(self) != Py_TYPE(other)) {
+        return map_view_set_op(
+            self, other,
+            difference ? "difference_update" : "intersection_update");
+    }
+
+    MapView *view = (MapView *)self;
+    MapObject *o = map_select(
+        view->mv_obj, ((MapView *)other)->mv_obj, difference,
+        MapItems_Check(MAP_STATE(self), self));
+    if (o == NULL) {
+        return NULL;
+    }
+
+    PyObject *res = map_view_new_like(view, o);
+    Py_DECREF(o);
+    return res;
+}
+
+static PyObject *
+map_view_and(PyObject *self, PyObject *other)
+{
+    return map_view_select(self, other, 0);
+}
+
+static PyObject *
+map_view_sub(PyObject *self, PyObject *other)
+{
+    return map_view_select(self, other, 1);
+}
+
+static PyObject *
+map_view_or(PyObject *self, PyObject *other)
+{
+    /* A union of two item views can have several values for one key,
+       hence it can't be represented by a Map. */
+    if (Py_TYPE(self) != Py_TYPE(other) ||
+            MapItems_Check(MAP_STATE(self), self))
+    {
+        return map_view_set_op(self, other, "update");
+    }
+
+    MapView *view = (MapView *)self;
+    MapObject *o = map_merge(((MapView *)other)->mv_obj, view->mv_obj, NULL);
+    if (o == NULL) {
+        return NULL;
+    }
+
+    PyObject *res = map_view_new_like(view, o);
+    Py_DECREF(o);
+    return res;
+}
+
+static PyObject *
+map_view_xor(PyObject *self, PyObject *other)
+{
+    if (Py_TYPE(self) != Py_TYPE(other) ||
+            MapItems_Check(MAP_STATE(self), self))
+    {
+        return map_view_set_op(self, other, "symmetric_difference_update");
+    }
+
+    MapView *view = (MapView *)self;
+    MapObject *m1 = view->mv_obj;
+    MapObject *m2 = ((MapView *)other)->mv_obj;
+    MapObject *o = NULL;
+    PyObject *res = NULL;
+
+    MapObject *diff1 = map_select(m1, m2, 1, 0);
+    if (diff1 == NULL) {
+        return NULL;
+    }
+
+    MapObject *diff2 = map_select(m2, m1, 1, 0);
+    if (diff2 == NULL) {
+        goto fin;
+    }
+
+    o = map_merge(diff1, diff2, NULL);
+    if (o == NULL) {
+        goto fin;
+    }
+
+    res = map_view_new_like(view, o);
+
+fin:
+    Py_DECREF(diff1);
+    Py_XDECREF(diff2);
+    Py_XDECREF(o);
+    return res;
+}
+
+static PyObject *
+map_view_isdisjoint(MapView *self, PyObject *other)
+{
+    MapModuleState *st = MAP_STATE(self);
+
+    if (Py_TYPE(self) != Py_TYPE(other)) {
+        PyObject *set = PySet_New((PyObject *)self);
+        if (set == NULL) {
+            return NULL;
+        }
+
+        PyObject *res = PyObject_CallMethod(set, "isdisjoint", "(O)", other);
+        Py_DECREF(set);
+        return res;
+    }
+
+    MapObject *o = map_select(
+        self->mv_obj, ((MapView *)other)->mv_obj, 0, MapItems_Check(st, self));
+    if (o == NULL) {
+        return NULL;
+    }
+
+    PyObject *res = PyBool_FromLong(o->h_count == 0);
+    Py_DECREF(o);
+    return res;
+}
+
+static PyObject *
+map_view_tp_richcompare(PyObject *self, PyObject *other, int op)
+{
+    if (Py_TYPE(self) != Py_TYPE(other)) {
+        if (!PyAnySet_Check(other)) {
+            Py_RETURN_NOTIMPLEMENTED;
+        }
+
+        PyObject *set = PySet_New(self);
+        if (set == NULL) {
+            return NULL;
+        }
+
+        PyObject *res = PyObject_RichCompare(set, other, op);
+        Py_DECREF(set);
+        return res;
+    }
+
+    MapView *v = (MapView *)self;
+    MapView *w = (MapView *)other;
+    Py_ssize_t v_count = v->mv_obj->h_count;
+    Py_ssize_t w_count = w->mv_obj->h_count;
+    int res;
+
+    switch (op) {
+        case Py_EQ:
+        case Py_NE:
+            res = v_count == w_count ? map_view_issubset(v, w) : 0;
+            if (res >= 0 && op == Py_NE) {
+                res = !res;
+            }
+            break;
+        case Py_LE:
+            res = map_view_issubset(v, w);
+            break;
+        case Py_LT:
+            res = v_count < w_count ? map_view_issubset(v, w) : 0;
+            break;
+        case Py_GE:
+            res = map_view_issubset(w, v);
+            break;
+        case Py_GT:
+            res = v_count > w_count ? map_view_issubset(w, v) : 0;
+            break;
+        default:
+            abort();
+    }
+
+    if (res < 0) {
+        return NULL;
+    }
+
+    return PyBool_FromLong(res);
+}
+
+static PyMethodDef MapView_methods[] = {
+    {"isdisjoint", (PyCFunction)map_view_isdisjoint, METH_O, NULL},
+    {NULL, NULL}
+};
+
+#define SET_VIEW_TYPE_SLOTS                                     \
+    {Py_nb_subtract, map_view_sub},                             \
+    {Py_nb_and, map_view_and},                                  \
+    {Py_nb_xor, map_view_xor},                                  \
+    {Py_nb_or, map_view_or},                                    \
+    {Py_tp_richcompare, map_view_tp_richcompare},               \
+    {Py_tp_methods, MapView_methods},
+
+#define VIEW_TYPE_SPEC(type_name, type_slots)                   \
+    {                                                           \
+        .name = "immutables._map." type_name,                   \
+        .basicsize = sizeof(MapView),                           \
+        .flags = MAP_TPFLAGS_INTERNAL,                          \
+        .slots = type_slots,                                    \
+    }
+
+
+/////////////////////////////////// MapItems
+
+
+static PyType_Slot MapItems_slots[] = {
+    VIEW_TYPE_SHARED_SLOTS
+    SET_VIEW_TYPE_SLOTS
+    {0, NULL}
+};
+
+static PyType_Spec MapItems_spec = VIEW_TYPE_SPEC("items", MapItems_slots);
+
+static PyType_Spec MapItemsIter_spec = ITERATOR_TYPE_SPEC("items_iterator");
+
+static PyObject *
+map_iter_yield_items(PyObject *key, PyObject *val)
+{
+    return PyTuple_Pack(2, key, val);
+}
+
+static PyObject *
+map_new_items_view(MapObject *o)
+{
+    MapModuleState *st = MAP_STATE(o);
+
+    return map_baseview_new(
+        st->ms_items_type, map_iter_yield_items, o,
+        st->ms_items_iter_type);
+}
+
+
+/////////////////////////////////// MapKeys
+
+
+static PyType_Slot MapKeys_slots[] = {
+    VIEW_TYPE_SHARED_SLOTS
+    SET_VIEW_TYPE_SLOTS
+    {0, NULL}
+};
+
+static PyType_Spec MapKeys_spec = VIEW_TYPE_SPEC("keys", MapKeys_slots);
+
+static PyType_Spec MapKeysIter_spec = ITERATOR_TYPE_SPEC("keys_iterator");
+
+static PyObject *
+map_iter_yield_keys(PyObject *key, PyObject *val)
+{
+    Py_INCREF(key);
+    return key;
+}
+
+static PyObject *
+map_new_keys_iter(MapObject *o)
+{
+    return map_baseview_newiter(
+        MAP_STATE(o)->ms_keys_iter_type, map_iter_yield_keys, o);
+}
+
+static PyObject *
+map_new_keys_view(MapObject *o)
+{
+    MapModuleState *st = MAP_STATE(o);
+
+    return map_baseview_new(
+        st->ms_keys_type, map_iter_yield_keys, o,
+        st->ms_keys_iter_type);
+}
+
+/////////////////////////////////// MapValues
+
+
+static PyType_Slot MapValues_slots[] = {
+    VIEW_TYPE_SHARED_SLOTS
+    {0, NULL}
+};
+
+static PyType_Spec MapValues_spec = VIEW_TYPE_SPEC("values", MapValues_slots);
+
+static PyType_Spec MapValuesIter_spec =
+    ITERATOR_TYPE_SPEC("values_iterator");
+
+static PyObject *
+map_iter_yield_values(PyObject *key, PyObject *val)
+{
+    Py_INCREF(val);
+    return val;
+}
+
+static PyObject *
+map_new_values_view(MapObject *o)
+{
+    MapModuleState *st = MAP_STATE(o);
+
+    return map_baseview_new(
+        st->ms_values_type, map_iter_yield_values, o,
+        st->ms_values_iter_type);
+}
+
+
+/////////////////////////////////// Map
+
+
+static PyObject *
+map_dump(MapObject *self);
+
+
+static int
+map_check_nargs(const char *name, Py_ssize_t nargs,
+                Py_ssize_t min, Py_ssize_t max)
+{
+    /* Check the number of positional arguments the same way
+       PyArg_UnpackTuple does. */
+
+    if (nargs < min) {
+        PyErr_Format(
+            PyExc_TypeError,
+            "%.200s expected %s%zd argument%s, got %zd",
+            name, (min == max ? "" : "at least "),
+            min, min == 1 ? "" : "s", nargs);
+        return 0;
+    }
+
+    if (nargs > max) {
+        PyErr_Format(
+            PyExc_TypeError,
+            "%.200s expected %s%zd argument%s, got %zd",
+            name, (min == max ? "" : "at most "),
+            max, max == 1 ? "" : "s", nargs);
+        return 0;
+    }
+
+    return 1;
+}
+
+
+static MapObject *
+map_new_for_args(MapModuleState *st, PyObject *arg, Py_ssize_t nkwds)
+{
+    /* Create an empty Map with room for the items of Map(arg, **kwds)
+       if it is going to be flat. */
+
+    Py_ssize_t size = nkwds;
+
+    if (arg != NULL && Map_Check(st, arg)) {
+        size += IS_FLAT_MAP(arg) ? ((MapObject *)arg)->h_count :
+                                   MAP_FLAT_MAXSIZE + 1;
+    }
+    else if (arg != NULL && PyDict_Check(arg)) {
+        size += PyDict_GET_SIZE(arg);
+    }
+    else if (arg != NULL) {
+        Py_ssize_t hint = PyObject_LengthHint(arg, MAP_FLAT_MAXSIZE);
+        if (hint < 0) {
+            return NULL;
+        }
+        size += hint;
+    }
+
+    MapObject *o = map_alloc(st, size <= MAP_FLAT_MAXSIZE ? size : 0);
+    if (o == NULL) {
+        return NULL;
+    }
+
+    map_settle(o);
+    return o;
+}
+
+
+static PyObject *
+map_tp_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    MapModuleState *st = MAP_TYPE_STATE(type);
+    PyObject *arg = NULL;
+
+    if (!PyArg_UnpackTuple(args, "immutables.Map", 0, 1, &arg)) {
+        return NULL;
+    }
+
+    return (PyObject *)map_new_for_args(
+        st, arg, kwds != NULL ? PyDict_GET_SIZE(kwds) : 0);
+}
+
+
+static int
+map_init(MapObject *self, PyObject *arg, PyObject *kwds)
+{
+    MapModuleState *st = MAP_STATE(self);
+    MapBuildBuffer buf;
+    uint64_t mutid;
+    int ret = -1;
+
+    if (arg != NULL && MapMutation_Check(st, arg)) {
+        PyErr_Format(
+            PyExc_TypeError,
+            "cannot create Maps from MapMutations");
+        return -1;
+    }
+
+    if (kwds != NULL && !PyArg_ValidateKeywordArguments(kwds)) {
+        return -1;
+    }
+
+    if (arg != NULL && Map_Check(st, arg)) {
+        /* The contents of "self" are replaced with the contents of
+           the other Map. */
+
+        MapObject *other = (MapObject *)arg;
+        MapNode *root = NULL;
+        arg = NULL;
+
+        if (other != self) {
+            if (!IS_FLAT_MAP(other) || other->h_count > Py_SIZE(self)) {
+                root = map_root(other, 0);
+                if (root == NULL) {
+                    return -1;
+                }
+            }
+
+            if (IS_FLAT_MAP(self)) {
+                map_entries_clear(self);
+            }
+            else {
+                Py_CLEAR(self->h_root);
+            }
+
+            if (root != NULL) {
+                self->h_root = root;
+            }
+            else {
+                map_entries_copy(
+                    self->h_entries, other->h_entries, other->h_count);
+            }
+            self->h_count = other->h_count;
+            MAP_STORE_HASH(self->h_hash, MAP_LOAD_HASH(other->h_hash));
+        }
+    }
+
+    if (arg == NULL && kwds == NULL) {
+        map_settle(self);
+        return 0;
+    }
+
+    MAP_STORE_HASH(self->h_hash, -1);
+    mutid = map_next_mutid(st);
+
+    if (!IS_FLAT_MAP(self)) {
+        if (arg != NULL &&
+                map_update_inplace(mutid, (BaseMapObject *)self, arg))
+        {
+            return -1;
+        }
+
+        if (kwds != NULL &&
+                map_update_inplace(mutid, (BaseMapObject *)self, kwds))
+        {
+            return -1;
+        }
+
+        map_settle(self);
+        return 0;
+    }
+
+    map_build_buffer_init(&buf);
+
+    if (map_build_buffer_extend(st, &buf, (PyObject *)self)) {
+        goto err;
+    }
+    if (arg != NULL && map_build_buffer_extend(st, &buf, arg)) {
+        goto err;
+    }
+    if (kwds != NULL && map_build_buffer_extend(st, &buf, kwds)) {
+        goto err;
+    }
+
+    map_entries_clear(self);
+    if (map_set_entries(self, &buf, mutid)) {
+        goto err;
+    }
+
+    map_settle(self);
+    ret = 0;
+
+err:
+    map_build_buffer_clear(&buf);
+    return ret;
+}
+
+
+static int
+map_tp_init(MapObject *self, PyObject *args, PyObject *kwds)
+{
+    PyObject *arg = NULL;
+
+    int res;
+
+    if (!PyArg_UnpackTuple(args, "immutables.Map", 0, 1, &arg)) {
+        return -1;
+    }
+
+    Py_BEGIN_CRITICAL_SECTION(self);
+    res = map_init(self, arg, kwds);
+    Py_END_CRITICAL_SECTION();
+    return res;
+}
+
+
+#if PY_VERSION_HEX >= 0x030900A4
+static PyObject *
+map_vectorcall(PyObject *type, PyObject *const *args,
+               size_t nargsf, PyObject *kwnames)
+{
+    /* Calling Map() goes through tp_new and tp_init with an argument
+       tuple and a keyword arguments dict; skip all of that when
+       possible. */
+
+    MapModuleState *st = MAP_TYPE_STATE((PyTypeObject *)type);
+    Py_ssize_t nargs = PyVectorcall_NARGS(nargsf);
+    PyObject *kwds = NULL;
+    Py_ssize_t i;
+
+    if (!map_check_nargs("immutables.Map", nargs, 0, 1)) {
+        return NULL;
+    }
+
+    MapObject *o = map_new_for_args(
+        st, nargs ? args[0] : NULL,
+        kwnames != NULL ? PyTuple_GET_SIZE(kwnames) : 0);
+    if (o == NULL) {
+        return NULL;
+    }
+
+    if (kwnames != NULL && PyTuple_GET_SIZE(kwnames) > 0) {
+        kwds = PyDict_New();
+        if (kwds == NULL) {
+            goto err;
+        }
+
+        for (i = 0; i < PyTuple_GET_SIZE(kwnames); i++) {
+            if (PyDict_SetItem(kwds, PyTuple_GET_ITEM(kwnames, i),
+                               args[nargs + i]))
+            {
+                goto err;
+            }
+        }
+    }
+
+    if (map_init(o, nargs ? args[0] : NULL, kwds)) {
+        goto err;
+    }
+
+    Py_XDECREF(kwds);
+    return (PyObject *)o;
+
+err:
+    Py_XDECREF(kwds);
+    Py_DECREF(o);
+    return NULL;
+}
+#endif
+
+
+static int
+map_tp_clear(BaseMapObject *self)
+{
+    if (IS_FLAT_MAP(self)) {
+        map_entries_clear((MapObject *)self);
+    }
+    else {
+        Py_CLEAR(self->b_root);
+        self->b_count = 0;
+    }
+    return 0;
+}
+
+
+static int
+map_tp_traverse(BaseMapObject *self, visitproc visit, void *arg)
+{
+    MAP_VISIT_TYPE(self);
+    if (IS_FLAT_MAP(self)) {
+        MapObject *o = (MapObject *)self;
+        Py_ssize_t i;
+
+        for (i = 0; i < o->h_count; i++) {
+            Py_VISIT(o->h_entries[i].e_key);
+            Py_VISIT(o->h_entries[i].e_val);
+        }
+    }
+    else {
+        Py_VISIT(self->b_root);
+    }
+    return 0;
+}
+
+static void
+map_tp_dealloc(BaseMapObject *self)
+{
+    PyTypeObject *tp = Py_TYPE(self);
+    MapModuleState *st = map_dealloc_state(tp);
+
+    PyObject_GC_UnTrack(self);
+    if (self->b_weakreflist != NULL) {
+        PyObject_ClearWeakRefs((PyObject*)self);
+    }
+    (void)map_tp_clear(self);
+    if (MAP_USE_FREELISTS && st != NULL && tp == st->ms_map_type &&
+            st->ms_map_freelist_len[Py_SIZE(self)] < MAP_FREELIST_MAXLEN)
+    {
+        MapObject *o = (MapObject *)self;
+        o->h_root = (MapNode *)st->ms_map_freelist[Py_SIZE(o)];
+        st->ms_map_freelist[Py_SIZE(o)] = o;
+        st->ms_map_freelist_len[Py_SIZE(o)]++;
+    }
+    else {
+        tp->tp_free(self);
+    }
+    MAP_DECREF_TYPE(tp);
+}
+
+
+static PyObject *
+map_tp_richcompare(PyObject *v, PyObject *w, int op)
+{
+    MapModuleState *st = MAP_STATE(v);
+
+    if (!Map_Check(st, v) || !Map_Check(st, w) ||
+            (op != Py_EQ && op != Py_NE))
+    {
+        Py_RETURN_NOTIMPLEMENTED;
+    }
+
+    int res = map_eq((BaseMapObject *)v, (BaseMapObject *)w);
+    if (res < 0) {
+        return NULL;
+    }
+
+    if (op == Py_NE) {
+        res = !res;
+    }
+
+    if (res) {
+        Py_RETURN_TRUE;
+    }
+    else {
+        Py_RETURN_FALSE;
+    }
+}
+
+static int
+map_tp_contains(BaseMapObject *self, PyObject *key)
+{
+    PyObject *val;
+    map_find_t res = map_find(self, key, &val);
+    switch (res) {
+        case F_ERROR:
+            return -1;
+        case F_NOT_FOUND:
+            return 0;
+        case F_FOUND:
+            return 1;
+        default:
+            abort();
+    }
+}
+
+static PyObject *
+map_tp_subscript(BaseMapObject *self, PyObject *key)
+{
+    PyObject *val;
+    map_find_t res = map_find(self, key, &val);
+    switch (res) {
+        case F_ERROR:
+            return NULL;
+        case F_FOUND:
+            Py_INCREF(val);
+            return val;
+        case F_NOT_FOUND:
+            PyErr_SetObject(PyExc_KeyError, key);
+            return NULL;
+        default:
+            abort();
+    }
+}
+
+static Py_ssize_t
+map_tp_len(BaseMapObject *self)
+{
+    return map_len(self);
+}
+
+static PyObject *
+map_tp_iter(MapObject *self)
+{
+    return map_new_keys_iter(self);
+}
+
+static PyObject *
+map_py_set(MapObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    if (!map_check_nargs("set", nargs, 2, 2)) {
+        return NULL;
+    }
+
+    return (PyObject *)map_assoc(self, args[0], args[1]);
+}
+
+MAP_FASTCALL_WRAPPER(map_py_set, MapObject)
+
+static PyObject *
+map_py_get(BaseMapObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    if (!map_check_nargs("get", nargs, 1, 2)) {
+        return NULL;
+    }
+
+    PyObject *key = args[0];
+    PyObject *def = nargs > 1 ? args[1] : NULL;
+
+    PyObject *val = NULL;
+    map_find_t res = map_find(self, key, &val);
+    switch (res) {
+        case F_ERROR:
+            return NULL;
+        case F_FOUND:
+            Py_INCREF(val);
+            return val;
+        case F_NOT_FOUND:
+            if (def == NULL) {
+                Py_RETURN_NONE;
+            }
+            Py_INCREF(def);
+            return def;
+        default:
+            abort();
+    }
+}
+
+MAP_FASTCALL_WRAPPER(map_py_get, BaseMapObject)
+
+static PyObject *
+map_py_get_many(MapObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"keys", "default", NULL};
+
+    PyObject *keys;
+    PyObject *def = Py_None;
+    PyObject *key;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|O:get_many", kwlist,
+                                     &keys, &def))
+    {
+        return NULL;
+    }
+
+    /* Keys' __hash__ and __eq__ can modify `keys`, so it is iterated
+       over instead of being accessed as an array. */
+    PyObject *it = PyObject_GetIter(keys);
+    if (it == NULL) {
+        return NULL;
+    }
+
+    PyObject *res = PyList_New(0);
+    if (res == NULL) {
+        Py_DECREF(it);
+        return NULL;
+    }
+
+    while ((key = PyIter_Next(it))) {
+        PyObject *val;
+
+        switch (map_find((BaseMapObject *)self, key, &val)) {
+            case F_ERROR:
+                Py_DECREF(key);
+                goto error;
+            case F_FOUND:
+                break;
+            case F_NOT_FOUND:
+                val = def;
+                break;
+            default:
+                abort();
+        }
+
+        Py_DECREF(key);
+        if (PyList_Append(res, val)) {
+            goto error;
+        }
+    }
+
+    if (PyErr_Occurred()) {
+        goto error;
+    }
+
+    Py_DECREF(it);
+    return res;
+
+error:
+    Py_DECREF(it);
+    Py_DECREF(res);
+    return NULL;
+}
+
+static PyObject *
+map_py_take(MapObject *self, PyObject *keys)
+{
+    return (PyObject *)map_take(self, keys);
+}
+
+static PyObject *
+map_py_delete(MapObject *self, PyObject *key)
+{
+    return (PyObject *)map_without(self, key);
+}
+
+static PyObject *
+map_py_delete_many(MapObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"keys", "missing_ok", NULL};
+
+    PyObject *keys;
+    int missing_ok = 1;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|p:delete_many", kwlist,
+                                     &keys, &missing_ok))
+    {
+        return NULL;
+    }
+
+    return (PyObject *)map_delete_many(self, keys, missing_ok);
+}
+
+static PyObject *
+map_py_filter(MapObject *self, PyObject *pred)
+{
+    return (PyObject *)map_transform(self, T_FILTER, pred);
+}
+
+static PyObject *
+map_py_filter_keys(MapObject *self, PyObject *pred)
+{
+    return (PyObject *)map_transform(self, T_FILTER_KEYS, pred);
+}
+
+static PyObject *
+map_py_map_values(MapObject *self, PyObject *func)
+{
+    return (PyObject *)map_transform(self, T_MAP_VALUES, func);
+}
+
+static PyObject *
+map_py_split(MapObject *self, PyObject *args)
+{
+    Py_ssize_t n;
+
+    if (!PyArg_ParseTuple(args, "n:split", &n)) {
+        return NULL;
+    }
+
+    return map_split(self, n);
+}
+
+static PyObject *
+map_py_partitions(MapObject *self, PyObject *args)
+{
+    return map_partitions(self);
+}
+
+static PyObject *
+map_py_mutate(MapObject *self, PyObject *args)
+{
+    MapModuleState *st = MAP_STATE(self);
+    MapMutationObject *o;
+    o = PyObject_GC_New(MapMutationObject, st->ms_mapmut_type);
+    if (o == NULL) {
+        return NULL;
+    }
+    Py_SET_SIZE(o, 0);
+    o->m_weakreflist = NULL;
+    o->m_count = self->h_count;
+    o->m_mutid = map_next_mutid(st);
+
+    /* The tree built for a flat Map is owned by the mutation. */
+    o->m_root = map_root(self, o->m_mutid);
+    if (o->m_root == NULL) {
+        PyObject_GC_Del(o);
+        MAP_DECREF_TYPE(st->ms_mapmut_type);
+        return NULL;
+    }
+
+    PyObject_GC_Track(o);
+    return (PyObject *)o;
+}
+
+static PyObject *
+map_py_update(MapObject *self, PyObject *args, PyObject *kwds)
+{
+    MapModuleState *st = MAP_STATE(self);
+    PyObject *arg = NULL;
+    MapObject *new = NULL;
+
+    if (!PyArg_UnpackTuple(args, "update", 0, 1, &arg)) {
+        return NULL;
+    }
+
+    if (arg != NULL) {
+        new = map_update(map_next_mutid(st), self, arg);
+        if (new == NULL) {
+            return NULL;
+        }
+    }
+    else {
+        Py_INCREF(self);
+        new = self;
+    }
+
+    if (kwds != NULL) {
+        if (!PyArg_ValidateKeywordArguments(kwds)) {
+            Py_DECREF(new);
+            return NULL;
+        }
+
+        /* "new" is a complete Map now: its nodes must not be
+           modified, so use a new mutid. */
+        MapObject *new2 = map_update(map_next_mutid(st), new, kwds);
+        Py_DECREF(new);
+        if (new2 == NULL) {
+            return NULL;
+        }
+        new = new2;
+    }
+
+    return (PyObject *)new;
+}
+
+static PyObject *
+map_py_merge(MapObject *self, PyObject *args, PyObject *kwds)
+{
+    MapModuleState *st = MAP_STATE(self);
+    static char *kwlist[] = {"other", "resolve", NULL};
+
+    PyObject *arg;
+    PyObject *resolve = Py_None;
+    MapObject *other;
+    MapObject *new;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|O:merge", kwlist,
+                                     &arg, &resolve))
+    {
+        return NULL;
+    }
+
+    if (resolve == Py_None) {
+        resolve = NULL;
+    }
+    else if (!PyCallable_Check(resolve)) {
+        PyErr_Format(
+            PyExc_TypeError,
+            "resolve must be a callable or None, not %.100s",
+            Py_TYPE(resolve)->tp_name);
+        return NULL;
+    }
+
+    if (Map_Check(st, arg)) {
+        Py_INCREF(arg);
+        other = (MapObject *)arg;
+    }
+    else if (MapMutation_Check(st, arg)) {
+        PyErr_Format(
+            PyExc_TypeError,
+            "cannot create Maps from MapMutations");
+        return NULL;
+    }
+    else {
+        MapObject *empty = map_new(st);
+        if (empty == NULL) {
+            return NULL;
+        }
+
+        other = map_update(map_next_mutid(st), empty, arg);
+        Py_DECREF(empty);
+        if (other == NULL) {
+            return NULL;
+        }
+    }
+
+    new = map_merge(self, other, resolve);
+    Py_DECREF(other);
+    return (PyObject *)new;
+}
+
+static PyObject *
+map_py_diff(MapObject *self, PyObject *other)
+{
+    MapModuleState *st = MAP_STATE(self);
+
+    if (!Map_Check(st, other)) {
+        PyErr_Format(
+            PyExc_TypeError,
+            "Map.diff() argument must be a Map, not %.100s",
+            Py_TYPE(other)->tp_name);
+        return NULL;
+    }
+
+    return map_diff(self, (MapObject *)other);
+}
+
+static PyObject *
+map_py_items(MapObject *self, PyObject *args)
+{
+    return map_new_items_view(self);
+}
+
+static PyObject *
+map_py_values(MapObject *self, PyObject *args)
+{
+    return map_new_values_view(self);
+}
+
+static PyObject *
+map_py_keys(MapObject *self, PyObject *args)
+{
+    return map_new_keys_view(self);
+}
+
+static PyObject *
+map_py_dump(MapObject *self, PyObject *args)
+{
+    return map_dump(self);
+}
+
+static PyObject *
+map_py_stats(MapObject *self, PyObject *args)
+{
+    return map_stats(self);
+}
+
+static PyObject *
+map_py_sizeof(MapObject *self, PyObject *args)
+{
+    MapStats stats;
+    map_collect_stats(self, &stats);
+    return PyLong_FromSsize_t(stats.s_bytes);
+}
+
+
+static PyObject *
+map_py_repr(BaseMapObject *m)
+{
+    MapModuleState *st = MAP_STATE(m);
+    Py_ssize_t i;
+    _PyUnicodeWriter writer;
+
+
+    i = Py_ReprEnter((PyObject *)m);
+    if (i != 0) {
+        return i > 0 ? PyUnicode_FromString("{...}") : NULL;
+    }
+
+    _PyUnicodeWriter_Init(&writer);
+
+    if (MapMutation_Check(st, m)) {
+        if (_PyUnicodeWriter_WriteASCIIString(
+                &writer, "<immutables.MapMutation({", 25) < 0)
+        {
+            goto error;
+        }
+    }
+    else {
+        if (_PyUnicodeWriter_WriteASCIIString(
+                &writer, "<immutables.Map({", 17) < 0)
+        {
+            goto error;
+        }
+    }
+
+    MapIteratorState iter;
+    map_iter_t iter_res;
+    map_iterator_init_map(&iter, m);
+    int second = 0;
+    do {
+        PyObject *v_key;
+        PyObject *v_val;
+
+        iter_res = map_iterator_next(&iter, &v_key, &v_val);
+        if (iter_res == I_ITEM) {
+            if (second) {
+                if (_PyUnicodeWriter_WriteASCIIString(&writer, ", ", 2) < 0) {
+                    goto error;
+                }
+            }
+
+            PyObject *s = PyObject_Repr(v_key);
+            if (s == NULL) {
+                goto error;
+            }
+            if (_PyUnicodeWriter_WriteStr(&writer, s) < 0) {
+                Py_DECREF(s);
+                goto error;
+            }
+            Py_DECREF(s);
+
+            if (_PyUnicodeWriter_WriteASCIIString(&writer, ": ", 2) < 0) {
+                goto error;
+            }
+
+            s = PyObject_Repr(v_val);
+            if (s == NULL) {
+                goto error;
+            }
+            if (_PyUnicodeWriter_WriteStr(&writer, s) < 0) {
+                Py_DECREF(s);
+                goto error;
+            }
+            Py_DECREF(s);
+        }
+
+        second = 1;
+    } while (iter_res != I_END);
+
+    if (_PyUnicodeWriter_WriteASCIIString(&writer, "})", 2) < 0) {
+        goto error;
+    }
+
+    PyObject *addr = PyUnicode_FromFormat(" at %p>", m);
+    if (addr == NULL) {
+        goto error;
+    }
+    if (_PyUnicodeWriter_WriteStr(&writer, addr) < 0) {
+        Py_DECREF(addr);
+        goto error;
+    }
+    Py_DECREF(addr);
+
+    Py_ReprLeave((PyObject *)m);
+    return _PyUnicodeWriter_Finish(&writer);
+
+error:
+    _PyUnicodeWriter_Dealloc(&writer);
+    Py_ReprLeave((PyObject *)m);
+    return NULL;
+}
+
+
+static Py_hash_t
+map_py_hash(MapObject *self)
+{
+    /* Adapted version of frozenset.__hash__: it's important
+       that Map.__hash__ is independant of key/values order.
+
+       The XOR of hashes of key/value pairs is memoized for every
+       HAMT node, so only the nodes that are not shared with other
+       already hashed maps are visited.
+    */
+
+    Py_hash_t cached_hash = MAP_LOAD_HASH(self->h_hash);
+    if (cached_hash != -1) {
+        return cached_hash;
+    }
+
+    Py_uhash_t hash = 0;
+    if (IS_FLAT_MAP(self)) {
+        Py_ssize_t i;
+
+        for (i = 0; i < self->h_count; i++) {
+            Py_uhash_t item_hash;
+            if (map_item_hash(self->h_entries[i].e_key,
+                              self->h_entries[i].e_val, &item_hash))
+            {
+                return -1;
+            }
+            hash ^= item_hash;
+        }
+    }
+    else if (map_node_items_hash(self->h_root, &hash)) {
+        return -1;
+    }
+
+    hash ^= ((Py_uhash_t)self->h_count * 2 + 1) * 1927868237UL;
+
+    hash ^= (hash >> 11) ^ (hash >> 25);
+    hash = hash * 69069U + 907133923UL;
+
+    cached_hash = (Py_hash_t)hash;
+    if (cached_hash == -1) {
+        cached_hash = 1;
+    }
+    MAP_STORE_HASH(self->h_hash, cached_hash);
+    return cached_hash;
+}
+
+static PyObject *
+map_reduce(MapObject *self)
+{
+    /* Maps are pickled as a tuple of keys and a tuple of values
+       that Map._unpickle() bulk-loads.  Hashes aren't pickled:
+       hashes of str and bytes objects differ between processes. */
+
+    MapIteratorState iter;
+    map_iter_t iter_res;
+    PyObject *keys = NULL;
+    PyObject *vals = NULL;
+    PyObject *unpickle = NULL;
+    PyObject *res = NULL;
+    Py_ssize_t i = 0;
+
+    keys = PyTuple_New(self->h_count);
+    if (keys == NULL) {
+        goto fin;
+    }
+
+    vals = PyTuple_New(self->h_count);
+    if (vals == NULL) {
+        goto fin;
+    }
+
+    map_iterator_init_map(&iter, (BaseMapObject *)self);
+    do {
+        PyObject *key;
+        PyObject *val;
+
+        iter_res = map_iterator_next(&iter, &key, &val);
+        if (iter_res == I_ITEM) {
+            assert(i < self->h_count);
+            Py_INCREF(key);
+            PyTuple_SET_ITEM(keys, i, key);
+            Py_INCREF(val);
+            PyTuple_SET_ITEM(vals, i, val);
+            i++;
+        }
+    } while (iter_res != I_END);
+
+    assert(i == self->h_count);
+
+    unpickle = PyObject_GetAttrString((PyObject *)Py_TYPE(self), "_unpickle");
+    if (unpickle == NULL) {
+        goto fin;
+    }
+
+    res = Py_BuildValue("O(OO)", unpickle, keys, vals);
+
+fin:
+    Py_XDECREF(keys);
+    Py_XDECREF(vals);
+    Py_XDECREF(unpickle);
+    return res;
+}
+
+static PyObject *
+map_py_unpickle(PyObject *type, PyObject *args)
+{
+    MapModuleState *st = MAP_TYPE_STATE((PyTypeObject *)type);
+    MapBuildBuffer buf;
+    PyObject *keys;
+    PyObject *vals;
+    MapObject *o = NULL;
+    Py_ssize_t i;
+
+    if (!PyArg_ParseTuple(args, "O!O!:_unpickle",
+                          &PyTuple_Type, &keys, &PyTuple_Type, &vals))
+    {
+        return NULL;
+    }
+
+    Py_ssize_t n = PyTuple_GET_SIZE(keys);
+    if (PyTuple_GET_SIZE(vals) != n) {
+        PyErr_SetString(PyExc_ValueError,
+                        "keys and values must have the same length");
+        return NULL;
+    }
+
+    map_build_buffer_init(&buf);
+
+    if (map_build_buffer_reserve(&buf, n)) {
+        goto fin;
+    }
+
+    for (i = 0; i < n; i++) {
+        PyObject *key = PyTuple_GET_ITEM(keys, i);
+
+        map_hash_t key_hash = map_hash(key);
+        if (key_hash == -1) {
+            goto fin;
+        }
+
+        if (map_build_buffer_append(
+                &buf, key_hash, key, PyTuple_GET_ITEM(vals, i)))
+        {
+            goto fin;
+        }
+    }
+
+    o = map_from_build_buffer(st, &buf, map_next_mutid(st));
+
+fin:
+    map_build_buffer_clear(&buf);
+    return (PyObject *)o;
+}
+
+static PyObject *
+map_py_class_getitem(PyObject *type, PyObject *item)
+{
+    Py_INCREF(type);
+    return type;
+}
+
+static PyMethodDef Map_methods[] = {
+    {"set", MAP_FASTCALL_METH(map_py_set), NULL},
+    {"get", MAP_FASTCALL_METH(map_py_get), NULL},
+    {
+        "get_many",
+        (PyCFunction)map_py_get_many,
+        METH_VARARGS | METH_KEYWORDS,
+        NULL
+    },
+    {"take", (PyCFunction)map_py_take, METH_O, NULL},
+    {"delete", (PyCFunction)map_py_delete, METH_O, NULL},
+    {
+        "delete_many",
+        (PyCFunction)map_py_delete_many,
+        METH_VARARGS | METH_KEYWORDS,
+        NULL
+    },
+    {"filter", (PyCFunction)map_py_filter, METH_O, NULL},
+    {"filter_keys", (PyCFunction)map_py_filter_keys, METH_O, NULL},
+    {"map_values", (PyCFunction)map_py_map_values, METH_O, NULL},
+    {"split", (PyCFunction)map_py_split, METH_VARARGS, NULL},
+    {"partitions", (PyCFunction)map_py_partitions, METH_NOARGS, NULL},
+    {"mutate", (PyCFunction)map_py_mutate, METH_NOARGS, NULL},
+    {"items", (PyCFunction)map_py_items, METH_NOARGS, NULL},
+    {"keys", (PyCFunction)map_py_keys, METH_NOARGS, NULL},
+    {"values", (PyCFunction)map_py_values, METH_NOARGS, NULL},
+    {"update", (PyCFunction)map_py_update, METH_VARARGS | METH_KEYWORDS, NULL},
+    {"merge", (PyCFunction)map_py_merge, METH_VARARGS | METH_KEYWORDS, NULL},
+    {"diff", (PyCFunction)map_py_diff, METH_O, NULL},
+    {"__reduce__", (PyCFunction)map_reduce, METH_NOARGS, NULL},
+    {
+        "_unpickle",
+        (PyCFunction)map_py_unpickle,
+        METH_VARARGS | METH_CLASS,
+        NULL
+    },
+    {"stats", (PyCFunction)map_py_stats, METH_NOARGS, NULL},
+    {"__sizeof__", (PyCFunction)map_py_sizeof, METH_NOARGS, NULL},
+    {"__dump__", (PyCFunction)map_py_dump, METH_NOARGS, NULL},
+    {
+        "__class_getitem__",
+        (PyCFunction)map_py_class_getitem,
+        METH_O|METH_CLASS,
+        NULL
+    },
+    {NULL, NULL}
+};
+
+MAP_WEAKLIST_MEMBERS(Map_members, MapObject, h_weakreflist)
+
+static PyType_Slot Map_slots[] = {
+    {Py_tp_methods, Map_methods},
+    MAP_MEMBERS_SLOT(Map_members)
+    {Py_sq_contains, map_tp_contains},
+    {Py_mp_length, map_tp_len},
+    {Py_mp_subscript, map_tp_subscript},
+    {Py_tp_iter, map_tp_iter},
+    {Py_tp_dealloc, map_tp_dealloc},
+    {Py_tp_richcompare, map_tp_richcompare},
+    {Py_tp_traverse, map_tp_traverse},
+    {Py_tp_clear, map_tp_clear},
+    {Py_tp_new, map_tp_new},
+    {Py_tp_init, map_tp_init},
+    {Py_tp_hash, map_py_hash},
+    {Py_tp_repr, map_py_repr},
+    {0, NULL}
+};
+
+static PyType_Spec Map_spec = {
+    .name = "immutables._map.Map",
+    .basicsize = sizeof(MapObject) - sizeof(MapEntry),
+    .itemsize = sizeof(MapEntry),
+    .flags = MAP_TPFLAGS,
+    .slots = Map_slots,
+};
+
+
+/////////////////////////////////// MapMutation
+
+
+static int
+map_node_update_from_map(MapModuleState *st, uint64_t mutid,
+                         MapObject *map,
+                         MapNode *root, Py_ssize_t count,
+                         MapNode **new_root, Py_ssize_t *new_count)
+{
+    assert(Map_Check(st, map));
+
+    Py_ssize_t added = 0;
+    MapNode *merged;
+
+    if (IS_FLAT_MAP(map)) {
+        MapBuildBuffer buf;
+        int ret = -1;
+
+        map_build_buffer_init(&buf);
+        if (map_build_buffer_extend(st, &buf, (PyObject *)map) == 0) {
+            ret = map_node_update_from_entries(
+                st, mutid, &buf, root, count, new_root, new_count);
+        }
+        map_build_buffer_clear(&buf);
+        return ret;
+    }
+
+    if (count == 0) {
+        Py_INCREF(map->h_root);
+        *new_root = map->h_root;
+        *new_count = map->h_count;
+        return 0;
+    }
+
+    merged = map_node_merge(st, root, map->h_root, 0, NULL, &added, mutid);
+    if (merged == NULL) {
+        return -1;
+    }
+
+    *new_root = merged;
+    *new_count = count + added;
+    return 0;
+}
+
+
+static void
+map_build_buffer_init(MapBuildBuffer *buf)
+{
+    buf->b_entries = NULL;
+    buf->b_size = 0;
+    buf->b_allocated = 0;
+}
+
+static void
+map_build_buffer_clear(MapBuildBuffer *buf)
+{
+    Py_ssize_t i;
+
+    for (i = 0; i < buf->b_size; i++) {
+        /* Keys and values of duplicate entries are cleared by
+           map_build_dedup, hence XDECREF. */
+        Py_XDECREF(buf->b_entries[i].e_key);
+        Py_XDECREF(buf->b_entries[i].e_val);
+    }
+
+    PyMem_Free(buf->b_entries);
+    map_build_buffer_init(buf);
+}
+
+static int
+map_build_buffer_reserve(MapBuildBuffer *buf, Py_ssize_t size)
+{
+    if (size <= buf->b_allocated) {
+        return 0;
+    }
+
+    if (size < buf->b_allocated * 2) {
+        size = buf->b_allocated * 2;
+    }
+    if (size < 16) {
+        size = 16;
+    }
+
+    if ((size_t)size > (SIZE_MAX >> 1) / sizeof(MapEntry)) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    MapEntry *entries = (MapEntry *)PyMem_Realloc(
+        buf->b_entries, (size_t)size * sizeof(MapEntry));
+    if (entries == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    buf->b_entries = entries;
+    buf->b_allocated = size;
+    return 0;
+}
+
+static int
+map_build_buffer_append(MapBuildBuffer *buf, map_hash_t key_hash,
+                        PyObject *key, PyObject *val)
+{
+    if (map_build_buffer_reserve(buf, buf->b_size + 1)) {
+        return -1;
+    }
+
+    MapEntry *entry = &buf->b_entries[buf->b_size++];
+    entry->e_hash = key_hash;
+    Py_INCREF(key);
+    entry->e_key = key;
+    Py_INCREF(val);
+    entry->e_val = val;
+    return 0;
+}
+
+
+static Py_ssize_t
+map_build_dedup(MapEntry *entries, Py_ssize_t n)
+{
+    /* Drop entries with keys equal to keys of preceding entries, just
+       like consecutive map_node_assoc calls would do: the first key is
+       kept, along with the value of the last of the equal keys.  Keys
+       are only compared if their hashes are equal.
+
+       Dropped entries get their e_key and e_val set to NULL.
+
+       Return the number of remaining entries or -1 on error.
+    */
+
+    Py_ssize_t i, j;
+    Py_ssize_t unique = n;
+
+    for (i = 1; i < n; i++) {
+        for (j = 0; j < i; j++) {
+            if (entries[j].e_key == NULL ||
+                    entries[j].e_hash != entries[i].e_hash)
+            {
+                continue;
+            }
+
+            int cmp = PyObject_RichCompareBool(
+                entries[i].e_key, entries[j].e_key, Py_EQ);
+            if (cmp < 0) {
+                return -1;
+            }
+            if (cmp == 1) {
+                Py_SETREF(entries[j].e_val, entries[i].e_val);
+                entries[i].e_val = NULL;
+                Py_CLEAR(entries[i].e_key);
+                unique--;
+                break;
+            }
+        }
+    }
+
+    return unique;
+}
+
+
+typedef struct {
+    Py_hash_t s_hash;
+    Py_ssize_t s_index;
+    MapEntry s_entry;
+} MapCollisionSortEntry;
+
+
+static int
+map_collision_sort_cmp(const void *a, const void *b)
+{
+    const MapCollisionSortEntry *x = (const MapCollisionSortEntry *)a;
+    const MapCollisionSortEntry *y = (const MapCollisionSortEntry *)b;
+
+    if (x->s_hash != y->s_hash) {
+        return x->s_hash < y->s_hash ? -1 : 1;
+    }
+
+    /* Keep the order of entries with equal hashes for map_build_dedup */
+    return x->s_index < y->s_index ? -1 : (x->s_index > y->s_index);
+}
+
+static int
+map_node_build_collision(MapModuleState *st, MapEntry *entries, Py_ssize_t n,
+                         PyObject **key_or_null, PyObject **val_or_node,
+                         Py_ssize_t *count, uint64_t mutid)
+{
+    /* Fill a key/value slot of a Bitmap node with `n` entries that
+       have the same hash: a Collision node, or a single key/value pair
+       if all keys are equal.
+
+       The entries are sorted by the full hashes of their keys, so
+       only keys with equal full hashes are compared with each other.
+    */
+
+    MapCollisionSortEntry *sorted;
+    MapNode_Collision *node;
+    Py_ssize_t unique = 0;
+    Py_ssize_t i, j, run;
+    int ret = -1;
+
+    assert(n > 1);
+
+    if ((size_t)n > (SIZE_MAX >> 1) / sizeof(MapCollisionSortEntry)) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    sorted = (MapCollisionSortEntry *)PyMem_Malloc(
+        (size_t)n * sizeof(MapCollisionSortEntry));
+    if (sorted == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    for (i = 0; i < n; i++) {
+        sorted[i].s_hash = map_collision_hash(
+            entries[i].e_key, entries[i].e_hash);
+        if (sorted[i].s_hash == -1) {
+            goto done;
+        }
+        sorted[i].s_index = i;
+        sorted[i].s_entry = entries[i];
+    }
+
+    qsort(sorted, (size_t)n, sizeof(MapCollisionSortEntry),
+          map_collision_sort_cmp);
+
+    for (i = 0; i < n; i++) {
+        entries[i] = sorted[i].s_entry;
+    }
+
+    for (i = 0; i < n; i = run) {
+        for (run = i + 1; run < n; run++) {
+            if (sorted[run].s_hash != sorted[i].s_hash) {
+                break;
+            }
+        }
+
+        if (run - i == 1) {
+            unique++;
+            continue;
+        }
+
+        Py_ssize_t run_unique = map_build_dedup(entries + i, run - i);
+        if (run_unique < 0) {
+            goto done;
+        }
+        unique += run_unique;
+    }
+
+    *count += unique;
+
+    if (unique == 1) {
+        for (i = 0; entries[i].e_key == NULL; i++) {
+        }
+
+        Py_INCREF(entries[i].e_key);
+        *key_or_null = entries[i].e_key;
+        Py_INCREF(entries[i].e_val);
+        *val_or_node = entries[i].e_val;
+        ret = 0;
+        goto done;
+    }
+
+    node = (MapNode_Collision *)map_node_collision_new(
+        st, entries[0].e_hash, unique * 2, mutid);
+    if (node == NULL) {
+        goto done;
+    }
+
+    for (i = 0, j = 0; i < n; i++) {
+        if (entries[i].e_key == NULL) {
+            continue;
+        }
+
+        map_node_collision_set(
+            node, j, sorted[i].s_hash, entries[i].e_key, entries[i].e_val);
+        j += 2;
+    }
+    assert(j == unique * 2);
+
+    *key_or_null = NULL;
+    *val_or_node = (PyObject *)node;
+    ret = 0;
+
+done:
+    PyMem_Free(sorted);
+    return ret;
+}
+
+
+static int
+map_node_build_slot(MapModuleState *st, MapEntry *entries, MapEntry *scratch,
+                    Py_ssize_t n, uint32_t shift,
+                    PyObject **key_or_null, PyObject **val_or_node,
+                    Py_ssize_t *count, uint64_t mutid)
+{
+    /* Fill a key/value slot of a Bitmap node with `n` entries that
+       share the same hash bits up to the `shift` level.
+
+       A single key/value pair is stored in the slot directly;
+       otherwise the slot will point to a Collision node (if all
+       entries have the same hash) or to a new tree level.
+    */
+
+    Py_ssize_t i;
+
+    assert(n > 0);
+
+    for (i = 1; i < n; i++) {
+        if (entries[i].e_hash != entries[0].e_hash) {
+            break;
+        }
+    }
+
+    if (i < n) {
+        MapNode *node = map_node_build(
+            st, entries, scratch, n, shift, count, mutid);
+        if (node == NULL) {
+            return -1;
+        }
+
+        *key_or_null = NULL;
+        *val_or_node = (PyObject *)node;
+        return 0;
+    }
+
+    if (n == 1) {
+        *count += 1;
+
+        Py_INCREF(entries[0].e_key);
+        *key_or_null = entries[0].e_key;
+        Py_INCREF(entries[0].e_val);
+        *val_or_node = entries[0].e_val;
+        return 0;
+    }
+
+    return map_node_build_collision(
+        st, entries, n, key_or_null, val_or_node, count, mutid);
+}
+
+
+static MapNode *
+map_node_build_subtree(MapModuleState *st,
+                       MapBuildBuffer *buf, uint32_t shift, uint64_t mutid)
+{
+    /* Build a subtree located at the `shift` level out of the
+       (non-empty) buffer of unique keys; the subtree is built the way
+       it would be stored in its parent node: keys with equal hashes
+       become a bare Collision node. */
+
+    Py_ssize_t count = 0;
+    PyObject *new_key;
+    PyObject *new_val;
+    MapNode *res;
+
+    assert(buf->b_size > 0);
+
+    MapEntry *scratch = (MapEntry *)PyMem_Malloc(
+        (size_t)buf->b_size * sizeof(MapEntry));
+    if (scratch == NULL) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+
+    int build_res = map_node_build_slot(
+        st, buf->b_entries, scratch, buf->b_size, shift,
+        &new_key, &new_val, &count, mutid);
+    PyMem_Free(scratch);
+    if (build_res) {
+        return NULL;
+    }
+
+    if (new_key == NULL) {
+        return (MapNode *)new_val;
+    }
+
+    res = map_node_bitmap_new_item(
+        st, shift, buf->b_entries[0].e_hash, new_key, new_val, mutid);
+    Py_DECREF(new_key);
+    Py_DECREF(new_val);
+    return res;
+}
+
+
+static MapNode *
+map_node_build(MapModuleState *st, MapEntry *entries, MapEntry *scratch,
+               Py_ssize_t n, uint32_t shift,
+               Py_ssize_t *count, uint64_t mutid)
+{
+    /* Build a tree level at `shift` out of `n` entries in one go.
+
+       The entries are partitioned by the 5-bit chunk of their
+       hashes corresponding to `shift` (a stable counting sort, so
+       that duplicate keys keep their relative order), and every
+       partition is then turned into a key/value slot or a subtree.
+       Every node is allocated exactly once with its final size;
+       node types follow the same rules as in map_node_assoc
+       (e.g. levels with more than 16 slots become Array nodes).
+
+       `scratch` must point to a buffer of at least `n` entries.
+       The number of unique keys is added to *count.
+    */
+
+    Py_ssize_t starts[HAMT_ARRAY_NODE_SIZE];
+    Py_ssize_t ends[HAMT_ARRAY_NODE_SIZE];
+    Py_ssize_t i;
+    uint32_t slot;
+    uint32_t slots = 0;
+
+    assert(n > 0);
+    assert(shift < MAP_HASH_BITS);
+
+    for (slot = 0; slot < HAMT_ARRAY_NODE_SIZE; slot++) {
+        ends[slot] = 0;
+    }
+    for (i = 0; i < n; i++) {
+        ends[map_mask(entries[i].e_hash, shift)]++;
+    }
+
+    Py_ssize_t offset = 0;
+    for (slot = 0; slot < HAMT_ARRAY_NODE_SIZE; slot++) {
+        if (ends[slot]) {
+            slots++;
+        }
+        starts[slot] = offset;
+        offset += ends[slot];
+        ends[slot] = starts[slot];
+    }
+
+    for (i = 0; i < n; i++) {
+        scratch[ends[map_mask(entries[i].e_hash, shift)]++] = entries[i];
+    }
+    memcpy(entries, scratch, (size_t)n * sizeof(MapEntry));
+
+    if (slots > 16) {
+        /* Consecutive map_node_assoc calls would have converted
+           a Bitmap node with that many slots to an Array node. */
+
+        MapNode_Array *node = (MapNode_Array *)map_node_array_new(
+            st, slots, mutid);
+        if (node == NULL) {
+            return NULL;
+        }
+
+        for (slot = 0; slot < HAMT_ARRAY_NODE_SIZE; slot++) {
+            PyObject *key;
+            PyObject *val;
+
+            if (starts[slot] == ends[slot]) {
+                continue;
+            }
+
+            if (map_node_build_slot(
+                    st, entries + starts[slot], scratch + starts[slot],
+                    ends[slot] - starts[slot], shift + 5,
+                    &key, &val, count, mutid))
+            {
+                Py_DECREF(node);
+                return NULL;
+            }
+
+            if (key == NULL) {
+                node->a_array[slot] = (MapNode *)val;
+                continue;
+            }
+
+            /* Array nodes can only point to other nodes: wrap
+               the key/value pair in a single-item Bitmap node. */
+            node->a_array[slot] = map_node_bitmap_new_item(
+                st, shift + 5, entries[starts[slot]].e_hash, key, val, mutid);
+            Py_DECREF(key);
+            Py_DECREF(val);
+            if (node->a_array[slot] == NULL) {
+                Py_DECREF(node);
+                return NULL;
+            }
+        }
+
+        VALIDATE_ARRAY_NODE(node)
+        return (MapNode *)node;
+    }
+    else {
+        /* The slots are built first, as the size of the node depends
+           on how many of them turn out to be subnodes.  There's no
+           need to unwrap Collision nodes: map_node_build_slot(st) only
+           builds a new level when the hashes of its entries differ. */
+
+        map_hash_t hashes[16];
+        PyObject *keys[16];
+        PyObject *vals[16];
+        uint32_t datamap = 0;
+        uint32_t nodemap = 0;
+        Py_ssize_t built = 0;
+        MapNode_Bitmap *node = NULL;
+
+        for (slot = 0; slot < HAMT_ARRAY_NODE_SIZE; slot++) {
+            if (starts[slot] == ends[slot]) {
+                continue;
+            }
+
+            if (map_node_build_slot(
+                    st, entries + starts[slot], scratch + starts[slot],
+                    ends[slot] - starts[slot], shift + 5,
+                    &keys[built], &vals[built], count, mutid))
+            {
+                goto done;
+            }
+
+            if (keys[built] == NULL) {
+                nodemap |= (uint32_t)1 << slot;
+            }
+            else {
+                datamap |= (uint32_t)1 << slot;
+                hashes[built] = entries[starts[slot]].e_hash;
+            }
+            built++;
+        }
+
+        Py_ssize_t key_idx = 0;
+        Py_ssize_t node_idx = 2 * (Py_ssize_t)map_bitcount(datamap) +
+                              (Py_ssize_t)map_bitcount(nodemap);
+
+        node = (MapNode_Bitmap *)map_node_bitmap_new(st, node_idx, mutid);
+        if (node == NULL) {
+            goto done;
+        }
+
+        for (i = 0; i < built; i++) {
+            if (keys[i] == NULL) {
+                node->b_array[--node_idx] = vals[i];  /* borrow */
+            }
+            else {
+                node->b_array[key_idx] = keys[i];  /* borrow */
+                node->b_array[key_idx + 1] = vals[i];  /* borrow */
+                BITMAP_HASHES(node)[key_idx / 2] = hashes[i];
+                key_idx += 2;
+            }
+        }
+        built = 0;
+
+        node->b_datamap = datamap;
+        node->b_nodemap = nodemap;
+        VALIDATE_BITMAP_NODE(node)
+
+    done:
+        for (i = 0; i < built; i++) {
+            Py_XDECREF(keys[i]);
+            Py_DECREF(vals[i]);
+        }
+        return (MapNode *)node;
+    }
+}
+
+
+static int
+map_node_update_from_entries(MapModuleState *st, uint64_t mutid,
+                             MapBuildBuffer *buf,
+                             MapNode *root, Py_ssize_t count,
+                             MapNode **new_root, Py_ssize_t *new_count)
+{
+    MapNode *last_root;
+    Py_ssize_t last_count;
+    Py_ssize_t i;
+
+    if (count == 0 && buf->b_size > 0) {
+        /* Updating an empty map: build the whole tree bottom-up
+           instead of inserting the keys one by one. */
+
+        MapEntry *scratch = (MapEntry *)PyMem_Malloc(
+            (size_t)buf->b_size * sizeof(MapEntry));
+        if (scratch == NULL) {
+            PyErr_NoMemory();
+            return -1;
+        }
+
+        last_count = 0;
+        last_root = map_node_build(
+            st, buf->b_entries, scratch, buf->b_size, 0, &last_count, mutid);
+        PyMem_Free(scratch);
+        if (last_root == NULL) {
+            return -1;
+        }
+
+        *new_root = last_root;
+        *new_count = last_count;
+        return 0;
+    }
+
+    Py_INCREF(root);
+    last_root = root;
+    last_count = count;
+
+    for (i = 0; i < buf->b_size; i++) {
+        MapEntry *entry = &buf->b_entries[i];
+        int added_leaf;
+
+        MapNode *iter_root = map_node_assoc(
+            st, last_root,
+            0, entry->e_hash, entry->e_key, entry->e_val, &added_leaf,
+            mutid);
+
+        if (iter_root == NULL) {
+            Py_DECREF(last_root);
+            return -1;
+        }
+
+        if (added_leaf) {
+            last_count++;
+        }
+
+        Py_SETREF(last_root, iter_root);
+    }
+
+    *new_root = last_root;
+    *new_count = last_count;
+    return 0;
+}
+
+
+static int
+map_build_buffer_extend_dict(MapBuildBuffer *buf, PyObject *dct)
+{
+    assert(PyDict_Check(dct));
+
+    PyObject *key;
+    PyObject *val;
+    Py_ssize_t i;
+
+    if (PyDict_CheckExact(dct)) {
+        Py_ssize_t pos = 0;
+        Py_ssize_t start = buf->b_size;
+
+        if (map_build_buffer_reserve(buf, start + PyDict_GET_SIZE(dct))) {
+            return -1;
+        }
+
+        /* Collect all items first: hashing keys can run arbitrary
+           Python code, which must not happen while we're iterating
+           over the dict with PyDict_Next. */
+        while (PyDict_Next(dct, &pos, &key, &val)) {
+            if (map_build_buffer_append(buf, 0, key, val)) {
+                return -1;
+            }
+        }
+
+        for (i = start; i < buf->b_size; i++) {
+            buf->b_entries[i].e_hash = map_hash(buf->b_entries[i].e_key);
+            if (buf->b_entries[i].e_hash == -1) {
+                return -1;
+            }
+        }
+    }
+    else {
+        PyObject *it = PyObject_GetIter(dct);
+        if (it == NULL) {
+            return -1;
+        }
+
+        while ((key = PyIter_Next(it))) {
+            map_hash_t key_hash = map_hash(key);
+            if (key_hash == -1) {
+                Py_DECREF(key);
+                Py_DECREF(it);
+                return -1;
+            }
+
+            val = PyDict_GetItemWithError(dct, key);
+            if (val == NULL ||
+                    map_build_buffer_append(buf, key_hash, key, val))
+            {
+                Py_DECREF(key);
+                Py_DECREF(it);
+                return -1;
+            }
+
+            Py_DECREF(key);
+        }
+
+        Py_DECREF(it);
+        if (PyErr_Occurred()) {
+            return -1;
+        }
+    }
+
+    return 0;
+}
+
+
+static int
+map_build_buffer_extend_seq(MapBuildBuffer *buf, PyObject *seq)
+{
+    PyObject *it;
+    Py_ssize_t i;
+    PyObject *item = NULL;
+    PyObject *fast = NULL;
+    int ret = -1;
+
+    it = PyObject_GetIter(seq);
+    if (it == NULL) {
+        return -1;
+    }
+
+    Py_ssize_t size_hint = PyObject_LengthHint(seq, 0);
+    if (size_hint < 0) {
+        goto err;
+    }
+    if (map_build_buffer_reserve(buf, buf->b_size + size_hint)) {
+        goto err;
+    }
+
+    for (i = 0; ; i++) {
+        PyObject *key, *val;
+        Py_ssize_t n;
+        map_hash_t key_hash;
+
+        item = PyIter_Next(it);
+        if (item == NULL) {
+            if (PyErr_Occurred()) {
+                goto err;
+            }
+            break;
+        }
+
+        fast = PySequence_Fast(item, "");
+        if (fast == NULL) {
+            if (PyErr_ExceptionMatches(PyExc_TypeError))
+                PyErr_Format(PyExc_TypeError,
+                    "cannot convert map update "
+                    "sequence element #%zd to a sequence",
+                    i);
+            goto err;
+        }
+
+        n = PySequence_Fast_GET_SIZE(fast);
+        if (n != 2) {
+            PyErr_Format(PyExc_ValueError,
+                         "map update sequence element #%zd "
+                         "has length %zd; 2 is required",
+                         i, n);
+            goto err;
+        }
+
+        /* Hashing the key can run arbitrary code that modifies
+           `item`, so the key and the value must not be borrowed. */
+        key = PySequence_Fast_GET_ITEM(fast, 0);
+        val = PySequence_Fast_GET_ITEM(fast, 1);
+        Py_INCREF(key);
+        Py_INCREF(val);
+
+        key_hash = map_hash(key);
+        if (key_hash == -1 ||
+                map_build_buffer_append(buf, key_hash, key, val))
+        {
+            Py_DECREF(key);
+            Py_DECREF(val);
+            goto err;
+        }
+
+        Py_DECREF(key);
+        Py_DECREF(val);
+        Py_CLEAR(fast);
+        Py_CLEAR(item);
+    }
+
+    ret = 0;
+
+err:
+    Py_XDECREF(item);
+    Py_XDECREF(fast);
+    Py_DECREF(it);
+    return ret;
+}
+
+
+static int
+map_build_buffer_extend(MapModuleState *st, MapBuildBuffer *buf,
+                        PyObject *src)
+{
+    /* Append the items of a dict, of a sequence of pairs, or of
+       a flat Map to the buffer. */
+
+    if (Map_Check(st, src)) {
+        MapObject *map = (MapObject *)src;
+        Py_ssize_t i;
+
+        assert(IS_FLAT_MAP(map));
+
+        for (i = 0; i < map->h_count; i++) {
+            MapEntry *entry = &map->h_entries[i];
+            if (map_build_buffer_append(
+                    buf, entry->e_hash, entry->e_key, entry->e_val))
+            {
+                return -1;
+            }
+        }
+        return 0;
+    }
+    else if (PyDict_Check(src)) {
+        return map_build_buffer_extend_dict(buf, src);
+    }
+    else {
+        return map_build_buffer_extend_seq(buf, src);
+    }
+}
+
+
+static int
+map_node_update_from_dict(MapModuleState *st, uint64_t mutid,
+                          PyObject *dct,
+                          MapNode *root, Py_ssize_t count,
+                          MapNode **new_root, Py_ssize_t *new_count)
+{
+    MapBuildBuffer buf;
+    int ret = -1;
+
+    map_build_buffer_init(&buf);
+
+    if (map_build_buffer_extend_dict(&buf, dct) == 0) {
+        ret = map_node_update_from_entries(
+            st, mutid, &buf, root, count, new_root, new_count);
+    }
+
+    map_build_buffer_clear(&buf);
+    return ret;
+}
+
+
+static int
+map_node_update_from_seq(MapModuleState *st, uint64_t mutid,
+                         PyObject *seq,
+                         MapNode *root, Py_ssize_t count,
+                         MapNode **new_root, Py_ssize_t *new_count)
+{
+    MapBuildBuffer buf;
+    int ret = -1;
+
+    map_build_buffer_init(&buf);
+
+    if (map_build_buffer_extend_seq(&buf, seq) == 0) {
+        ret = map_node_update_from_entries(
+            st, mutid, &buf, root, count, new_root, new_count);
+    }
+
+    map_build_buffer_clear(&buf);
+    return ret;
+}
+
+
+static int
+map_node_update(MapModuleState *st, uint64_t mutid,
+                PyObject *src,
+                MapNode *root, Py_ssize_t count,
+                MapNode **new_root, Py_ssize_t *new_count)
+{
+    if (Map_Check(st, src)) {
+        return map_node_update_from_map(
+            st, mutid, (MapObject *)src, root, count, new_root, new_count);
+    }
+    else if (PyDict_Check(src)) {
+        return map_node_update_from_dict(
+            st, mutid, src, root, count, new_root, new_count);
+    }
+    else {
+        return map_node_update_from_seq(
+            st, mutid, src, root, count, new_root, new_count);
+    }
+}
+
+
+static int
+map_set_entries(MapObject *o, MapBuildBuffer *buf, uint64_t mutid)
+{
+    /* Set the contents of an empty flat Map: the entries of `buf` are
+       moved into "o" if they fit, otherwise "o" gets a tree built
+       out of them. */
+
+    MapModuleState *st = MAP_STATE(o);
+    Py_ssize_t i;
+
+    assert(IS_FLAT_MAP(o) && o->h_count == 0);
+
+    if (buf->b_size <= Py_SIZE(o)) {
+        if (map_build_dedup(buf->b_entries, buf->b_size) < 0) {
+            return -1;
+        }
+
+        for (i = 0; i < buf->b_size; i++) {
+            if (buf->b_entries[i].e_key != NULL) {
+                o->h_entries[o->h_count++] = buf->b_entries[i];
+                buf->b_entries[i].e_key = NULL;
+                buf->b_entries[i].e_val = NULL;
+            }
+        }
+        return 0;
+    }
+
+    return map_node_update_from_entries(
+        st, mutid, buf, NULL, 0, &o->h_root, &o->h_count);
+}
+
+
+static MapObject *
+map_from_build_buffer(MapModuleState *st, MapBuildBuffer *buf, uint64_t mutid)
+{
+    MapObject *o = map_alloc(
+        st, buf->b_size <= MAP_FLAT_MAXSIZE ? buf->b_size : 0);
+    if (o == NULL) {
+        return NULL;
+    }
+
+    if (map_set_entries(o, buf, mutid)) {
+        Py_DECREF(o);
+        return NULL;
+    }
+
+    map_settle(o);
+    return o;
+}
+
+
+static int
+map_update_inplace(uint64_t mutid, BaseMapObject *o, PyObject *src)
+{
+    MapModuleState *st = MAP_STATE(o);
+    MapNode *new_root = NULL;
+    Py_ssize_t new_count;
+
+    int ret = map_node_update(
+        st, mutid, src,
+        o->b_root, o->b_count,
+        &new_root, &new_count);
+
+    if (ret) {
+        return -1;
+    }
+
+    assert(new_root);
+
+    Py_SETREF(o->b_root, new_root);
+    o->b_count = new_count;
+
+    return 0;
+}
+
+
+static MapObject *
+map_update(uint64_t mutid, MapObject *o, PyObject *src)
+{
+    MapModuleState *st = MAP_STATE(o);
+    MapNode *root;
+    MapNode *new_root = NULL;
+    Py_ssize_t new_count;
+
+    if (IS_FLAT_MAP(o) && !(Map_Check(st, src) && !IS_FLAT_MAP(src))) {
+        /* The result is likely to be small enough to be flat. */
+
+        MapBuildBuffer buf;
+        MapObject *new = NULL;
+
+        map_build_buffer_init(&buf);
+        if (map_build_buffer_extend(st, &buf, (PyObject *)o) == 0 &&
+                map_build_buffer_extend(st, &buf, src) == 0)
+        {
+            new = map_from_build_buffer(st, &buf, mutid);
+        }
+        map_build_buffer_clear(&buf);
+        return new;
+    }
+
+    root = map_root(o, mutid);
+    if (root == NULL) {
+        return NULL;
+    }
+
+    int ret = map_node_update(
+        st, mutid, src,
+        root, o->h_count,
+        &new_root, &new_count);
+    Py_DECREF(root);
+
+    if (ret) {
+        return NULL;
+    }
+
+    assert(new_root);
+    return map_from_root(st, new_root, new_count);
+}
+
+static int
+mapmut_check_finalized(MapMutationObject *o)
+{
+    if (o->m_mutid == 0) {
+        PyErr_Format(
+            PyExc_ValueError,
+            "mutation %R has been finished",
+            o, NULL);
+        return -1;
+    }
+
+    return 0;
+}
+
+static int
+mapmut_delete(MapMutationObject *o, PyObject *key, map_hash_t key_hash)
+{
+    MapModuleState *st = MAP_STATE(o);
+    MapNode *new_root = NULL;
+
+    assert(key_hash != -1);
+    map_without_t res = map_node_without(
+        st, (MapNode *)(o->m_root),
+        0, key_hash, key,
+        &new_root,
+        o->m_mutid);
+
+    switch (res) {
+        case W_ERROR:
+            return -1;
+
+        case W_EMPTY:
+            new_root = map_node_bitmap_new(st, 0, o->m_mutid);
+            if (new_root == NULL) {
+                return -1;
+            }
+            Py_SETREF(o->m_root, new_root);
+            o->m_count = 0;
+            return 0;
+
+        case W_NOT_FOUND:
+            PyErr_SetObject(PyExc_KeyError, key);
+            return -1;
+
+        case W_NEWNODE: {
+            assert(new_root != NULL);
+            Py_SETREF(o->m_root, new_root);
+            o->m_count--;
+            return 0;
+        }
+
+        default:
+            abort();
+    }
+}
+
+static int
+mapmut_set(MapMutationObject *o, PyObject *key, map_hash_t key_hash,
+           PyObject *val)
+{
+    MapModuleState *st = MAP_STATE(o);
+    int added_leaf = 0;
+
+    assert(key_hash != -1);
+    MapNode *new_root = map_node_assoc(
+        st, (MapNode *)(o->m_root),
+        0, key_hash, key, val, &added_leaf,
+        o->m_mutid);
+    if (new_root == NULL) {
+        return -1;
+    }
+
+    if (added_leaf) {
+        o->m_count++;
+    }
+
+    if (new_root == o->m_root) {
+        Py_DECREF(new_root);
+        return 0;
+    }
+
+    Py_SETREF(o->m_root, new_root);
+    return 0;
+}
+
+static int
+mapmut_finish(MapMutationObject *o)
+{
+    o->m_mutid = 0;
+    return 0;
+}
+
+static PyObject *
+mapmut_py_set(MapMutationObject *o, PyObject *const *args, Py_ssize_t nargs)
+{
+    if (!map_check_nargs("set", nargs, 2, 2)) {
+        return NULL;
+    }
+
+    PyObject *key = args[0];
+    PyObject *val = args[1];
+
+    if (mapmut_check_finalized(o)) {
+        return NULL;
+    }
+
+    map_hash_t key_hash = map_hash(key);
+    if (key_hash == -1) {
+        return NULL;
+    }
+
+    if (mapmut_set(o, key, key_hash, val)) {
+        return NULL;
+    }
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+mapmut_tp_richcompare(PyObject *v, PyObject *w, int op)
+{
+    MapModuleState *st = MAP_STATE(v);
+
+    if (!MapMutation_Check(st, v) || !MapMutation_Check(st, w) ||
+            (op != Py_EQ && op != Py_NE))
+    {
+        Py_RETURN_NOTIMPLEMENTED;
+    }
+
+    int res;
+    Py_BEGIN_CRITICAL_SECTION2(v, w);
+    res = map_eq((BaseMapObject *)v, (BaseMapObject *)w);
+    Py_END_CRITICAL_SECTION2();
+    if (res < 0) {
+        return NULL;
+    }
+
+    if (op == Py_NE) {
+        res = !res;
+    }
+
+    if (res) {
+        Py_RETURN_TRUE;
+    }
+    else {
+        Py_RETURN_FALSE;
+    }
+}
+
+static PyObject *
+mapmut_py_update(MapMutationObject *self, PyObject *args, PyObject *kwds)
+{
+    PyObject *arg = NULL;
+
+    if (!PyArg_UnpackTuple(args, "update", 0, 1, &arg)) {
+        return NULL;
+    }
+
+    if (mapmut_check_finalized(self)) {
+        return NULL;
+    }
+
+    if (arg != NULL) {
+        if (map_update_inplace(self->m_mutid, (BaseMapObject *)self, arg)) {
+            return NULL;
+        }
+    }
+
+    if (kwds != NULL) {
+        if (!PyArg_ValidateKeywordArguments(kwds)) {
+            return NULL;
+        }
+
+        if (map_update_inplace(self->m_mutid, (BaseMapObject *)self, kwds)) {
+            return NULL;
+        }
+    }
+
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *
+mapmut_py_finish(MapMutationObject *self, PyObject *args)
+{
+    MapModuleState *st = MAP_STATE(self);
+
+    if (mapmut_finish(self)) {
+        return NULL;
+    }
+
+    Py_INCREF(self->m_root);
+    return (PyObject *)map_from_root(st, self->m_root, self->m_count);
+}
+
+static PyObject *
+mapmut_py_enter(MapMutationObject *self, PyObject *args)
+{
+    Py_INCREF(self);
+    return (PyObject *)self;
+}
+
+static PyObject *
+mapmut_py_exit(MapMutationObject *self,
+               PyObject *const *args, Py_ssize_t nargs)
+{
+    if (mapmut_finish(self)) {
+        return NULL;
+    }
+    Py_RETURN_FALSE;
+}
+
+static int
+mapmut_tp_ass_sub(MapMutationObject *self, PyObject *key, PyObject *val)
+{
+    if (mapmut_check_finalized(self)) {
+        return -1;
+    }
+
+    map_hash_t key_hash = map_hash(key);
+    if (key_hash == -1) {
+        return -1;
+    }
+
+    if (val == NULL) {
+        return mapmut_delete(self, key, key_hash);
+    }
+    else {
+        return mapmut_set(self, key, key_hash, val);
+    }
+}
+
+static PyObject *
+mapmut_py_pop(MapMutationObject *self,
+              PyObject *const *args, Py_ssize_t nargs)
+{
+    PyObject *val = NULL;
+
+    if (!map_check_nargs("pop", nargs, 1, 2)) {
+        return NULL;
+    }
+
+    PyObject *key = args[0];
+    PyObject *deflt = nargs > 1 ? args[1] : NULL;
+
+    if (mapmut_check_finalized(self)) {
+        return NULL;
+    }
+
+    if (!self->m_count) {
+        goto not_found;
+    }
+
+    map_hash_t key_hash = map_hash(key);
+    if (key_hash == -1) {
+        return NULL;
+    }
+
+    map_find_t find_res = map_node_find(self->m_root, 0, key_hash, key, &val);
+
+    switch (find_res) {
+        case F_ERROR:
+            return NULL;
+
+        case F_NOT_FOUND:
+            goto not_found;
+
+        case F_FOUND:
+            break;
+
+        default:
+            abort();
+    }
+
+    Py_INCREF(val);
+
+    if (mapmut_delete(self, key, key_hash)) {
+        Py_DECREF(val);
+        return NULL;
+    }
+
+    return val;
+
+not_found:
+    if (deflt) {
+        Py_INCREF(deflt);
+        return deflt;
+    }
+
+    PyErr_SetObject(PyExc_KeyError, key);
+    return NULL;
+}
+
+static PyObject *
+mapmut_py_delete_many(MapMutationObject *self, PyObject *args, PyObject *kwds)
+{
+    MapModuleState *st = MAP_STATE(self);
+    static char *kwlist[] = {"keys", "missing_ok", NULL};
+
+    PyObject *keys;
+    int missing_ok = 1;
+    MapNode *new_root;
+    Py_ssize_t new_count;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|p:delete_many", kwlist,
+                                     &keys, &missing_ok))
+    {
+        return NULL;
+    }
+
+    if (mapmut_check_finalized(self)) {
+        return NULL;
+    }
+
+    /* Iterating over `keys` can run arbitrary code that might
+       replace the root of the mutation. */
+    MapNode *root = self->m_root;
+    Py_INCREF(root);
+    int res = map_node_delete_many(
+        st, root, self->m_count, keys, missing_ok, self->m_mutid,
+        &new_root, &new_count);
+    Py_DECREF(root);
+    if (res) {
+        return NULL;
+    }
+
+    if (new_root == NULL) {
+        new_root = map_node_bitmap_new(st, 0, self->m_mutid);
+        if (new_root == NULL) {
+            return NULL;
+        }
+    }
+
+    Py_SETREF(self->m_root, new_root);
+    self->m_count = new_count;
+    Py_RETURN_NONE;
+}
+
+
+/* MapMutations are modified in place, so on free-threaded builds
+   their methods are called in a critical section of the mutation
+   (like the methods of lists and dicts are). */
+#define MAPMUT_LOCKED(name, func, ret_type, params, args)           \
+    static ret_type                                                 \
+    name params                                                     \
+    {                                                               \
+        ret_type ret;                                               \
+        Py_BEGIN_CRITICAL_SECTION(self);                            \
+        ret = func args;                                            \
+        Py_END_CRITICAL_SECTION();                                  \
+        return ret;                                                 \
+    }
+
+#define MAPMUT_FASTCALL_PARAMS \
+    (MapMutationObject *self, PyObject *const *args, Py_ssize_t nargs)
+
+MAPMUT_LOCKED(mapmut_py_set_locked, mapmut_py_set, PyObject *,
+              MAPMUT_FASTCALL_PARAMS, (self, args, nargs))
+MAPMUT_LOCKED(mapmut_py_get_locked, map_py_get, PyObject *,
+              MAPMUT_FASTCALL_PARAMS, ((BaseMapObject *)self, args, nargs))
+MAPMUT_LOCKED(mapmut_py_pop_locked, mapmut_py_pop, PyObject *,
+              MAPMUT_FASTCALL_PARAMS, (self, args, nargs))
+MAPMUT_LOCKED(mapmut_py_exit_locked, mapmut_py_exit, PyObject *,
+              MAPMUT_FASTCALL_PARAMS, (self, args, nargs))
+MAPMUT_LOCKED(mapmut_py_delete_many_locked, mapmut_py_delete_many,
+              PyObject *,
+              (MapMutationObject *self, PyObject *args, PyObject *kwds),
+              (self, args, kwds))
+MAPMUT_LOCKED(mapmut_py_update_locked, mapmut_py_update, PyObject *,
+              (MapMutationObject *self, PyObject *args, PyObject *kwds),
+              (self, args, kwds))
+MAPMUT_LOCKED(mapmut_py_finish_locked, mapmut_py_finish, PyObject *,
+              (MapMutationObject *self, PyObject *args), (self, args))
+MAPMUT_LOCKED(mapmut_py_repr_locked, map_py_repr, PyObject *,
+              (MapMutationObject *self), ((BaseMapObject *)self))
+MAPMUT_LOCKED(mapmut_tp_len_locked, map_tp_len, Py_ssize_t,
+              (MapMutationObject *self), ((BaseMapObject *)self))
+MAPMUT_LOCKED(mapmut_tp_contains_locked, map_tp_contains, int,
+              (MapMutationObject *self, PyObject *key),
+              ((BaseMapObject *)self, key))
+MAPMUT_LOCKED(mapmut_tp_subscript_locked, map_tp_subscript, PyObject *,
+              (MapMutationObject *self, PyObject *key),
+              ((BaseMapObject *)self, key))
+MAPMUT_LOCKED(mapmut_tp_ass_sub_locked, mapmut_tp_ass_sub, int,
+              (MapMutationObject *self, PyObject *key, PyObject *val),
+              (self, key, val))
+
+MAP_FASTCALL_WRAPPER(mapmut_py_set_locked, MapMutationObject)
+MAP_FASTCALL_WRAPPER(mapmut_py_get_locked, MapMutationObject)
+MAP_FASTCALL_WRAPPER(mapmut_py_pop_locked, MapMutationObject)
+MAP_FASTCALL_WRAPPER(mapmut_py_exit_locked, MapMutationObject)
+
+static PyMethodDef MapMutation_methods[] = {
+    {"set", MAP_FASTCALL_METH(mapmut_py_set_locked), NULL},
+    {"get", MAP_FASTCALL_METH(mapmut_py_get_locked), NULL},
+    {"pop", MAP_FASTCALL_METH(mapmut_py_pop_locked), NULL},
+    {"delete_many", (PyCFunction)mapmut_py_delete_many_locked,
+        METH_VARARGS | METH_KEYWORDS, NULL},
+    {"finish", (PyCFunction)mapmut_py_finish_locked, METH_NOARGS, NULL},
+    {"update", (PyCFunction)mapmut_py_update_locked,
+        METH_VARARGS | METH_KEYWORDS, NULL},
+    {"__enter__", (PyCFunction)mapmut_py_enter, METH_NOARGS, NULL},
+    {"__exit__", MAP_FASTCALL_METH(mapmut_py_exit_locked), NULL},
+    {NULL, NULL}
+};
+
+MAP_WEAKLIST_MEMBERS(MapMutation_members, MapMutationObject, m_weakreflist)
+
+static PyType_Slot MapMutation_slots[] = {
+    {Py_tp_methods, MapMutation_methods},
+    MAP_MEMBERS_SLOT(MapMutation_members)
+    {Py_sq_contains, mapmut_tp_contains_locked},
+    {Py_mp_length, mapmut_tp_len_locked},
+    {Py_mp_subscript, mapmut_tp_subscript_locked},
+    {Py_mp_ass_subscript, mapmut_tp_ass_sub_locked},
+    {Py_tp_dealloc, map_tp_dealloc},
+    {Py_tp_traverse, map_tp_traverse},
+    {Py_tp_richcompare, mapmut_tp_richcompare},
+    {Py_tp_clear, map_tp_clear},
+    {Py_tp_repr, mapmut_py_repr_locked},
+    {Py_tp_hash, PyObject_HashNotImplemented},
+    {0, NULL}
+};
+
+static PyType_Spec MapMutation_spec = {
+    .name = "immutables._map.MapMutation",
+    .basicsize = sizeof(MapMutationObject),
+    .flags = MAP_TPFLAGS_INTERNAL,
+    .slots = MapMutation_slots,
+};
+
+
+/////////////////////////////////// Diff
+
+
+typedef struct {
+    MapBuildBuffer d_added;
+    MapBuildBuffer d_removed;
+    MapBuildBuffer d_changed;
+} MapDiffState;
+
+
+static int
+map_diff_append_slot(MapBuildBuffer *buf, map_hash_t key_hash,
+                     PyObject *key_or_null, PyObject *val_or_node)
+{
+    /* Append a key/value pair, or all pairs of a subtree. */
+
+    MapIteratorState iter;
+    map_iter_t iter_res;
+    PyObject *key;
+    PyObject *val;
+
+    if (key_or_null != NULL) {
+        return map_build_buffer_append(
+            buf, key_hash, key_or_null, val_or_node);
+    }
+
+    map_iterator_init(&iter, (MapNode *)val_or_node);
+    do {
+        iter_res = map_iterator_next(&iter, &key, &val);
+        if (iter_res == I_ITEM) {
+            if (map_build_buffer_append(
+                    buf, map_iterator_hash(&iter), key, val))
+            {
+                return -1;
+            }
+        }
+    } while (iter_res != I_END);
+
+    return 0;
+}
+
+static int
+map_diff_values(MapDiffState *state, map_hash_t key_hash, PyObject *key,
+                PyObject *val, PyObject *other_val)
+{
+    if (val == other_val) {
+        return 0;
+    }
+
+    int cmp = PyObject_RichCompareBool(val, other_val, Py_EQ);
+    if (cmp < 0) {
+        return -1;
+    }
+    if (cmp == 1) {
+        return 0;
+    }
+
+    return map_build_buffer_append(
+        &state->d_changed, key_hash, key, other_val);
+}
+
+static int
+map_diff_items(MapDiffState *state, MapNode *node, MapNode *other,
+               uint32_t shift)
+{
+    /* Slow path of map_node_diff: look up every key of each node
+       in the other one. */
+
+    MapIteratorState iter;
+    map_iter_t iter_res;
+    PyObject *key;
+    PyObject *val;
+    PyObject *other_val;
+
+    map_iterator_init(&iter, node);
+    do {
+        iter_res = map_iterator_next(&iter, &key, &val);
+        if (iter_res == I_ITEM) {
+            map_hash_t key_hash = map_iterator_hash(&iter);
+
+            switch (map_node_find(other, shift, key_hash, key, &other_val)) {
+                case F_ERROR:
+                    return -1;
+
+                case F_NOT_FOUND:
+                    if (map_build_buffer_append(
+                            &state->d_removed, key_hash, key, val))
+                    {
+                        return -1;
+                    }
+                    break;
+
+                case F_FOUND:
+                    if (map_diff_values(
+                            state, key_hash, key, val, other_val))
+                    {
+                        return -1;
+                    }
+                    break;
+
+                default:
+                    abort();
+            }
+        }
+    } while (iter_res != I_END);
+
+    map_iterator_init(&iter, other);
+    do {
+        iter_res = map_iterator_next(&iter, &key, &val);
+        if (iter_res == I_ITEM) {
+            map_hash_t key_hash = map_iterator_hash(&iter);
+
+            switch (map_node_find(node, shift, key_hash, key, &other_val)) {
+                case F_ERROR:
+                    return -1;
+
+                case F_NOT_FOUND:
+                    if (map_build_buffer_append(
+                            &state->d_added, key_hash, key, val))
+                    {
+                        return -1;
+                    }
+                    break;
+
+                case F_FOUND:
+                    break;
+
+                default:
+                    abort();
+            }
+        }
+    } while (iter_res != I_END);
+
+    return 0;
+}
+
+static int
+map_diff_item_subtree(MapDiffState *state, map_hash_t key_hash,
+                      PyObject *key, PyObject *val, MapNode *node,
+                      int reversed)
+{
+    /* Diff a key/value pair of the old map against a subtree of
+       the new map that occupies the same slot, or, if `reversed`
+       is set, a pair of the new map against a subtree of the old
+       one. */
+
+    MapIteratorState iter;
+    map_iter_t iter_res;
+    PyObject *node_key;
+    PyObject *node_val;
+    int found = 0;
+
+    map_iterator_init(&iter, node);
+    do {
+        iter_res = map_iterator_next(&iter, &node_key, &node_val);
+        if (iter_res == I_ITEM) {
+            map_hash_t node_key_hash = map_iterator_hash(&iter);
+
+            if (!found && node_key_hash == key_hash) {
+                int cmp = PyObject_RichCompareBool(key, node_key, Py_EQ);
+                if (cmp < 0) {
+                    return -1;
+                }
+
+                if (cmp == 1) {
+                    found = 1;
+
+                    if (reversed) {
+                        cmp = map_diff_values(
+                            state, key_hash, key, node_val, val);
+                    }
+                    else {
+                        cmp = map_diff_values(
+                            state, key_hash, node_key, val, node_val);
+                    }
+                    if (cmp) {
+                        return -1;
+                    }
+                    continue;
+                }
+            }
+
+            if (map_build_buffer_append(
+                    reversed ? &state->d_removed : &state->d_added,
+                    node_key_hash, node_key, node_val))
+            {
+                return -1;
+            }
+        }
+    } while (iter_res != I_END);
+
+    if (!found) {
+        return map_build_buffer_append(
+            reversed ? &state->d_added : &state->d_removed,
+            key_hash, key, val);
+    }
+
+    return 0;
+}
+
+static int
+map_node_diff(MapDiffState *state, MapNode *node, MapNode *other,
+              uint32_t shift)
+{
+    /* Collect the differences between two nodes located at the
+       `shift` level of the tree.
+
+       The nodes are walked slot by slot: slots present in only one
+       of the nodes are added or removed wholesale, and identical
+       subtrees are skipped without looking at their contents.
+    */
+
+    uint32_t i;
+
+    if (node == other) {
+        return 0;
+    }
+
+    if (IS_COLLISION_NODE(node) || IS_COLLISION_NODE(other)) {
+        return map_diff_items(state, node, other, shift);
+    }
+
+    uint32_t bitmap = map_node_slot_bitmap(node);
+    uint32_t other_bitmap = map_node_slot_bitmap(other);
+
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        uint32_t bit = (uint32_t)1 << i;
+        map_hash_t hash, other_hash;
+        PyObject *key, *val, *other_key, *other_val;
+        int res;
+
+        if (!((bitmap | other_bitmap) & bit)) {
+            continue;
+        }
+
+        if (!(other_bitmap & bit)) {
+            map_node_get_slot(node, i, &hash, &key, &val);
+            res = map_diff_append_slot(&state->d_removed, hash, key, val);
+        }
+        else if (!(bitmap & bit)) {
+            map_node_get_slot(other, i, &other_hash, &other_key, &other_val);
+            res = map_diff_append_slot(
+                &state->d_added, other_hash, other_key, other_val);
+        }
+        else {
+            map_node_get_slot(node, i, &hash, &key, &val);
+            map_node_get_slot(other, i, &other_hash, &other_key, &other_val);
+
+            if (key == NULL && other_key == NULL) {
+                res = map_node_diff(
+                    state, (MapNode *)val, (MapNode *)other_val, shift + 5);
+            }
+            else if (key == NULL) {
+                res = map_diff_item_subtree(
+                    state, other_hash, other_key, other_val,
+                    (MapNode *)val, 1);
+            }
+            else if (other_key == NULL) {
+                res = map_diff_item_subtree(
+                    state, hash, key, val, (MapNode *)other_val, 0);
+            }
+            else {
+                res = 0;
+                if (hash == other_hash) {
+                    res = PyObject_RichCompareBool(key, other_key, Py_EQ);
+                }
+                if (res == 1) {
+                    res = map_diff_values(
+                        state, other_hash, other_key, val, other_val);
+                }
+                else if (res == 0) {
+                    res = map_build_buffer_append(
+                        &state->d_removed, hash, key, val);
+                    if (!res) {
+                        res = map_build_buffer_append(
+                            &state->d_added, other_hash, other_key,
+                            other_val);
+                    }
+                }
+            }
+        }
+
+        if (res) {
+            return -1;
+        }
+    }
+
+    return 0;
+}
+
+
+static PyObject *
+map_diff(MapObject *o, MapObject *other)
+{
+    MapModuleState *st = MAP_STATE(o);
+    MapDiffState state;
+    MapObject *added = NULL;
+    MapObject *removed = NULL;
+    MapObject *changed = NULL;
+    MapNode *o_root = NULL;
+    MapNode *other_root = NULL;
+    PyObject *res = NULL;
+
+    map_build_buffer_init(&state.d_added);
+    map_build_buffer_init(&state.d_removed);
+    map_build_buffer_init(&state.d_changed);
+
+    o_root = map_root(o, 0);
+    if (o_root == NULL) {
+        goto fin;
+    }
+
+    other_root = map_root(other, 0);
+    if (other_root == NULL) {
+        goto fin;
+    }
+
+    if (map_node_diff(&state, o_root, other_root, 0)) {
+        goto fin;
+    }
+
+    added = map_from_build_buffer(st, &state.d_added, map_next_mutid(st));
+    if (added == NULL) {
+        goto fin;
+    }
+
+    removed = map_from_build_buffer(st, &state.d_removed, map_next_mutid(st));
+    if (removed == NULL) {
+        goto fin;
+    }
+
+    changed = map_from_build_buffer(st, &state.d_changed, map_next_mutid(st));
+    if (changed == NULL) {
+        goto fin;
+    }
+
+    res = PyTuple_Pack(3, added, removed, changed);
+
+fin:
+    Py_XDECREF(added);
+    Py_XDECREF(removed);
+    Py_XDECREF(changed);
+    Py_XDECREF(o_root);
+    Py_XDECREF(other_root);
+    map_build_buffer_clear(&state.d_added);
+    map_build_buffer_clear(&state.d_removed);
+    map_build_buffer_clear(&state.d_changed);
+    return res;
+}
+
+
+/////////////////////////////////// Selection
+
+
+typedef struct {
+    /* Keep keys that are not in the other tree (otherwise keep
+       keys that are). */
+    int s_difference;
+
+    /* Keys are considered present in the other tree only if their
+       values are equal too. */
+    int s_items;
+
+    /* The number of dropped keys for intersections, and the number
+       of kept keys for differences. */
+    Py_ssize_t s_count;
+
+    /* Mutation id of the new nodes. */
+    uint64_t s_mutid;
+} MapSelectState;
+
+
+static int
+map_node_select(MapModuleState *st,
+                MapSelectState *state, MapNode *node, MapNode *other,
+                uint32_t shift, MapNode **result);
+
+
+static void
+map_select_account(MapSelectState *state,
+                   PyObject *key_or_null, PyObject *val_or_node, int keep)
+{
+    if (keep == state->s_difference) {
+        state->s_count +=
+            key_or_null == NULL ? map_node_count((MapNode *)val_or_node) : 1;
+    }
+}
+
+static int
+map_select_item(MapSelectState *state, PyObject *key, PyObject *val,
+                int found, PyObject *other_val)
+{
+    /* Return 1 if the key/value pair should be kept, 0 if not,
+       and -1 on error. */
+
+    if (found && state->s_items && val != other_val) {
+        found = PyObject_RichCompareBool(val, other_val, Py_EQ);
+        if (found < 0) {
+            return -1;
+        }
+    }
+
+    int keep = state->s_difference ? !found : found;
+    map_select_account(state, key, val, keep);
+    return keep;
+}
+
+static int
+map_select_items(MapModuleState *st,
+                 MapSelectState *state, MapNode *node, MapNode *other,
+                 uint32_t shift, MapNode **result)
+{
+    /* Slow path of map_node_select: look up every key of `node` in
+       `other` and build a new subtree out of the selected ones. */
+
+    MapIteratorState iter;
     map_iter_t iter_res;
-    map_iterator_init(&iter, m->b_root);
-    int second = 0;
-    do {
-        PyObject *v_key;
-        PyObject *v_val;
+    MapBuildBuffer buf;
+    PyObject *key;
+    PyObject *val;
+    PyObject *other_val = NULL;
+    Py_ssize_t total = 0;
+    int res = -1;
 
-        iter_res = map_iterator_next(&iter, &v_key, &v_val);
+    map_build_buffer_init(&buf);
+
+    map_iterator_init(&iter, node);
+    do {
+        iter_res = map_iterator_next(&iter, &key, &val);
         if (iter_res == I_ITEM) {
-            if (second) {
-                if (_PyUnicodeWriter_WriteASCIIString(&writer, ", ", 2) < 0) {
-                    goto error;
-                }
+            map_hash_t key_hash = map_iterator_hash(&iter);
+
+            map_find_t find_res = map_node_find(
+                other, shift, key_hash, key, &other_val);
+            if (find_res == F_ERROR) {
+                goto fin;
             }
 
-            PyObject *s = PyObject_Repr(v_key);
-            if (s == NULL) {
-                goto error;
+            int keep = map_select_item(
+                state, key, val, find_res == F_FOUND, other_val);
+            if (keep < 0) {
+                goto fin;
             }
-            if (_PyUnicodeWriter_WriteStr(&writer, s) < 0) {
-                Py_DECREF(s);
-                goto error;
+
+            if (keep && map_build_buffer_append(&buf, key_hash, key, val)) {
+                goto fin;
             }
-            Py_DECREF(s);
 
-            if (_PyUnicodeWriter_WriteASCIIString(&writer, ": ", 2) < 0) {
-                goto error;
+            total++;
+        }
+    } while (iter_res != I_END);
+
+    if (buf.b_size == total) {
+        Py_INCREF(node);
+        *result = node;
+    }
+    else if (buf.b_size == 0) {
+        *result = NULL;
+    }
+    else {
+        *result = map_node_build_subtree(st, &buf, shift, state->s_mutid);
+        if (*result == NULL) {
+            goto fin;
+        }
+    }
+
+    res = 0;
+
+fin:
+    map_build_buffer_clear(&buf);
+    return res;
+}
+
+static int
+map_select_wrapped(MapModuleState *st,
+                   MapSelectState *state, map_hash_t key_hash,
+                   PyObject *key, PyObject *val,
+                   uint32_t shift, MapNode *node, int wrapped_first,
+                   MapNode **result)
+{
+    /* Wrap the key/value pair in a single-item Bitmap node located
+       at the `shift` level, and select it against the `node`
+       subtree (or select `node` against it if `wrapped_first` is
+       not set). */
+
+    MapNode *wrapper = map_node_bitmap_new_item(
+        st, shift, key_hash, key, val, 0);
+    if (wrapper == NULL) {
+        return -1;
+    }
+
+    int res;
+    if (wrapped_first) {
+        res = map_node_select(
+            st, state, wrapper, node, shift, result);
+    }
+    else {
+        res = map_node_select(
+            st, state, node, wrapper, shift, result);
+    }
+
+    Py_DECREF(wrapper);
+    return res;
+}
+
+static int
+map_node_select(MapModuleState *st,
+                MapSelectState *state, MapNode *node, MapNode *other,
+                uint32_t shift, MapNode **result)
+{
+    /* Select keys of the `node` subtree that are present (or absent,
+       for differences) in the `other` subtree; both nodes are located
+       at the `shift` level of the tree.
+
+       On success, *result is set to a new reference to the resulting
+       node, or to NULL if no keys were selected.  Subtrees that are
+       kept or dropped entirely are reused or skipped as is.
+    */
+
+    map_hash_t hashes[HAMT_ARRAY_NODE_SIZE];
+    PyObject *keys[HAMT_ARRAY_NODE_SIZE];
+    PyObject *vals[HAMT_ARRAY_NODE_SIZE];
+    uint32_t bitmap;
+    uint32_t other_bitmap;
+    uint32_t new_bitmap = 0;
+    uint32_t i;
+    int changed = 0;
+    int res = -1;
+
+    if (node == other) {
+        if (state->s_difference) {
+            *result = NULL;
+        }
+        else {
+            Py_INCREF(node);
+            *result = node;
+        }
+        return 0;
+    }
+
+    if (IS_COLLISION_NODE(node) || IS_COLLISION_NODE(other)) {
+        return map_select_items(st, state, node, other, shift, result);
+    }
+
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        keys[i] = NULL;
+        vals[i] = NULL;
+    }
+
+    bitmap = map_node_slot_bitmap(node);
+    other_bitmap = map_node_slot_bitmap(other);
+
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        uint32_t bit = (uint32_t)1 << i;
+        map_hash_t other_hash;
+        PyObject *key, *val, *other_key, *other_val;
+        MapNode *sub_node = NULL;
+
+        if (!(bitmap & bit)) {
+            continue;
+        }
+
+        map_node_get_slot(node, i, &hashes[i], &key, &val);
+
+        if (!(other_bitmap & bit)) {
+            map_select_account(state, key, val, state->s_difference);
+            if (state->s_difference) {
+                Py_XINCREF(key);
+                keys[i] = key;
+                Py_INCREF(val);
+                vals[i] = val;
+                new_bitmap |= bit;
+            }
+            else {
+                changed = 1;
             }
+            continue;
+        }
 
-            s = PyObject_Repr(v_val);
-            if (s == NULL) {
-                goto error;
+        map_node_get_slot(other, i, &other_hash, &other_key, &other_val);
+
+        if (key != NULL && other_key != NULL) {
+            int found = 0;
+            if (hashes[i] == other_hash) {
+                found = PyObject_RichCompareBool(key, other_key, Py_EQ);
+                if (found < 0) {
+                    goto fin;
+                }
             }
-            if (_PyUnicodeWriter_WriteStr(&writer, s) < 0) {
-                Py_DECREF(s);
-                goto error;
+
+            int keep = map_select_item(state, key, val, found, other_val);
+            if (keep < 0) {
+                goto fin;
             }
-            Py_DECREF(s);
+
+            if (keep) {
+                Py_INCREF(key);
+                keys[i] = key;
+                Py_INCREF(val);
+                vals[i] = val;
+                new_bitmap |= bit;
+            }
+            else {
+                changed = 1;
+            }
+            continue;
         }
 
-        second = 1;
-    } while (iter_res != I_END);
+        if (key == NULL && other_key == NULL) {
+            res = map_node_select(
+                st, state, (MapNode *)val, (MapNode *)other_val, shift + 5,
+                &sub_node);
+        }
+        else if (key == NULL) {
+            res = map_select_wrapped(
+                st, state, other_hash, other_key, other_val,
+                shift + 5, (MapNode *)val, 0, &sub_node);
+        }
+        else {
+            res = map_select_wrapped(
+                st, state, hashes[i], key, val,
+                shift + 5, (MapNode *)other_val, 1, &sub_node);
+        }
+
+        if (res) {
+            goto fin;
+        }
+        res = -1;
+
+        if (sub_node == NULL) {
+            changed = 1;
+        }
+        else if (key != NULL) {
+            /* The wrapped key/value pair was selected. */
+            Py_DECREF(sub_node);
+            Py_INCREF(key);
+            keys[i] = key;
+            Py_INCREF(val);
+            vals[i] = val;
+            new_bitmap |= bit;
+        }
+        else {
+            if ((PyObject *)sub_node != val) {
+                changed = 1;
+            }
+            vals[i] = (PyObject *)sub_node;  /* borrow */
+            new_bitmap |= bit;
+        }
+    }
+
+    if (!changed) {
+        Py_INCREF(node);
+        *result = node;
+    }
+    else if (new_bitmap == 0) {
+        *result = NULL;
+    }
+    else {
+        *result = map_node_new_from_slots(
+            st, hashes, keys, vals, new_bitmap, shift, state->s_mutid);
+        if (*result == NULL) {
+            goto fin;
+        }
+    }
+
+    res = 0;
+
+fin:
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        Py_XDECREF(keys[i]);
+        Py_XDECREF(vals[i]);
+    }
+    return res;
+}
+
+
+static MapObject *
+map_select(MapObject *o, MapObject *other, int difference, int items)
+{
+    MapModuleState *st = MAP_STATE(o);
+    MapSelectState state;
+    MapNode *o_root;
+    MapNode *other_root;
+    MapNode *new_root;
+
+    if (o->h_count == 0 || (other->h_count == 0 && difference)) {
+        Py_INCREF(o);
+        return o;
+    }
+
+    if (other->h_count == 0) {
+        return map_new(st);
+    }
+
+    state.s_difference = difference;
+    state.s_items = items;
+    state.s_count = 0;
+    state.s_mutid = 0;
+
+    o_root = map_root(o, 0);
+    if (o_root == NULL) {
+        return NULL;
+    }
+
+    other_root = map_root(other, 0);
+    if (other_root == NULL) {
+        Py_DECREF(o_root);
+        return NULL;
+    }
+
+    int res = map_node_select(st, &state, o_root, other_root, 0, &new_root);
+    Py_DECREF(other_root);
+    Py_DECREF(o_root);
+    if (res) {
+        return NULL;
+    }
+
+    if (new_root == NULL) {
+        return map_new(st);
+    }
+
+    if (new_root == o_root) {
+        Py_DECREF(new_root);
+        Py_INCREF(o);
+        return o;
+    }
+
+    return map_from_root(
+        st, new_root, difference ? state.s_count : o->h_count - state.s_count);
+}
+
+
+static MapObject *
+map_take(MapObject *o, PyObject *keys)
+{
+    MapModuleState *st = MAP_STATE(o);
+    MapBuildBuffer buf;
+    MapObject *new_o = NULL;
+    PyObject *key;
+
+    /* Keys' __hash__ and __eq__ can modify `keys`, so it is iterated
+       over instead of being accessed as an array. */
+    PyObject *it = PyObject_GetIter(keys);
+    if (it == NULL) {
+        return NULL;
+    }
+
+    map_build_buffer_init(&buf);
+
+    while (o->h_count > 0 && (key = PyIter_Next(it))) {
+        PyObject *val;
+        int res = 0;
+
+        map_hash_t key_hash = map_hash(key);
+        if (key_hash == -1) {
+            Py_DECREF(key);
+            goto fin;
+        }
+
+        switch (map_find_hash((BaseMapObject *)o, key_hash, key, &val)) {
+            case F_ERROR:
+                res = -1;
+                break;
+
+            case F_NOT_FOUND:
+                break;
+
+            case F_FOUND:
+                res = map_build_buffer_append(&buf, key_hash, key, val);
+                break;
+
+            default:
+                abort();
+        }
 
-    if (_PyUnicodeWriter_WriteASCIIString(&writer, "})", 2) < 0) {
-        goto error;
+        Py_DECREF(key);
+        if (res) {
+            goto fin;
+        }
     }
 
-    PyObject *addr = PyUnicode_FromFormat(" at %p>", m);
-    if (addr == NULL) {
-        goto error;
-    }
-    if (_PyUnicodeWriter_WriteStr(&writer, addr) < 0) {
-        Py_DECREF(addr);
-        goto error;
+    if (PyErr_Occurred()) {
+        goto fin;
     }
-    Py_DECREF(addr);
 
-    Py_ReprLeave((PyObject *)m);
-    return _PyUnicodeWriter_Finish(&writer);
+    new_o = map_from_build_buffer(st, &buf, map_next_mutid(st));
+    if (new_o != NULL && new_o->h_count == o->h_count) {
+        /* All keys were taken. */
+        Py_DECREF(new_o);
+        Py_INCREF(o);
+        new_o = o;
+    }
 
-error:
-    _PyUnicodeWriter_Dealloc(&writer);
-    Py_ReprLeave((PyObject *)m);
-    return NULL;
+fin:
+    map_build_buffer_clear(&buf);
+    Py_DECREF(it);
+    return new_o;
 }
 
 
-static Py_uhash_t
-_shuffle_bits(Py_uhash_t h)
+static int
+map_node_delete_many(MapModuleState *st,
+                     MapNode *root, Py_ssize_t count, PyObject *keys,
+                     int missing_ok, uint64_t mutid,
+                     MapNode **new_root, Py_ssize_t *new_count)
 {
-    return ((h ^ 89869747UL) ^ (h << 16)) * 3644798167UL;
-}
+    /* Delete `keys` from the `root` tree.
 
+       Instead of deleting the keys one by one, they are put into
+       a temporary Map which is then subtracted from the tree: every
+       node that loses keys is rebuilt only once, and the untouched
+       subtrees are shared.
 
-static Py_hash_t
-map_py_hash(MapObject *self)
-{
-    /* Adapted version of frozenset.__hash__: it's important
-       that Map.__hash__ is independant of key/values order.
+       *new_root is set to NULL if all keys were deleted. */
 
-       Optimization idea: compute and memoize intermediate
-       hash values for HAMT nodes.
-    */
+    MapBuildBuffer buf;
+    MapObject *keys_map = NULL;
+    MapNode *keys_root = NULL;
+    PyObject *key;
+    int res = -1;
 
-    if (self->h_hash != -1) {
-        return self->h_hash;
+    PyObject *it = PyObject_GetIter(keys);
+    if (it == NULL) {
+        return -1;
     }
 
-    Py_uhash_t hash = 0;
+    map_build_buffer_init(&buf);
 
-    MapIteratorState iter;
-    map_iter_t iter_res;
-    map_iterator_init(&iter, self->h_root);
-    do {
-        PyObject *v_key;
-        PyObject *v_val;
+    while ((key = PyIter_Next(it))) {
+        map_hash_t key_hash = map_hash(key);
+        if (key_hash == -1) {
+            Py_DECREF(key);
+            goto fin;
+        }
 
-        iter_res = map_iterator_next(&iter, &v_key, &v_val);
-        if (iter_res == I_ITEM) {
-            Py_hash_t vh = PyObject_Hash(v_key);
-            if (vh == -1) {
-                return -1;
-            }
-            hash ^= _shuffle_bits((Py_uhash_t)vh);
+        if (!missing_ok) {
+            PyObject *val;
 
-            vh = PyObject_Hash(v_val);
-            if (vh == -1) {
-                return -1;
+            switch (map_node_find(root, 0, key_hash, key, &val)) {
+                case F_ERROR:
+                    Py_DECREF(key);
+                    goto fin;
+
+                case F_NOT_FOUND:
+                    PyErr_SetObject(PyExc_KeyError, key);
+                    Py_DECREF(key);
+                    goto fin;
+
+                case F_FOUND:
+                    break;
+
+                default:
+                    abort();
             }
-            hash ^= _shuffle_bits((Py_uhash_t)vh);
         }
-    } while (iter_res != I_END);
 
-    hash ^= ((Py_uhash_t)self->h_count * 2 + 1) * 1927868237UL;
+        if (map_build_buffer_append(&buf, key_hash, key, Py_None)) {
+            Py_DECREF(key);
+            goto fin;
+        }
 
-    hash ^= (hash >> 11) ^ (hash >> 25);
-    hash = hash * 69069U + 907133923UL;
+        Py_DECREF(key);
+    }
+
+    if (PyErr_Occurred()) {
+        goto fin;
+    }
+
+    if (count == 0 || buf.b_size == 0) {
+        Py_INCREF(root);
+        *new_root = root;
+        *new_count = count;
+        res = 0;
+        goto fin;
+    }
+
+    keys_map = map_from_build_buffer(st, &buf, map_next_mutid(st));
+    if (keys_map == NULL) {
+        goto fin;
+    }
+
+    keys_root = map_root(keys_map, 0);
+    if (keys_root == NULL) {
+        goto fin;
+    }
+
+    MapSelectState state;
+    state.s_difference = 1;
+    state.s_items = 0;
+    state.s_count = 0;
+    state.s_mutid = mutid;
 
-    self->h_hash = (Py_hash_t)hash;
-    if (self->h_hash == -1) {
-        self->h_hash = 1;
+    if (map_node_select(st, &state, root, keys_root, 0, new_root)) {
+        goto fin;
     }
-    return self->h_hash;
+
+    if (*new_root == NULL) {
+        *new_count = 0;
+    }
+    else if (*new_root == root) {
+        *new_count = count;
+    }
+    else {
+        *new_count = state.s_count;
+    }
+
+    res = 0;
+
+fin:
+    Py_XDECREF(keys_root);
+    Py_XDECREF(keys_map);
+    map_build_buffer_clear(&buf);
+    Py_DECREF(it);
+    return res;
 }
 
-static PyObject *
-map_reduce(MapObject *self)
+
+static MapObject *
+map_delete_many(MapObject *o, PyObject *keys, int missing_ok)
 {
-    MapIteratorState iter;
-    map_iter_t iter_res;
+    MapModuleState *st = MAP_STATE(o);
+    MapNode *new_root;
+    Py_ssize_t new_count;
 
-    PyObject *dict = PyDict_New();
-    if (dict == NULL) {
+    MapNode *root = map_root(o, 0);
+    if (root == NULL) {
         return NULL;
     }
 
-    map_iterator_init(&iter, self->h_root);
-    do {
-        PyObject *key;
-        PyObject *val;
+    int res = map_node_delete_many(
+        st, root, o->h_count, keys, missing_ok, 0, &new_root, &new_count);
+    Py_DECREF(root);
+    if (res) {
+        return NULL;
+    }
 
-        iter_res = map_iterator_next(&iter, &key, &val);
-        if (iter_res == I_ITEM) {
-            if (PyDict_SetItem(dict, key, val) < 0) {
-                Py_DECREF(dict);
-                return NULL;
-            }
-        }
-    } while (iter_res != I_END);
+    if (new_root == NULL) {
+        return map_new(st);
+    }
 
-    PyObject *args = PyTuple_Pack(1, dict);
-    Py_DECREF(dict);
-    if (args == NULL) {
-        return NULL;
+    if (new_root == root) {
+        /* None of the keys were in the Map. */
+        Py_DECREF(new_root);
+        Py_INCREF(o);
+        return o;
     }
 
-    PyObject *tup = PyTuple_Pack(2, Py_TYPE(self), args);
-    Py_DECREF(args);
-    return tup;
+    return map_from_root(st, new_root, new_count);
 }
 
-static PyObject *
-map_py_class_getitem(PyObject *type, PyObject *item)
-{
-    Py_INCREF(type);
-    return type;
-}
 
-static PyMethodDef Map_methods[] = {
-    {"set", (PyCFunction)map_py_set, METH_VARARGS, NULL},
-    {"get", (PyCFunction)map_py_get, METH_VARARGS, NULL},
-    {"delete", (PyCFunction)map_py_delete, METH_O, NULL},
-    {"mutate", (PyCFunction)map_py_mutate, METH_NOARGS, NULL},
-    {"items", (PyCFunction)map_py_items, METH_NOARGS, NULL},
-    {"keys", (PyCFunction)map_py_keys, METH_NOARGS, NULL},
-    {"values", (PyCFunction)map_py_values, METH_NOARGS, NULL},
-    {"update", (PyCFunction)map_py_update, METH_VARARGS | METH_KEYWORDS, NULL},
-    {"__reduce__", (PyCFunction)map_reduce, METH_NOARGS, NULL},
-    {"__dump__", (PyCFunction)map_py_dump, METH_NOARGS, NULL},
-    {
-        "__class_getitem__",
-        (PyCFunction)map_py_class_getitem,
-        METH_O|METH_CLASS,
-        NULL
-    },
-    {NULL, NULL}
-};
+/////////////////////////////////// Filtering and mapping
 
-static PySequenceMethods Map_as_sequence = {
-    0,                                /* sq_length */
-    0,                                /* sq_concat */
-    0,                                /* sq_repeat */
-    0,                                /* sq_item */
-    0,                                /* sq_slice */
-    0,                                /* sq_ass_item */
-    0,                                /* sq_ass_slice */
-    (objobjproc)map_tp_contains,      /* sq_contains */
-    0,                                /* sq_inplace_concat */
-    0,                                /* sq_inplace_repeat */
-};
 
-static PyMappingMethods Map_as_mapping = {
-    (lenfunc)map_tp_len,             /* mp_length */
-    (binaryfunc)map_tp_subscript,    /* mp_subscript */
-};
+typedef struct {
+    map_transform_t t_kind;
 
-PyTypeObject _Map_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "immutables._map.Map",
-    sizeof(MapObject),
-    .tp_methods = Map_methods,
-    .tp_as_mapping = &Map_as_mapping,
-    .tp_as_sequence = &Map_as_sequence,
-    .tp_iter = (getiterfunc)map_tp_iter,
-    .tp_dealloc = (destructor)map_tp_dealloc,
-    .tp_getattro = PyObject_GenericGetAttr,
-    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
-    .tp_richcompare = map_tp_richcompare,
-    .tp_traverse = (traverseproc)map_tp_traverse,
-    .tp_clear = (inquiry)map_tp_clear,
-    .tp_new = map_tp_new,
-    .tp_init = (initproc)map_tp_init,
-    .tp_weaklistoffset = offsetof(MapObject, h_weakreflist),
-    .tp_hash = (hashfunc)map_py_hash,
-    .tp_repr = (reprfunc)map_py_repr,
-};
+    /* The predicate for filters, or the function to apply
+       to values. */
+    PyObject *t_func;
 
+    /* The number of kept keys. */
+    Py_ssize_t t_count;
+} MapTransformState;
 
-/////////////////////////////////// MapMutation
 
+static int
+map_transform_item(MapTransformState *state, PyObject *key, PyObject *val,
+                   PyObject **new_val)
+{
+    /* Set *new_val to a new reference to the new value of the key,
+       or to NULL if the key is dropped.  Return -1 on error. */
+
+    PyObject *res;
+    int keep;
+
+    if (state->t_kind == T_MAP_VALUES) {
+        res = PyObject_CallFunctionObjArgs(state->t_func, val, NULL);
+        if (res == NULL) {
+            return -1;
+        }
+        state->t_count++;
+        *new_val = res;
+        return 0;
+    }
+
+    if (state->t_kind == T_FILTER) {
+        res = PyObject_CallFunctionObjArgs(state->t_func, key, val, NULL);
+    }
+    else {
+        assert(state->t_kind == T_FILTER_KEYS);
+        res = PyObject_CallFunctionObjArgs(state->t_func, key, NULL);
+    }
+    if (res == NULL) {
+        return -1;
+    }
+
+    keep = PyObject_IsTrue(res);
+    Py_DECREF(res);
+    if (keep < 0) {
+        return -1;
+    }
+
+    if (keep) {
+        state->t_count++;
+        Py_INCREF(val);
+        *new_val = val;
+    }
+    else {
+        *new_val = NULL;
+    }
+    return 0;
+}
 
 static int
-map_node_update_from_map(uint64_t mutid,
-                         MapObject *map,
-                         MapNode *root, Py_ssize_t count,
-                         MapNode **new_root, Py_ssize_t *new_count)
+map_transform_items(MapModuleState *st,
+                    MapTransformState *state, MapNode *node,
+                    uint32_t shift, MapNode **result)
 {
-    assert(Map_Check(map));
+    /* Transform the items of a Collision node located at the `shift`
+       level; see map_node_transform(st). */
 
     MapIteratorState iter;
     map_iter_t iter_res;
+    MapBuildBuffer buf;
+    PyObject *key;
+    PyObject *val;
+    PyObject *new_val;
+    int changed = 0;
+    int res = -1;
 
-    MapNode *last_root;
-    Py_ssize_t last_count;
-
-    Py_INCREF(root);
-    last_root = root;
-    last_count = count;
+    map_build_buffer_init(&buf);
 
-    map_iterator_init(&iter, map->h_root);
+    map_iterator_init(&iter, node);
     do {
-        PyObject *key;
-        PyObject *val;
-        int32_t key_hash;
-        int added_leaf;
-
         iter_res = map_iterator_next(&iter, &key, &val);
         if (iter_res == I_ITEM) {
-            key_hash = map_hash(key);
-            if (key_hash == -1) {
-                goto err;
-            }
-
-            MapNode *iter_root = map_node_assoc(
-                last_root,
-                0, key_hash, key, val, &added_leaf,
-                mutid);
+            map_hash_t key_hash = map_iterator_hash(&iter);
 
-            if (iter_root == NULL) {
-                goto err;
+            if (map_transform_item(state, key, val, &new_val)) {
+                goto fin;
             }
 
-            if (added_leaf) {
-                last_count++;
+            if (new_val != val) {
+                changed = 1;
             }
 
-            Py_SETREF(last_root, iter_root);
+            if (new_val != NULL) {
+                int append_res = map_build_buffer_append(
+                    &buf, key_hash, key, new_val);
+                Py_DECREF(new_val);
+                if (append_res) {
+                    goto fin;
+                }
+            }
         }
     } while (iter_res != I_END);
 
-    *new_root = last_root;
-    *new_count = last_count;
+    if (!changed) {
+        Py_INCREF(node);
+        *result = node;
+    }
+    else if (buf.b_size == 0) {
+        *result = NULL;
+    }
+    else {
+        *result = map_node_build_subtree(st, &buf, shift, 0);
+        if (*result == NULL) {
+            goto fin;
+        }
+    }
 
-    return 0;
+    res = 0;
 
-err:
-    Py_DECREF(last_root);
-    return -1;
+fin:
+    map_build_buffer_clear(&buf);
+    return res;
 }
 
-
 static int
-map_node_update_from_dict(uint64_t mutid,
-                          PyObject *dct,
-                          MapNode *root, Py_ssize_t count,
-                          MapNode **new_root, Py_ssize_t *new_count)
+map_node_transform(MapModuleState *st, MapTransformState *state, MapNode *node,
+                   uint32_t shift, MapNode **result)
 {
-    assert(PyDict_Check(dct));
+    /* Filter the keys of the `node` subtree located at the `shift`
+       level, or replace their values.
 
-    PyObject *it = PyObject_GetIter(dct);
-    if (it == NULL) {
-        return -1;
-    }
+       On success, *result is set to a new reference to the resulting
+       node, or to NULL if no keys were kept.  Subtrees that have not
+       changed are reused as is, and so is `node` itself.
+    */
 
-    MapNode *last_root;
-    Py_ssize_t last_count;
+    map_hash_t hashes[HAMT_ARRAY_NODE_SIZE];
+    PyObject *keys[HAMT_ARRAY_NODE_SIZE];
+    PyObject *vals[HAMT_ARRAY_NODE_SIZE];
+    uint32_t bitmap;
+    uint32_t new_bitmap = 0;
+    uint32_t i;
+    int changed = 0;
+    int res = -1;
 
-    Py_INCREF(root);
-    last_root = root;
-    last_count = count;
+    if (IS_COLLISION_NODE(node)) {
+        return map_transform_items(st, state, node, shift, result);
+    }
 
-    PyObject *key;
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        keys[i] = NULL;
+        vals[i] = NULL;
+    }
 
-    while ((key = PyIter_Next(it))) {
-        PyObject *val;
-        int added_leaf;
-        int32_t key_hash;
+    bitmap = map_node_slot_bitmap(node);
 
-        key_hash = map_hash(key);
-        if (key_hash == -1) {
-            Py_DECREF(key);
-            goto err;
-        }
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        uint32_t bit = (uint32_t)1 << i;
+        PyObject *key, *val, *new_val;
 
-        val = PyDict_GetItemWithError(dct, key);
-        if (val == NULL) {
-            Py_DECREF(key);
-            goto err;
+        if (!(bitmap & bit)) {
+            continue;
         }
 
-        MapNode *iter_root = map_node_assoc(
-            last_root,
-            0, key_hash, key, val, &added_leaf,
-            mutid);
+        map_node_get_slot(node, i, &hashes[i], &key, &val);
 
-        Py_DECREF(key);
+        if (key == NULL) {
+            MapNode *sub_node;
+            if (map_node_transform(
+                    st, state, (MapNode *)val, shift + 5, &sub_node))
+            {
+                goto fin;
+            }
+            new_val = (PyObject *)sub_node;
+        }
+        else if (map_transform_item(state, key, val, &new_val)) {
+            goto fin;
+        }
 
-        if (iter_root == NULL) {
-            goto err;
+        if (new_val != val) {
+            changed = 1;
         }
 
-        if (added_leaf) {
-            last_count++;
+        if (new_val != NULL) {
+            Py_XINCREF(key);
+            keys[i] = key;
+            vals[i] = new_val;  /* borrow */
+            new_bitmap |= bit;
         }
+    }
 
-        Py_SETREF(last_root, iter_root);
+    if (!changed) {
+        Py_INCREF(node);
+        *result = node;
+    }
+    else if (new_bitmap == 0) {
+        *result = NULL;
+    }
+    else {
+        *result = map_node_new_from_slots(
+            st, hashes, keys, vals, new_bitmap, shift, 0);
+        if (*result == NULL) {
+            goto fin;
+        }
+    }
+
+    res = 0;
+
+fin:
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        Py_XDECREF(keys[i]);
+        Py_XDECREF(vals[i]);
+    }
+    return res;
+}
+
+
+static MapObject *
+map_transform(MapObject *o, map_transform_t kind, PyObject *func)
+{
+    MapModuleState *st = MAP_STATE(o);
+    MapTransformState state;
+    MapNode *root;
+    MapNode *new_root;
+
+    if (o->h_count == 0) {
+        Py_INCREF(o);
+        return o;
     }
 
-    if (key == NULL && PyErr_Occurred()) {
-        goto err;
+    state.t_kind = kind;
+    state.t_func = func;
+    state.t_count = 0;
+
+    root = map_root(o, 0);
+    if (root == NULL) {
+        return NULL;
     }
 
-    Py_DECREF(it);
+    int res = map_node_transform(st, &state, root, 0, &new_root);
+    Py_DECREF(root);
+    if (res) {
+        return NULL;
+    }
 
-    *new_root = last_root;
-    *new_count = last_count;
+    if (new_root == NULL) {
+        return map_new(st);
+    }
 
-    return 0;
+    if (new_root == root) {
+        Py_DECREF(new_root);
+        Py_INCREF(o);
+        return o;
+    }
 
-err:
-    Py_DECREF(it);
-    Py_DECREF(last_root);
-    return -1;
+    return map_from_root(st, new_root, state.t_count);
 }
 
 
+/////////////////////////////////// Splitting
+
+
 static int
-map_node_update_from_seq(uint64_t mutid,
-                         PyObject *seq,
-                         MapNode *root, Py_ssize_t count,
-                         MapNode **new_root, Py_ssize_t *new_count)
+map_node_split(MapModuleState *st,
+               MapNode *node, uint32_t shift, Py_ssize_t base,
+               const Py_ssize_t *cuts, Py_ssize_t nparts,
+               Py_ssize_t *counts, MapNode **results)
 {
-    PyObject *it;
-    Py_ssize_t i;
-    PyObject *item = NULL;
-    PyObject *fast = NULL;
+    /* Split the `node` subtree located at the `shift` level into
+       `nparts` parts.
+
+       Keys are numbered in the order of their slots, starting with
+       `base` for the first key of the subtree; the k-th part gets
+       the keys numbered from cuts[k] up to cuts[k + 1].  Slots that
+       fall into a single part are shared with `node`, so only the
+       nodes on the boundaries between parts are copied.  Collision
+       nodes are never split: they go to the part of their first key.
+
+       results[k] is set to a new reference to the root of the k-th
+       part (or to NULL if the part is empty), and the number of its
+       keys is added to counts[k].
+    */
 
-    MapNode *last_root;
-    Py_ssize_t last_count;
+    map_hash_t *hashes = NULL;
+    PyObject **keys = NULL;
+    PyObject **vals = NULL;
+    uint32_t *bitmaps = NULL;
+    MapNode **sub_results = NULL;
+    Py_ssize_t n = nparts * HAMT_ARRAY_NODE_SIZE;
+    Py_ssize_t p = 0;
+    Py_ssize_t k;
+    uint32_t bitmap;
+    uint32_t i;
+    int slots_ready = 0;
+    int res = -1;
 
-    it = PyObject_GetIter(seq);
-    if (it == NULL) {
-        return -1;
+    assert(!IS_COLLISION_NODE(node));
+
+    for (k = 0; k < nparts; k++) {
+        results[k] = NULL;
     }
 
-    Py_INCREF(root);
-    last_root = root;
-    last_count = count;
+    hashes = (map_hash_t *)PyMem_Malloc((size_t)n * sizeof(map_hash_t));
+    keys = (PyObject **)PyMem_Malloc((size_t)n * sizeof(PyObject *));
+    vals = (PyObject **)PyMem_Malloc((size_t)n * sizeof(PyObject *));
+    bitmaps = (uint32_t *)PyMem_Malloc((size_t)nparts * sizeof(uint32_t));
+    sub_results = (MapNode **)PyMem_Malloc(
+        (size_t)nparts * sizeof(MapNode *));
+    if (hashes == NULL || keys == NULL || vals == NULL ||
+            bitmaps == NULL || sub_results == NULL)
+    {
+        PyErr_NoMemory();
+        goto fin;
+    }
 
-    for (i = 0; ; i++) {
+    for (k = 0; k < n; k++) {
+        keys[k] = NULL;
+        vals[k] = NULL;
+    }
+    for (k = 0; k < nparts; k++) {
+        bitmaps[k] = 0;
+    }
+    slots_ready = 1;
+
+    bitmap = map_node_slot_bitmap(node);
+
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        uint32_t bit = (uint32_t)1 << i;
+        map_hash_t key_hash;
         PyObject *key, *val;
-        Py_ssize_t n;
-        int32_t key_hash;
-        int added_leaf;
+        Py_ssize_t size;
+        Py_ssize_t q;
 
-        item = PyIter_Next(it);
-        if (item == NULL) {
-            if (PyErr_Occurred()) {
-                goto err;
-            }
-            break;
+        if (!(bitmap & bit)) {
+            continue;
         }
 
-        fast = PySequence_Fast(item, "");
-        if (fast == NULL) {
-            if (PyErr_ExceptionMatches(PyExc_TypeError))
-                PyErr_Format(PyExc_TypeError,
-                    "cannot convert map update "
-                    "sequence element #%zd to a sequence",
-                    i);
-            goto err;
-        }
+        map_node_get_slot(node, i, &key_hash, &key, &val);
+        size = key != NULL ? 1 : map_node_count((MapNode *)val);
 
-        n = PySequence_Fast_GET_SIZE(fast);
-        if (n != 2) {
-            PyErr_Format(PyExc_ValueError,
-                         "map update sequence element #%zd "
-                         "has length %zd; 2 is required",
-                         i, n);
-            goto err;
+        /* The slot starts in the p-th part and ends in the q-th one. */
+        while (p < nparts - 1 && base >= cuts[p + 1]) {
+            p++;
+        }
+        q = p;
+        while (q < nparts - 1 && base + size > cuts[q + 1]) {
+            q++;
         }
 
-        key = PySequence_Fast_GET_ITEM(fast, 0);
-        val = PySequence_Fast_GET_ITEM(fast, 1);
-        Py_INCREF(key);
-        Py_INCREF(val);
-
-        key_hash = map_hash(key);
-        if (key_hash == -1) {
-            Py_DECREF(key);
-            Py_DECREF(val);
-            goto err;
+        if (q == p || key != NULL || IS_COLLISION_NODE(val)) {
+            Py_ssize_t slot = p * HAMT_ARRAY_NODE_SIZE + i;
+            hashes[slot] = key_hash;
+            Py_XINCREF(key);
+            keys[slot] = key;
+            Py_INCREF(val);
+            vals[slot] = val;
+            bitmaps[p] |= bit;
+            counts[p] += size;
         }
+        else {
+            if (map_node_split(
+                    st, (MapNode *)val, shift + 5, base,
+                    cuts + p, q - p + 1, counts + p, sub_results))
+            {
+                goto fin;
+            }
 
-        MapNode *iter_root = map_node_assoc(
-            last_root,
-            0, key_hash, key, val, &added_leaf,
-            mutid);
+            for (k = p; k <= q; k++) {
+                if (sub_results[k - p] != NULL) {
+                    Py_ssize_t slot = k * HAMT_ARRAY_NODE_SIZE + i;
+                    hashes[slot] = -1;
+                    vals[slot] = (PyObject *)sub_results[k - p];
+                    bitmaps[k] |= bit;
+                }
+            }
+        }
 
-        Py_DECREF(key);
-        Py_DECREF(val);
+        base += size;
+    }
 
-        if (iter_root == NULL) {
-            goto err;
+    for (k = 0; k < nparts; k++) {
+        if (bitmaps[k] == 0) {
+            continue;
         }
 
-        if (added_leaf) {
-            last_count++;
+        results[k] = map_node_new_from_slots(
+            st, hashes + k * HAMT_ARRAY_NODE_SIZE,
+            keys + k * HAMT_ARRAY_NODE_SIZE,
+            vals + k * HAMT_ARRAY_NODE_SIZE,
+            bitmaps[k], shift, 0);
+        if (results[k] == NULL) {
+            goto fin;
         }
+    }
 
-        Py_SETREF(last_root, iter_root);
+    res = 0;
 
-        Py_DECREF(fast);
-        Py_DECREF(item);
+fin:
+    if (res) {
+        for (k = 0; k < nparts; k++) {
+            Py_CLEAR(results[k]);
+        }
+    }
+    if (slots_ready) {
+        for (k = 0; k < n; k++) {
+            Py_XDECREF(keys[k]);
+            Py_XDECREF(vals[k]);
+        }
     }
+    PyMem_Free(hashes);
+    PyMem_Free(keys);
+    PyMem_Free(vals);
+    PyMem_Free(bitmaps);
+    PyMem_Free(sub_results);
+    return res;
+}
 
-    Py_DECREF(it);
 
-    *new_root = last_root;
-    *new_count = last_count;
+static PyObject *
+map_split_at(MapObject *o, MapNode *root,
+             const Py_ssize_t *cuts, Py_ssize_t nparts)
+{
+    /* Split the `root` tree of `o` into parts along the `cuts`
+       (see map_node_split), and return a list of non-empty Maps. */
 
-    return 0;
+    MapModuleState *st = MAP_STATE(o);
+    Py_ssize_t *counts = NULL;
+    MapNode **results = NULL;
+    PyObject *list = NULL;
+    Py_ssize_t k;
 
-err:
-    Py_DECREF(last_root);
-    Py_XDECREF(item);
-    Py_XDECREF(fast);
-    Py_DECREF(it);
-    return -1;
-}
+    counts = (Py_ssize_t *)PyMem_Malloc(
+        (size_t)nparts * sizeof(Py_ssize_t));
+    results = (MapNode **)PyMem_Malloc((size_t)nparts * sizeof(MapNode *));
+    if (counts == NULL || results == NULL) {
+        PyErr_NoMemory();
+        goto fin;
+    }
 
+    for (k = 0; k < nparts; k++) {
+        counts[k] = 0;
+    }
 
-static int
-map_node_update(uint64_t mutid,
-                PyObject *src,
-                MapNode *root, Py_ssize_t count,
-                MapNode **new_root, Py_ssize_t *new_count)
-{
-    if (Map_Check(src)) {
-        return map_node_update_from_map(
-            mutid, (MapObject *)src, root, count, new_root, new_count);
+    if (map_node_split(st, root, 0, 0, cuts, nparts, counts, results)) {
+        PyMem_Free(counts);
+        PyMem_Free(results);
+        return NULL;
     }
-    else if (PyDict_Check(src)) {
-        return map_node_update_from_dict(
-            mutid, src, root, count, new_root, new_count);
+
+    list = PyList_New(0);
+    if (list == NULL) {
+        goto fin;
     }
-    else {
-        return map_node_update_from_seq(
-            mutid, src, root, count, new_root, new_count);
+
+    for (k = 0; k < nparts; k++) {
+        MapObject *part;
+
+        if (results[k] == NULL) {
+            continue;
+        }
+
+        if (counts[k] == o->h_count) {
+            /* Everything went into a single part. */
+            Py_INCREF(o);
+            part = o;
+        }
+        else {
+            part = map_from_root(st, results[k], counts[k]);
+            results[k] = NULL;
+            if (part == NULL) {
+                Py_CLEAR(list);
+                goto fin;
+            }
+        }
+
+        int append_res = PyList_Append(list, (PyObject *)part);
+        Py_DECREF(part);
+        if (append_res) {
+            Py_CLEAR(list);
+            goto fin;
+        }
+    }
+
+fin:
+    if (results != NULL) {
+        for (k = 0; k < nparts; k++) {
+            Py_XDECREF(results[k]);
+        }
     }
+    PyMem_Free(counts);
+    PyMem_Free(results);
+    return list;
 }
 
 
-static int
-map_update_inplace(uint64_t mutid, BaseMapObject *o, PyObject *src)
+static PyObject *
+map_split(MapObject *o, Py_ssize_t n)
 {
-    MapNode *new_root = NULL;
-    Py_ssize_t new_count;
+    /* Split `o` into at most `n` Maps of roughly equal size. */
 
-    int ret = map_node_update(
-        mutid, src,
-        o->b_root, o->b_count,
-        &new_root, &new_count);
+    Py_ssize_t *cuts;
+    Py_ssize_t count = o->h_count;
+    Py_ssize_t k;
 
-    if (ret) {
-        return -1;
+    if (n < 1) {
+        PyErr_SetString(PyExc_ValueError,
+                        "the number of parts must be positive");
+        return NULL;
     }
 
-    assert(new_root);
+    if (count == 0) {
+        return PyList_New(0);
+    }
 
-    Py_SETREF(o->b_root, new_root);
-    o->b_count = new_count;
+    if (n == 1) {
+        PyObject *list = PyList_New(1);
+        if (list == NULL) {
+            return NULL;
+        }
+        Py_INCREF(o);
+        PyList_SET_ITEM(list, 0, (PyObject *)o);
+        return list;
+    }
 
-    return 0;
+    if (n > count) {
+        n = count;
+    }
+
+    cuts = (Py_ssize_t *)PyMem_Malloc(
+        ((size_t)n + 1) * sizeof(Py_ssize_t));
+    if (cuts == NULL) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+
+    for (k = 0; k <= n; k++) {
+        cuts[k] = k * (count / n) + Py_MIN(k, count % n);
+    }
+
+    MapNode *root = map_root(o, 0);
+    if (root == NULL) {
+        PyMem_Free(cuts);
+        return NULL;
+    }
+
+    PyObject *res = map_split_at(o, root, cuts, n);
+    Py_DECREF(root);
+    PyMem_Free(cuts);
+    return res;
 }
 
 
-static MapObject *
-map_update(uint64_t mutid, MapObject *o, PyObject *src)
+static PyObject *
+map_partitions(MapObject *o)
 {
-    MapNode *new_root = NULL;
-    Py_ssize_t new_count;
+    /* Split `o` into one Map per slot of its root node. */
 
-    int ret = map_node_update(
-        mutid, src,
-        o->h_root, o->h_count,
-        &new_root, &new_count);
+    Py_ssize_t cuts[HAMT_ARRAY_NODE_SIZE + 1];
+    Py_ssize_t nparts = 0;
+    uint32_t bitmap;
+    uint32_t i;
 
-    if (ret) {
-        return NULL;
+    if (o->h_count == 0) {
+        return PyList_New(0);
     }
 
-    assert(new_root);
-
-    MapObject *new = map_alloc();
-    if (new == NULL) {
-        Py_DECREF(new_root);
+    MapNode *root = map_root(o, 0);
+    if (root == NULL) {
         return NULL;
     }
 
-    Py_XSETREF(new->h_root, new_root);
-    new->h_count = new_count;
+    bitmap = map_node_slot_bitmap(root);
+    cuts[0] = 0;
 
-    return new;
-}
+    for (i = 0; i < HAMT_ARRAY_NODE_SIZE; i++) {
+        map_hash_t key_hash;
+        PyObject *key, *val;
 
-static int
-mapmut_check_finalized(MapMutationObject *o)
-{
-    if (o->m_mutid == 0) {
-        PyErr_Format(
-            PyExc_ValueError,
-            "mutation %R has been finished",
-            o, NULL);
-        return -1;
+        if (bitmap & ((uint32_t)1 << i)) {
+            map_node_get_slot(root, i, &key_hash, &key, &val);
+            cuts[nparts + 1] = cuts[nparts] +
+                (key != NULL ? 1 : map_node_count((MapNode *)val));
+            nparts++;
+        }
     }
 
-    return 0;
+    PyObject *res = map_split_at(o, root, cuts, nparts);
+    Py_DECREF(root);
+    return res;
 }
 
-static int
-mapmut_delete(MapMutationObject *o, PyObject *key, int32_t key_hash)
+
+/////////////////////////////////// Atom
+
+
+static PyObject *
+atom_load(AtomObject *self)
 {
-    MapNode *new_root = NULL;
+    /* Return a new reference to the current value.
 
-    assert(key_hash != -1);
-    map_without_t res = map_node_without(
-        (MapNode *)(o->m_root),
-        0, key_hash, key,
-        &new_root,
-        o->m_mutid);
+       With the GIL, reading the value can't be interleaved with
+       a write, so readers never lock.  On free-threaded builds the
+       value could be replaced and freed between loading the pointer
+       and increfing it, so the read is done in a critical section.
+    */
 
-    switch (res) {
-        case W_ERROR:
-            return -1;
+    PyObject *value;
 
-        case W_EMPTY:
-            new_root = map_node_bitmap_new(0, o->m_mutid);
-            if (new_root == NULL) {
-                return -1;
-            }
-            Py_SETREF(o->m_root, new_root);
-            o->m_count = 0;
-            return 0;
+    Py_BEGIN_CRITICAL_SECTION(self);
+    value = self->a_value;
+    Py_INCREF(value);
+    Py_END_CRITICAL_SECTION();
 
-        case W_NOT_FOUND:
-            PyErr_SetObject(PyExc_KeyError, key);
-            return -1;
+    return value;
+}
 
-        case W_NEWNODE: {
-            assert(new_root != NULL);
-            Py_SETREF(o->m_root, new_root);
-            o->m_count--;
-            return 0;
-        }
+static int
+atom_compare_and_set(AtomObject *self, PyObject *old, PyObject *new)
+{
+    /* Replace the value with "new" if it is "old".  Values are
+       compared by identity, so no Python code runs between checking
+       the value and replacing it.
 
-        default:
-            abort();
+       Return 1 if the value was replaced, 0 otherwise.
+    */
+
+    PyObject *prev = NULL;
+
+    Py_BEGIN_CRITICAL_SECTION(self);
+    if (self->a_value == old) {
+        prev = self->a_value;
+        Py_INCREF(new);
+        self->a_value = new;
     }
+    Py_END_CRITICAL_SECTION();
+
+    if (prev == NULL) {
+        return 0;
+    }
+
+    /* Deallocating the previous value can run arbitrary code, so
+       it's done after the value was replaced. */
+    Py_DECREF(prev);
+    return 1;
 }
 
-static int
-mapmut_set(MapMutationObject *o, PyObject *key, int32_t key_hash,
-           PyObject *val)
+static PyObject *
+atom_tp_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 {
-    int added_leaf = 0;
+    MapModuleState *st = MAP_TYPE_STATE(type);
+    static char *kwlist[] = {"value", NULL};
 
-    assert(key_hash != -1);
-    MapNode *new_root = map_node_assoc(
-        (MapNode *)(o->m_root),
-        0, key_hash, key, val, &added_leaf,
-        o->m_mutid);
-    if (new_root == NULL) {
-        return -1;
+    PyObject *value = NULL;
+    AtomObject *o;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|O:Atom", kwlist,
+                                     &value))
+    {
+        return NULL;
     }
 
-    if (added_leaf) {
-        o->m_count++;
+    if (value == NULL) {
+        value = (PyObject *)map_new(st);
+        if (value == NULL) {
+            return NULL;
+        }
+    }
+    else {
+        Py_INCREF(value);
     }
 
-    if (new_root == o->m_root) {
-        Py_DECREF(new_root);
-        return 0;
+    o = PyObject_GC_New(AtomObject, type);
+    if (o == NULL) {
+        Py_DECREF(value);
+        return NULL;
     }
+    o->a_value = value;
+    o->a_weakreflist = NULL;
+    PyObject_GC_Track(o);
+    return (PyObject *)o;
+}
 
-    Py_SETREF(o->m_root, new_root);
+static int
+atom_tp_clear(AtomObject *self)
+{
+    Py_CLEAR(self->a_value);
     return 0;
 }
 
 static int
-mapmut_finish(MapMutationObject *o)
+atom_tp_traverse(AtomObject *self, visitproc visit, void *arg)
 {
-    o->m_mutid = 0;
+    MAP_VISIT_TYPE(self);
+    Py_VISIT(self->a_value);
     return 0;
 }
 
-static PyObject *
-mapmut_py_set(MapMutationObject *o, PyObject *args)
+static void
+atom_tp_dealloc(AtomObject *self)
 {
-    PyObject *key;
-    PyObject *val;
+    PyTypeObject *tp = Py_TYPE(self);
 
-    if (!PyArg_UnpackTuple(args, "set", 2, 2, &key, &val)) {
-        return NULL;
+    PyObject_GC_UnTrack(self);
+    if (self->a_weakreflist != NULL) {
+        PyObject_ClearWeakRefs((PyObject *)self);
     }
+    (void)atom_tp_clear(self);
+    tp->tp_free(self);
+    MAP_DECREF_TYPE(tp);
+}
 
-    if (mapmut_check_finalized(o)) {
-        return NULL;
-    }
+static PyObject *
+atom_py_repr(AtomObject *self)
+{
+    PyObject *value;
+    PyObject *res;
+    int i;
 
-    int32_t key_hash = map_hash(key);
-    if (key_hash == -1) {
-        return NULL;
+    i = Py_ReprEnter((PyObject *)self);
+    if (i != 0) {
+        return i > 0 ? PyUnicode_FromString("<immutables.Atom(...)>") : NULL;
     }
 
-    if (mapmut_set(o, key, key_hash, val)) {
-        return NULL;
-    }
+    value = atom_load(self);
+    res = PyUnicode_FromFormat(
+        "<immutables.Atom(%R) at %p>", value, self);
+    Py_DECREF(value);
 
-    Py_RETURN_NONE;
+    Py_ReprLeave((PyObject *)self);
+    return res;
 }
 
 static PyObject *
-mapmut_tp_richcompare(PyObject *v, PyObject *w, int op)
+atom_py_get(AtomObject *self, PyObject *args)
 {
-    if (!MapMutation_Check(v) || !MapMutation_Check(w) ||
-            (op != Py_EQ && op != Py_NE))
-    {
-        Py_RETURN_NOTIMPLEMENTED;
-    }
+    return atom_load(self);
+}
 
-    int res = map_eq((BaseMapObject *)v, (BaseMapObject *)w);
-    if (res < 0) {
+static PyObject *
+atom_py_compare_and_set(AtomObject *self,
+                        PyObject *const *args, Py_ssize_t nargs)
+{
+    if (!map_check_nargs("compare_and_set", nargs, 2, 2)) {
         return NULL;
     }
 
-    if (op == Py_NE) {
-        res = !res;
-    }
-
-    if (res) {
+    if (atom_compare_and_set(self, args[0], args[1])) {
         Py_RETURN_TRUE;
     }
     else {
@@ -3895,290 +9796,370 @@ mapmut_tp_richcompare(PyObject *v, PyObject *w, int op)
     }
 }
 
+MAP_FASTCALL_WRAPPER(atom_py_compare_and_set, AtomObject)
+
 static PyObject *
-mapmut_py_update(MapMutationObject *self, PyObject *args, PyObject *kwds)
+atom_py_swap(AtomObject *self, PyObject *args)
 {
-    PyObject *arg = NULL;
-
-    if (!PyArg_UnpackTuple(args, "update", 0, 1, &arg)) {
-        return NULL;
-    }
+    /* Set the value to the result of func(value, *args).  If another
+       thread replaces the value while func() is running, func() is
+       called again with the new value. */
+
+    Py_ssize_t nargs = PyTuple_GET_SIZE(args);
+    PyObject *func;
+    PyObject *call_args;
+    PyObject *old;
+    PyObject *new;
+    Py_ssize_t i;
 
-    if (mapmut_check_finalized(self)) {
+    if (nargs < 1) {
+        PyErr_SetString(PyExc_TypeError,
+                        "swap expected at least 1 argument, got 0");
         return NULL;
     }
+    func = PyTuple_GET_ITEM(args, 0);
 
-    if (arg != NULL) {
-        if (map_update_inplace(self->m_mutid, (BaseMapObject *)self, arg)) {
+    for (;;) {
+        call_args = PyTuple_New(nargs);
+        if (call_args == NULL) {
             return NULL;
         }
-    }
+        for (i = 1; i < nargs; i++) {
+            PyObject *arg = PyTuple_GET_ITEM(args, i);
+            Py_INCREF(arg);
+            PyTuple_SET_ITEM(call_args, i, arg);
+        }
 
-    if (kwds != NULL) {
-        if (!PyArg_ValidateKeywordArguments(kwds)) {
+        old = atom_load(self);
+        Py_INCREF(old);
+        PyTuple_SET_ITEM(call_args, 0, old);
+
+        new = PyObject_Call(func, call_args, NULL);
+        Py_DECREF(call_args);
+        if (new == NULL) {
+            Py_DECREF(old);
             return NULL;
         }
 
-        if (map_update_inplace(self->m_mutid, (BaseMapObject *)self, kwds)) {
-            return NULL;
+        if (atom_compare_and_set(self, old, new)) {
+            Py_DECREF(old);
+            return new;
         }
-    }
 
-    Py_RETURN_NONE;
+        Py_DECREF(old);
+        Py_DECREF(new);
+    }
 }
 
 
-static PyObject *
-mapmut_py_finish(MapMutationObject *self, PyObject *args)
+static PyMethodDef Atom_methods[] = {
+    {"get", (PyCFunction)atom_py_get, METH_NOARGS, NULL},
+    {"compare_and_set", MAP_FASTCALL_METH(atom_py_compare_and_set), NULL},
+    {"swap", (PyCFunction)atom_py_swap, METH_VARARGS, NULL},
+    {NULL, NULL}
+};
+
+MAP_WEAKLIST_MEMBERS(Atom_members, AtomObject, a_weakreflist)
+
+static PyType_Slot Atom_slots[] = {
+    {Py_tp_methods, Atom_methods},
+    MAP_MEMBERS_SLOT(Atom_members)
+    {Py_tp_dealloc, atom_tp_dealloc},
+    {Py_tp_traverse, atom_tp_traverse},
+    {Py_tp_clear, atom_tp_clear},
+    {Py_tp_new, atom_tp_new},
+    {Py_tp_repr, atom_py_repr},
+    {0, NULL}
+};
+
+static PyType_Spec Atom_spec = {
+    .name = "immutables._map.Atom",
+    .basicsize = sizeof(AtomObject),
+    .flags = MAP_TPFLAGS,
+    .slots = Atom_slots,
+};
+
+
+/////////////////////////////////// Tree Node Types
+
+
+static PyType_Slot MapArrayNode_slots[] = {
+    {Py_tp_dealloc, map_node_array_dealloc},
+    {Py_tp_traverse, map_node_array_traverse},
+    {Py_tp_hash, PyObject_HashNotImplemented},
+    {0, NULL}
+};
+
+static PyType_Spec MapArrayNode_spec = {
+    .name = "immutables._map.map_array_node",
+    .basicsize = sizeof(MapNode_Array),
+    .flags = MAP_TPFLAGS_INTERNAL,
+    .slots = MapArrayNode_slots,
+};
+
+static PyType_Slot MapBitmapNode_slots[] = {
+    {Py_tp_dealloc, map_node_bitmap_dealloc},
+    {Py_tp_traverse, map_node_bitmap_traverse},
+    {Py_tp_hash, PyObject_HashNotImplemented},
+    {0, NULL}
+};
+
+static PyType_Spec MapBitmapNode_spec = {
+    .name = "immutables._map.map_bitmap_node",
+    .basicsize = sizeof(MapNode_Bitmap) - sizeof(PyObject *),
+    .itemsize = sizeof(PyObject *),
+    .flags = MAP_TPFLAGS_INTERNAL,
+    .slots = MapBitmapNode_slots,
+};
+
+static PyType_Slot MapCollisionNode_slots[] = {
+    {Py_tp_dealloc, map_node_collision_dealloc},
+    {Py_tp_traverse, map_node_collision_traverse},
+    {Py_tp_hash, PyObject_HashNotImplemented},
+    {0, NULL}
+};
+
+static PyType_Spec MapCollisionNode_spec = {
+    .name = "immutables._map.map_collision_node",
+    .basicsize = sizeof(MapNode_Collision) - sizeof(PyObject *),
+    .itemsize = sizeof(PyObject *),
+    .flags = MAP_TPFLAGS_INTERNAL,
+    .slots = MapCollisionNode_slots,
+};
+
+
+/////////////////////////////////// Module
+
+
+static MapModuleState *
+map_module_state(PyObject *m)
 {
-    if (mapmut_finish(self)) {
-        return NULL;
+#if PY_VERSION_HEX >= 0x03090000
+    return (MapModuleState *)PyModule_GetState(m);
+#else
+    return &_map_module_state;
+#endif
+}
+
+#if PY_VERSION_HEX >= 0x03090000
+static void
+map_clear_freelists(MapModuleState *st)
+{
+    MapNode_Bitmap *node;
+    int i;
+
+    for (i = 0; i < MAP_BITMAP_FREELIST_MAXSIZE; i++) {
+        while (st->ms_bitmap_freelist[i] != NULL) {
+            node = st->ms_bitmap_freelist[i];
+            st->ms_bitmap_freelist[i] = (MapNode_Bitmap *)node->b_array[0];
+            PyObject_GC_Del(node);
+        }
+        st->ms_bitmap_freelist_len[i] = 0;
     }
 
-    MapObject *o = map_alloc();
-    if (o == NULL) {
-        return NULL;
+    for (i = 0; i <= MAP_FLAT_MAXSIZE; i++) {
+        while (st->ms_map_freelist[i] != NULL) {
+            MapObject *o = st->ms_map_freelist[i];
+            st->ms_map_freelist[i] = (MapObject *)o->h_root;
+            PyObject_GC_Del(o);
+        }
+        st->ms_map_freelist_len[i] = 0;
     }
 
-    Py_INCREF(self->m_root);
-    o->h_root = self->m_root;
-    o->h_count = self->m_count;
+    while (st->ms_iter_freelist_len > 0) {
+        PyObject_GC_Del(st->ms_iter_freelist[--st->ms_iter_freelist_len]);
+    }
+}
 
-    return (PyObject *)o;
+static int
+module_traverse(PyObject *m, visitproc visit, void *arg)
+{
+    MapModuleState *st = map_module_state(m);
+
+    Py_VISIT(st->ms_map_type);
+    Py_VISIT(st->ms_mapmut_type);
+    Py_VISIT(st->ms_array_node_type);
+    Py_VISIT(st->ms_bitmap_node_type);
+    Py_VISIT(st->ms_collision_node_type);
+    Py_VISIT(st->ms_keys_type);
+    Py_VISIT(st->ms_values_type);
+    Py_VISIT(st->ms_items_type);
+    Py_VISIT(st->ms_keys_iter_type);
+    Py_VISIT(st->ms_values_iter_type);
+    Py_VISIT(st->ms_items_iter_type);
+    Py_VISIT(st->ms_atom_type);
+    Py_VISIT(st->ms_empty_bitmap_node);
+    return 0;
 }
 
-static PyObject *
-mapmut_py_enter(MapMutationObject *self, PyObject *args)
+static int
+module_clear(PyObject *m)
 {
-    Py_INCREF(self);
-    return (PyObject *)self;
+    MapModuleState *st = map_module_state(m);
+
+    Py_CLEAR(st->ms_empty_bitmap_node);
+    map_clear_freelists(st);
+
+    Py_CLEAR(st->ms_map_type);
+    Py_CLEAR(st->ms_mapmut_type);
+    Py_CLEAR(st->ms_array_node_type);
+    Py_CLEAR(st->ms_bitmap_node_type);
+    Py_CLEAR(st->ms_collision_node_type);
+    Py_CLEAR(st->ms_keys_type);
+    Py_CLEAR(st->ms_values_type);
+    Py_CLEAR(st->ms_items_type);
+    Py_CLEAR(st->ms_keys_iter_type);
+    Py_CLEAR(st->ms_values_iter_type);
+    Py_CLEAR(st->ms_items_iter_type);
+    Py_CLEAR(st->ms_atom_type);
+    return 0;
 }
 
-static PyObject *
-mapmut_py_exit(MapMutationObject *self, PyObject *args)
+static void
+module_free(void *m)
 {
-    if (mapmut_finish(self)) {
-        return NULL;
-    }
-    Py_RETURN_FALSE;
+    (void)module_clear((PyObject *)m);
 }
+#endif
+
 
 static int
-mapmut_tp_ass_sub(MapMutationObject *self, PyObject *key, PyObject *val)
+map_add_type(PyObject *m, PyType_Spec *spec, PyTypeObject **type)
 {
-    if (mapmut_check_finalized(self)) {
-        return -1;
-    }
-
-    int32_t key_hash = map_hash(key);
-    if (key_hash == -1) {
+#if PY_VERSION_HEX >= 0x03090000
+    *type = (PyTypeObject *)PyType_FromModuleAndSpec(m, spec, NULL);
+#else
+    *type = (PyTypeObject *)PyType_FromSpec(spec);
+#endif
+    if (*type == NULL) {
         return -1;
     }
 
-    if (val == NULL) {
-        return mapmut_delete(self, key, key_hash);
+#if PY_VERSION_HEX < 0x030A0000
+    /* Types without a Py_tp_new slot inherit object.__new__ */
+    PyType_Slot *slot = spec->slots;
+    while (slot->slot != 0 && slot->slot != Py_tp_new) {
+        slot++;
     }
-    else {
-        return mapmut_set(self, key, key_hash, val);
+    if (slot->slot == 0) {
+        (*type)->tp_new = NULL;
     }
+#endif
+
+    return 0;
 }
 
-static PyObject *
-mapmut_py_pop(MapMutationObject *self, PyObject *args)
+static int
+map_module_init_state(PyObject *m, MapModuleState *st)
 {
-    PyObject *key, *deflt = NULL, *val = NULL;
-
-    if(!PyArg_UnpackTuple(args, "pop", 1, 2, &key, &deflt)) {
-        return NULL;
-    }
-
-    if (mapmut_check_finalized(self)) {
-        return NULL;
+    if (map_add_type(m, &Map_spec, &st->ms_map_type) ||
+        map_add_type(m, &MapMutation_spec, &st->ms_mapmut_type) ||
+        map_add_type(m, &MapArrayNode_spec, &st->ms_array_node_type) ||
+        map_add_type(m, &MapBitmapNode_spec, &st->ms_bitmap_node_type) ||
+        map_add_type(m, &MapCollisionNode_spec,
+                     &st->ms_collision_node_type) ||
+        map_add_type(m, &MapKeys_spec, &st->ms_keys_type) ||
+        map_add_type(m, &MapValues_spec, &st->ms_values_type) ||
+        map_add_type(m, &MapItems_spec, &st->ms_items_type) ||
+        map_add_type(m, &MapKeysIter_spec, &st->ms_keys_iter_type) ||
+        map_add_type(m, &MapValuesIter_spec, &st->ms_values_iter_type) ||
+        map_add_type(m, &MapItemsIter_spec, &st->ms_items_iter_type) ||
+        map_add_type(m, &Atom_spec, &st->ms_atom_type))
+    {
+        return -1;
     }
 
-    if (!self->m_count) {
-        goto not_found;
-    }
+#if PY_VERSION_HEX >= 0x030900A4
+    st->ms_map_type->tp_vectorcall = (vectorcallfunc)map_vectorcall;
+#endif
 
-    int32_t key_hash = map_hash(key);
-    if (key_hash == -1) {
-        return NULL;
-    }
+#if PY_VERSION_HEX < 0x03090000
+    st->ms_map_type->tp_weaklistoffset =
+        offsetof(MapObject, h_weakreflist);
+    st->ms_mapmut_type->tp_weaklistoffset =
+        offsetof(MapMutationObject, m_weakreflist);
+    st->ms_atom_type->tp_weaklistoffset =
+        offsetof(AtomObject, a_weakreflist);
+#endif
 
-    map_find_t find_res = map_node_find(self->m_root, 0, key_hash, key, &val);
+    st->ms_mutid_counter = 1;
 
-    switch (find_res) {
-        case F_ERROR:
-            return NULL;
+    /* Bitmap nodes are immutable, so a single empty bitmap node
+       is shared by all Maps.  It's created and settled here rather
+       than on first use so that threads never race to do that. */
+    st->ms_empty_bitmap_node =
+        (MapNode_Bitmap *)map_node_bitmap_new(st, 0, 0);
+    if (st->ms_empty_bitmap_node == NULL) {
+        return -1;
+    }
+    (void)map_node_settle((MapNode *)st->ms_empty_bitmap_node);
 
-        case F_NOT_FOUND:
-            goto not_found;
+    return 0;
+}
 
-        case F_FOUND:
-            break;
+static int
+map_module_exec(PyObject *m)
+{
+    MapModuleState *st = map_module_state(m);
 
-        default:
-            abort();
+    /* Before Python 3.9 the state is shared by all instances of
+       the module and is only initialized once. */
+    if (st->ms_map_type == NULL && map_module_init_state(m, st)) {
+        return -1;
     }
 
-    Py_INCREF(val);
-
-    if (mapmut_delete(self, key, key_hash)) {
-        Py_DECREF(val);
-        return NULL;
+    Py_INCREF(st->ms_map_type);
+    if (PyModule_AddObject(m, "Map", (PyObject *)st->ms_map_type) < 0) {
+        Py_DECREF(st->ms_map_type);
+        return -1;
     }
 
-    return val;
-
-not_found:
-    if (deflt) {
-        Py_INCREF(deflt);
-        return deflt;
+    Py_INCREF(st->ms_atom_type);
+    if (PyModule_AddObject(m, "Atom", (PyObject *)st->ms_atom_type) < 0) {
+        Py_DECREF(st->ms_atom_type);
+        return -1;
     }
 
-    PyErr_SetObject(PyExc_KeyError, key);
-    return NULL;
+    return 0;
 }
 
 
-static PyMethodDef MapMutation_methods[] = {
-    {"set", (PyCFunction)mapmut_py_set, METH_VARARGS, NULL},
-    {"get", (PyCFunction)map_py_get, METH_VARARGS, NULL},
-    {"pop", (PyCFunction)mapmut_py_pop, METH_VARARGS, NULL},
-    {"finish", (PyCFunction)mapmut_py_finish, METH_NOARGS, NULL},
-    {"update", (PyCFunction)mapmut_py_update,
-        METH_VARARGS | METH_KEYWORDS, NULL},
-    {"__enter__", (PyCFunction)mapmut_py_enter, METH_NOARGS, NULL},
-    {"__exit__", (PyCFunction)mapmut_py_exit, METH_VARARGS, NULL},
-    {NULL, NULL}
-};
-
-static PySequenceMethods MapMutation_as_sequence = {
-    0,                                /* sq_length */
-    0,                                /* sq_concat */
-    0,                                /* sq_repeat */
-    0,                                /* sq_item */
-    0,                                /* sq_slice */
-    0,                                /* sq_ass_item */
-    0,                                /* sq_ass_slice */
-    (objobjproc)map_tp_contains,      /* sq_contains */
-    0,                                /* sq_inplace_concat */
-    0,                                /* sq_inplace_repeat */
-};
-
-static PyMappingMethods MapMutation_as_mapping = {
-    (lenfunc)map_tp_len,              /* mp_length */
-    (binaryfunc)map_tp_subscript,     /* mp_subscript */
-    (objobjargproc)mapmut_tp_ass_sub, /* mp_subscript */
-};
-
-PyTypeObject _MapMutation_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "immutables._map.MapMutation",
-    sizeof(MapMutationObject),
-    .tp_methods = MapMutation_methods,
-    .tp_as_mapping = &MapMutation_as_mapping,
-    .tp_as_sequence = &MapMutation_as_sequence,
-    .tp_dealloc = (destructor)map_tp_dealloc,
-    .tp_getattro = PyObject_GenericGetAttr,
-    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
-    .tp_traverse = (traverseproc)map_tp_traverse,
-    .tp_richcompare = mapmut_tp_richcompare,
-    .tp_clear = (inquiry)map_tp_clear,
-    .tp_weaklistoffset = offsetof(MapMutationObject, m_weakreflist),
-    .tp_repr = (reprfunc)map_py_repr,
-    .tp_hash = PyObject_HashNotImplemented,
-};
-
-
-/////////////////////////////////// Tree Node Types
-
-
-PyTypeObject _Map_ArrayNode_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "map_array_node",
-    sizeof(MapNode_Array),
-    0,
-    .tp_dealloc = (destructor)map_node_array_dealloc,
-    .tp_getattro = PyObject_GenericGetAttr,
-    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
-    .tp_traverse = (traverseproc)map_node_array_traverse,
-    .tp_free = PyObject_GC_Del,
-    .tp_hash = PyObject_HashNotImplemented,
-};
-
-PyTypeObject _Map_BitmapNode_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "map_bitmap_node",
-    sizeof(MapNode_Bitmap) - sizeof(PyObject *),
-    sizeof(PyObject *),
-    .tp_dealloc = (destructor)map_node_bitmap_dealloc,
-    .tp_getattro = PyObject_GenericGetAttr,
-    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
-    .tp_traverse = (traverseproc)map_node_bitmap_traverse,
-    .tp_free = PyObject_GC_Del,
-    .tp_hash = PyObject_HashNotImplemented,
-};
-
-PyTypeObject _Map_CollisionNode_Type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "map_collision_node",
-    sizeof(MapNode_Collision) - sizeof(PyObject *),
-    sizeof(PyObject *),
-    .tp_dealloc = (destructor)map_node_collision_dealloc,
-    .tp_getattro = PyObject_GenericGetAttr,
-    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
-    .tp_traverse = (traverseproc)map_node_collision_traverse,
-    .tp_free = PyObject_GC_Del,
-    .tp_hash = PyObject_HashNotImplemented,
+static PyModuleDef_Slot _mapmodule_slots[] = {
+    {Py_mod_exec, map_module_exec},
+#if PY_VERSION_HEX >= 0x030C0000
+    {Py_mod_multiple_interpreters, Py_MOD_PER_INTERPRETER_GIL_SUPPORTED},
+#endif
+#if PY_VERSION_HEX >= 0x030D0000
+    {Py_mod_gil, Py_MOD_GIL_NOT_USED},
+#endif
+    {0, NULL}
 };
 
 
-static void
-module_free(void *m)
-{
-    Py_CLEAR(_empty_bitmap_node);
-}
-
-
 static struct PyModuleDef _mapmodule = {
     PyModuleDef_HEAD_INIT,      /* m_base */
     "_map",                     /* m_name */
     NULL,                       /* m_doc */
-    -1,                         /* m_size */
+#if PY_VERSION_HEX >= 0x03090000
+    sizeof(MapModuleState),     /* m_size */
     NULL,                       /* m_methods */
-    NULL,                       /* m_slots */
+    _mapmodule_slots,           /* m_slots */
+    module_traverse,            /* m_traverse */
+    module_clear,               /* m_clear */
+    module_free,                /* m_free */
+#else
+    0,                          /* m_size */
+    NULL,                       /* m_methods */
+    _mapmodule_slots,           /* m_slots */
     NULL,                       /* m_traverse */
     NULL,                       /* m_clear */
-    module_free,                /* m_free */
+    NULL,                       /* m_free */
+#endif
 };
 
 
 PyMODINIT_FUNC
 PyInit__map(void)
 {
-    PyObject *m = PyModule_Create(&_mapmodule);
-
-    if ((PyType_Ready(&_Map_Type) < 0) ||
-        (PyType_Ready(&_MapMutation_Type) < 0) ||
-        (PyType_Ready(&_Map_ArrayNode_Type) < 0) ||
-        (PyType_Ready(&_Map_BitmapNode_Type) < 0) ||
-        (PyType_Ready(&_Map_CollisionNode_Type) < 0) ||
-        (PyType_Ready(&_MapKeys_Type) < 0) ||
-        (PyType_Ready(&_MapValues_Type) < 0) ||
-        (PyType_Ready(&_MapItems_Type) < 0) ||
-        (PyType_Ready(&_MapKeysIter_Type) < 0) ||
-        (PyType_Ready(&_MapValuesIter_Type) < 0) ||
-        (PyType_Ready(&_MapItemsIter_Type) < 0))
-    {
-        return 0;
-    }
-
-    Py_INCREF(&_Map_Type);
-    if (PyModule_AddObject(m, "Map", (PyObject *)&_Map_Type) < 0) {
-        Py_DECREF(&_Map_Type);
-        return NULL;
-    }
-
-    return m;
+    return PyModuleDef_Init(&_mapmodule);
 }
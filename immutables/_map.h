@@ -4,11 +4,35 @@
 #include <stdint.h>
 #include "Python.h"
 
-#define _Py_HAMT_MAX_TREE_DEPTH 7
+/* The number of hash bits used to index the trie.
 
+   By default Python's 64-bit hashes are folded into 32 bits, which
+   limits the trie to 7 levels of Bitmap/Array nodes.  Building with
+   MAP_HASH_BITS=64 (IMMUTABLES_HASH_BITS=64 in setup.py) uses the full
+   hash and up to 13 levels, so that very large Maps don't end up with
+   collision nodes for keys with different hashes.
 
-#define Map_Check(o) (Py_TYPE(o) == &_Map_Type)
-#define MapMutation_Check(o) (Py_TYPE(o) == &_MapMutation_Type)
+   _Py_HAMT_MAX_TREE_DEPTH accounts for one more level: a Collision
+   node can be a child of a node on the last level.
+*/
+#ifndef MAP_HASH_BITS
+#define MAP_HASH_BITS 32
+#endif
+
+#if MAP_HASH_BITS == 64
+#if SIZEOF_PY_HASH_T < 8
+#error "MAP_HASH_BITS=64 requires a 64-bit Py_hash_t"
+#endif
+typedef int64_t map_hash_t;
+typedef uint64_t map_uhash_t;
+#define _Py_HAMT_MAX_TREE_DEPTH 14
+#elif MAP_HASH_BITS == 32
+typedef int32_t map_hash_t;
+typedef uint32_t map_uhash_t;
+#define _Py_HAMT_MAX_TREE_DEPTH 8
+#else
+#error "MAP_HASH_BITS must be either 32 or 64"
+#endif
 
 
 /* Abstract tree node. */
@@ -18,7 +42,7 @@ typedef struct {
 
 
 #define _MapCommonFields(pref)          \
-    PyObject_HEAD                       \
+    PyObject_VAR_HEAD                   \
     MapNode *pref##_root;               \
     PyObject *pref##_weakreflist;       \
     Py_ssize_t pref##_count;
@@ -31,10 +55,24 @@ typedef struct {
 } BaseMapObject;
 
 
-/* An HAMT immutable mapping collection. */
+/* A key/value pair along with the hash of the key. */
+typedef struct {
+    map_hash_t e_hash;
+    PyObject *e_key;
+    PyObject *e_val;
+} MapEntry;
+
+
+/* An HAMT immutable mapping collection.
+
+   Small Maps don't have a tree: h_root is NULL, and h_count key/value
+   pairs are stored in the h_entries array, which has room for
+   Py_SIZE(map) entries.
+*/
 typedef struct {
     _MapCommonFields(h)
     Py_hash_t h_hash;
+    MapEntry h_entries[1];
 } MapObject;
 
 
@@ -45,6 +83,15 @@ typedef struct {
 } MapMutationObject;
 
 
+/* Atom object: a reference to a Map (or any other value) that is
+   replaced atomically with `compare_and_set()` and `swap()`. */
+typedef struct {
+    PyObject_HEAD
+    PyObject *a_value;
+    PyObject *a_weakreflist;
+} AtomObject;
+
+
 /* A struct to hold the state of depth-first traverse of the tree.
 
    HAMT is an immutable collection.  Iterators will hold a strong reference
@@ -88,20 +135,4 @@ typedef struct {
 } MapIterator;
 
 
-/* PyTypes */
-
-
-PyTypeObject _Map_Type;
-PyTypeObject _MapMutation_Type;
-PyTypeObject _Map_ArrayNode_Type;
-PyTypeObject _Map_BitmapNode_Type;
-PyTypeObject _Map_CollisionNode_Type;
-PyTypeObject _MapKeys_Type;
-PyTypeObject _MapValues_Type;
-PyTypeObject _MapItems_Type;
-PyTypeObject _MapKeysIter_Type;
-PyTypeObject _MapValuesIter_Type;
-PyTypeObject _MapItemsIter_Type;
-
-
 #endif
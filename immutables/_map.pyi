@@ -1,11 +1,16 @@
+from typing import AbstractSet
 from typing import Any
+from typing import Callable
+from typing import Dict
 from typing import Generic
 from typing import Hashable
 from typing import Iterable
 from typing import Iterator
+from typing import List
 from typing import Mapping
 from typing import MutableMapping
 from typing import NoReturn
+from typing import Optional
 from typing import overload
 from typing import Tuple
 from typing import Type
@@ -16,6 +21,7 @@ from typing import Union
 K = TypeVar('K', bound=Hashable)
 V = TypeVar('V', bound=Any)
 D = TypeVar('D', bound=Any)
+T = TypeVar('T', bound=Any)
 
 
 class BitmapNode: ...
@@ -25,6 +31,23 @@ class MapKeys(Generic[K]):
     def __init__(self, c: int, m: BitmapNode) -> None: ...
     def __len__(self) -> int: ...
     def __iter__(self) -> Iterator[K]: ...
+    def __and__(
+        self, other: Iterable[Any]
+    ) -> Union[MapKeys[K], AbstractSet[K]]: ...
+    def __or__(
+        self, other: Iterable[Any]
+    ) -> Union[MapKeys[K], AbstractSet[Any]]: ...
+    def __sub__(
+        self, other: Iterable[Any]
+    ) -> Union[MapKeys[K], AbstractSet[K]]: ...
+    def __xor__(
+        self, other: Iterable[Any]
+    ) -> Union[MapKeys[K], AbstractSet[Any]]: ...
+    def isdisjoint(self, other: Iterable[Any]) -> bool: ...
+    def __le__(self, other: Any) -> bool: ...
+    def __lt__(self, other: Any) -> bool: ...
+    def __ge__(self, other: Any) -> bool: ...
+    def __gt__(self, other: Any) -> bool: ...
 
 
 class MapValues(Generic[V]):
@@ -37,6 +60,19 @@ class MapItems(Generic[K, V]):
     def __init__(self, c: int, m: BitmapNode) -> None: ...
     def __len__(self) -> int: ...
     def __iter__(self) -> Iterator[Tuple[K, V]]: ...
+    def __and__(
+        self, other: Iterable[Any]
+    ) -> Union[MapItems[K, V], AbstractSet[Tuple[K, V]]]: ...
+    def __or__(self, other: Iterable[Any]) -> AbstractSet[Any]: ...
+    def __sub__(
+        self, other: Iterable[Any]
+    ) -> Union[MapItems[K, V], AbstractSet[Tuple[K, V]]]: ...
+    def __xor__(self, other: Iterable[Any]) -> AbstractSet[Any]: ...
+    def isdisjoint(self, other: Iterable[Any]) -> bool: ...
+    def __le__(self, other: Any) -> bool: ...
+    def __lt__(self, other: Any) -> bool: ...
+    def __ge__(self, other: Any) -> bool: ...
+    def __gt__(self, other: Any) -> bool: ...
 
 
 class Map(Mapping[K, V]):
@@ -46,7 +82,14 @@ class Map(Mapping[K, V]):
     def __init__(
         self, col: Union[Mapping[K, V], Iterable[Tuple[K, V]]], **kw: V
     ) -> None: ...
-    def __reduce__(self) -> Tuple[Type[Map], Tuple[dict]]: ...
+    def __reduce__(self) -> Tuple[
+        Callable[[Tuple[K, ...], Tuple[V, ...]], Map[K, V]],
+        Tuple[Tuple[K, ...], Tuple[V, ...]],
+    ]: ...
+    @classmethod
+    def _unpickle(
+        cls, keys: Tuple[K, ...], values: Tuple[V, ...]
+    ) -> Map[K, V]: ...
     def __len__(self) -> int: ...
     def __eq__(self, other: Any) -> bool: ...
     @overload
@@ -55,10 +98,33 @@ class Map(Mapping[K, V]):
     def update(
         self, col: Union[Mapping[K, V], Iterable[Tuple[K, V]]], **kw: V
     ) -> Map[K, V]: ...
+    def merge(
+        self,
+        other: Union[Mapping[K, V], Iterable[Tuple[K, V]]],
+        resolve: Optional[Callable[[K, V, V], V]] = ...,
+    ) -> Map[K, V]: ...
+    def diff(
+        self, other: Map[K, V]
+    ) -> Tuple[Map[K, V], Map[K, V], Map[K, V]]: ...
     def mutate(self) -> MapMutation[K, V]: ...
     def set(self, key: K, val: V) -> Map[K, V]: ...
     def delete(self, key: K) -> Map[K, V]: ...
+    def delete_many(
+        self, keys: Iterable[K], missing_ok: bool = ...
+    ) -> Map[K, V]: ...
     def get(self, key: K, default: D = ...) -> Union[V, D]: ...
+    @overload
+    def get_many(self, keys: Iterable[K]) -> List[Optional[V]]: ...
+    @overload
+    def get_many(
+        self, keys: Iterable[K], default: D = ...
+    ) -> List[Union[V, D]]: ...
+    def take(self, keys: Iterable[K]) -> Map[K, V]: ...
+    def filter(self, pred: Callable[[K, V], object]) -> Map[K, V]: ...
+    def filter_keys(self, pred: Callable[[K], object]) -> Map[K, V]: ...
+    def map_values(self, func: Callable[[V], T]) -> Map[K, T]: ...
+    def split(self, n: int) -> List[Map[K, V]]: ...
+    def partitions(self) -> List[Map[K, V]]: ...
     def __getitem__(self, key: K) -> V: ...
     def __contains__(self, key: object) -> bool: ...
     def __iter__(self) -> Iterator[K]: ...
@@ -66,6 +132,8 @@ class Map(Mapping[K, V]):
     def values(self) -> MapValues[V]: ...
     def items(self) -> MapItems[K, V]: ...
     def __hash__(self) -> int: ...
+    def stats(self) -> Dict[str, Any]: ...
+    def __sizeof__(self) -> int: ...
     def __dump__(self) -> str: ...
     def __class_getitem__(cls, item: Any) -> Type[Map]: ...
 
@@ -82,6 +150,9 @@ class MapMutation(MutableMapping[K, V]):
     def __delitem__(self, key: K) -> None: ...
     def __setitem__(self, key: K, val: V) -> None: ...
     def pop(self, __key: K, __default: D = ...) -> Union[V, D]: ...
+    def delete_many(
+        self, keys: Iterable[K], missing_ok: bool = ...
+    ) -> None: ...
     def get(self, key: K, default: D = ...) -> Union[V, D]: ...
     def __getitem__(self, key: K) -> V: ...
     def __contains__(self, key: Any) -> bool: ...
@@ -94,3 +165,13 @@ class MapMutation(MutableMapping[K, V]):
     def finish(self) -> Map[K, V]: ...
     def __len__(self) -> int: ...
     def __eq__(self, other: Any) -> bool: ...
+
+
+class Atom(Generic[T]):
+    @overload
+    def __init__(self: Atom[Map[Any, Any]]) -> None: ...
+    @overload
+    def __init__(self, value: T) -> None: ...
+    def get(self) -> T: ...
+    def compare_and_set(self, old: T, new: T) -> bool: ...
+    def swap(self, func: Callable[..., T], *args: Any) -> T: ...
@@ -1,10 +1,12 @@
 import collections.abc
 import itertools
+import operator
 import reprlib
 import sys
+import threading
 
 
-__all__ = ('Map',)
+__all__ = ('Map', 'Atom')
 
 
 # Thread-safe counter.
@@ -43,6 +45,275 @@ def map_bitindex(bitmap, bit):
     return map_bitcount(bitmap & (bit - 1))
 
 
+_HASH_MAX = sys.maxsize
+_HASH_MASK = 2 * _HASH_MAX + 1
+
+
+def map_item_hash(key, val):
+    hx = hash(key)
+    h = ((hx ^ (hx << 16) ^ 89869747) * 3644798167) & _HASH_MASK
+    hx = hash(val)
+    h ^= ((hx ^ (hx << 16) ^ 89869747) * 3644798167) & _HASH_MASK
+    return h
+
+
+def map_node_items_in(node, other, shift):
+    for key, val in node.items():
+        try:
+            oval = other.find(shift, map_hash(key), key)
+        except KeyError:
+            return False
+        if oval != val:
+            return False
+    return True
+
+
+def map_node_merge_item(node, shift, hash, key, val, resolve, mutid):
+    if resolve is not None:
+        try:
+            old_val = node.find(shift, hash, key)
+        except KeyError:
+            pass
+        else:
+            val = resolve(key, old_val, val)
+
+    return node.assoc(shift, hash, key, val, mutid)
+
+
+def map_node_merge_items(node, other, shift, resolve, mutid):
+    added = 0
+    for key, val in other.items():
+        node, added_leaf = map_node_merge_item(
+            node, shift, map_hash(key), key, val, resolve, mutid)
+        if added_leaf:
+            added += 1
+    return node, added
+
+
+def map_node_merge_slot(key_or_null, val_or_node,
+                        other_key_or_null, other_val_or_node,
+                        shift, resolve, mutid):
+    # Merge two slots located at the same position of two trees;
+    # `shift` is the level of their subtrees.  Returns a
+    # (key_or_null, val_or_node, added) tuple.
+    if key_or_null is _NULL:
+        if other_key_or_null is _NULL:
+            sub_node, added = val_or_node.merge(
+                other_val_or_node, shift, resolve, mutid)
+        else:
+            sub_node, added = map_node_merge_item(
+                val_or_node, shift, map_hash(other_key_or_null),
+                other_key_or_null, other_val_or_node, resolve, mutid)
+        return _NULL, sub_node, int(added)
+
+    if other_key_or_null is _NULL:
+        # Merge our key into the other subtree; its values
+        # win unless `resolve` says otherwise.
+        hash = map_hash(key_or_null)
+        try:
+            old_val = other_val_or_node.find(shift, hash, key_or_null)
+        except KeyError:
+            sub_node, _ = other_val_or_node.assoc(
+                shift, hash, key_or_null, val_or_node, mutid)
+            return _NULL, sub_node, other_val_or_node.count()
+
+        sub_node = other_val_or_node
+        if resolve is not None:
+            sub_node, _ = other_val_or_node.assoc(
+                shift, hash, key_or_null,
+                resolve(key_or_null, val_or_node, old_val), mutid)
+        return _NULL, sub_node, other_val_or_node.count() - 1
+
+    if other_key_or_null == key_or_null:
+        if resolve is not None:
+            return (key_or_null,
+                    resolve(key_or_null, val_or_node, other_val_or_node), 0)
+        return key_or_null, other_val_or_node, 0
+
+    hash = map_hash(key_or_null)
+    other_hash = map_hash(other_key_or_null)
+    if hash == other_hash:
+        sub_node = CollisionNode(
+            4, hash,
+            [key_or_null, val_or_node, other_key_or_null, other_val_or_node],
+            mutid)
+    else:
+        sub_node = BitmapNode(0, 0, [], mutid)
+        sub_node, _ = sub_node.assoc(
+            shift, hash, key_or_null, val_or_node, mutid)
+        sub_node, _ = sub_node.assoc(
+            shift, other_hash, other_key_or_null, other_val_or_node, mutid)
+    return _NULL, sub_node, 1
+
+
+def map_node_diff_values(key, val, other_val, changed):
+    if other_val is not val and not (val == other_val):
+        changed.append((map_hash(key), key, other_val))
+
+
+def map_node_diff_slot(entries, key_or_null, val_or_node):
+    if key_or_null is _NULL:
+        for key, val in val_or_node.items():
+            entries.append((map_hash(key), key, val))
+    else:
+        entries.append((map_hash(key_or_null), key_or_null, val_or_node))
+
+
+def map_node_diff_items(node, other, shift, added, removed, changed):
+    for key, val in node.items():
+        hash = map_hash(key)
+        try:
+            other_val = other.find(shift, hash, key)
+        except KeyError:
+            removed.append((hash, key, val))
+        else:
+            map_node_diff_values(key, val, other_val, changed)
+
+    for key, val in other.items():
+        hash = map_hash(key)
+        try:
+            node.find(shift, hash, key)
+        except KeyError:
+            added.append((hash, key, val))
+
+
+def map_node_diff_item(key, val, node, reversed, added, removed, changed):
+    # Diff a key/value pair of the old map against a subtree of the
+    # new map occupying the same slot (or the other way around if
+    # `reversed` is set).
+    if reversed:
+        added, removed = removed, added
+
+    hash = map_hash(key)
+    found = False
+    for node_key, node_val in node.items():
+        node_hash = map_hash(node_key)
+        if not found and node_hash == hash and key == node_key:
+            found = True
+            if reversed:
+                map_node_diff_values(key, node_val, val, changed)
+            else:
+                map_node_diff_values(node_key, val, node_val, changed)
+            continue
+        added.append((node_hash, node_key, node_val))
+
+    if not found:
+        removed.append((hash, key, val))
+
+
+def map_node_select_item(key, val, found, other_val, difference, items):
+    if found and items and other_val is not val:
+        found = val == other_val
+    return not found if difference else bool(found)
+
+
+def map_node_select_items(node, other, shift, difference, items):
+    entries = []
+    total = 0
+    for key, val in node.items():
+        hash = map_hash(key)
+        try:
+            other_val = other.find(shift, hash, key)
+        except KeyError:
+            found, other_val = False, None
+        else:
+            found = True
+
+        if map_node_select_item(
+                key, val, found, other_val, difference, items):
+            entries.append((hash, key, val))
+        total += 1
+
+    if len(entries) == total:
+        return node
+    if not entries:
+        return None
+    return map_node_build(entries, shift, 0)[0]
+
+
+def map_node_transform_items(node, shift, func):
+    entries = []
+    changed = False
+    for key, val in node.items():
+        new_val = func(key, val)
+        if new_val is not val:
+            changed = True
+        if new_val is not void:
+            entries.append((map_hash(key), key, new_val))
+
+    if not changed:
+        return node
+    if not entries:
+        return None
+    return map_node_build(entries, shift, 0)[0]
+
+
+def map_node_split(node, shift, base, cuts, counts):
+    # Split the subtree into len(cuts) - 1 parts; the k-th part gets
+    # the keys numbered from cuts[k] up to cuts[k + 1] in the order
+    # of their slots (starting with `base`).  Collision nodes are
+    # never split.  Returns a list of part roots (None for empty
+    # parts) and adds the sizes of the parts to `counts`.
+    nparts = len(cuts) - 1
+    parts = [(0, []) for _ in range(nparts)]
+    p = 0
+
+    idx = 0
+    bits = node.bitmap
+    while bits:
+        bit = bits & -bits
+        bits ^= bit
+
+        key_or_null = node.array[idx]
+        val_or_node = node.array[idx + 1]
+        idx += 2
+
+        size = 1 if key_or_null is not _NULL else val_or_node.count()
+
+        while p < nparts - 1 and base >= cuts[p + 1]:
+            p += 1
+        q = p
+        while q < nparts - 1 and base + size > cuts[q + 1]:
+            q += 1
+
+        if (q == p or key_or_null is not _NULL or
+                type(val_or_node) is CollisionNode):
+            parts[p] = (parts[p][0] | bit,
+                        parts[p][1] + [key_or_null, val_or_node])
+            counts[p] += size
+        else:
+            sub_counts = counts[p:q + 1]
+            sub_nodes = map_node_split(
+                val_or_node, shift + 5, base, cuts[p:q + 2], sub_counts)
+            counts[p:q + 1] = sub_counts
+
+            for k, sub_node in enumerate(sub_nodes, p):
+                if sub_node is None:
+                    continue
+                new_key_or_null = _NULL
+                if (type(sub_node) is BitmapNode and sub_node.size == 2 and
+                        sub_node.array[0] is not _NULL):
+                    new_key_or_null, sub_node = sub_node.array
+                parts[k] = (parts[k][0] | bit,
+                            parts[k][1] + [new_key_or_null, sub_node])
+
+        base += size
+
+    return [BitmapNode(len(array), bitmap, array, 0) if array else None
+            for bitmap, array in parts]
+
+
+def map_stats_add_keys(stats, level, n):
+    depths = stats['depths']
+    while len(depths) <= level:
+        depths.append(0)
+    depths[level] += n
+
+
+def map_node_wrap(key, val, shift):
+    return BitmapNode(2, map_bitpos(map_hash(key), shift), [key, val], 0)
+
+
 W_EMPTY, W_NEWNODE, W_NOT_FOUND = range(3)
 void = object()
 
@@ -62,6 +333,8 @@ class BitmapNode:
         assert isinstance(array, list) and len(array) == size
         self.array = array
         self.mutid = mutid
+        self.cached_hash = -1
+        self.cached_count = -1
 
     def clone(self, mutid):
         return BitmapNode(self.size, self.bitmap, self.array.copy(), mutid)
@@ -81,10 +354,14 @@ class BitmapNode:
                 sub_node, added = val_or_node.assoc(
                     shift + 5, hash, key, val, mutid)
                 if val_or_node is sub_node:
+                    if added:
+                        # `sub_node` was modified in place.
+                        self.cached_count = -1
                     return self, added
 
                 if mutid and mutid == self.mutid:
                     self.array[val_idx] = sub_node
+                    self.cached_count = -1
                     return self, added
                 else:
                     ret = self.clone(mutid)
@@ -120,6 +397,7 @@ class BitmapNode:
             if mutid and mutid == self.mutid:
                 self.array[key_idx] = _NULL
                 self.array[val_idx] = sub_node
+                self.cached_count = -1
                 return self, True
             else:
                 ret = self.clone(mutid)
@@ -142,6 +420,7 @@ class BitmapNode:
                 self.size = 2 * (n + 1)
                 self.bitmap |= bit
                 self.array = new_array
+                self.cached_count = -1
                 return self, True
             else:
                 return BitmapNode(
@@ -194,6 +473,7 @@ class BitmapNode:
                     if mutid and mutid == self.mutid:
                         self.array[key_idx] = sub_node.array[0]
                         self.array[val_idx] = sub_node.array[1]
+                        self.cached_count = -1
                         return W_NEWNODE, self
                     else:
                         clone = self.clone(mutid)
@@ -203,6 +483,7 @@ class BitmapNode:
 
                 if mutid and mutid == self.mutid:
                     self.array[val_idx] = sub_node
+                    self.cached_count = -1
                     return W_NEWNODE, self
                 else:
                     clone = self.clone(mutid)
@@ -225,6 +506,7 @@ class BitmapNode:
                     self.size -= 2
                     self.bitmap &= ~bit
                     self.array = new_array
+                    self.cached_count = -1
                     return W_NEWNODE, self
                 else:
                     new_node = BitmapNode(
@@ -234,6 +516,350 @@ class BitmapNode:
             else:
                 return W_NOT_FOUND, None
 
+    def issubset(self, other, shift):
+        if self is other:
+            return True
+
+        if type(other) is not BitmapNode:
+            return map_node_items_in(self, other, shift)
+
+        if self.bitmap & other.bitmap != self.bitmap:
+            return False
+
+        bitmap = self.bitmap
+        idx = 0
+        while bitmap:
+            bit = bitmap & -bitmap
+            bitmap ^= bit
+
+            key_or_null = self.array[idx]
+            val_or_node = self.array[idx + 1]
+            idx += 2
+
+            other_idx = 2 * map_bitindex(other.bitmap, bit)
+            other_key_or_null = other.array[other_idx]
+            other_val_or_node = other.array[other_idx + 1]
+
+            if key_or_null is _NULL:
+                if other_key_or_null is _NULL:
+                    if not val_or_node.issubset(
+                            other_val_or_node, shift + 5):
+                        return False
+                else:
+                    for key, val in val_or_node.items():
+                        if (key != other_key_or_null or
+                                val != other_val_or_node):
+                            return False
+
+            elif other_key_or_null is _NULL:
+                try:
+                    oval = other_val_or_node.find(
+                        shift + 5, map_hash(key_or_null), key_or_null)
+                except KeyError:
+                    return False
+                if oval != val_or_node:
+                    return False
+
+            elif (key_or_null != other_key_or_null or
+                    val_or_node != other_val_or_node):
+                return False
+
+        return True
+
+    def items_hash(self):
+        if self.cached_hash != -1:
+            return self.cached_hash
+
+        h = 0
+        for i in range(0, self.size, 2):
+            key_or_null = self.array[i]
+            val_or_node = self.array[i + 1]
+
+            if key_or_null is _NULL:
+                h ^= val_or_node.items_hash()
+            else:
+                h ^= map_item_hash(key_or_null, val_or_node)
+
+        self.cached_hash = h
+        return h
+
+    def merge(self, other, shift, resolve, mutid):
+        # Identical subtrees can only be skipped if there is no
+        # `resolve` to call for their keys.
+        if self is other and resolve is None:
+            return self, 0
+
+        if type(other) is not BitmapNode:
+            return map_node_merge_items(self, other, shift, resolve, mutid)
+
+        bitmap = self.bitmap | other.bitmap
+        array = []
+        added = 0
+        changed = False
+
+        idx = 0
+        other_idx = 0
+        bits = bitmap
+        while bits:
+            bit = bits & -bits
+            bits ^= bit
+
+            if not (other.bitmap & bit):
+                array.append(self.array[idx])
+                array.append(self.array[idx + 1])
+                idx += 2
+                continue
+
+            other_key_or_null = other.array[other_idx]
+            other_val_or_node = other.array[other_idx + 1]
+            other_idx += 2
+
+            if not (self.bitmap & bit):
+                array.append(other_key_or_null)
+                array.append(other_val_or_node)
+                if other_key_or_null is _NULL:
+                    added += other_val_or_node.count()
+                else:
+                    added += 1
+                changed = True
+                continue
+
+            key_or_null = self.array[idx]
+            val_or_node = self.array[idx + 1]
+            idx += 2
+
+            new_key_or_null, new_val_or_node, slot_added = \
+                map_node_merge_slot(
+                    key_or_null, val_or_node,
+                    other_key_or_null, other_val_or_node,
+                    shift + 5, resolve, mutid)
+
+            if (new_key_or_null is not key_or_null or
+                    new_val_or_node is not val_or_node):
+                changed = True
+
+            array.append(new_key_or_null)
+            array.append(new_val_or_node)
+            added += slot_added
+
+        if not changed:
+            return self, 0
+
+        return BitmapNode(len(array), bitmap, array, mutid), added
+
+    def diff(self, other, shift, added, removed, changed):
+        if self is other:
+            return
+
+        if type(other) is not BitmapNode:
+            map_node_diff_items(self, other, shift, added, removed, changed)
+            return
+
+        bits = self.bitmap | other.bitmap
+        while bits:
+            bit = bits & -bits
+            bits ^= bit
+
+            if self.bitmap & bit:
+                idx = 2 * map_bitindex(self.bitmap, bit)
+                key_or_null = self.array[idx]
+                val_or_node = self.array[idx + 1]
+
+            if other.bitmap & bit:
+                idx = 2 * map_bitindex(other.bitmap, bit)
+                other_key_or_null = other.array[idx]
+                other_val_or_node = other.array[idx + 1]
+
+            if not (other.bitmap & bit):
+                map_node_diff_slot(removed, key_or_null, val_or_node)
+
+            elif not (self.bitmap & bit):
+                map_node_diff_slot(
+                    added, other_key_or_null, other_val_or_node)
+
+            elif key_or_null is _NULL:
+                if other_key_or_null is _NULL:
+                    val_or_node.diff(
+                        other_val_or_node, shift + 5,
+                        added, removed, changed)
+                else:
+                    map_node_diff_item(
+                        other_key_or_null, other_val_or_node, val_or_node,
+                        True, added, removed, changed)
+
+            elif other_key_or_null is _NULL:
+                map_node_diff_item(
+                    key_or_null, val_or_node, other_val_or_node,
+                    False, added, removed, changed)
+
+            elif key_or_null == other_key_or_null:
+                map_node_diff_values(
+                    other_key_or_null, val_or_node, other_val_or_node,
+                    changed)
+
+            else:
+                map_node_diff_slot(removed, key_or_null, val_or_node)
+                map_node_diff_slot(
+                    added, other_key_or_null, other_val_or_node)
+
+    def select(self, other, shift, difference, items):
+        # Select keys of this subtree that are present (or absent
+        # if `difference` is set) in the `other` subtree.  Returns
+        # None if no keys were selected.
+        if self is other:
+            return None if difference else self
+
+        if type(other) is not BitmapNode:
+            return map_node_select_items(
+                self, other, shift, difference, items)
+
+        bitmap = 0
+        array = []
+        changed = False
+
+        idx = 0
+        bits = self.bitmap
+        while bits:
+            bit = bits & -bits
+            bits ^= bit
+
+            key_or_null = self.array[idx]
+            val_or_node = self.array[idx + 1]
+            idx += 2
+
+            if not (other.bitmap & bit):
+                if not difference:
+                    changed = True
+                    continue
+                new_key_or_null = key_or_null
+                new_val_or_node = val_or_node
+
+            else:
+                other_idx = 2 * map_bitindex(other.bitmap, bit)
+                other_key_or_null = other.array[other_idx]
+                other_val_or_node = other.array[other_idx + 1]
+
+                new_key_or_null = _NULL
+                if key_or_null is _NULL:
+                    if other_key_or_null is not _NULL:
+                        other_val_or_node = map_node_wrap(
+                            other_key_or_null, other_val_or_node,
+                            shift + 5)
+                    new_val_or_node = val_or_node.select(
+                        other_val_or_node, shift + 5, difference, items)
+                    if new_val_or_node is None:
+                        new_val_or_node = void
+
+                elif other_key_or_null is _NULL:
+                    keep = map_node_wrap(
+                        key_or_null, val_or_node, shift + 5).select(
+                            other_val_or_node, shift + 5,
+                            difference, items)
+                    new_key_or_null = key_or_null
+                    new_val_or_node = val_or_node if keep else void
+
+                else:
+                    found = key_or_null == other_key_or_null
+                    new_key_or_null = key_or_null
+                    new_val_or_node = val_or_node
+                    if not map_node_select_item(
+                            key_or_null, val_or_node,
+                            found, other_val_or_node,
+                            difference, items):
+                        new_val_or_node = void
+
+                # Values can be None, so dropped slots are marked
+                # with `void`.
+                if new_val_or_node is void:
+                    changed = True
+                    continue
+
+                if (new_key_or_null is _NULL and
+                        type(new_val_or_node) is BitmapNode and
+                        new_val_or_node.size == 2 and
+                        new_val_or_node.array[0] is not _NULL):
+                    new_key_or_null, new_val_or_node = new_val_or_node.array
+
+                if (new_key_or_null is not key_or_null or
+                        new_val_or_node is not val_or_node):
+                    changed = True
+
+            bitmap |= bit
+            array.append(new_key_or_null)
+            array.append(new_val_or_node)
+
+        if not changed:
+            return self
+        if not array:
+            return None
+        return BitmapNode(len(array), bitmap, array, 0)
+
+    def transform(self, shift, func):
+        # Call `func(key, val)` for every key/value pair of this
+        # subtree; it returns either the new value, or `void` to drop
+        # the key.  Returns None if no keys were kept.
+        bitmap = 0
+        array = []
+        changed = False
+
+        idx = 0
+        bits = self.bitmap
+        while bits:
+            bit = bits & -bits
+            bits ^= bit
+
+            key_or_null = self.array[idx]
+            val_or_node = self.array[idx + 1]
+            idx += 2
+
+            new_key_or_null = key_or_null
+            if key_or_null is _NULL:
+                new_val_or_node = val_or_node.transform(shift + 5, func)
+                if new_val_or_node is None:
+                    changed = True
+                    continue
+
+                if (type(new_val_or_node) is BitmapNode and
+                        new_val_or_node.size == 2 and
+                        new_val_or_node.array[0] is not _NULL):
+                    new_key_or_null, new_val_or_node = new_val_or_node.array
+
+            else:
+                new_val_or_node = func(key_or_null, val_or_node)
+                if new_val_or_node is void:
+                    changed = True
+                    continue
+
+            if (new_key_or_null is not key_or_null or
+                    new_val_or_node is not val_or_node):
+                changed = True
+
+            bitmap |= bit
+            array.append(new_key_or_null)
+            array.append(new_val_or_node)
+
+        if not changed:
+            return self
+        if not array:
+            return None
+        return BitmapNode(len(array), bitmap, array, 0)
+
+    def count(self):
+        # Memoized like the hash; nodes that are modified in place
+        # by a MapMutation reset it.
+        if self.cached_count != -1:
+            return self.cached_count
+
+        count = 0
+        for i in range(0, self.size, 2):
+            if self.array[i] is _NULL:
+                count += self.array[i + 1].count()
+            else:
+                count += 1
+
+        self.cached_count = count
+        return count
+
     def keys(self):
         for i in range(0, self.size, 2):
             key_or_null = self.array[i]
@@ -264,6 +890,20 @@ class BitmapNode:
             else:
                 yield key_or_null, val_or_node
 
+    def stats(self, level, stats):
+        stats['bitmap_nodes'] += 1
+        stats['slots'] += self.size // 2
+        stats['bytes'] += sys.getsizeof(self) + sys.getsizeof(self.array)
+
+        keys = 0
+        for i in range(0, self.size, 2):
+            if self.array[i] is _NULL:
+                self.array[i + 1].stats(level + 1, stats)
+            else:
+                keys += 1
+        if keys:
+            map_stats_add_keys(stats, level, keys)
+
     def dump(self, buf, level):  # pragma: no cover
         buf.append(
             '    ' * (level + 1) +
@@ -290,6 +930,7 @@ class CollisionNode:
         self.hash = hash
         self.array = array
         self.mutid = mutid
+        self.cached_hash = -1
 
     def find_index(self, key):
         for i in range(0, self.size, 2):
@@ -373,6 +1014,44 @@ class CollisionNode:
                 self.size - 2, self.hash, new_array, mutid)
             return W_NEWNODE, new_node
 
+    def issubset(self, other, shift):
+        if self is other:
+            return True
+        return map_node_items_in(self, other, shift)
+
+    def merge(self, other, shift, resolve, mutid):
+        # Identical subtrees can only be skipped if there is no
+        # `resolve` to call for their keys.
+        if self is other and resolve is None:
+            return self, 0
+        return map_node_merge_items(self, other, shift, resolve, mutid)
+
+    def diff(self, other, shift, added, removed, changed):
+        if self is not other:
+            map_node_diff_items(self, other, shift, added, removed, changed)
+
+    def select(self, other, shift, difference, items):
+        if self is other:
+            return None if difference else self
+        return map_node_select_items(self, other, shift, difference, items)
+
+    def transform(self, shift, func):
+        return map_node_transform_items(self, shift, func)
+
+    def count(self):
+        return self.size // 2
+
+    def items_hash(self):
+        if self.cached_hash != -1:
+            return self.cached_hash
+
+        h = 0
+        for i in range(0, self.size, 2):
+            h ^= map_item_hash(self.array[i], self.array[i + 1])
+
+        self.cached_hash = h
+        return h
+
     def keys(self):
         for i in range(0, self.size, 2):
             yield self.array[i]
@@ -385,6 +1064,11 @@ class CollisionNode:
         for i in range(0, self.size, 2):
             yield self.array[i], self.array[i + 1]
 
+    def stats(self, level, stats):
+        stats['collision_nodes'] += 1
+        stats['bytes'] += sys.getsizeof(self) + sys.getsizeof(self.array)
+        map_stats_add_keys(stats, level, self.size // 2)
+
     def dump(self, buf, level):  # pragma: no cover
         pad = '    ' * (level + 1)
         buf.append(
@@ -399,7 +1083,210 @@ class CollisionNode:
             buf.append('{}{!r}: {!r}'.format(pad, key, val))
 
 
-class MapKeys:
+def map_node_build(entries, shift, mutid):
+    # Build a tree level out of a list of (hash, key, val) tuples
+    # in one go, instead of inserting keys one by one.
+    # Returns a (node, count) tuple.
+    slots = {}
+    for entry in entries:
+        slots.setdefault(map_mask(entry[0], shift), []).append(entry)
+
+    bitmap = 0
+    array = []
+    count = 0
+
+    for idx in sorted(slots):
+        slot = slots[idx]
+        bitmap |= 1 << idx
+
+        hash = slot[0][0]
+        if any(entry[0] != hash for entry in slot):
+            sub_node, sub_count = map_node_build(slot, shift + 5, mutid)
+            array.append(_NULL)
+            array.append(sub_node)
+            count += sub_count
+            continue
+
+        # All keys have the same hash; drop duplicates just like
+        # consecutive assoc() calls would do.
+        unique = []
+        for _, key, val in slot:
+            for i, (ukey, _) in enumerate(unique):
+                if key == ukey:
+                    unique[i] = (ukey, val)
+                    break
+            else:
+                unique.append((key, val))
+
+        count += len(unique)
+        if len(unique) == 1:
+            array.extend(unique[0])
+        else:
+            array.append(_NULL)
+            array.append(CollisionNode(
+                2 * len(unique), hash,
+                [x for item in unique for x in item], mutid))
+
+    return BitmapNode(len(array), bitmap, array, mutid), count
+
+
+def map_node_update(it, root, count, mutid):
+    entries = []
+
+    i = 0
+    while True:
+        try:
+            tup = next(it)
+        except StopIteration:
+            break
+
+        try:
+            tup = tuple(tup)
+        except TypeError:
+            raise TypeError(
+                'cannot convert map update '
+                'sequence element #{} to a sequence'.format(i)) from None
+        key, val, *r = tup
+        if r:
+            raise ValueError(
+                'map update sequence element #{} has length '
+                '{}; 2 is required'.format(i, len(r) + 2))
+
+        entries.append((map_hash(key), key, val))
+
+        i += 1
+
+    if count == 0 and entries:
+        return map_node_build(entries, 0, mutid)
+
+    for hash, key, val in entries:
+        root, added = root.assoc(0, hash, key, val, mutid)
+        if added:
+            count += 1
+
+    return root, count
+
+
+def map_node_delete_many(keys, root, missing_ok):
+    # Delete all `keys` at once by subtracting a tree built out of
+    # them, so that every touched node is copied only once.
+    # Returns the new root, or None if no keys are left.
+    entries = []
+    for key in keys:
+        hash = map_hash(key)
+        if not missing_ok:
+            try:
+                root.find(0, hash, key)
+            except KeyError:
+                raise KeyError(key) from None
+        entries.append((hash, key, None))
+
+    if not entries:
+        return root
+
+    other, _ = map_node_build(entries, 0, 0)
+    return root.select(other, 0, True, False)
+
+
+class MapSetView:
+    # Set operations shared by MapKeys and MapItems.  Operations on
+    # two views of the same kind are performed on their tries; other
+    # operands are handled like dict views handle them.
+
+    _items = False
+
+    def _map(self):
+        raise NotImplementedError
+
+    def _view(self, map):
+        raise NotImplementedError
+
+    def _issubset(self, other):
+        return (len(self) <= len(other) and
+                not self._map()._select(other._map(), True, self._items))
+
+    def __and__(self, other):
+        if type(other) is type(self):
+            return self._view(
+                self._map()._select(other._map(), False, self._items))
+        return set(self).intersection(other)
+
+    def __rand__(self, other):
+        return set(other).intersection(self)
+
+    def __sub__(self, other):
+        if type(other) is type(self):
+            return self._view(
+                self._map()._select(other._map(), True, self._items))
+        return set(self).difference(other)
+
+    def __rsub__(self, other):
+        return set(other).difference(self)
+
+    def __or__(self, other):
+        # A union of two item views can have several values for
+        # one key, hence it can't be represented by a Map.
+        if type(other) is type(self) and not self._items:
+            return self._view(other._map().merge(self._map()))
+        return set(self).union(other)
+
+    def __ror__(self, other):
+        return set(other).union(self)
+
+    def __xor__(self, other):
+        if type(other) is type(self) and not self._items:
+            m1 = self._map()
+            m2 = other._map()
+            return self._view(
+                m1._select(m2, True, False).merge(
+                    m2._select(m1, True, False)))
+        return set(self).symmetric_difference(other)
+
+    def __rxor__(self, other):
+        return set(other).symmetric_difference(self)
+
+    def isdisjoint(self, other):
+        if type(other) is type(self):
+            return not self._map()._select(other._map(), False, self._items)
+        return set(self).isdisjoint(other)
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return len(self) == len(other) and self._issubset(other)
+        if isinstance(other, (set, frozenset)):
+            return set(self) == other
+        return NotImplemented
+
+    def __le__(self, other):
+        if type(other) is type(self):
+            return self._issubset(other)
+        if isinstance(other, (set, frozenset)):
+            return set(self) <= other
+        return NotImplemented
+
+    def __lt__(self, other):
+        if type(other) is type(self):
+            return len(self) < len(other) and self._issubset(other)
+        if isinstance(other, (set, frozenset)):
+            return set(self) < other
+        return NotImplemented
+
+    def __ge__(self, other):
+        if type(other) is type(self):
+            return other._issubset(self)
+        if isinstance(other, (set, frozenset)):
+            return set(self) >= other
+        return NotImplemented
+
+    def __gt__(self, other):
+        if type(other) is type(self):
+            return len(self) > len(other) and other._issubset(self)
+        if isinstance(other, (set, frozenset)):
+            return set(self) > other
+        return NotImplemented
+
+
+class MapKeys(MapSetView):
 
     def __init__(self, c, m):
         self.__count = c
@@ -411,6 +1298,12 @@ class MapKeys:
     def __iter__(self):
         return iter(self.__root.keys())
 
+    def _map(self):
+        return Map._new(self.__count, self.__root)
+
+    def _view(self, map):
+        return map.keys()
+
 
 class MapValues:
 
@@ -425,7 +1318,9 @@ class MapValues:
         return iter(self.__root.values())
 
 
-class MapItems:
+class MapItems(MapSetView):
+
+    _items = True
 
     def __init__(self, c, m):
         self.__count = c
@@ -437,6 +1332,12 @@ class MapItems:
     def __iter__(self):
         return iter(self.__root.items())
 
+    def _map(self):
+        return Map._new(self.__count, self.__root)
+
+    def _view(self, map):
+        return map.items()
+
 
 class Map:
 
@@ -476,8 +1377,23 @@ class Map:
         m.__hash = -1
         return m
 
+    @classmethod
+    def _from_entries(cls, entries):
+        if not entries:
+            return Map()
+        root, count = map_node_build(entries, 0, _mut_id())
+        return Map._new(count, root)
+
     def __reduce__(self):
-        return (type(self), (dict(self.items()),))
+        return (type(self)._unpickle,
+                (tuple(self.__root.keys()), tuple(self.__root.values())))
+
+    @classmethod
+    def _unpickle(cls, keys, values):
+        if len(keys) != len(values):
+            raise ValueError('keys and values must have the same length')
+        return cls._from_entries(
+            [(map_hash(key), key, val) for key, val in zip(keys, values)])
 
     def __len__(self):
         return self.__count
@@ -489,16 +1405,7 @@ class Map:
         if len(self) != len(other):
             return False
 
-        for key, val in self.__root.items():
-            try:
-                oval = other.__root.find(0, map_hash(key), key)
-            except KeyError:
-                return False
-            else:
-                if oval != val:
-                    return False
-
-        return True
+        return self.__root.issubset(other.__root, 0)
 
     def update(self, *args, **kw):
         if not args:
@@ -510,6 +1417,9 @@ class Map:
                 "update expected at most 1 arguments, got {}".format(len(args))
             )
 
+        if isinstance(col, Map) and not kw:
+            return self.merge(col)
+
         it = None
 
         if col is not None:
@@ -529,36 +1439,116 @@ class Map:
 
             return self
 
-        mutid = _mut_id()
-        root = self.__root
-        count = self.__count
+        root, count = map_node_update(
+            it, self.__root, self.__count, _mut_id())
 
-        i = 0
-        while True:
-            try:
-                tup = next(it)
-            except StopIteration:
-                break
+        return Map._new(count, root)
 
-            try:
-                tup = tuple(tup)
-            except TypeError:
-                raise TypeError(
-                    'cannot convert map update '
-                    'sequence element #{} to a sequence'.format(i)) from None
-            key, val, *r = tup
-            if r:
-                raise ValueError(
-                    'map update sequence element #{} has length '
-                    '{}; 2 is required'.format(i, len(r) + 2))
-
-            root, added = root.assoc(0, map_hash(key), key, val, mutid)
-            if added:
-                count += 1
+    def merge(self, other, resolve=None):
+        if resolve is not None and not callable(resolve):
+            raise TypeError(
+                'resolve must be a callable or None, not {}'.format(
+                    type(resolve).__name__))
 
-            i += 1
+        if not isinstance(other, Map):
+            other = Map(other)
 
-        return Map._new(count, root)
+        if not other.__count:
+            return self
+        if not self.__count:
+            return other
+
+        root, added = self.__root.merge(
+            other.__root, 0, resolve, _mut_id())
+        if root is self.__root:
+            return self
+
+        return Map._new(self.__count + added, root)
+
+    def diff(self, other):
+        if not isinstance(other, Map):
+            raise TypeError(
+                'Map.diff() argument must be a Map, not {}'.format(
+                    type(other).__name__))
+
+        added = []
+        removed = []
+        changed = []
+        self.__root.diff(other.__root, 0, added, removed, changed)
+
+        return (
+            Map._from_entries(added),
+            Map._from_entries(removed),
+            Map._from_entries(changed),
+        )
+
+    def _select(self, other, difference, items):
+        root = self.__root.select(other.__root, 0, difference, items)
+        if root is self.__root:
+            return self
+        if root is None:
+            return Map()
+        return Map._new(root.count(), root)
+
+    def _transform(self, func):
+        root = self.__root.transform(0, func)
+        if root is self.__root:
+            return self
+        if root is None:
+            return Map()
+        return Map._new(root.count(), root)
+
+    def filter(self, pred):
+        return self._transform(
+            lambda key, val: val if pred(key, val) else void)
+
+    def filter_keys(self, pred):
+        return self._transform(
+            lambda key, val: val if pred(key) else void)
+
+    def map_values(self, func):
+        return self._transform(lambda key, val: func(val))
+
+    def _split_at(self, cuts):
+        counts = [0] * (len(cuts) - 1)
+        roots = map_node_split(self.__root, 0, 0, cuts, counts)
+
+        parts = []
+        for root, count in zip(roots, counts):
+            if root is None:
+                continue
+            if count == self.__count:
+                parts.append(self)
+            else:
+                parts.append(Map._new(count, root))
+        return parts
+
+    def split(self, n):
+        n = operator.index(n)
+        if n < 1:
+            raise ValueError('the number of parts must be positive')
+
+        count = self.__count
+        if count == 0:
+            return []
+        if n == 1:
+            return [self]
+
+        n = min(n, count)
+        return self._split_at(
+            [k * (count // n) + min(k, count % n) for k in range(n + 1)])
+
+    def partitions(self):
+        if self.__count == 0:
+            return []
+
+        cuts = [0]
+        for i in range(0, self.__root.size, 2):
+            key_or_null = self.__root.array[i]
+            val_or_node = self.__root.array[i + 1]
+            size = 1 if key_or_null is not _NULL else val_or_node.count()
+            cuts.append(cuts[-1] + size)
+        return self._split_at(cuts)
 
     def mutate(self):
         return MapMutation(self.__count, self.__root)
@@ -585,12 +1575,48 @@ class Map:
         else:
             return Map._new(self.__count - 1, node)
 
+    def delete_many(self, keys, missing_ok=True):
+        root = map_node_delete_many(keys, self.__root, missing_ok)
+        if root is self.__root:
+            return self
+        if root is None:
+            return Map()
+        return Map._new(root.count(), root)
+
     def get(self, key, default=None):
         try:
             return self.__root.find(0, map_hash(key), key)
         except KeyError:
             return default
 
+    def get_many(self, keys, default=None):
+        res = []
+        for key in keys:
+            try:
+                res.append(self.__root.find(0, map_hash(key), key))
+            except KeyError:
+                res.append(default)
+        return res
+
+    def take(self, keys):
+        if not self.__count:
+            return self
+
+        entries = []
+        for key in keys:
+            hash = map_hash(key)
+            try:
+                val = self.__root.find(0, hash, key)
+            except KeyError:
+                pass
+            else:
+                entries.append((hash, key, val))
+
+        res = Map._from_entries(entries)
+        if len(res) == self.__count:
+            return self
+        return res
+
     def __getitem__(self, key):
         return self.__root.find(0, map_hash(key), key)
 
@@ -618,20 +1644,13 @@ class Map:
         if self.__hash != -1:
             return self.__hash
 
-        MAX = sys.maxsize
-        MASK = 2 * MAX + 1
+        MAX = _HASH_MAX
+        MASK = _HASH_MASK
 
         h = 1927868237 * (self.__count * 2 + 1)
         h &= MASK
 
-        for key, value in self.__root.items():
-            hx = hash(key)
-            h ^= (hx ^ (hx << 16) ^ 89869747) * 3644798167
-            h &= MASK
-
-            hx = hash(value)
-            h ^= (hx ^ (hx << 16) ^ 89869747) * 3644798167
-            h &= MASK
+        h ^= self.__root.items_hash()
 
         h = h * 69069 + 907133923
         h &= MASK
@@ -652,6 +1671,27 @@ class Map:
         return '<immutables.Map({{{}}}) at 0x{:0x}>'.format(
             ', '.join(items), id(self))
 
+    def stats(self):
+        stats = {
+            'bitmap_nodes': 0,
+            'array_nodes': 0,
+            'collision_nodes': 0,
+            'depths': [],
+            'fill': 0.0,
+            'bytes': object.__sizeof__(self),
+            'slots': 0,
+        }
+        self.__root.stats(0, stats)
+
+        slots = stats.pop('slots')
+        nodes = stats['bitmap_nodes'] + stats['array_nodes']
+        if nodes:
+            stats['fill'] = slots / (nodes * 32)
+        return stats
+
+    def __sizeof__(self):
+        return self.stats()['bytes']
+
     def __dump__(self):  # pragma: no cover
         buf = []
         self.__root.dump(buf, 0)
@@ -696,6 +1736,18 @@ class MapMutation:
             self.__root = new_root
             self.__count -= 1
 
+    def delete_many(self, keys, missing_ok=True):
+        if self.__mutid == 0:
+            raise ValueError('mutation {!r} has been finished'.format(self))
+
+        root = map_node_delete_many(keys, self.__root, missing_ok)
+        if root is None:
+            self.__count = 0
+            self.__root = BitmapNode(0, 0, [], self.__mutid)
+        elif root is not self.__root:
+            self.__root = root
+            self.__count = root.count()
+
     def __setitem__(self, key, val):
         if self.__mutid == 0:
             raise ValueError('mutation {!r} has been finished'.format(self))
@@ -778,36 +1830,8 @@ class MapMutation:
         if it is None:
             return
 
-        root = self.__root
-        count = self.__count
-
-        i = 0
-        while True:
-            try:
-                tup = next(it)
-            except StopIteration:
-                break
-
-            try:
-                tup = tuple(tup)
-            except TypeError:
-                raise TypeError(
-                    'cannot convert map update '
-                    'sequence element #{} to a sequence'.format(i)) from None
-            key, val, *r = tup
-            if r:
-                raise ValueError(
-                    'map update sequence element #{} has length '
-                    '{}; 2 is required'.format(i, len(r) + 2))
-
-            root, added = root.assoc(0, map_hash(key), key, val, self.__mutid)
-            if added:
-                count += 1
-
-            i += 1
-
-        self.__root = root
-        self.__count = count
+        self.__root, self.__count = map_node_update(
+            it, self.__root, self.__count, self.__mutid)
 
     def finish(self):
         self.__mutid = 0
@@ -837,16 +1861,41 @@ class MapMutation:
         if len(self) != len(other):
             return False
 
-        for key, val in self.__root.items():
-            try:
-                oval = other.__root.find(0, map_hash(key), key)
-            except KeyError:
+        return self.__root.issubset(other.__root, 0)
+
+
+class Atom:
+
+    def __init__(self, value=void):
+        if value is void:
+            value = Map()
+        self.__value = value
+        self.__lock = threading.Lock()
+
+    def get(self):
+        return self.__value
+
+    def compare_and_set(self, old, new):
+        with self.__lock:
+            if self.__value is not old:
                 return False
-            else:
-                if oval != val:
-                    return False
+            self.__value = new
+            return True
 
-        return True
+    def swap(self, func, *args):
+        while True:
+            old = self.__value
+            new = func(old, *args)
+            if self.compare_and_set(old, new):
+                return new
+
+    @reprlib.recursive_repr("<immutables.Atom(...)>")
+    def __repr__(self):
+        return '<immutables.Atom({!r}) at 0x{:0x}>'.format(
+            self.__value, id(self))
+
+    def __reduce__(self):
+        raise TypeError("can't pickle {} objects".format(type(self).__name__))
 
 
 collections.abc.Mapping.register(Map)
@@ -0,0 +1,302 @@
+"""Read-only Map snapshots stored in memory-mapped files.
+
+A Map with str, bytes and int keys and values can be written to
+a file with `write_snapshot()` and opened with `MapSnapshot`.  Items
+are decoded from the mapped file on access and the file is never
+written to, so processes that open the same snapshot share one
+physical copy of it, and opening a snapshot doesn't load anything.
+
+File layout (all integers are little-endian):
+
+* a header: the magic string, the number of items, the number of
+  hash table slots, and the offsets of the records and of the hash
+  table;
+
+* records, one per item, in the iteration order of the Map: the
+  type tag and the length of the key followed by the encoded key,
+  then the same for the value;
+
+* an open-addressing hash table (linear probing, the number of
+  slots is a power of two): every slot holds the hash of an encoded
+  key and the offset of its record, or a zero offset if it's empty.
+
+Python's hashes of str and bytes objects are randomized per process,
+so the hash table is indexed with CRC32 of the encoded keys instead.
+"""
+
+import collections.abc
+import mmap
+import numbers
+import os
+import reprlib
+import struct
+import tempfile
+import zlib
+
+
+__all__ = ('MapSnapshot', 'write_snapshot')
+
+
+_MAGIC = b'IMMSNAP1'
+
+# magic, number of items, number of slots, records offset, table offset
+_HEADER = struct.Struct('<8sQQQQ')
+
+# hash of the encoded key, offset of the record
+_SLOT = struct.Struct('<IQ')
+
+# type tag and length of an encoded key or value
+_FIELD = struct.Struct('<BI')
+
+_BYTES, _STR, _INT = range(3)
+
+
+def _encode(obj):
+    tp = type(obj)
+    if tp is str:
+        return _STR, obj.encode('utf-8', 'surrogatepass')
+    if tp is bytes:
+        return _BYTES, obj
+    if tp is int:
+        return _INT, obj.to_bytes(
+            (obj.bit_length() + 8) // 8, 'little', signed=True)
+    raise TypeError(
+        'snapshots can only store str, bytes and int objects, '
+        'got {!r}'.format(tp.__name__))
+
+
+def _encode_key(key):
+    # Encode a key to look up; equal objects of other types (such as
+    # subclasses of str or int, or numbers equal to an int, like 1.0
+    # or Decimal(1)) are found as well.  Returns None if the key can't
+    # be in a snapshot.
+    if isinstance(key, str):
+        return _encode(str(key))
+    if isinstance(key, bytes):
+        return _encode(bytes(key))
+    if isinstance(key, int):
+        return _encode(int(key))
+    hash(key)  # unhashable keys are an error, just like for Maps
+    if isinstance(key, numbers.Number):
+        num = key
+        if isinstance(num, complex):
+            if num.imag:
+                return None
+            num = num.real
+        try:
+            int_key = int(num)
+        except (TypeError, ValueError, OverflowError):
+            # NaNs, infinities and numbers that can't be converted.
+            return None
+        if int_key == key:
+            return _encode(int_key)
+    return None
+
+
+def _decode(tag, data):
+    if tag == _STR:
+        return data.decode('utf-8', 'surrogatepass')
+    if tag == _BYTES:
+        return data
+    if tag == _INT:
+        return int.from_bytes(data, 'little', signed=True)
+    raise ValueError('corrupted snapshot: unknown type tag {}'.format(tag))
+
+
+def _key_hash(tag, data):
+    return zlib.crc32(data, tag)
+
+
+def _get_umask():
+    # The umask can only be read by setting it.
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+def write_snapshot(mapping, path):
+    """Write the items of `mapping` to the snapshot file at `path`.
+
+    The file is replaced atomically, so snapshots that are already
+    open keep reading the old contents.  Replacing a file that is open
+    as a snapshot only works on POSIX systems: on Windows, mapped files
+    can't be replaced or removed, so all snapshots of `path` have to be
+    closed first.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=os.path.basename(path), suffix='.tmp')
+    try:
+        # mkstemp() creates files that only their owner can read;
+        # give the snapshot the permissions of a file created with
+        # open().
+        os.chmod(tmp_path, 0o666 & ~_get_umask())
+        with open(fd, 'wb') as f:
+            _write_snapshot(mapping, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _write_snapshot(mapping, f):
+    count = len(mapping)
+    nslots = 1
+    while nslots < 2 * count:
+        nslots *= 2
+    mask = nslots - 1
+    table = bytearray(nslots * _SLOT.size)
+
+    f.write(bytes(_HEADER.size))
+    offset = _HEADER.size
+
+    written = 0
+    for key, val in mapping.items():
+        key_tag, key_data = _encode(key)
+        val_tag, val_data = _encode(val)
+
+        key_hash = _key_hash(key_tag, key_data)
+        i = key_hash & mask
+        while _SLOT.unpack_from(table, i * _SLOT.size)[1]:
+            i = (i + 1) & mask
+        _SLOT.pack_into(table, i * _SLOT.size, key_hash, offset)
+
+        record = b''.join([
+            _FIELD.pack(key_tag, len(key_data)), key_data,
+            _FIELD.pack(val_tag, len(val_data)), val_data])
+        f.write(record)
+        offset += len(record)
+        written += 1
+
+    if written != count:
+        raise RuntimeError('mapping changed size during iteration')
+
+    f.write(table)
+    f.seek(0)
+    f.write(_HEADER.pack(_MAGIC, count, nslots, _HEADER.size, offset))
+
+
+class MapSnapshot(collections.abc.Mapping):
+    """A read-only Map stored in a snapshot file."""
+
+    def __init__(self, path):
+        self._path = path
+        with open(path, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if len(self._buf) < _HEADER.size:
+                raise ValueError('{!r} is not a Map snapshot'.format(path))
+
+            magic, count, nslots, start, table = _HEADER.unpack_from(
+                self._buf)
+            if (magic != _MAGIC or nslots & (nslots - 1) or
+                    table + nslots * _SLOT.size != len(self._buf)):
+                raise ValueError('{!r} is not a Map snapshot'.format(path))
+        except BaseException:
+            self._buf.close()
+            raise
+
+        self._count = count
+        self._mask = nslots - 1
+        self._start = start
+        self._table = table
+
+    def close(self):
+        self._buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __reduce__(self):
+        return (type(self), (self._path,))
+
+    def __len__(self):
+        return self._count
+
+    def _find(self, key):
+        # Return the offset of the value of `key`, or -1 if not found.
+        encoded = _encode_key(key)
+        if encoded is None:
+            return -1
+        tag, data = encoded
+
+        buf = self._buf
+        key_hash = _key_hash(tag, data)
+        i = key_hash & self._mask
+        while True:
+            slot_hash, offset = _SLOT.unpack_from(
+                buf, self._table + i * _SLOT.size)
+            if not offset:
+                return -1
+
+            if slot_hash == key_hash:
+                key_tag, size = _FIELD.unpack_from(buf, offset)
+                offset += _FIELD.size
+                if (key_tag == tag and size == len(data) and
+                        buf[offset:offset + size] == data):
+                    return offset + size
+
+            i = (i + 1) & self._mask
+
+    def _read(self, offset):
+        # Decode the field at `offset`; returns (obj, next offset).
+        tag, size = _FIELD.unpack_from(self._buf, offset)
+        offset += _FIELD.size
+        return _decode(tag, self._buf[offset:offset + size]), offset + size
+
+    def __getitem__(self, key):
+        offset = self._find(key)
+        if offset < 0:
+            raise KeyError(key)
+        return self._read(offset)[0]
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def get(self, key, default=None):
+        offset = self._find(key)
+        if offset < 0:
+            return default
+        return self._read(offset)[0]
+
+    def _iter_items(self):
+        offset = self._start
+        while offset < self._table:
+            key, offset = self._read(offset)
+            val, offset = self._read(offset)
+            yield key, val
+
+    def __iter__(self):
+        for key, _ in self._iter_items():
+            yield key
+
+    def keys(self):
+        return collections.abc.KeysView(self)
+
+    def values(self):
+        return _SnapshotValues(self)
+
+    def items(self):
+        return _SnapshotItems(self)
+
+    def __repr__(self):
+        return 'immutables.snapshot.MapSnapshot({})'.format(
+            reprlib.repr(self._path))
+
+
+class _SnapshotValues(collections.abc.ValuesView):
+
+    def __iter__(self):
+        for _, val in self._mapping._iter_items():
+            yield val
+
+
+class _SnapshotItems(collections.abc.ItemsView):
+
+    def __iter__(self):
+        return self._mapping._iter_items()
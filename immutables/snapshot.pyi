@@ -0,0 +1,30 @@
+from typing import Any
+from typing import ItemsView
+from typing import Iterator
+from typing import KeysView
+from typing import Mapping
+from typing import TypeVar
+from typing import Union
+from typing import ValuesView
+
+
+Key = Union[str, bytes, int]
+Value = Union[str, bytes, int]
+S = TypeVar('S', bound='MapSnapshot')
+
+
+def write_snapshot(mapping: Mapping[Key, Value], path: str) -> None: ...
+
+
+class MapSnapshot(Mapping[Key, Value]):
+    def __init__(self, path: str) -> None: ...
+    def close(self) -> None: ...
+    def __enter__(self: S) -> S: ...
+    def __exit__(self, *exc: Any) -> bool: ...
+    def __len__(self) -> int: ...
+    def __getitem__(self, key: Key) -> Value: ...
+    def __contains__(self, key: object) -> bool: ...
+    def __iter__(self) -> Iterator[Key]: ...
+    def keys(self) -> KeysView[Key]: ...
+    def values(self) -> ValuesView[Value]: ...
+    def items(self) -> ItemsView[Key, Value]: ...
@@ -29,6 +29,16 @@ if platform.python_implementation() == 'CPython':
         define_macros = [('NDEBUG', '1')]
         undef_macros = []
 
+    # Set IMMUTABLES_HASH_BITS=64 to index the trie with full 64-bit
+    # hashes instead of folding them into 32 bits; this avoids hash
+    # collisions in Maps with tens of millions of keys.
+    hash_bits = os.environ.get("IMMUTABLES_HASH_BITS")
+    if hash_bits:
+        if hash_bits not in ('32', '64'):
+            raise RuntimeError(
+                'IMMUTABLES_HASH_BITS must be either 32 or 64')
+        define_macros.append(('MAP_HASH_BITS', hash_bits))
+
     ext_modules = [
         setuptools.Extension(
             "immutables._map",
@@ -0,0 +1,139 @@
+import gc
+import pickle
+import threading
+import unittest
+import weakref
+
+from immutables.map import Map as PyMap, Atom as PyAtom
+
+
+class BaseAtomTest:
+
+    Map = None
+    Atom = None
+
+    def test_atom_1(self):
+        a = self.Atom()
+        m = a.get()
+        self.assertIsInstance(m, self.Map)
+        self.assertEqual(m, self.Map())
+
+        m2 = m.set('a', 1)
+        self.assertTrue(a.compare_and_set(m, m2))
+        self.assertIs(a.get(), m2)
+
+        # Values are compared by identity.
+        self.assertFalse(a.compare_and_set(self.Map(a=1), m))
+        self.assertFalse(a.compare_and_set(m, m2))
+        self.assertIs(a.get(), m2)
+
+        self.assertIsNone(self.Atom(None).get())
+        self.assertIs(self.Atom(value=m).get(), m)
+
+        with self.assertRaises(TypeError):
+            a.compare_and_set(m)
+        with self.assertRaises(TypeError):
+            self.Atom(m, m)
+
+    def test_atom_swap_1(self):
+        a = self.Atom(self.Map(a=1))
+
+        m = a.swap(lambda m: m.set('b', 2))
+        self.assertEqual(m, self.Map(a=1, b=2))
+        self.assertIs(a.get(), m)
+
+        m = a.swap(self.Map.set, 'c', 3)
+        self.assertEqual(m, self.Map(a=1, b=2, c=3))
+        self.assertIs(a.get(), m)
+
+        with self.assertRaises(ZeroDivisionError):
+            a.swap(lambda m: 1 / 0)
+        self.assertIs(a.get(), m)
+
+        with self.assertRaises(TypeError):
+            a.swap()
+
+    def test_atom_swap_2(self):
+        # swap() calls the function again if the value was replaced
+        # while it was running.
+        a = self.Atom(self.Map())
+        calls = []
+
+        def func(m):
+            calls.append(m)
+            if len(calls) == 1:
+                a.compare_and_set(m, m.set('x', 1))
+            return m.set('y', 2)
+
+        m = a.swap(func)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(m, self.Map(x=1, y=2))
+        self.assertIs(a.get(), m)
+
+    def test_atom_threads_1(self):
+        a = self.Atom()
+        barrier = threading.Barrier(4)
+
+        def worker(n):
+            barrier.wait()
+            for i in range(200):
+                a.swap(lambda m: m.set((n, i), i))
+                a.get()[(n, 0)]
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(a.get()), 800)
+
+    def test_atom_repr_1(self):
+        a = self.Atom(self.Map(a=1))
+        self.assertTrue(repr(a).startswith(
+            "<immutables.Atom(<immutables.Map({'a': 1}) at 0x"))
+
+        a.compare_and_set(a.get(), a)
+        self.assertTrue(repr(a).startswith(
+            "<immutables.Atom(<immutables.Atom(...)>) at 0x"))
+
+    def test_atom_gc_1(self):
+        class Obj:
+            pass
+
+        obj = Obj()
+        a = self.Atom(self.Map(obj=obj))
+        obj.atom = a
+        ref = weakref.ref(a)
+
+        del a, obj
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_atom_pickle_1(self):
+        with self.assertRaises(TypeError):
+            pickle.dumps(self.Atom())
+
+
+class PyAtomTest(BaseAtomTest, unittest.TestCase):
+
+    Map = PyMap
+    Atom = PyAtom
+
+
+try:
+    from immutables._map import Map as CMap, Atom as CAtom
+except ImportError:
+    CMap = CAtom = None
+
+
+@unittest.skipIf(CMap is None, 'C Map is not available')
+class CAtomTest(BaseAtomTest, unittest.TestCase):
+
+    Map = CMap
+    Atom = CAtom
+
+
+if __name__ == "__main__":
+    unittest.main()
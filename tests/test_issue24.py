@@ -45,7 +45,7 @@ class Issue24Base:
         self.dump_check_node_size(header, 2 * count)
 
     def test_bitmap_node_update_in_place_count(self):
-        keys = range(7)
+        keys = range(12)
         new_entries = dict.fromkeys(keys, True)
         m = self.Map(new_entries)
         d = m.__dump__().splitlines()
@@ -54,10 +54,10 @@ class Issue24Base:
             header = d[1] # skip _map.Map.__dump__() header
         else:
             header = d[0]
-        self.dump_check_bitmap_node_count(header, 7)
+        self.dump_check_bitmap_node_count(header, 12)
 
     def test_bitmap_node_delete_in_place_count(self):
-        keys = range(7)
+        keys = range(12)
         new_entries = dict.fromkeys(keys, True)
         m = self.Map(new_entries)
         with m.mutate() as mm:
@@ -69,10 +69,10 @@ class Issue24Base:
             header = d[1] # skip _map.Map.__dump__() header
         else:
             header = d[0]
-        self.dump_check_bitmap_node_count(header, 4)
+        self.dump_check_bitmap_node_count(header, 9)
 
     def test_collision_node_update_in_place_count(self):
-        keys = (CollisionKey() for i in range(7))
+        keys = (CollisionKey() for i in range(12))
         new_entries = dict.fromkeys(keys, True)
         m = self.Map(new_entries)
         d = m.__dump__().splitlines()
@@ -83,10 +83,10 @@ class Issue24Base:
         else:
             h1, h2 = d[0], d[2]
         self.dump_check_node_kind(h1, 'Bitmap')
-        self.dump_check_collision_node_count(h2, 7)
+        self.dump_check_collision_node_count(h2, 12)
 
     def test_collision_node_delete_in_place_count(self):
-        keys = [CollisionKey() for i in range(7)]
+        keys = [CollisionKey() for i in range(12)]
         new_entries = dict.fromkeys(keys, True)
         m = self.Map(new_entries)
         with m.mutate() as mm:
@@ -100,7 +100,7 @@ class Issue24Base:
         else:
             h1, h2 = d[0], d[2]
         self.dump_check_node_kind(h1, 'Bitmap')
-        self.dump_check_collision_node_count(h2, 4)
+        self.dump_check_collision_node_count(h2, 9)
 
 try:
     from immutables._map import Map as CMap
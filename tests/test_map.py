@@ -1,8 +1,12 @@
 import collections.abc
 import gc
+import importlib.util
+import os
 import pickle
 import random
+import re
 import sys
+import textwrap
 import unittest
 import weakref
 
@@ -159,7 +163,71 @@ class BaseMapTest:
         #                             <Key name:E hash:362244>: 'e'
         #     <Key name:B hash:101>: 'b'
 
+    def test_map_collision_3(self):
+        # These keys have different 64-bit hashes that are folded into
+        # the same 32-bit hash (unless the C extension was built with
+        # IMMUTABLES_HASH_BITS=64).
+        low = 0b011000011100000100
+        keys = [HashKey((i << 32) | (low ^ i), str(i))
+                for i in range(1, 100)]
+        keys.append(HashKey(low, 'low'))
+        # Pushes the Collision node to the deepest level of the trie.
+        keys.append(HashKey(low | (1 << 30), 'deep'))
 
+        h = self.Map()
+        for i, key in enumerate(keys):
+            h = h.set(key, i)
+        self.assertEqual(len(h), len(keys))
+        self.assertEqual(dict(h), {key: i for i, key in enumerate(keys)})
+
+        h2 = self.Map({key: i for i, key in enumerate(keys)})
+        self.assertEqual(h, h2)
+        self.assertEqual(hash(h), hash(h2))
+
+        for key in keys[::2]:
+            h = h.delete(key)
+        self.assertEqual(
+            h, self.Map({key: i for i, key in enumerate(keys) if i % 2}))
+        self.assertEqual(set(h2.diff(h)[1]), set(keys[::2]))
+
+        self.assertEqual(set(h2), set(keys))
+
+    def test_map_collision_4(self):
+        # Same folded hash; every third key shares its full hash
+        # with the previous one.
+        low = 0b101
+        keys = []
+        for i in range(1, 61):
+            full = ((i - i % 3) << 32) | (low ^ (i - i % 3))
+            keys.append(HashKey(full, str(i)))
+        random.shuffle(keys)
+
+        d = {}
+        h = self.Map()
+        for i, key in enumerate(keys):
+            h = h.set(key, i)
+            d[key] = i
+        self.assertEqual(dict(h), d)
+        for key in keys:
+            self.assertEqual(h[key], d[key])
+            self.assertEqual(h.get(HashKey(key.hash, 'missing')), None)
+
+        # Equal keys: the first key is kept and the last value wins.
+        dups = [HashKey(key.hash, key.name) for key in keys]
+        items = list(zip(keys, range(60))) + list(zip(dups, range(60, 120)))
+        h2 = self.Map(items)
+        self.assertEqual(len(h2), 60)
+        self.assertEqual(h2, self.Map(zip(keys, range(60, 120))))
+        self.assertEqual(
+            {id(k) for k in h2}, {id(k) for k in keys})
+
+        for key in keys[::2]:
+            h = h.delete(key)
+            del d[key]
+            self.assertEqual(dict(h), d)
+        for key in keys[::2]:
+            with self.assertRaises(KeyError):
+                h.delete(key)
 
     def test_map_stress_01(self):
         COLLECTION_SIZE = 7000
@@ -758,6 +826,74 @@ class BaseMapTest:
     def test_map_eq_3(self):
         self.assertNotEqual(self.Map(), 1)
 
+    def test_map_eq_4(self):
+        # Maps that share their trees must be compared without
+        # calling __eq__ on the shared keys.
+        keys = [HashKey(i, str(i)) for i in range(1000)]
+        h1 = self.Map({k: i for i, k in enumerate(keys)})
+        h2 = self.Map(h1)
+
+        with HashKeyCrasher(error_on_eq=True):
+            self.assertTrue(h1 == h2)
+            self.assertFalse(h1 != h2)
+
+        h3 = h1.set(keys[10], 'x')
+        h4 = h1.set(keys[10], 'x')
+        self.assertTrue(h3 == h4)
+        self.assertFalse(h1 == h3)
+        self.assertFalse(h3 == h1)
+
+        h5 = h3.set(keys[10], 10)
+        self.assertTrue(h1 == h5)
+        self.assertTrue(h5 == h1)
+
+        h6 = h1.delete(keys[500]).set(HashKey(5000, '5000'), 500)
+        self.assertFalse(h1 == h6)
+        self.assertFalse(h6 == h1)
+
+    def test_map_eq_5(self):
+        # Compare equal maps that have different tree shapes.
+        N = 300
+        keys = [HashKey(i * 7, str(i)) for i in range(N)]
+
+        h1 = self.Map()
+        for i, k in enumerate(keys):
+            h1 = h1.set(k, i)
+        for k in keys[N // 2:]:
+            h1 = h1.delete(k)
+
+        h2 = self.Map()
+        for i, k in enumerate(keys[:N // 2]):
+            h2 = h2.set(k, i)
+
+        self.assertTrue(h1 == h2)
+        self.assertTrue(h2 == h1)
+
+        h3 = h2.set(keys[0], 'x')
+        self.assertFalse(h1 == h3)
+        self.assertFalse(h3 == h1)
+
+        h4 = h2.delete(keys[0]).set(keys[-1], 0)
+        self.assertFalse(h1 == h4)
+        self.assertFalse(h4 == h1)
+
+    def test_map_eq_6(self):
+        # Inlined keys compared against collision nodes.
+        A = HashKey(100, 'A')
+        B = HashKey(100, 'B')
+        C = HashKey(100, 'C')
+
+        h1 = self.Map({A: 1, B: 2})
+        h2 = self.Map({A: 1, C: 2})
+        h3 = self.Map({A: 1, B: 2})
+
+        self.assertFalse(h1 == h2)
+        self.assertTrue(h1 == h3)
+
+        h4 = self.Map({A: 1, HashKey(200, 'D'): 2})
+        self.assertFalse(h1 == h4)
+        self.assertFalse(h4 == h1)
+
     def test_map_gc_1(self):
         A = HashKey(100, 'A')
 
@@ -800,6 +936,33 @@ class BaseMapTest:
 
         self.assertIsNone(ref())
 
+    def test_map_gc_3(self):
+        # Freed Maps, nodes, and iterators can be reused by _map.c;
+        # make sure reused objects start from a clean state.
+        for _ in range(3):
+            maps = [self.Map({j: j for j in range(i)}) for i in range(50)]
+            refs = [weakref.ref(h) for h in maps]
+            iters = [iter(h.keys()) for h in maps]
+            iters += [iter(h.items()) for h in maps]
+            del maps, iters
+            self.assertEqual([ref() for ref in refs], [None] * len(refs))
+
+        h = self.Map(a=1)
+        ref = weakref.ref(h)
+        self.assertIs(ref(), h)
+
+        self.assertEqual(list(iter(h.values())), [1])
+        self.assertEqual(list(iter(h.items())), [('a', 1)])
+        self.assertEqual(list(iter(h.keys())), ['a'])
+
+        h2 = h
+        for i in range(1000):
+            h2 = h2.set(i, i)
+        for i in range(1000):
+            h2 = h2.delete(i)
+        self.assertEqual(h2, h)
+        self.assertEqual(dict(h2), {'a': 1})
+
     def test_map_in_1(self):
         A = HashKey(100, 'A')
         AA = HashKey(100, 'A')
@@ -882,6 +1045,50 @@ class BaseMapTest:
         self.assertTrue(repr(h).startswith(
             '<immutables.Map({{...}: 1}) at 0x'))
 
+    def test_map_stats_1(self):
+        for n in [0, 1, 8, 9, 100, 5000]:
+            h = self.Map({i: i for i in range(n)})
+            stats = h.stats()
+            self.assertEqual(set(stats), {
+                'bitmap_nodes', 'array_nodes', 'collision_nodes',
+                'depths', 'fill', 'bytes'})
+            self.assertEqual(sum(stats['depths']), n)
+            self.assertEqual(stats['collision_nodes'], 0)
+            self.assertGreaterEqual(stats['fill'], 0.0)
+            self.assertLessEqual(stats['fill'], 1.0)
+            self.assertEqual(stats['bytes'], h.__sizeof__())
+            if n > 100:
+                self.assertGreater(len(stats['depths']), 1)
+
+    def test_map_stats_2(self):
+        A = HashKey(100, 'A')
+        B = HashKey(100, 'B')
+        C = HashKey(200, 'C')
+
+        h = self.Map({A: 1, B: 2, C: 3, **{i: i for i in range(20)}})
+        stats = h.stats()
+        self.assertEqual(stats['collision_nodes'], 1)
+        self.assertEqual(sum(stats['depths']), 23)
+
+        stats = h.delete(A).stats()
+        self.assertEqual(stats['collision_nodes'], 0)
+        self.assertEqual(sum(stats['depths']), 22)
+
+    def test_map_sizeof_1(self):
+        h = self.Map()
+        empty_size = size = sys.getsizeof(h)
+        for i in range(1000):
+            h = h.set(i, i)
+            new_size = sys.getsizeof(h)
+            self.assertGreaterEqual(new_size, size)
+            size = new_size
+        self.assertGreater(size, empty_size + 1000 * 8)
+
+        # Keys and values are not counted.
+        self.assertEqual(
+            sys.getsizeof(h.set(1, 'x' * 10000)),
+            sys.getsizeof(h.set(1, 'x')))
+
     def test_hash_1(self):
         h = self.Map()
         self.assertNotEqual(hash(h), -1)
@@ -909,6 +1116,44 @@ class BaseMapTest:
             with HashKeyCrasher(error_on_hash=True):
                 hash(m)
 
+    def test_hash_3(self):
+        hash_calls = 0
+
+        class Key(HashKey):
+            def __hash__(self):
+                nonlocal hash_calls
+                hash_calls += 1
+                return super().__hash__()
+
+        keys = [Key(i, str(i)) for i in range(1000)]
+        h = self.Map({k: i for i, k in enumerate(keys)})
+        hash(h)
+
+        h2 = h.set(keys[10], 'x').delete(keys[500])
+        self.assertEqual(
+            hash(h2),
+            hash(self.Map({
+                k: 'x' if k is keys[10] else i
+                for i, k in enumerate(keys) if k is not keys[500]})))
+
+        # Only the nodes that are not shared with `h2` should
+        # be visited.
+        hash_calls = 0
+        hash(h2.set(keys[20], 'y'))
+        self.assertLess(hash_calls, 100)
+
+    def test_hash_4(self):
+        h = self.Map()
+        for i in range(100):
+            h = h.set(i, i)
+            self.assertEqual(
+                hash(h), hash(self.Map({j: j for j in range(i + 1)})))
+
+        for i in range(100):
+            h = h.delete(i)
+            self.assertEqual(
+                hash(h), hash(self.Map({j: j for j in range(i + 1, 100)})))
+
     def test_abc_1(self):
         self.assertTrue(issubclass(self.Map, collections.abc.Mapping))
 
@@ -1028,6 +1273,26 @@ class BaseMapTest:
 
         self.assertEqual(dict(h.items()), {'a': 1, 'b': 2, 'z': 100})
 
+    def test_map_mut_6_hash_clears_item(self):
+        # Keys' __hash__ can modify the key/value pairs they are in.
+        pairs = []
+
+        class Key:
+            def __hash__(self):
+                for pair in pairs:
+                    pair.clear()
+                return 1
+
+        pairs.append([Key(), object()])
+        h = self.Map(pairs)
+        key, = h
+        self.assertIsInstance(key, Key)
+        self.assertIsInstance(h[key], object)
+
+        pairs[:] = [[Key(), object()], [Key(), object()]]
+        with self.assertRaises(ValueError):
+            self.Map(pairs)
+
     def test_map_mut_7(self):
         key = HashKey(123, 'aaa')
 
@@ -1042,7 +1307,13 @@ class BaseMapTest:
         upd = self.Map({key: 'zzz'})
         with HashKeyCrasher(error_on_hash=True):
             with self.assertRaises(HashingError):
-                h.update(upd)
+                self.Map({HashKey(27, 'x'): 1}).update(upd)
+
+        with HashKeyCrasher(error_on_hash=True):
+            # Maps are merged structurally; keys that land in
+            # free slots are adopted without being hashed again.
+            h2 = self.Map({1: 2}).update(upd)
+        self.assertEqual(dict(h2.items()), {1: 2, key: 'zzz'})
 
         upd = [(1, 2), (key, 'zzz')]
         with HashKeyCrasher(error_on_hash=True):
@@ -1351,6 +1622,53 @@ class BaseMapTest:
         with self.assertRaisesRegex(TypeError, "can('t|not) pickle"):
             pickle.dumps(h.mutate())
 
+    def test_map_pickle_2(self):
+        A = HashKey(100, 'A')
+        B = HashKey(101, 'B')
+        C = HashKey(100, 'C')
+
+        for d in [{}, {'a': 1}, {A: 'a', B: 'b', C: 'c'},
+                  {str(i): i for i in range(1000)}]:
+            h = self.Map(d)
+            for proto in range(pickle.HIGHEST_PROTOCOL + 1):
+                uh = pickle.loads(pickle.dumps(h, proto))
+                self.assertEqual(uh, h)
+                self.assertEqual(len(uh), len(d))
+                self.assertEqual(dict(uh.items()), d)
+
+        # Maps are pickled as a tuple of keys and a tuple of values.
+        h = self.Map(a=1, b=2)
+        func, args = h.__reduce__()
+        self.assertEqual(len(args), 2)
+        self.assertEqual(dict(zip(*args)), {'a': 1, 'b': 2})
+        self.assertEqual(func(*args), h)
+
+        with self.assertRaisesRegex(ValueError, 'same length'):
+            self.Map._unpickle(('a', 'b'), (1,))
+
+        # Maps pickled as a dict by older versions can be loaded.
+        class Old:
+            def __reduce__(_):
+                return (self.Map, ({'a': 1},))
+
+        self.assertEqual(pickle.loads(pickle.dumps(Old())), self.Map(a=1))
+
+    @unittest.skipIf(sys.version_info < (3, 8), 'requires pickle protocol 5')
+    def test_map_pickle_out_of_band(self):
+        data = bytearray(b'x' * 1000)
+        h = self.Map({i: i for i in range(100)}).set(
+            'data', pickle.PickleBuffer(data))
+
+        buffers = []
+        p = pickle.dumps(h, protocol=5, buffer_callback=buffers.append)
+        self.assertEqual(len(buffers), 1)
+        self.assertLess(len(p), len(data))
+
+        uh = pickle.loads(p, buffers=buffers)
+        self.assertEqual(len(uh), 101)
+        self.assertEqual(bytes(uh['data']), bytes(data))
+        self.assertEqual(uh.delete('data'), h.delete('data'))
+
     @unittest.skipIf(sys.version_info < (3, 7, 0), "__class_getitem__ is not available")
     def test_map_is_subscriptable(self):
         self.assertIs(self.Map[int, str], self.Map)
@@ -1360,6 +1678,928 @@ class BaseMapTest:
         self.assertEqual(dict(self.Map(a=0, col=1)), {"a": 0, "col": 1})
         self.assertEqual(dict(self.Map({"a": 0}, col=1)), {"a": 0, "col": 1})
 
+    def test_map_bulk_1(self):
+        keys = [HashKey(i * 31, str(i)) for i in range(5000)]
+        d = {k: i for i, k in enumerate(keys)}
+
+        h1 = self.Map(d)
+        h2 = self.Map()
+        for k, v in d.items():
+            h2 = h2.set(k, v)
+
+        self.assertEqual(len(h1), len(d))
+        self.assertEqual(dict(h1.items()), d)
+        self.assertEqual(h1, h2)
+        self.assertEqual(hash(h1), hash(h2))
+
+        self.assertEqual(self.Map(d.items()), h1)
+        self.assertEqual(self.Map().update(d), h1)
+
+        for k in keys[::3]:
+            h1 = h1.delete(k)
+            del d[k]
+        self.assertEqual(dict(h1.items()), d)
+
+    def test_map_bulk_2(self):
+        A = HashKey(100, 'A')
+        A2 = HashKey(100, 'A')
+        B = HashKey(100, 'B')
+        C = HashKey(100 + (1 << 20), 'C')
+
+        h = self.Map([(A, 1), (B, 2), (A2, 3), (C, 4), (B, 5)])
+        self.assertEqual(len(h), 3)
+        self.assertEqual(dict(h.items()), {A: 3, B: 5, C: 4})
+        self.assertIs(next(k for k in h if k == A), A)
+
+        h = self.Map([(A, 1), (A2, 2)])
+        self.assertEqual(len(h), 1)
+        self.assertEqual(h[A], 2)
+        self.assertEqual(h.delete(A), self.Map())
+
+    def test_map_bulk_3(self):
+        Er = HashKey(100, 'Er')
+        A = HashKey(100, 'A', error_on_eq_to=Er)
+
+        with self.assertRaisesRegex(ValueError, 'cannot compare'):
+            self.Map([(A, 1), (Er, 2)])
+
+        with self.assertRaises(HashingError):
+            with HashKeyCrasher(error_on_hash=True):
+                self.Map({A: 1})
+
+        with self.assertRaisesRegex(ValueError, 'element #1'):
+            self.Map([(1, 2), (3, 4, 5)])
+
+        with self.assertRaisesRegex(TypeError, 'element #2'):
+            self.Map([(1, 2), (3, 4), 5])
+
+        with self.Map().mutate() as mm:
+            mm.update({i: i for i in range(100)})
+            mm[1000] = 1000
+            del mm[0]
+            self.assertEqual(len(mm), 100)
+            h = mm.finish()
+        self.assertEqual(
+            dict(h.items()), {i: i for i in list(range(1, 100)) + [1000]})
+
+    def test_map_merge_1(self):
+        h = self.Map(a=1, b=2, c=3)
+
+        self.assertIs(h.merge({}), h)
+        self.assertIs(h.merge(self.Map()), h)
+        self.assertIs(self.Map().merge(h), h)
+        self.assertIs(h.merge(h), h)
+        self.assertIs(h.merge({'a': 1}), h)
+
+        h2 = h.merge({'c': 30, 'd': 4})
+        self.assertEqual(h2, self.Map(a=1, b=2, c=30, d=4))
+        self.assertEqual(h, self.Map(a=1, b=2, c=3))
+
+        h2 = h.merge([('c', 30), ('d', 4)], lambda k, a, b: a + b)
+        self.assertEqual(h2, self.Map(a=1, b=2, c=33, d=4))
+
+        h2 = h.merge(self.Map(c=30), resolve=lambda k, a, b: (k, a, b))
+        self.assertEqual(h2, self.Map(a=1, b=2, c=('c', 3, 30)))
+
+        h2 = h.merge(self.Map(c=30), resolve=None)
+        self.assertEqual(h2, self.Map(a=1, b=2, c=30))
+
+    def test_map_merge_2(self):
+        calls = []
+
+        def resolve(key, a, b):
+            calls.append(key)
+            return a
+
+        base = self.Map({i: str(i) for i in range(1000)})
+        other = base.mutate()
+        for i in range(0, 2000, 100):
+            other[i] = -i
+        other = other.finish()
+
+        # `resolve` is called for every key present in both Maps,
+        # including the keys of the subtrees they share.
+        h = base.merge(other, resolve)
+        self.assertEqual(sorted(calls), list(range(1000)))
+        self.assertEqual(len(h), 1010)
+        expected = {i: str(i) for i in range(1000)}
+        expected.update({i: -i for i in range(1000, 2000, 100)})
+        self.assertEqual(dict(h.items()), expected)
+
+        calls.clear()
+        h = other.merge(base, resolve)
+        self.assertEqual(sorted(calls), list(range(1000)))
+        self.assertEqual(h, other)
+        self.assertEqual(base.merge(other), other)
+
+        calls.clear()
+        h = base.merge(base.set(1, 'x').set(2000, 'y'), resolve)
+        self.assertEqual(sorted(calls), list(range(1000)))
+        self.assertEqual(len(h), 1001)
+
+        h = base.merge({i: i for i in range(500, 1500)})
+        self.assertEqual(
+            h, self.Map({i: str(i) if i < 500 else i for i in range(1500)}))
+        for i in range(1500):
+            h = h.delete(i)
+        self.assertEqual(len(h), 0)
+
+    def test_map_merge_resolve_same_values(self):
+        # `resolve` is called even if both values are equal or are
+        # the same object.
+        def add(key, a, b):
+            return a + b
+
+        self.assertEqual(
+            self.Map(hits=2).merge({'hits': 2}, add), self.Map(hits=4))
+        self.assertEqual(
+            self.Map(a=1, b=10 ** 20).merge({'b': 10 ** 20}, add),
+            self.Map(a=1, b=2 * 10 ** 20))
+
+        for n in [5, 1000]:
+            h = self.Map({i: i for i in range(n)})
+            self.assertEqual(
+                h.merge(h, add), self.Map({i: 2 * i for i in range(n)}))
+            h2 = h.set(n, n)
+            self.assertEqual(
+                h.merge(h2, add),
+                self.Map({i: 2 * i for i in range(n + 1)}).set(n, n))
+            self.assertEqual(
+                h.merge(dict(h.items()), add),
+                self.Map({i: 2 * i for i in range(n)}))
+
+        A = HashKey(100, 'A')
+        B = HashKey(100, 'B')
+        h = self.Map({A: 1, B: 2, 'c': 3})
+        self.assertEqual(
+            h.merge(h, add), self.Map({A: 2, B: 4, 'c': 6}))
+
+        # Without `resolve`, merging identical values keeps the Map.
+        self.assertIs(h.merge(h), h)
+
+    def test_map_merge_3(self):
+        A = HashKey(100, 'A')
+        B = HashKey(101, 'B')
+        C = HashKey(100, 'C')
+        D = HashKey(100100, 'D')
+        E = HashKey(100, 'E')
+
+        h1 = self.Map({A: 'a', B: 'b', D: 'd'})
+        h2 = self.Map({C: 'c', B: 'bb', E: 'e'})
+
+        h = h1.merge(h2, lambda k, a, b: a + b)
+        self.assertEqual(
+            h, self.Map({A: 'a', B: 'bbb', C: 'c', D: 'd', E: 'e'}))
+        self.assertEqual(len(h), 5)
+
+        h = h2.merge(h1)
+        self.assertEqual(
+            h, self.Map({A: 'a', B: 'b', C: 'c', D: 'd', E: 'e'}))
+
+        h = h.delete(A).delete(B).delete(C).delete(D)
+        self.assertEqual(h, self.Map({E: 'e'}))
+
+    def test_map_merge_4(self):
+        h = self.Map(a=1, b=2)
+
+        with self.assertRaisesRegex(TypeError, 'resolve must be a callable'):
+            h.merge({'a': 2}, 1)
+
+        with self.assertRaisesRegex(TypeError, 'from MapMutations'):
+            h.merge(h.mutate())
+
+        with self.assertRaises(ZeroDivisionError):
+            h.merge({'a': 2}, lambda k, a, b: 1 / 0)
+
+        Er = HashKey(100, 'Er')
+        A = HashKey(100, 'A', error_on_eq_to=Er)
+        h = self.Map({A: 1})
+        with self.assertRaisesRegex(ValueError, 'cannot compare'):
+            h.merge({Er: 2})
+
+        with self.assertRaises(HashingError):
+            with HashKeyCrasher(error_on_hash=True):
+                h.merge({A: 2})
+
+    def test_map_merge_5(self):
+        h = self.Map({i: i for i in range(100)})
+        h2 = self.Map({i: -i for i in range(50, 150)})
+
+        self.assertEqual(
+            h.update(h2),
+            self.Map({i: i if i < 50 else -i for i in range(150)}))
+
+        with h.mutate() as mm:
+            mm.update(h2)
+            mm.update(self.Map({1: 'a'}))
+            self.assertEqual(len(mm), 150)
+            self.assertEqual(mm[1], 'a')
+            self.assertEqual(mm[99], -99)
+
+    def test_map_diff_1(self):
+        h = self.Map(a=1, b=2, c=3)
+        empty = self.Map()
+
+        self.assertEqual(h.diff(h), (empty, empty, empty))
+        self.assertEqual(
+            h.diff(self.Map(a=1, b=2, c=3)), (empty, empty, empty))
+        self.assertEqual(h.diff(empty), (empty, h, empty))
+        self.assertEqual(empty.diff(h), (h, empty, empty))
+
+        h2 = h.set('a', 10).delete('b').set('d', 4).set('c', 3.0)
+        self.assertEqual(
+            h.diff(h2),
+            (self.Map(d=4), self.Map(b=2), self.Map(a=10)))
+        self.assertEqual(
+            h2.diff(h),
+            (self.Map(b=2), self.Map(d=4), self.Map(a=1)))
+
+    def test_map_diff_2(self):
+        base = self.Map({i: i for i in range(1000)})
+
+        h = base.mutate()
+        for i in range(0, 1000, 100):
+            h[i] = -i - 1
+        for i in range(1, 1000, 100):
+            del h[i]
+        for i in range(1000, 1010):
+            h[i] = i
+        h = h.finish()
+
+        added, removed, changed = base.diff(h)
+        self.assertEqual(added, self.Map({i: i for i in range(1000, 1010)}))
+        self.assertEqual(
+            removed, self.Map({i: i for i in range(1, 1000, 100)}))
+        self.assertEqual(
+            changed, self.Map({i: -i - 1 for i in range(0, 1000, 100)}))
+
+        self.assertEqual(
+            base.diff(self.Map({i: i for i in range(500, 1500)})),
+            (self.Map({i: i for i in range(1000, 1500)}),
+             self.Map({i: i for i in range(500)}),
+             self.Map()))
+
+    def test_map_diff_3(self):
+        A = HashKey(100, 'A')
+        B = HashKey(101, 'B')
+        C = HashKey(100, 'C')
+        D = HashKey(100100, 'D')
+        E = HashKey(100, 'E')
+
+        h1 = self.Map({A: 'a', B: 'b', D: 'd'})
+        h2 = self.Map({C: 'c', B: 'bb', E: 'e', D: 'd'})
+
+        self.assertEqual(
+            h1.diff(h2),
+            (self.Map({C: 'c', E: 'e'}),
+             self.Map({A: 'a'}),
+             self.Map({B: 'bb'})))
+
+        self.assertEqual(
+            h2.diff(h1),
+            (self.Map({A: 'a'}),
+             self.Map({C: 'c', E: 'e'}),
+             self.Map({B: 'b'})))
+
+        h3 = h1.set(C, 'c')
+        self.assertEqual(
+            h3.diff(h1), (self.Map(), self.Map({C: 'c'}), self.Map()))
+
+    def test_map_diff_4(self):
+        h = self.Map(a=1)
+
+        with self.assertRaisesRegex(TypeError, 'must be a Map'):
+            h.diff({'a': 1})
+
+        class BrokenEq:
+            def __eq__(self, other):
+                1 / 0
+
+        with self.assertRaises(ZeroDivisionError):
+            h.diff(self.Map(a=BrokenEq()))
+
+        Er = HashKey(100, 'Er')
+        A = HashKey(100, 'A', error_on_eq_to=Er)
+        with self.assertRaisesRegex(ValueError, 'cannot compare'):
+            self.Map({A: 1}).diff(self.Map({Er: 1}))
+
+    def test_map_keys_setops_1(self):
+        h1 = self.Map(a=1, b=2, c=3)
+        h2 = self.Map(b=20, c=3, d=4)
+
+        keys_type = type(h1.keys())
+
+        res = h1.keys() & h2.keys()
+        self.assertIs(type(res), keys_type)
+        self.assertEqual(set(res), {'b', 'c'})
+        self.assertEqual(len(res), 2)
+
+        res = h1.keys() - h2.keys()
+        self.assertIs(type(res), keys_type)
+        self.assertEqual(set(res), {'a'})
+
+        res = h1.keys() | h2.keys()
+        self.assertIs(type(res), keys_type)
+        self.assertEqual(set(res), {'a', 'b', 'c', 'd'})
+        self.assertEqual(len(res), 4)
+
+        res = h1.keys() ^ h2.keys()
+        self.assertIs(type(res), keys_type)
+        self.assertEqual(set(res), {'a', 'd'})
+
+        self.assertFalse(h1.keys().isdisjoint(h2.keys()))
+        self.assertTrue(h1.keys().isdisjoint(self.Map(z=1).keys()))
+
+        self.assertTrue(h1.keys() <= h1.set('z', 1).keys())
+        self.assertTrue(h1.keys() < h1.set('z', 1).keys())
+        self.assertFalse(h1.keys() < h1.keys())
+        self.assertTrue(h1.keys() >= h1.delete('a').keys())
+        self.assertFalse(h1.keys() <= h2.keys())
+        self.assertTrue(h1.keys() == h1.set('a', 100).keys())
+        self.assertTrue(h1.keys() != h2.keys())
+
+    def test_map_keys_setops_2(self):
+        h = self.Map(a=1, b=2)
+
+        self.assertEqual(h.keys() & ['a', 'z'], {'a'})
+        self.assertEqual(['a', 'z'] & h.keys(), {'a'})
+        self.assertEqual(h.keys() | ['z'], {'a', 'b', 'z'})
+        self.assertEqual({'z'} | h.keys(), {'a', 'b', 'z'})
+        self.assertEqual(h.keys() - {'a'}, {'b'})
+        self.assertEqual({'a', 'z'} - h.keys(), {'z'})
+        self.assertEqual(h.keys() ^ ('a', 'z'), {'b', 'z'})
+        self.assertEqual({'a', 'z'} ^ h.keys(), {'b', 'z'})
+        self.assertEqual(h.keys() & {}.keys(), set())
+
+        self.assertTrue(h.keys().isdisjoint(['z']))
+        self.assertFalse(h.keys().isdisjoint(('a',)))
+        self.assertTrue(h.keys() == {'a', 'b'})
+        self.assertTrue(h.keys() <= {'a', 'b', 'c'})
+        self.assertTrue({'a', 'b', 'c'} > h.keys())
+        self.assertFalse(h.keys() == ['a', 'b'])
+
+        with self.assertRaises(TypeError):
+            h.keys() & 1
+
+        with self.assertRaises(TypeError):
+            h.keys() < ['a']
+
+    def test_map_keys_setops_3(self):
+        base = self.Map({i: i for i in range(1000)})
+
+        h = base.mutate()
+        for i in range(0, 1000, 10):
+            del h[i]
+        for i in range(1000, 1100):
+            h[i] = i
+        h = h.finish()
+
+        self.assertEqual(
+            set(base.keys() & h.keys()),
+            set(range(1000)) - set(range(0, 1000, 10)))
+        self.assertEqual(len(base.keys() & h.keys()), 900)
+        self.assertEqual(
+            set(base.keys() - h.keys()), set(range(0, 1000, 10)))
+        self.assertEqual(
+            set(base.keys() ^ h.keys()),
+            set(range(0, 1000, 10)) | set(range(1000, 1100)))
+        self.assertEqual(len(base.keys() | h.keys()), 1100)
+        self.assertTrue(base.keys() & base.keys() == base.keys())
+        self.assertEqual(len(base.keys() - base.keys()), 0)
+
+        A = HashKey(100, 'A')
+        B = HashKey(101, 'B')
+        C = HashKey(100, 'C')
+        D = HashKey(100100, 'D')
+
+        h1 = self.Map({A: 1, B: 2, C: 3})
+        h2 = self.Map({C: 3, D: 4})
+        self.assertEqual(set(h1.keys() & h2.keys()), {C})
+        self.assertEqual(set(h1.keys() - h2.keys()), {A, B})
+        self.assertEqual(set(h2.keys() - h1.keys()), {D})
+        self.assertEqual(set(h1.keys() ^ h2.keys()), {A, B, D})
+
+    def test_map_keys_setops_4(self):
+        # Keys whose values are None are not dropped.
+        h1 = self.Map(x=None, y=None)
+        h2 = self.Map(x=0, z=None)
+
+        self.assertEqual(set(h1.keys() & h2.keys()), {'x'})
+        self.assertEqual(set(h1.keys() - h2.keys()), {'y'})
+        self.assertFalse(h1.keys().isdisjoint(h2.keys()))
+        self.assertTrue(h1.keys() <= h1.set('z', None).keys())
+        self.assertTrue(h1.keys() == self.Map(x=0, y=0).keys())
+        self.assertEqual(
+            set(h1.items() & self.Map(x=None).items()), {('x', None)})
+        self.assertEqual(set(h1.items() - h2.items()),
+                         {('x', None), ('y', None)})
+
+        base = self.Map({i: None for i in range(1000)})
+        h = base.set(1000, None).delete(0)
+        self.assertEqual(len(base.keys() & h.keys()), 999)
+        self.assertEqual(set(base.keys() - h.keys()), {0})
+        self.assertEqual(len(base.items() & h.items()), 999)
+        self.assertTrue(base.delete(0).keys() <= h.keys())
+
+    def test_map_items_setops_1(self):
+        h1 = self.Map(a=1, b=2, c=3)
+        h2 = self.Map(b=20, c=3, d=4)
+
+        items_type = type(h1.items())
+
+        res = h1.items() & h2.items()
+        self.assertIs(type(res), items_type)
+        self.assertEqual(set(res), {('c', 3)})
+
+        res = h1.items() - h2.items()
+        self.assertIs(type(res), items_type)
+        self.assertEqual(set(res), {('a', 1), ('b', 2)})
+
+        self.assertEqual(
+            h1.items() | h2.items(),
+            {('a', 1), ('b', 2), ('b', 20), ('c', 3), ('d', 4)})
+        self.assertEqual(
+            h1.items() ^ h2.items(),
+            {('a', 1), ('b', 2), ('b', 20), ('d', 4)})
+
+        self.assertFalse(h1.items().isdisjoint(h2.items()))
+        self.assertTrue(
+            h1.items().isdisjoint(h1.set('a', 2).items() - h1.items()))
+        self.assertTrue(h1.items() <= h1.set('z', 1).items())
+        self.assertFalse(h1.items() <= h1.set('a', 2).items())
+        self.assertTrue(h1.items() == self.Map(a=1.0, b=2, c=3).items())
+        self.assertTrue(h1.items() == {('a', 1), ('b', 2), ('c', 3)})
+        self.assertEqual(h1.items() & [('a', 1), ('b', 1)], {('a', 1)})
+
+    def test_map_items_setops_2(self):
+        Er = HashKey(100, 'Er')
+        A = HashKey(100, 'A', error_on_eq_to=Er)
+
+        h1 = self.Map({A: 1})
+        h2 = self.Map({Er: 1})
+
+        with self.assertRaisesRegex(ValueError, 'cannot compare'):
+            h1.keys() & h2.keys()
+
+        with self.assertRaisesRegex(ValueError, 'cannot compare'):
+            h1.items() - h2.items()
+
+        class BrokenEq:
+            def __eq__(self, other):
+                1 / 0
+
+        h = self.Map(a=BrokenEq())
+        with self.assertRaises(ZeroDivisionError):
+            h.items() & self.Map(a=1).items()
+
+    def test_map_args(self):
+        h = self.Map(a=1)
+
+        self.assertEqual(h.get('a'), 1)
+        self.assertEqual(h.get('z', 2), 2)
+        self.assertEqual(h.set('b', 2), self.Map(a=1, b=2))
+
+        with self.assertRaises(TypeError):
+            h.get()
+        with self.assertRaises(TypeError):
+            h.get('a', 1, 2)
+        with self.assertRaises(TypeError):
+            h.set('a')
+        with self.assertRaises(TypeError):
+            h.set('a', 1, 2)
+
+        with self.assertRaises(TypeError):
+            self.Map({}, {})
+        self.assertEqual(self.Map({'a': 1}, b=2), self.Map(a=1, b=2))
+        self.assertEqual(self.Map(h, b=2), self.Map(a=1, b=2))
+        self.assertEqual(self.Map(h), h)
+        self.assertEqual(len(self.Map()), 0)
+
+        with h.mutate() as mm:
+            self.assertEqual(mm.get('a'), 1)
+            self.assertEqual(mm.get('z', 2), 2)
+            mm.set('z', 100)
+            self.assertEqual(mm.pop('z'), 100)
+            self.assertEqual(mm.pop('z', 200), 200)
+
+            with self.assertRaises(TypeError):
+                mm.set('a')
+            with self.assertRaises(TypeError):
+                mm.pop()
+            with self.assertRaises(TypeError):
+                mm.pop('a', 1, 2)
+
+    def test_map_get_many_1(self):
+        h = self.Map(a=1, b=2, c=3)
+
+        self.assertEqual(h.get_many(['a', 'c', 'z']), [1, 3, None])
+        self.assertEqual(h.get_many(('z', 'a'), 0), [0, 1])
+        self.assertEqual(h.get_many(iter('ab'), default=0), [1, 2])
+        self.assertEqual(h.get_many([]), [])
+        self.assertEqual(self.Map().get_many(['a']), [None])
+
+        keys = list(range(0, 2000, 7))
+        h = self.Map({i: str(i) for i in range(1000)})
+        self.assertEqual(
+            h.get_many(keys),
+            [str(i) if i < 1000 else None for i in keys])
+
+        with self.assertRaises(TypeError):
+            h.get_many(1)
+
+        with self.assertRaisesRegex(TypeError, 'unhashable'):
+            h.get_many([[]])
+
+    def test_map_get_many_2(self):
+        A = HashKey(100, 'A')
+        B = HashKey(101, 'B')
+        C = HashKey(100, 'C')
+
+        h = self.Map({A: 'a', B: 'b'})
+        self.assertEqual(h.get_many([A, B, C]), ['a', 'b', None])
+
+        with self.assertRaises(HashingError):
+            with HashKeyCrasher(error_on_hash=True):
+                h.get_many([A])
+
+    def test_map_get_many_3(self):
+        # Keys' __eq__ can modify the list of keys that are looked up.
+        class Key:
+            def __init__(self, keys=None):
+                self.keys = keys
+
+            def __hash__(self):
+                return 1
+
+            def __eq__(self, other):
+                for key in (self, other):
+                    if key.keys is not None:
+                        key.keys.clear()
+                return self is other
+
+        h = self.Map({Key(): 1, Key(): 2, Key(): 3})
+
+        keys = []
+        keys.extend([Key(keys)] + list(h))
+        self.assertEqual(h.get_many(keys), [None])
+
+        keys = []
+        keys.extend([Key(keys)] + list(h))
+        self.assertEqual(h.take(keys), self.Map())
+
+    def test_map_take_1(self):
+        h = self.Map(a=1, b=2, c=3)
+
+        self.assertEqual(h.take(['a', 'c', 'z']), self.Map(a=1, c=3))
+        self.assertEqual(h.take(iter(['z'])), self.Map())
+        self.assertEqual(h.take([]), self.Map())
+        self.assertEqual(h.take('aa'), self.Map(a=1))
+        self.assertIs(h.take(['c', 'b', 'a']), h)
+        self.assertEqual(len(h.take(['a', 'a', 'b'])), 2)
+
+        h = self.Map({i: str(i) for i in range(1000)})
+        h2 = h.take(range(0, 2000, 7))
+        self.assertEqual(
+            h2, self.Map({i: str(i) for i in range(0, 1000, 7)}))
+        self.assertEqual(h2.set(1, '1')[1], '1')
+
+        with self.assertRaises(TypeError):
+            h.take(1)
+
+        A = HashKey(100, 'A')
+        B = HashKey(101, 'B')
+        C = HashKey(100, 'C')
+        D = HashKey(100, 'D')
+
+        h = self.Map({A: 'a', B: 'b', C: 'c'})
+        self.assertEqual(h.take([A, C, D]), self.Map({A: 'a', C: 'c'}))
+
+        with self.assertRaises(HashingError):
+            with HashKeyCrasher(error_on_hash=True):
+                h.take([A])
+
+    def test_map_delete_many_1(self):
+        h = self.Map(a=1, b=2, c=3)
+
+        self.assertEqual(h.delete_many(['a', 'c', 'z']), self.Map(b=2))
+        self.assertEqual(h.delete_many(iter(['a', 'a'])), self.Map(b=2, c=3))
+        self.assertEqual(h.delete_many('abc'), self.Map())
+        self.assertIs(h.delete_many([]), h)
+        self.assertIs(h.delete_many(['x', 'y']), h)
+        e = self.Map()
+        self.assertIs(e.delete_many(['x']), e)
+
+        with self.assertRaisesRegex(KeyError, 'z'):
+            h.delete_many(['a', 'z'], missing_ok=False)
+        with self.assertRaisesRegex(KeyError, 'x'):
+            self.Map().delete_many(['x'], missing_ok=False)
+        self.assertEqual(
+            h.delete_many(['a', 'b'], missing_ok=False), self.Map(c=3))
+
+        with self.assertRaises(TypeError):
+            h.delete_many(1)
+
+        h = self.Map({i: str(i) for i in range(1000)})
+        h2 = h.delete_many(range(0, 2000, 7))
+        self.assertEqual(
+            h2, self.Map({i: str(i) for i in range(1000) if i % 7}))
+        self.assertEqual(len(h2), 857)
+        self.assertEqual(h2.set(7, '7')[7], '7')
+        self.assertEqual(h2.delete_many(range(1000)), self.Map())
+        self.assertEqual(h, self.Map({i: str(i) for i in range(1000)}))
+
+        A = HashKey(100, 'A')
+        B = HashKey(101, 'B')
+        C = HashKey(100, 'C')
+        D = HashKey(100, 'D')
+
+        h = self.Map({A: 'a', B: 'b', C: 'c'})
+        self.assertEqual(h.delete_many([A, D]), self.Map({B: 'b', C: 'c'}))
+        self.assertEqual(h.delete_many([C, B]), self.Map({A: 'a'}))
+
+        with self.assertRaises(HashingError):
+            with HashKeyCrasher(error_on_hash=True):
+                h.delete_many([A])
+
+        with self.assertRaises(EqError):
+            with HashKeyCrasher(error_on_eq=True):
+                h.delete_many([D])
+
+        h = self.Map({i: None for i in range(100)})
+        self.assertIs(h.delete_many(range(1000, 1100)), h)
+        h2 = h.delete_many(range(0, 100, 2))
+        self.assertEqual(h2, self.Map({i: None for i in range(1, 100, 2)}))
+        with h.mutate() as mm:
+            mm.delete_many([0, 1000])
+            self.assertEqual(len(mm), 99)
+            self.assertEqual(dict(mm.finish().items()),
+                             {i: None for i in range(1, 100)})
+
+    def test_map_delete_many_2(self):
+        h = self.Map({i: str(i) for i in range(100)})
+
+        with h.mutate() as mm:
+            mm.delete_many(range(0, 200, 3))
+            self.assertEqual(len(mm), 66)
+            self.assertNotIn(3, mm)
+            self.assertEqual(mm[4], '4')
+
+            mm[3] = 'three'
+            del mm[4]
+            mm.delete_many([5, 1000])
+
+            with self.assertRaisesRegex(KeyError, '1000'):
+                mm.delete_many([1, 1000], missing_ok=False)
+            self.assertEqual(len(mm), 65)
+
+            h2 = mm.finish()
+
+        d = {i: str(i) for i in range(100) if i % 3 and i not in (4, 5)}
+        d[3] = 'three'
+        self.assertEqual(h2, self.Map(d))
+        self.assertEqual(len(h), 100)
+
+        with self.assertRaisesRegex(ValueError, 'has been finished'):
+            mm.delete_many([1])
+
+        mm = h2.mutate()
+        mm.delete_many(list(h2))
+        self.assertEqual(len(mm), 0)
+        mm['a'] = 1
+        self.assertEqual(mm.finish(), self.Map(a=1))
+
+
+    def test_map_filter_1(self):
+        h = self.Map(a=1, b=2, c=3, d=4)
+
+        self.assertEqual(h.filter(lambda k, v: v % 2), self.Map(a=1, c=3))
+        self.assertEqual(
+            h.filter_keys(lambda k: k in 'bd'), self.Map(b=2, d=4))
+        self.assertEqual(h.filter(lambda k, v: False), self.Map())
+        self.assertIs(h.filter(lambda k, v: True), h)
+        self.assertIs(h.filter_keys(lambda k: 1), h)
+
+        e = self.Map()
+        self.assertIs(e.filter(lambda k, v: 1 / 0), e)
+
+        with self.assertRaises(ZeroDivisionError):
+            h.filter(lambda k, v: 1 / 0)
+        with self.assertRaises(TypeError):
+            h.filter_keys(lambda k, v: True)
+
+        h = self.Map({i: str(i) for i in range(1000)})
+        h2 = h.filter(lambda k, v: k % 7 == 0 or v.endswith('3'))
+        self.assertEqual(h2, self.Map(
+            {i: str(i) for i in range(1000) if i % 7 == 0 or i % 10 == 3}))
+        self.assertEqual(len(h2), 229)
+        self.assertEqual(h2.set(1, '1')[1], '1')
+        self.assertEqual(len(h2.delete(0)), 228)
+
+        h3 = h.filter_keys(lambda k: k < 5)
+        self.assertEqual(h3, self.Map({i: str(i) for i in range(5)}))
+        self.assertEqual(len(h3), 5)
+
+        A = HashKey(100, 'A')
+        B = HashKey(101, 'B')
+        C = HashKey(100, 'C')
+        D = HashKey(100, 'D')
+
+        h = self.Map({A: 'a', B: 'b', C: 'c', D: 'd'})
+        self.assertEqual(
+            h.filter_keys(lambda k: k.name != 'C'),
+            self.Map({A: 'a', B: 'b', D: 'd'}))
+        self.assertEqual(
+            h.filter(lambda k, v: v in 'bc'), self.Map({B: 'b', C: 'c'}))
+        self.assertEqual(
+            h.filter(lambda k, v: v == 'a'), self.Map({A: 'a'}))
+
+    def test_map_map_values_1(self):
+        h = self.Map(a=1, b=2, c=3)
+
+        self.assertEqual(h.map_values(lambda v: v * 10),
+                         self.Map(a=10, b=20, c=30))
+        self.assertIs(h.map_values(lambda v: v), h)
+
+        e = self.Map()
+        self.assertIs(e.map_values(lambda v: 1 / 0), e)
+
+        with self.assertRaises(ZeroDivisionError):
+            h.map_values(lambda v: 1 / 0)
+
+        h = self.Map({i: str(i) for i in range(1000)})
+        h2 = h.map_values(lambda v: v if v != '500' else 'x')
+        self.assertEqual(len(h2), 1000)
+        self.assertEqual(h2[500], 'x')
+        self.assertEqual(h2.delete(500), h.delete(500))
+        self.assertEqual(h, self.Map({i: str(i) for i in range(1000)}))
+
+        self.assertEqual(
+            h.map_values(int), self.Map({i: i for i in range(1000)}))
+
+        A = HashKey(100, 'A')
+        B = HashKey(101, 'B')
+        C = HashKey(100, 'C')
+
+        h = self.Map({A: 'a', B: 'b', C: 'c'})
+        self.assertEqual(h.map_values(str.upper),
+                         self.Map({A: 'A', B: 'B', C: 'C'}))
+        h2 = h.map_values(lambda v: v if v != 'c' else 'x')
+        self.assertEqual(h2, self.Map({A: 'a', B: 'b', C: 'x'}))
+        self.assertIs(h2.map_values(lambda v: v), h2)
+
+    def test_map_split_1(self):
+        h = self.Map({i: str(i) for i in range(1000)})
+
+        for n in [2, 3, 7, 32, 100, 999, 1000, 5000]:
+            parts = h.split(n)
+            self.assertEqual(len(parts), min(n, 1000))
+            sizes = [len(p) for p in parts]
+            self.assertEqual(sum(sizes), 1000)
+            self.assertLessEqual(max(sizes) - min(sizes), 1)
+
+            merged = {}
+            for p in parts:
+                self.assertEqual(len(list(p.items())), len(p))
+                merged.update(p.items())
+            self.assertEqual(merged, dict(h.items()))
+
+        self.assertEqual(h.split(1), [h])
+        self.assertIs(h.split(1)[0], h)
+        self.assertEqual(self.Map().split(5), [])
+        self.assertEqual(self.Map(a=1).split(5), [self.Map(a=1)])
+
+        h2 = self.Map(a=1, b=2, c=3)
+        parts = h2.split(2)
+        self.assertEqual([len(p) for p in parts], [2, 1])
+        self.assertEqual(parts[0].update(parts[1]), h2)
+
+        p = h.split(3)[1]
+        self.assertEqual(p.set('x', 1)['x'], 1)
+        self.assertEqual(len(p.delete(next(iter(p)))), len(p) - 1)
+
+        with self.assertRaises(ValueError):
+            h.split(0)
+        with self.assertRaises(TypeError):
+            h.split(2.0)
+
+    def test_map_split_2(self):
+        A = HashKey(100, 'A')
+        B = HashKey(101, 'B')
+        C = HashKey(100, 'C')
+        D = HashKey(100, 'D')
+
+        # Collision nodes are never split.
+        h = self.Map({A: 'a', B: 'b', C: 'c', D: 'd'})
+        parts = h.split(4)
+        self.assertEqual(sorted(len(p) for p in parts), [1, 3])
+        self.assertEqual(parts[0].update(parts[1]), h)
+
+        h = self.Map({A: 'a', C: 'c', D: 'd'})
+        self.assertEqual(h.split(3), [h])
+        self.assertIs(h.split(3)[0], h)
+        self.assertEqual(h.partitions(), [h])
+
+    def test_map_split_3(self):
+        # Subtree counts are memoized; check that they stay exact in
+        # derived Maps and in Maps built by mutations.
+        h = self.Map({i: i for i in range(5000)})
+        self.assertEqual(sum(len(p) for p in h.split(3)), 5000)
+
+        def check(m, expected):
+            self.assertEqual(len(m), len(expected))
+            for n in [2, 5, 64]:
+                parts = m.split(n)
+                sizes = [len(p) for p in parts]
+                self.assertEqual(sum(sizes), len(expected))
+                self.assertLessEqual(max(sizes) - min(sizes), 1)
+                merged = {}
+                for p in parts:
+                    merged.update(p.items())
+                self.assertEqual(merged, expected)
+            self.assertEqual(
+                sum(len(p) for p in m.partitions()), len(expected))
+
+        expected = dict(h.items())
+        h2 = h.set(5000, 0).delete(7).delete(4000)
+        expected[5000] = 0
+        del expected[7], expected[4000]
+        check(h2, expected)
+
+        with h2.mutate() as mm:
+            for i in range(0, 5000, 3):
+                mm.pop(i, None)
+                expected.pop(i, None)
+            mm.delete_many(range(1, 100, 3))
+            for i in range(1, 100, 3):
+                expected.pop(i, None)
+            for i in range(6000, 6500):
+                mm[i] = i
+                expected[i] = i
+            h3 = mm.finish()
+        check(h3, expected)
+
+        with h3.mutate() as mm:
+            mm.delete_many(range(6000, 6100))
+            for i in range(6000, 6100):
+                del expected[i]
+            for i in range(2, 2000, 3):
+                del mm[i]
+                del expected[i]
+            h3 = mm.finish()
+        check(h3, expected)
+        merged = dict(h2.items())
+        merged.update(expected)
+        check(h2.merge(h3), merged)
+
+    def test_map_partitions_1(self):
+        h = self.Map({i: str(i) for i in range(1000)})
+
+        parts = h.partitions()
+        self.assertEqual(len(parts), 32)
+        self.assertEqual(sum(len(p) for p in parts), 1000)
+        for i, p in enumerate(parts):
+            self.assertEqual(set(p), set(range(i, 1000, 32)))
+
+        self.assertEqual(self.Map().partitions(), [])
+        self.assertEqual(
+            self.Map(a=1).partitions(), [self.Map(a=1)])
+
+    def test_map_threads_1(self):
+        import threading
+
+        h = self.Map({str(i): i for i in range(1000)})
+        expected = {}
+        for i in range(0, 1000, 7):
+            expected[i] = hash(h.set(str(i), -i))
+
+        errors = []
+        barrier = threading.Barrier(4)
+
+        def worker():
+            barrier.wait()
+            try:
+                for i in range(0, 1000, 7):
+                    h2 = h.set(str(i), -i)
+                    self.assertEqual(hash(h2), expected[i])
+                    self.assertEqual(h2[str(i)], -i)
+                    self.assertEqual(h[str(i)], i)
+
+                    with h2.mutate() as mm:
+                        mm[str(i)] = i
+                        del mm[str(i + 1)]
+                    self.assertEqual(mm.finish(), h.delete(str(i + 1)))
+            except BaseException as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(h), 1000)
+
 
 class PyMapTest(BaseMapTest, unittest.TestCase):
 
@@ -1371,12 +2611,436 @@ try:
 except ImportError:
     CMap = None
 
+try:
+    import _interpreters as interpreters
+except ImportError:
+    try:
+        import _xxsubinterpreters as interpreters
+    except ImportError:
+        interpreters = None
+
 
 @unittest.skipIf(CMap is None, 'C Map is not available')
 class CMapTest(BaseMapTest, unittest.TestCase):
 
     Map = CMap
 
+    def assertNodesTracked(self, h, tracked):
+        nodes = [h]
+        while nodes:
+            node = nodes.pop()
+            self.assertEqual(gc.is_tracked(node), tracked, node)
+            nodes.extend(
+                obj for obj in gc.get_referents(node)
+                if type(obj).__name__.endswith('_node'))
+
+    def test_map_gc_tracking_1(self):
+        A = HashKey(100, 'A')
+
+        h = self.Map({i: str(i) for i in range(1000)})
+        self.assertNodesTracked(h, False)
+        self.assertNodesTracked(self.Map(), False)
+        self.assertNodesTracked(self.Map(a=(1, 2), b=None), False)
+
+        h2 = h.set('a', [])
+        self.assertTrue(gc.is_tracked(h2))
+        self.assertNodesTracked(h, False)
+
+        h3 = h2.delete('a')
+        self.assertNodesTracked(h3, False)
+
+        # Maps, unlike tuples, are never trusted to stay untracked.
+        self.assertTrue(gc.is_tracked(self.Map(a=self.Map())))
+        self.assertTrue(gc.is_tracked(self.Map({A: 1})))
+        self.assertTrue(gc.is_tracked(self.Map({1: A})))
+
+    def test_map_gc_tracking_2(self):
+        h = self.Map({i: i for i in range(100)})
+
+        with h.mutate() as mm:
+            mm[1000] = [mm]
+            self.assertTrue(gc.is_tracked(mm))
+            h2 = mm.finish()
+        self.assertTrue(gc.is_tracked(h2))
+
+        with h2.mutate() as mm:
+            del mm[1000]
+            mm[1001] = 1
+            h3 = mm.finish()
+        self.assertNodesTracked(h3, False)
+
+        self.assertNodesTracked(h.update({1000: 1}, a=2), False)
+        self.assertTrue(gc.is_tracked(h.update({1000: []})))
+        self.assertNodesTracked(h.merge({1000: 1}), False)
+        self.assertTrue(gc.is_tracked(h.merge({1000: {}})))
+
+        h4 = self.Map()
+        self.assertFalse(gc.is_tracked(h4))
+        h4.__init__(a=[])
+        self.assertTrue(gc.is_tracked(h4))
+
+    def test_map_stats_flat(self):
+        h = self.Map({i: i for i in range(8)})
+        self.assertEqual(h.stats(), {
+            'bitmap_nodes': 0,
+            'array_nodes': 0,
+            'collision_nodes': 0,
+            'depths': [8],
+            'fill': 0.0,
+            'bytes': h.__sizeof__(),
+        })
+
+        h = h.set(8, 8)
+        stats = h.stats()
+        self.assertEqual(stats['bitmap_nodes'], 1)
+        self.assertEqual(stats['depths'], [9])
+        self.assertEqual(stats['fill'], 9 / 32)
+        self.assertGreater(stats['bytes'], self.Map().__sizeof__())
+
+        stats = self.Map({i: i for i in range(10000)}).stats()
+        self.assertGreater(stats['array_nodes'], 0)
+        self.assertEqual(stats['depths'][0], 0)
+
+    def test_map_collision_no_eq(self):
+        # Keys in a Collision node are only compared with __eq__ when
+        # their full hashes are equal.
+        keys = [HashKey((i << 32) | (5 ^ i), str(i)) for i in range(1, 50)]
+        h = self.Map()
+        for i, key in enumerate(keys):
+            h = h.set(key, i)
+        h2 = self.Map(zip(keys, range(49)))
+
+        with HashKeyCrasher(error_on_eq=True):
+            for i, key in enumerate(keys):
+                self.assertEqual(h[key], i)
+                self.assertEqual(h2[key], i)
+            self.assertIsNone(h.get(HashKey(70 << 32 | (5 ^ 70), 'x')))
+            h = h.delete(keys[10])
+            h = h.set(HashKey(80 << 32 | (5 ^ 80), 'y'), 1)
+            with self.assertRaises(EqError):
+                h.get(HashKey(keys[0].hash, keys[0].name))
+        self.assertEqual(len(h), 49)
+
+    def test_map_canonical_shape(self):
+        # The shape of the tree only depends on the keys it holds
+        # (Maps with up to 8 keys can be flat and have no tree).
+
+        def dump(h):
+            return re.sub(r'id=0x[0-9a-f]+', '', h.__dump__())
+
+        rnd = random.Random(13)
+        hashes = rnd.sample(range(1 << 12), 300)
+        # Keys that only differ in the upper 32 bits of their hashes
+        # share a Collision node unless the full hashes are used.
+        hashes += [(i << 32) | hashes[0] for i in range(1, 4)]
+        keys = [HashKey(h, str(h)) for h in hashes]
+        extra = [HashKey(h, 'extra') for h in hashes[::7]]
+        expected = {key: i for i, key in enumerate(keys)}
+
+        for size in [9, 17, 40, 303]:
+            items = dict(list(expected.items())[-size:])
+            shape = dump(self.Map(items))
+
+            h = self.Map()
+            order = list(items)
+            rnd.shuffle(order)
+            for key in order:
+                h = h.set(key, items[key])
+            self.assertEqual(dump(h), shape)
+
+            h = self.Map(items).update(dict.fromkeys(extra))
+            for key in extra:
+                h = h.delete(key)
+            self.assertEqual(dump(h), shape)
+
+            with self.Map(dict.fromkeys(extra + order)).mutate() as mm:
+                for key in extra:
+                    del mm[key]
+                mm.update(items)
+                h = mm.finish()
+            self.assertEqual(dump(h), shape)
+
+            half = len(order) // 2
+            h = self.Map({key: items[key] for key in order[:half]})
+            h = h.update(dict.fromkeys(order[half::2])).merge(
+                {key: items[key] for key in order[half:]})
+            self.assertEqual(dump(h), shape)
+
+    def test_map_eq_shape(self):
+        A = HashKey(1, 'A')
+        B = HashKey(2, 'B')
+        C = HashKey(3, 'C')
+        D = HashKey(100, 'D')
+
+        h1 = self.Map({A: 1, B: 2})
+        h2 = self.Map({A: 1, C: 2})
+        h3 = self.Map({A: 1, B: 2, C: 3})
+        h4 = self.Map({A: 1, B: 2, D: 3})
+
+        # Maps of the same size with different shapes are never
+        # equal, and are compared without calling __eq__.
+        with HashKeyCrasher(error_on_eq=True):
+            self.assertNotEqual(h1, h2)
+            self.assertNotEqual(h3, h4)
+
+        self.assertEqual(h3, h4.delete(D).set(C, 3))
+        self.assertEqual(h3.delete(C), h1)
+
+    def assertFlat(self, h, flat):
+        self.assertEqual('FlatMap' in h.__dump__(), flat)
+
+    def test_map_flat_1(self):
+        keys = [HashKey(i, str(i)) for i in range(20)]
+
+        h = self.Map()
+        self.assertFlat(h, True)
+        for i, key in enumerate(keys):
+            h = h.set(key, i)
+            self.assertFlat(h, i < 8)
+            self.assertEqual(len(h), i + 1)
+            self.assertEqual(dict(h.items()), dict(zip(keys, range(i + 1))))
+
+        self.assertFlat(self.Map(zip(keys[:8], range(8))), True)
+        self.assertFlat(self.Map(zip(keys[:9], range(9))), False)
+        self.assertFlat(self.Map(dict.fromkeys(keys[:8]), a=1), False)
+        self.assertFlat(self.Map(dict.fromkeys(keys[:7]), a=1), True)
+        self.assertFlat(self.Map(x for x in zip(keys[:5], range(5))), True)
+
+        h = self.Map(zip(keys[:8], range(8)))
+        self.assertIs(h.set(keys[3], 3), h)
+        h2 = h.set(keys[3], 'x')
+        self.assertFlat(h2, True)
+        self.assertEqual(h2[keys[3]], 'x')
+        self.assertEqual(h[keys[3]], 3)
+
+        for key in keys[:8]:
+            h = h.delete(key)
+            self.assertFlat(h, True)
+            self.assertNotIn(key, h)
+        self.assertEqual(len(h), 0)
+        with self.assertRaises(KeyError):
+            h.delete(keys[0])
+
+    def test_map_flat_2(self):
+        keys = [HashKey(i, str(i)) for i in range(12)]
+        items = dict(zip(keys, range(12)))
+
+        flat = self.Map(zip(keys[:8], range(8)))
+        tree = self.Map(items)
+        self.assertFlat(tree, False)
+        for key in keys[8:]:
+            tree = tree.delete(key)
+
+        # Trees that shrink are flattened (with their keys in
+        # a different order).
+        self.assertFlat(flat, True)
+        self.assertFlat(tree, True)
+        self.assertEqual(list(tree), sorted(keys[:8], key=hash))
+        self.assertEqual(flat, tree)
+        self.assertEqual(tree, flat)
+        self.assertEqual(hash(flat), hash(tree))
+        self.assertNotEqual(flat.set(keys[0], 'x'), tree)
+        self.assertNotEqual(tree, flat.delete(keys[0]).set(keys[9], 0))
+
+        self.assertEqual(flat.update(items), self.Map(items))
+        self.assertEqual(flat.merge(items), self.Map(items))
+        self.assertEqual(self.Map(items).merge(flat), self.Map(items))
+        self.assertEqual(
+            flat.merge({keys[0]: 10}, resolve=lambda k, a, b: a + b)[keys[0]],
+            10)
+        self.assertIs(flat.merge(self.Map({keys[0]: 0})), flat)
+        self.assertEqual(flat.diff(tree), (self.Map(), self.Map(), self.Map()))
+        self.assertEqual(
+            self.Map(items).diff(flat)[1],
+            self.Map(zip(keys[8:], range(8, 12))))
+        self.assertEqual(flat.keys() & tree.keys(), set(keys[:8]))
+        self.assertIs(flat.take(keys), flat)
+
+        with flat.mutate() as mm:
+            mm[keys[8]] = 8
+            del mm[keys[0]]
+            h = mm.finish()
+        self.assertEqual(h, self.Map(zip(keys[1:9], range(1, 9))))
+
+    def test_map_flat_3(self):
+        A = HashKey(1, 'A')
+        B = HashKey(1, 'B')
+        C = HashKey(2, 'C')
+
+        h = self.Map({A: 1, C: 2})
+        with HashKeyCrasher(error_on_eq=True):
+            # Keys with different hashes are never compared.
+            self.assertEqual(h.set(C, 3)[C], 3)
+            self.assertIsNone(h.get(HashKey(3, 'D')))
+            with self.assertRaises(EqError):
+                h.set(B, 3)
+
+        h = h.set(B, 3)
+        self.assertEqual(len(h), 3)
+        self.assertEqual(h[A], 1)
+        self.assertEqual(h[B], 3)
+
+        h4 = self.Map(a=1)
+        h4.__init__({'b': 2, 'c': 3})
+        self.assertEqual(h4, self.Map(a=1, b=2, c=3))
+        h4.__init__(self.Map(x=1))
+        self.assertEqual(h4, self.Map(x=1))
+
+    def test_map_flat_4(self):
+        keys = [HashKey(i, str(i)) for i in range(40)]
+        items = dict(zip(keys, range(40)))
+        h = self.Map(items)
+        small = self.Map(zip(keys[:5], range(5)))
+
+        mm = h.mutate()
+        for key in keys[8:]:
+            del mm[key]
+
+        with HashKeyCrasher(error_on_hash=True):
+            # Trees are flattened without hashing their keys again.
+            h8 = mm.finish()
+            self.assertFlat(h8, True)
+            self.assertEqual(len(h.keys() & small.keys()), 5)
+            self.assertEqual(len(h.items() - h8.items()), 32)
+            self.assertFlat(h.diff(h8)[1], False)
+
+            with h8.mutate() as mm:
+                mm.update(h)
+                h9 = mm.finish()
+            self.assertFlat(h9, False)
+            self.assertEqual(h9, h)
+
+        self.assertEqual(h8, self.Map(zip(keys[:8], range(8))))
+        self.assertEqual(h8.set(keys[8], 8).delete(keys[8]), h8)
+        self.assertFlat(h8.set(keys[8], 8).delete(keys[0]), True)
+
+    def test_map_transform_shares_nodes(self):
+        def nodes(obj):
+            return [o for o in gc.get_referents(obj)
+                    if type(o).__name__.endswith('_node')]
+
+        h = self.Map({i: i for i in range(1000)})
+        root, = nodes(h)
+        children = {id(node) for node in nodes(root)}
+
+        for h2 in [h.map_values(lambda v: -v if v == 500 else v),
+                   h.filter_keys(lambda k: k != 500),
+                   h.filter(lambda k, v: v != 500)]:
+            new_root, = nodes(h2)
+            new_children = {id(node) for node in nodes(new_root)}
+            self.assertEqual(len(new_children), len(children))
+            self.assertEqual(len(new_children & children), len(children) - 1)
+
+    def test_map_split_shares_nodes(self):
+        def nodes(obj):
+            return [o for o in gc.get_referents(obj)
+                    if type(o).__name__.endswith('_node')]
+
+        h = self.Map({i: i for i in range(1000)})
+        root, = nodes(h)
+        children = {id(node) for node in nodes(root)}
+
+        for n in [2, 3, 5]:
+            shared = 0
+            for part in h.split(n):
+                part_root, = nodes(part)
+                shared += len(
+                    {id(node) for node in nodes(part_root)} & children)
+            # Only the nodes on the boundaries between parts are copied.
+            self.assertGreaterEqual(shared, len(children) - (n - 1))
+
+    def test_map_stored_hashes(self):
+        keys = [HashKey(i, str(i)) for i in range(100)]
+        h = self.Map(zip(keys[:60], range(60)))
+        h2 = self.Map(zip(keys[40:], range(40, 100)))
+
+        with HashKeyCrasher(error_on_hash=True):
+            # Keys are not hashed again when they are moved to new
+            # levels of the tree, or when trees are combined.
+            h3 = h.set(5 + 32 * 3, 'a').set(7 + 32 * 64, 'b')
+            self.assertEqual(len(h3), 62)
+            self.assertEqual(len(h.update(h2)), 100)
+            self.assertEqual(len(h.merge(h2)), 100)
+            self.assertEqual(len(h.merge(h2, resolve=lambda k, a, b: a)), 100)
+            self.assertEqual(len(h.diff(h2)[0]), 40)
+            self.assertEqual(len(h.keys() & h2.keys()), 20)
+            self.assertEqual(len(h.items() - h2.items()), 40)
+            self.assertEqual(len(self.Map(h2)), 60)
+            with h.mutate() as mm:
+                mm.update(h2)
+                self.assertEqual(len(mm.finish()), 100)
+
+        with HashKeyCrasher(error_on_eq=True):
+            # Keys with different hashes are never compared.
+            self.assertEqual(h3[5 + 32 * 3], 'a')
+            self.assertIsNone(h.get(HashKey(7 + 32 * 64, 'x')))
+            with self.assertRaises(KeyError):
+                h.delete(HashKey(5 + 32 * 64, 'x'))
+
+    def test_map_flat_gc(self):
+        class Obj:
+            pass
+
+        self.assertFalse(gc.is_tracked(self.Map(a=1, b=(1, 'a'))))
+        self.assertTrue(gc.is_tracked(self.Map(a=1, b=[])))
+
+        obj = Obj()
+        h = self.Map(a=obj)
+        self.assertFlat(h, True)
+        obj.h = h
+        ref = weakref.ref(obj)
+        del h, obj
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_map_module_instances(self):
+        # Every instance of the extension module gets its own types,
+        # freelists and mutid counter.
+        spec = importlib.util.find_spec('immutables._map')
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        if sys.version_info >= (3, 9):
+            self.assertIsNot(mod.Map, self.Map)
+
+        h = mod.Map({i: str(i) for i in range(1000)}).set('a', 1)
+        with h.mutate() as mm:
+            del mm[0]
+            mm['b'] = 2
+            h2 = mm.finish()
+        self.assertEqual(len(h2), 1001)
+        self.assertEqual(set(h2.keys() - h.keys()), {'b'})
+        self.assertEqual(dict(h2.items()), dict(h.delete(0).set('b', 2)))
+        self.assertEqual(mod.Atom(h).swap(mod.Map.delete, 'a'), h.delete('a'))
+
+        self.assertEqual(len(self.Map({i: i for i in range(100)})), 100)
+
+    @unittest.skipIf(interpreters is None, 'subinterpreters are not available')
+    def test_map_subinterpreter(self):
+        code = textwrap.dedent("""\
+            import sys
+            sys.path.insert(0, {path!r})
+            from immutables._map import Map, Atom
+
+            h = Map({{i: str(i) for i in range(1000)}})
+            with h.mutate() as mm:
+                for i in range(500):
+                    del mm[i]
+                h2 = mm.finish()
+            assert len(h2) == 500, h2
+            assert dict(h.update(h2)) == dict(h), h
+            assert len(h.keys() & h2.keys()) == 500
+            assert Atom(h2).swap(Map.set, 'a', 1)['a'] == 1
+        """).format(path=os.path.dirname(os.path.dirname(
+            sys.modules[CMap.__module__].__file__)))
+
+        interp = interpreters.create()
+        try:
+            # Failures are raised on Python 3.12 and older, and are
+            # returned on newer versions.
+            self.assertIsNone(interpreters.run_string(interp, code))
+        finally:
+            interpreters.destroy(interp)
+
 
 if __name__ == "__main__":
     unittest.main()
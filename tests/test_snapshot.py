@@ -0,0 +1,212 @@
+import decimal
+import enum
+import fractions
+import os
+import pickle
+import sys
+import tempfile
+import unittest
+
+from immutables.map import Map as PyMap
+from immutables.snapshot import MapSnapshot, write_snapshot
+
+
+class MyStr(str):
+    pass
+
+
+class MyInt(enum.IntEnum):
+    ONE = 1
+
+
+class BaseSnapshotTest:
+
+    Map = None
+
+    def setUp(self):
+        self.path = self.make_path()
+
+    def make_path(self):
+        fd, path = tempfile.mkstemp(suffix='.snapshot')
+        os.close(fd)
+        # Cleanups run in reverse order, so snapshots opened later are
+        # closed before their files are removed (Windows can't remove
+        # files that are mapped).
+        self.addCleanup(os.unlink, path)
+        return path
+
+    def snapshot(self, m, path=None):
+        # Every snapshot gets its own file by default: mapped files
+        # can't be replaced on Windows.
+        if path is None:
+            path = self.make_path()
+        write_snapshot(m, path)
+        s = MapSnapshot(path)
+        self.addCleanup(s.close)
+        return s
+
+    def test_snapshot_1(self):
+        d = {
+            'a': 1,
+            b'b': 'B',
+            3: b'c',
+            -2 ** 100: 2 ** 100,
+            0: -1,
+            '': b'',
+            'snow☃ \udc80': 'x' * 1000,
+        }
+        h = self.Map(d)
+        s = self.snapshot(h)
+
+        self.assertEqual(len(s), len(d))
+        self.assertEqual(list(s), list(h))
+        self.assertEqual(list(s.keys()), list(h.keys()))
+        self.assertEqual(list(s.values()), list(h.values()))
+        self.assertEqual(list(s.items()), list(h.items()))
+        self.assertEqual(self.Map(s.items()), h)
+        self.assertEqual(s, d)
+
+        for key, val in d.items():
+            self.assertEqual(s[key], val)
+            self.assertEqual(type(s[key]), type(val))
+            self.assertEqual(s.get(key), val)
+            self.assertIn(key, s)
+
+        for key in ['b', b'a', 1, 2 ** 100, 1.5, None, ('a',)]:
+            self.assertNotIn(key, s)
+            self.assertIsNone(s.get(key))
+            self.assertEqual(s.get(key, 'default'), 'default')
+            with self.assertRaises(KeyError):
+                s[key]
+
+        with self.assertRaises(TypeError):
+            s[['a']]
+
+        self.assertEqual(s[MyStr('a')], 1)
+        self.assertEqual(s[False], -1)
+        self.assertNotIn(MyInt.ONE, s)
+        self.assertEqual(self.snapshot(self.Map({1: 'one'}))[MyInt.ONE], 'one')
+
+    def test_snapshot_numeric_keys(self):
+        # Numbers equal to an int key are found, like in Maps.
+        h = self.Map({1: 'one', -5: 'minus five', 2 ** 70: 'big'})
+        s = self.snapshot(h)
+
+        for key in [1.0, True, decimal.Decimal(1), fractions.Fraction(1),
+                    1 + 0j, -5.0, decimal.Decimal('-5.000'),
+                    float(2 ** 70), complex(2 ** 70)]:
+            self.assertIn(key, h)
+            self.assertIn(key, s)
+            self.assertEqual(s[key], h[key])
+            self.assertEqual(s.get(key), h[key])
+
+        for key in [1.5, 1 + 1j, decimal.Decimal('1.5'),
+                    fractions.Fraction(1, 2), float('nan'), float('inf'),
+                    decimal.Decimal('NaN'), decimal.Decimal('-Infinity'),
+                    False, 0.0]:
+            self.assertNotIn(key, h)
+            self.assertNotIn(key, s)
+            self.assertIsNone(s.get(key))
+
+    def test_snapshot_2(self):
+        s = self.snapshot(self.Map())
+        self.assertEqual(len(s), 0)
+        self.assertEqual(list(s.items()), [])
+        self.assertNotIn('a', s)
+
+        h = self.Map({str(i): i for i in range(10000)})
+        s = self.snapshot(h)
+        self.assertEqual(len(s), 10000)
+        for i in range(10000):
+            self.assertEqual(s[str(i)], i)
+        self.assertNotIn('10000', s)
+        self.assertEqual(dict(s.items()), dict(h.items()))
+
+    def test_snapshot_3(self):
+        for m in [{'a': 1.5}, {'a': None}, {1.5: 'a'}, {True: 1},
+                  {MyStr('a'): 1}]:
+            with self.assertRaisesRegex(TypeError, 'str, bytes and int'):
+                write_snapshot(self.Map(m), self.path)
+
+        with open(self.path, 'wb') as f:
+            f.write(b'not a snapshot' * 10)
+        with self.assertRaisesRegex(ValueError, 'not a Map snapshot'):
+            MapSnapshot(self.path)
+
+        with open(self.path, 'wb') as f:
+            f.write(b'abc')
+        with self.assertRaisesRegex(ValueError, 'not a Map snapshot'):
+            MapSnapshot(self.path)
+
+    def test_snapshot_4(self):
+        write_snapshot(self.Map(a=1), self.path)
+
+        with MapSnapshot(self.path) as s:
+            self.assertEqual(s['a'], 1)
+            self.assertTrue(repr(s).startswith(
+                'immutables.snapshot.MapSnapshot('))
+
+            s2 = pickle.loads(pickle.dumps(s))
+            self.addCleanup(s2.close)
+            self.assertEqual(s2, s)
+
+        with self.assertRaises(ValueError):
+            s['a']
+
+    @unittest.skipIf(sys.platform == 'win32',
+                     'mapped files cannot be replaced on Windows')
+    def test_snapshot_replace(self):
+        s = self.snapshot(
+            self.Map({str(i): i for i in range(1000)}), self.path)
+        s2 = self.snapshot(self.Map(a=1), self.path)
+
+        # Open snapshots keep reading the file they were opened with.
+        self.assertEqual(len(s), 1000)
+        self.assertEqual(s['999'], 999)
+        self.assertEqual(dict(s2.items()), {'a': 1})
+
+        # Failed writes leave neither the old snapshot changed nor
+        # temporary files behind.
+        with self.assertRaises(TypeError):
+            write_snapshot({'a': None}, self.path)
+        with MapSnapshot(self.path) as s3:
+            self.assertEqual(dict(s3.items()), {'a': 1})
+
+        name = os.path.basename(self.path)
+        self.assertEqual(
+            [n for n in os.listdir(os.path.dirname(self.path))
+             if n.startswith(name) and n.endswith('.tmp')], [])
+
+
+    @unittest.skipIf(sys.platform == 'win32',
+                     'file permissions are POSIX-only')
+    def test_snapshot_mode(self):
+        for umask in [0o022, 0o077, 0o002]:
+            old_umask = os.umask(umask)
+            try:
+                write_snapshot(self.Map(a=1), self.path)
+            finally:
+                os.umask(old_umask)
+            self.assertEqual(
+                os.stat(self.path).st_mode & 0o777, 0o666 & ~umask)
+
+
+class PySnapshotTest(BaseSnapshotTest, unittest.TestCase):
+
+    Map = PyMap
+
+
+try:
+    from immutables._map import Map as CMap
+except ImportError:
+    CMap = None
+
+
+@unittest.skipIf(CMap is None, 'C Map is not available')
+class CSnapshotTest(BaseSnapshotTest, unittest.TestCase):
+
+    Map = CMap
+
+
+if __name__ == "__main__":
+    unittest.main()